@@ -232,6 +232,7 @@ sub rfamlive {
   if($self->location ne 'JFRC' && 
      $self->location ne 'EBI' &&
      $self->location ne '' &&
+     $self->location ne 'LOCAL' &&
      $self->location ne 'CLOUD') { 
     return undef; 
   }
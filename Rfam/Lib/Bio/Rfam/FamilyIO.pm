@@ -38,6 +38,7 @@ use Bio::Rfam::Family;
 use Bio::Rfam::Family::DESC;
 use Bio::Rfam::Family::CM;
 use Bio::Rfam::Family::Scores;
+use Bio::Rfam::TbloutStore;
 
 #-------------------------------------------------------------------------------
 
@@ -1572,14 +1573,17 @@ sub writeTbloutDependentFiles {
   # parse TBLOUT to get tbloutHA, a hash of arrays:
   my %tbloutHA; # hash of arrays, key is source sequence name of hit, value is array of scalars
                 # of form: "<start>:<end>:<bitscore>"
-  parseTbloutForOverlapCheck("TBLOUT", \%tbloutHA);
+  # read from the binary store of TBLOUT if we can, one sequence at a time
+  my $tblStore = Bio::Rfam::TbloutStore::open_current_store($tblI);
+  if(defined $tblStore) { tie(%tbloutHA, 'Bio::Rfam::TbloutStore::OverlapHash', $tblStore); }
+  else                  { parseTbloutForOverlapCheck("TBLOUT", \%tbloutHA); }
 
   # Paul's comment:
   # If you don't like this you can fuck off!:
   # Shell grep & sort are a hell of a lot less resource greedy than perl's equivalents.
   
   # parse REVTBLOUT
-  my $tblline;
+  my $hitHR;
   my $rev_evalue = "";
   my $chunksize = 100;
   my $nlines_cur = 0;
@@ -1589,11 +1593,11 @@ sub writeTbloutDependentFiles {
     # if we ever see the sort below failing here, it may be due to multiple spaces being the separator, 
     # using sed to replace all multiple spaces with single spaces should fix the problem, but
     # then we'll need to do some reformatting to get nice human-readable spacing back
-    open(RTBL, "grep -v ^'#' $rtblI | sort -k 15,15rn -k 16,16g | ") || croak "FATAL: could not open pipe for reading $rtblI\n[$!]";
-    while ($tblline = <RTBL>) {
-      # extract data from this REVTBLOUT line into variables we'll print out using processTbloutLine() subroutine
+    my $next_rtbl = _sorted_tblout_hits($rtblI);
+    while (defined($hitHR = $next_rtbl->())) {
+      # extract data from this REVTBLOUT hit into variables we'll print out using processTbloutHit() subroutine
       my ($bits, $evalue, $name, $start, $end, $strand, $qstart, $qend, $trunc, $shortSpecies, $description, $ncbiId, $species, $taxString) = 
-          processTbloutLine($tblline, $sthDesc, $sthTax, 1, $require_tax); # '1' says: yes this is a reversed search
+          processTbloutHit($hitHR, $sthDesc, $sthTax, 1, $require_tax); # '1' says: yes this is a reversed search
 
       # determine if this reverse hit overlaps with any positive hits
       my $overlap_str = _outlist_species_get_overlap_string(\%tbloutHA, $name, $start, $end, $bits, 1); # '1' says this is a reversed hit
@@ -1633,11 +1637,11 @@ sub writeTbloutDependentFiles {
     # if we ever see the sort below failing here, it may be due to multiple spaces being the separator, 
     # using sed to replace all multiple spaces with single spaces should fix the problem, but
     # then we'll need to do some reformatting to get nice human-readable spacing back
-    open(STBL, "grep -v ^'#' $stblI | sort -k 15,15rn -k 16,16g | ") || croak "FATAL: could not open pipe for reading $rtblI\n[$!]";
-    while ($tblline = <STBL>) {
-      # extract data from this SEEDTBLOUT line into variables we'll print out using processTbloutLine() subroutine
+    my $next_stbl = _sorted_tblout_hits($stblI);
+    while (defined($hitHR = $next_stbl->())) {
+      # extract data from this SEEDTBLOUT hit into variables we'll print out using processTbloutHit() subroutine
       my ($bits, $evalue, $name, $start, $end, $strand, $qstart, $qend, $trunc, $shortSpecies, $description, $ncbiId, $species, $taxString, $got_tax) = 
-          processTbloutLine($tblline, $sthDesc, $sthTax, 0, 0); # '0, 0' says: this is not a reversed search and don't require tax info
+          processTbloutHit($hitHR, $sthDesc, $sthTax, 0, 0); # '0, 0' says: this is not a reversed search and don't require tax info
 
       my $gaLabel   = undef; # set to 'GA:A' if bit score >= $ga, else set to 'GA:B'
       my $revLabel  = undef; # set to 'RV:A' if E-value <= $rev_evalue, else set to 'RV:B'
@@ -1719,7 +1723,7 @@ sub writeTbloutDependentFiles {
         @seed_spcAA = ();
         $nlines_cur = 0;
       }
-    } # closes 'while($tblline'
+    } # closes 'while($hitHR'
 
     if (! $printed_thresh) { 
       $outline = _commentLineForOutlistOrSpecies(" CURRENT GA THRESHOLD: $ga BITS ");
@@ -1756,10 +1760,10 @@ sub writeTbloutDependentFiles {
   # if we ever see the sort below failing here, it may be due to multiple spaces being the separator, 
   # using sed to replace all multiple spaces with single spaces should fix the problem, but
   # then we'll need to do some reformatting to get nice human-readable spacing back
-  open(TBL, "cat $stblI $tblI | grep -v ^'#' | sort -k 15,15rn -k 16,16g | ") || croak "FATAL: could not open pipe for reading $tblI\n[$!]";
-  while ($tblline = <TBL>) {
+  my $next_tbl = _sorted_tblout_hits($stblI, $tblI);
+  while (defined($hitHR = $next_tbl->())) {
     my ($bits, $evalue, $name, $start, $end, $strand, $qstart, $qend, $trunc, $shortSpecies, $description, $ncbiId, $species, $taxString, $got_tax) = 
-        processTbloutLine($tblline, $sthDesc, $sthTax, 0, 0); #'0, 0' says: no this is not a reversed search, taxonomy info is not required
+        processTbloutHit($hitHR, $sthDesc, $sthTax, 0, 0); #'0, 0' says: no this is not a reversed search, taxonomy info is not required
 
     # determine if this hit overlaps with any other hits on opposite strand
     my $overlap_str = _outlist_species_get_overlap_string(\%tbloutHA, $name, $start, $end, $bits, 0); # '0' says this is not a reversed hit
@@ -1851,7 +1855,7 @@ sub writeTbloutDependentFiles {
     }
     printf RIN  "%0.2f\t%0.6s\t$domainKingdom\n", $bits, $seqLabel;
     $nlines_tot++;
-  } # closes 'while($tblline = <TBL>)'
+  } # closes 'while($hitHR = $next_tbl->())'
 
   # if we haven't printed the threshold yet, do it
   if (! $printed_thresh) { 
@@ -1938,7 +1942,6 @@ sub writeTbloutDependentFiles {
     }
   }
     
-  close(TBL);
   close($outFH);
   close($spcFH);
   close(RIN);
@@ -2049,8 +2052,26 @@ sub processTbloutLine {
   ###target name         accession query name           accession mdl mdl from   mdl to seq from   seq to strand trunc pass   gc  bias  score   E-value inc description of target
   ###------------------- --------- -------------------- --------- --- -------- -------- -------- -------- ------ ----- ---- ---- ----- ------ --------- --- ---------------------
   ## AAAA02006309.1      -         RF00014              -          cm        1       85      192      105      -    no    1 0.44   0.0   86.0   1.6e-11 !   Oryza sativa Indica Group chromosome 2 Ctg006309, whole genome shotgun sequence.
-  my @tblA = split(/\s+/, $tblline);
-  my ($name, $qstart, $qend, $start, $end, $strand, $trunc, $bits, $evalue) = ($tblA[0], $tblA[5], $tblA[6], $tblA[7], $tblA[8], $tblA[9], $tblA[10], $tblA[14], $tblA[15]);
+  return processTbloutHit(Bio::Rfam::TbloutStore::parse_hit_line($tblline), $sthDesc, $sthTax, $is_reversed, $require_tax);
+}
+
+=head2 processTbloutHit
+
+    Title    : processTbloutHit
+    Usage    : processTbloutHit($hitHR, $sthDesc, $sthTax, $is_reversed, $require_tax)
+    Function : Same as processTbloutLine(), for the columns of a hit read from
+             : a Bio::Rfam::TbloutStore or Bio::Rfam::TbloutStore::parse_hit_line().
+    Args     : $hitHR:       hash ref of the hit columns
+             : $sthDesc, $sthTax, $is_reversed, $require_tax: see processTbloutLine()
+    Returns  : see processTbloutLine()
+    Dies     : see processTbloutLine()
+
+=cut
+
+sub processTbloutHit { 
+  my ($hitHR, $sthDesc, $sthTax, $is_reversed, $require_tax) = @_;
+
+  my ($name, $qstart, $qend, $start, $end, $strand, $trunc, $bits, $evalue) = @{$hitHR}{qw(name qstart qend start end strand trunc bits evalue)};
 
   my $description  = undef;
   my $species      = undef;
@@ -3410,6 +3431,44 @@ sub fetchFromOutlistOrTblout {
 
 #-------------------------------------------------
     
+=head2 _sorted_tblout_hits
+
+    Title    : _sorted_tblout_hits
+    Usage    : my $next = _sorted_tblout_hits(@tbloutA); while(defined($hitHR = $next->())) { }
+    Function : Returns the hits of one or more tblout files sorted by 
+             : decreasing bit score, then increasing E-value. They are read
+             : with a scan of the score index of the binary stores of the 
+             : files (see Bio::Rfam::TbloutStore), built the first time, or
+             : parsed from 'cat <files> | grep -v ^# | sort -k 15,15rn -k 16,16g'
+             : if a store can't be used.
+    Args     : @tbloutA: tblout files, those that don't exist are skipped
+    Returns  : code ref returning the columns of the next hit (see 
+             : Bio::Rfam::TbloutStore::parse_hit_line()), undef after the last
+    Dies     : if the sort pipe can't be opened
+
+=cut
+
+sub _sorted_tblout_hits { 
+  my (@tbloutA) = @_;
+
+  my @filesA  = grep { -e $_ } @tbloutA;
+  my @storesA = grep { defined $_ } map { Bio::Rfam::TbloutStore::open_current_store($_) } @filesA;
+  if(scalar(@storesA) == scalar(@filesA)) { 
+    return Bio::Rfam::TbloutStore::sorted_hit_iterator(@storesA);
+  }
+
+  my $files = join(" ", @filesA);
+  my $tblFH;
+  open($tblFH, "cat $files /dev/null | grep -v ^'#' | sort -k 15,15rn -k 16,16g | ") || croak "FATAL: could not open pipe for reading $files\n[$!]";
+  return sub { 
+    my $line = <$tblFH>;
+    if(! defined $line) { close($tblFH); return undef; }
+    return Bio::Rfam::TbloutStore::parse_hit_line($line);
+  };
+}
+
+#-------------------------------------------------
+    
 =head2 parseTbloutForOverlapCheck
 
     Title    : parseTbloutForOverlapCheck
@@ -278,21 +278,7 @@ sub cmsearch_or_cmscan_wrapper {
     Bio::Rfam::Utils::run_local_command($config->infernalPath . "$program $options $cmPath $seqfilePath > $outPath"); 
   }
   else { # submit to cluster
-    my $ncpu;
-    
-    if ($config->location eq "CLOUD"){
-	if ($cpus > 8){
-		$ncpu = 8; # maximum number of CPUs allowed per job on K8s 
-	}
-	else{
-   		$ncpu = ($cpus == 0) ? 1 : $cpus;
-	}
-    }
-    
-    else {
-    	$ncpu = ($cpus == 0) ? 1 : $cpus; # --cpu 0 actually means 'use 1 CPU'
-    }
-    
+    my $ncpu = cluster_ncpu($config, $cpus);
     my $requiredMb = $ncpu * $gbPerThread * 1000.; # 
     Bio::Rfam::Utils::submit_nonmpi_job($config, $config->infernalPath . "$program $options $cmPath $seqfilePath > $outPath", $jobname, $errPath, $ncpu, $requiredMb, $submitExStr, $queue);
   }
@@ -300,6 +286,80 @@ sub cmsearch_or_cmscan_wrapper {
   return;
 }
 
+=head2 cmsearch_array_wrapper
+
+  Title    : cmsearch_array_wrapper
+  Usage    : Bio::Rfam::Infernal::cmsearch_array_wrapper($config, $jobname, $jobnameAR, $tblOAR, $options, $cmPath, $seqfileAR, $outAR, $errAR, $submitExStr, $queue, $gbPerThread)
+  Function : Submit a set of cmsearch jobs (non-MPI) to the cluster, one per
+           : sequence file in @{$seqfileAR}, with a single call to
+           : Bio::Rfam::Utils::submit_nonmpi_job_array(). On CLOUD
+           : this creates a single k8s Indexed job named $jobname.
+           : All options except --tblout should already be specified
+           : in $options, including '--cpu <n>'.
+  Args     : $config:       Rfam config, with infernalPath
+           : $jobname:      name for the job array
+           : $jobnameAR:    ref to array of names, one per job
+           : $tblOAR:       ref to array of --tblout paths, one per job
+           : $options:      option string for cmsearch (must contain --cpu)
+           : $cmPath:       path to CM (often 'CM')
+           : $seqfileAR:    ref to array of sequence files to search
+           : $outAR:        ref to array of files to save standard output to
+           : $errAR:        ref to array of files to save standard error output to
+           : $submitExStr:  extra string to add to qsub/bsub/sbatch command
+           : $queue:        queue to submit to, "" for default
+           : $gbPerThread:  number of Gb of memory to request per thread
+  Returns  : void
+  Dies     : if submission fails
+
+=cut
+
+sub cmsearch_array_wrapper {
+  my ($config, $jobname, $jobnameAR, $tblOAR, $options, $cmPath, $seqfileAR, $outAR, $errAR, $submitExStr, $queue, $gbPerThread) = @_;
+  my $cpus;
+  if(! defined $gbPerThread || $gbPerThread eq "") { $gbPerThread = 3.0; }
+
+  if($options =~ /\-\-cpu (\d+)/) { 
+    $cpus = $1; 
+  }
+  else { 
+    die "ERROR cmsearch_array_wrapper() option string ($options) does not contain --cpu";
+  }
+
+  my @cmdA = ();
+  for(my $i = 0; $i < scalar(@{$seqfileAR}); $i++) { 
+    push(@cmdA, $config->infernalPath . "cmsearch --tblout $tblOAR->[$i] $options $cmPath $seqfileAR->[$i] > $outAR->[$i]");
+  }
+
+  my $ncpu = cluster_ncpu($config, $cpus);
+  my $requiredMb = $ncpu * $gbPerThread * 1000.;
+  Bio::Rfam::Utils::submit_nonmpi_job_array($config, \@cmdA, $jobname, $jobnameAR, $errAR, $ncpu, $requiredMb, $submitExStr, $queue);
+
+  return;
+}
+
+=head2 cluster_ncpu
+
+  Title    : cluster_ncpu
+  Usage    : Bio::Rfam::Infernal::cluster_ncpu($config, $cpus)
+  Function : Return the number of CPUs to request on the cluster for a
+           : job run with '--cpu $cpus'.
+  Args     : $config:  Rfam config, with 'location'
+           : $cpus:    value of --cpu option
+  Returns  : number of CPUs to request
+
+=cut
+
+sub cluster_ncpu {
+  my ($config, $cpus) = @_;
+
+  my $ncpu = ($cpus == 0) ? 1 : $cpus; # --cpu 0 actually means 'use 1 CPU'
+  if (($config->location eq "CLOUD") && ($ncpu > 8)) { 
+    $ncpu = 8; # maximum number of CPUs allowed per job on K8s 
+  }
+
+  return $ncpu;
+}
+
 =head2 cmalign_wrapper
   Title    : cmalign_wrapper
   Incept   : EPN, Mon Apr  1 10:20:32 2013
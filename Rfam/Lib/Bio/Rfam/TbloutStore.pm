@@ -0,0 +1,709 @@
+=head1 NAME
+
+Bio::Rfam::TbloutStore - a binary columnar store of the hits of a cmsearch tblout file
+
+=cut
+
+package Bio::Rfam::TbloutStore;
+
+=head1 DESCRIPTION
+
+Converts the hits of a cmsearch 'tblout' file (TBLOUT, REVTBLOUT,
+SEEDTBLOUT) into a binary store, and reads them back. rfmake re-sorts and
+re-parses the full text of these files on every pass, a store is built
+once per search and then read with range scans over its columns: hits in
+score order down to a threshold, and the hits of one target sequence for
+the overlap checks.
+
+Only the columns rfmake reads are stored (target name, model and sequence
+coordinates, strand, truncation, bit score and E-value), so a store is a
+fraction of the size of the text. Bit scores and E-values are stored as
+numbers and given back formatted as cmsearch prints them ('%.1f' and
+'%.2g'); a file with values that don't round trip can't be stored.
+
+All integers are little endian, all sections start on 8 byte boundaries,
+so the file can be memory mapped (File::Map is used if installed,
+otherwise the sections are read with sysread):
+
+  header   magic "RFTBLS\0\2", then 15 unsigned 64 bit integers: number of
+           hits, number of target sequences, size and mtime of the tblout
+           file it was built from, and the offsets of the sections below
+  names    the target sequence names, sorted and concatenated
+  seqtab   one 12 byte entry per target sequence, in name order, then one
+           closing entry: offset of its name in names, and its first hit
+           and number of hits
+  columns  one column per field, one value per hit. Hits are sorted by
+           target name, then by the lower of seq from and seq to:
+             seq     target sequence number (32 bit)
+             from    seq from (32 bit)
+             to      seq to (32 bit)
+             qfrom   mdl from (32 bit)
+             qto     mdl to (32 bit)
+             bits    bit score (double)
+             evalue  E-value (double)
+             flags   strand (bit 0, set for '-') and truncation code, an
+                     index in @TRUNC_CODES (bits 1-7), one byte
+  score    hit numbers (32 bit) sorted like 'sort -k 15,15rn -k 16,16g':
+           decreasing bit score, then increasing E-value, then line
+
+The text lines are not kept, the tblout file is the record of the search.
+
+=head1 COPYRIGHT
+
+File: TbloutStore.pm
+
+=cut
+
+#-------------------------------------------------------------------------------
+
+use strict;
+use warnings;
+use Carp;
+use File::stat;
+
+our $STORE_SUFFIX = ".rfs";
+our $MAGIC        = "RFTBLS\0\2";
+our @TRUNC_CODES  = ("no", "5'", "3'", "5'&3'", "-");
+
+my @HEADER_FIELDS   = qw(nrec nseq text_size src_mtime names_off seqtab_off seq_off from_off to_off
+                         qfrom_off qto_off bits_off evalue_off flags_off score_off);
+my $HEADER_TEMPLATE = "a8 " . join(" ", ("Q<") x scalar(@HEADER_FIELDS));
+my $HEADER_SIZE     = 8 + (8 * scalar(@HEADER_FIELDS));
+my $SEQTAB_SIZE     = 12;
+my $CHUNK_SIZE      = 4096; # hits read at a time by the iterators
+
+# packed columns: name => [pack template, bytes per value]
+my %COLUMNS = (seq    => ["L<", 4],
+               from   => ["L<", 4],
+               to     => ["L<", 4],
+               qfrom  => ["L<", 4],
+               qto    => ["L<", 4],
+               bits   => ["d<", 8],
+               evalue => ["d<", 8],
+               flags  => ["C",  1]);
+my @COLUMN_ORDER = qw(seq from to qfrom qto bits evalue flags);
+
+my %TRUNC_CODE = map { $TRUNC_CODES[$_] => $_ } (0..$#TRUNC_CODES);
+
+my $HAVE_FILE_MAP = eval { require File::Map; 1; };
+
+#-------------------------------------------------------------------------------
+
+=head2 store_path
+
+  Title    : store_path
+  Usage    : Bio::Rfam::TbloutStore::store_path($tblout)
+  Function : Returns the path of the store of a tblout file.
+  Args     : $tblout: tblout file
+  Returns  : path of the store, $tblout with $STORE_SUFFIX appended
+
+=cut
+
+sub store_path {
+  my ($tblout) = @_;
+
+  return $tblout . $STORE_SUFFIX;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 remove_store
+
+  Title    : remove_store
+  Usage    : Bio::Rfam::TbloutStore::remove_store($tblout)
+  Function : Removes the store of a tblout file, if there is one, e.g. when
+           : the search that wrote the file is run again.
+  Args     : $tblout: tblout file
+  Returns  : void
+
+=cut
+
+sub remove_store {
+  my ($tblout) = @_;
+
+  my $store = store_path($tblout);
+  if(-e $store) { unlink $store; }
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 parse_hit_line
+
+  Title    : parse_hit_line
+  Usage    : my $hitHR = Bio::Rfam::TbloutStore::parse_hit_line($line)
+  Function : Reads the columns rfmake uses from a tblout hit line.
+  Args     : $line: tblout hit line
+  Returns  : hash ref with keys "name", "qstart", "qend", "start", "end",
+           : "strand", "trunc", "bits" and "evalue", as they are in the line
+           : undefined for missing columns
+
+=cut
+
+sub parse_hit_line {
+  my ($line) = @_;
+
+  my @tblA = split(/\s+/, $line);
+
+  return { name   => $tblA[0],
+           qstart => $tblA[5],
+           qend   => $tblA[6],
+           start  => $tblA[7],
+           end    => $tblA[8],
+           strand => $tblA[9],
+           trunc  => $tblA[10],
+           bits   => $tblA[14],
+           evalue => $tblA[15] };
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 write_store
+
+  Title    : write_store
+  Usage    : Bio::Rfam::TbloutStore::write_store($tblout, $store)
+  Function : Converts the hits of a tblout file into a store. The store is
+           : written to a temporary file and renamed, so readers never see
+           : a partial one.
+  Args     : $tblout: tblout file to convert
+           : $store:  store to write, defaults to store_path($tblout)
+  Returns  : number of hits stored
+  Dies     : upon file input/output error, or if a hit line can't be parsed
+           : or stored exactly
+
+=cut
+
+sub write_store {
+  my ($tblout, $store) = @_;
+
+  if(! defined $store) { $store = store_path($tblout); }
+
+  my $st = stat($tblout) || croak "ERROR unable to stat $tblout: $!";
+
+  open(my $inFH, "<", $tblout) || croak "ERROR unable to open $tblout for reading: $!";
+  binmode($inFH);
+  my @hitA  = ();
+  my @lineA = (); # hit lines, for the sort tie break
+  my $size = 0;
+  while(my $line = <$inFH>) {
+    $size += length($line);
+    if($line =~ m/^\#/ || $line !~ m/\S/) { next; }
+
+    my $hitHR = parse_hit_line($line);
+    if(! defined $hitHR->{evalue} || grep { $hitHR->{$_} !~ m/^\d+$/ } qw(qstart qend start end)) {
+      croak "ERROR unable to parse hit line in $tblout: $line";
+    }
+    if(($hitHR->{strand} ne "+" && $hitHR->{strand} ne "-") || ! exists $TRUNC_CODE{$hitHR->{trunc}} ||
+       _format_bits($hitHR->{bits}) ne $hitHR->{bits} || _format_evalue($hitHR->{evalue}) ne $hitHR->{evalue}) {
+      croak "ERROR unable to store hit line in $tblout exactly: $line";
+    }
+    push(@hitA, $hitHR);
+    push(@lineA, $line);
+  }
+  close($inFH);
+  if($size != $st->size) { croak "ERROR $tblout changed while it was being converted"; }
+
+  # hits in per sequence order, hit i of the store is hit $orderA[i] of the file
+  my $nrec = scalar(@hitA);
+  my @orderA = sort { $hitA[$a]{name} cmp $hitA[$b]{name} ||
+                      _min($hitA[$a]{start}, $hitA[$a]{end}) <=> _min($hitA[$b]{start}, $hitA[$b]{end}) ||
+                      $a <=> $b } (0..$nrec-1);
+  my @recA = map { $hitA[$_] } @orderA;
+
+  # score order, the same as the 'sort -k 15,15rn -k 16,16g' rfmake used on the text
+  my @scoreA = sort { $recA[$b]{bits} <=> $recA[$a]{bits} ||
+                      $recA[$a]{evalue} <=> $recA[$b]{evalue} ||
+                      $lineA[$orderA[$a]] cmp $lineA[$orderA[$b]] } (0..$nrec-1);
+
+  # sequence names and table
+  my $names = "";
+  my $seqtab = "";
+  my @seqA = ();
+  my $nseq = 0;
+  foreach my $pos (0..$nrec-1) {
+    if($pos == 0 || $recA[$pos]{name} ne $recA[$pos-1]{name}) {
+      $seqtab .= pack("L< L< L<", length($names), $pos, 0);
+      $names .= $recA[$pos]{name};
+      $nseq++;
+    }
+    push(@seqA, $nseq - 1);
+  }
+  $seqtab .= pack("L< L< L<", length($names), $nrec, 0);
+  foreach my $seq (0..$nseq-1) {
+    my (undef, $first)     = unpack("L< L<", substr($seqtab, $seq * $SEQTAB_SIZE, 8));
+    my (undef, $nextFirst) = unpack("L< L<", substr($seqtab, ($seq + 1) * $SEQTAB_SIZE, 8));
+    substr($seqtab, ($seq * $SEQTAB_SIZE) + 8, 4) = pack("L<", $nextFirst - $first);
+  }
+
+  my %dataH = (names  => $names,
+               seqtab => $seqtab,
+               seq    => pack("L<*", @seqA),
+               from   => pack("L<*", map { $_->{start} }  @recA),
+               to     => pack("L<*", map { $_->{end} }    @recA),
+               qfrom  => pack("L<*", map { $_->{qstart} } @recA),
+               qto    => pack("L<*", map { $_->{qend} }   @recA),
+               bits   => pack("d<*", map { $_->{bits} }   @recA),
+               evalue => pack("d<*", map { $_->{evalue} } @recA),
+               flags  => pack("C*",  map { (($_->{strand} eq "-") ? 1 : 0) | ($TRUNC_CODE{$_->{trunc}} << 1) } @recA),
+               score  => pack("L<*", @scoreA));
+
+  my $tmp = "$store.$$.tmp";
+  open(my $outFH, ">", $tmp) || croak "ERROR unable to open $tmp for writing: $!";
+  binmode($outFH);
+
+  my %headerH = (nrec => $nrec, nseq => $nseq, text_size => $size, src_mtime => $st->mtime);
+  my $body = "";
+  foreach my $section ("names", "seqtab", @COLUMN_ORDER, "score") {
+    $headerH{$section . "_off"} = $HEADER_SIZE + length($body);
+    $body .= $dataH{$section} . ("\0" x (_align8(length($dataH{$section})) - length($dataH{$section})));
+  }
+  print $outFH pack($HEADER_TEMPLATE, $MAGIC, @headerH{@HEADER_FIELDS}), $body;
+  close($outFH) || croak "ERROR unable to write $tmp: $!";
+
+  rename($tmp, $store) || croak "ERROR unable to rename $tmp to $store: $!";
+
+  return $nrec;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 open_current_store
+
+  Title    : open_current_store
+  Usage    : Bio::Rfam::TbloutStore::open_current_store($tblout)
+  Function : Opens the store of a tblout file, (re)building it first if it
+           : is missing or was built from an older version of the file.
+  Args     : $tblout: tblout file
+  Returns  : Bio::Rfam::TbloutStore object, undef if $tblout does not exist
+           : or the store can't be built (e.g. read-only directory), in which
+           : case callers read the text file.
+
+=cut
+
+sub open_current_store {
+  my ($tblout) = @_;
+
+  if(! -e $tblout) { return undef; }
+
+  my $store = store_path($tblout);
+  my $self = undef;
+
+  eval {
+    if(-e $store) {
+      $self = eval { Bio::Rfam::TbloutStore->new($store) };
+      if(defined $self && ! $self->is_current($tblout)) {
+        $self->close_store();
+        $self = undef;
+      }
+    }
+    if(! defined $self) {
+      write_store($tblout, $store);
+      $self = Bio::Rfam::TbloutStore->new($store);
+    }
+  };
+  if($@) {
+    warn "WARNING: unable to use $store, reading $tblout: $@";
+    return undef;
+  }
+
+  return $self;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 new
+
+  Title    : new
+  Usage    : my $store = Bio::Rfam::TbloutStore->new($store)
+  Function : Opens a store for reading.
+  Args     : $store: store file, written by write_store()
+  Returns  : Bio::Rfam::TbloutStore object
+  Dies     : if the file can't be read or is not a store of this version
+
+=cut
+
+sub new {
+  my ($class, $file) = @_;
+
+  my $self = bless { file => $file }, $class;
+
+  if($HAVE_FILE_MAP) {
+    my $map;
+    File::Map::map_file($map, $file, "<");
+    $self->{map} = \$map;
+  }
+  else {
+    open(my $fh, "<", $file) || croak "ERROR unable to open $file: $!";
+    binmode($fh);
+    $self->{fh} = $fh;
+  }
+
+  my ($magic, @fieldA) = unpack($HEADER_TEMPLATE, $self->_bytes(0, $HEADER_SIZE));
+  if($magic ne $MAGIC) { croak "ERROR $file is not a tblout store"; }
+  @{$self}{@HEADER_FIELDS} = @fieldA;
+
+  return $self;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 close_store
+
+  Title    : close_store
+  Usage    : $store->close_store()
+  Function : Releases the file handle or mapping of the store.
+  Returns  : void
+
+=cut
+
+sub close_store {
+  my ($self) = @_;
+
+  if(defined $self->{fh}) { close($self->{fh}); }
+  delete $self->{fh};
+  delete $self->{map};
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 is_current
+
+  Title    : is_current
+  Usage    : $store->is_current($tblout)
+  Function : Checks the store was built from the current version of a tblout
+           : file, by its size and modification time.
+  Args     : $tblout: tblout file
+  Returns  : '1' if it was, '0' if not
+
+=cut
+
+sub is_current {
+  my ($self, $tblout) = @_;
+
+  my $st = stat($tblout);
+
+  return (defined $st && $st->size == $self->{text_size} && $st->mtime == $self->{src_mtime}) ? 1 : 0;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 nhits
+
+  Title    : nhits
+  Usage    : $store->nhits()
+  Returns  : number of hits in the store
+
+=cut
+
+sub nhits {
+  my ($self) = @_;
+
+  return $self->{nrec};
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 hits
+
+  Title    : hits
+  Usage    : my @hitA = $store->hits($first, $count)
+  Function : Reads the columns of a range of hits, in store order (see
+           : DESCRIPTION), reading each column once.
+  Args     : $first: first hit, 0..nhits-1
+           : $count: number of hits
+  Returns  : list of hash refs, see parse_hit_line()
+
+=cut
+
+sub hits {
+  my ($self, $first, $count) = @_;
+
+  if($count <= 0) { return (); }
+
+  my %colH = ();
+  foreach my $column (@COLUMN_ORDER) {
+    my ($template, $width) = @{$COLUMNS{$column}};
+    $colH{$column} = [ unpack($template . "*", $self->_bytes($self->{$column . "_off"} + ($width * $first), $width * $count)) ];
+  }
+
+  my @hitA = ();
+  foreach my $i (0..$count-1) {
+    push(@hitA, { name   => $self->_seq_name($colH{seq}[$i]),
+                  qstart => $colH{qfrom}[$i],
+                  qend   => $colH{qto}[$i],
+                  start  => $colH{from}[$i],
+                  end    => $colH{to}[$i],
+                  strand => ($colH{flags}[$i] & 1) ? "-" : "+",
+                  trunc  => $TRUNC_CODES[$colH{flags}[$i] >> 1],
+                  bits   => _format_bits($colH{bits}[$i]),
+                  evalue => _format_evalue($colH{evalue}[$i]) });
+  }
+
+  return @hitA;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 hit
+
+  Title    : hit
+  Usage    : my $hitHR = $store->hit($rec)
+  Function : Reads the columns of one hit.
+  Args     : $rec: hit number, 0..nhits-1 in store order
+  Returns  : hash ref, see parse_hit_line()
+
+=cut
+
+sub hit {
+  my ($self, $rec) = @_;
+
+  return ($self->hits($rec, 1))[0];
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 nhits_above
+
+  Title    : nhits_above
+  Usage    : $store->nhits_above($bits)
+  Function : Counts the hits scoring at least $bits, with a binary search of
+           : the score index over the bit score column. These are the first
+           : hits returned by score_iterator().
+  Args     : $bits: bit score threshold
+  Returns  : number of hits with a bit score >= $bits
+
+=cut
+
+sub nhits_above {
+  my ($self, $bits) = @_;
+
+  my ($lo, $hi) = (0, $self->{nrec});
+  while($lo < $hi) {
+    my $mid = int(($lo + $hi) / 2);
+    if($self->_score_bits($mid) >= $bits) { $lo = $mid + 1; }
+    else                                  { $hi = $mid; }
+  }
+
+  return $lo;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 score_iterator
+
+  Title    : score_iterator
+  Usage    : my $next = $store->score_iterator($min_bits); while(my $hitHR = $next->()) { }
+  Function : Iterates over hits in score order (see write_store), from the
+           : top hit down to $min_bits.
+  Args     : $min_bits: optional, lowest bit score returned
+  Returns  : code ref returning the next hit (see parse_hit_line()), undef
+           : after the last
+
+=cut
+
+sub score_iterator {
+  my ($self, $min_bits) = @_;
+
+  my $n = (defined $min_bits) ? $self->nhits_above($min_bits) : $self->{nrec};
+  my $pos = 0;
+  my @chunkA = ();
+
+  return sub {
+    if($pos >= $n) { return undef; }
+    if(! @chunkA) {
+      my $len = _min($CHUNK_SIZE, $n - $pos);
+      @chunkA = map { $self->hit($_) } unpack("L<*", $self->_bytes($self->{score_off} + (4 * $pos), 4 * $len));
+    }
+    $pos++;
+    return shift(@chunkA);
+  };
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 sequence_hits
+
+  Title    : sequence_hits
+  Usage    : my @hitA = $store->sequence_hits($name)
+  Function : Returns the hits to one target sequence, with a binary search
+           : of the sequence names.
+  Args     : $name: target sequence name
+  Returns  : list of hits (see parse_hit_line()), sorted by their lower
+           : coordinate, empty if there are none
+
+=cut
+
+sub sequence_hits {
+  my ($self, $name) = @_;
+
+  my ($lo, $hi) = (0, $self->{nseq});
+  while($lo < $hi) {
+    my $mid = int(($lo + $hi) / 2);
+    my $cmp = $self->_seq_name($mid) cmp $name;
+    if($cmp == 0) {
+      my (undef, $first, $count) = $self->_seqtab($mid);
+      return $self->hits($first, $count);
+    }
+    if($cmp < 0) { $lo = $mid + 1; }
+    else         { $hi = $mid; }
+  }
+
+  return ();
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 sorted_hit_iterator
+
+  Title    : sorted_hit_iterator
+  Usage    : my $next = Bio::Rfam::TbloutStore::sorted_hit_iterator(@storeA)
+  Function : Merges the hits of several stores in score order, the order of
+           : 'cat <tblouts> | grep -v ^# | sort -k 15,15rn -k 16,16g'. Hits of
+           : different stores with the same score and E-value are in target
+           : name then coordinate order.
+  Args     : @storeA: Bio::Rfam::TbloutStore objects
+  Returns  : code ref returning the next hit (see parse_hit_line()), undef
+           : after the last
+
+=cut
+
+sub sorted_hit_iterator {
+  my (@storeA) = @_;
+
+  my @nextA = map { $_->score_iterator() } @storeA;
+  my @headA = map { $_->() } @nextA;
+
+  return sub {
+    my $best = undef;
+    foreach my $i (0..$#headA) {
+      if(! defined $headA[$i]) { next; }
+      if(! defined $best || _cmp_hits($headA[$i], $headA[$best]) < 0) { $best = $i; }
+    }
+    if(! defined $best) { return undef; }
+
+    my $hitHR = $headA[$best];
+    $headA[$best] = $nextA[$best]->();
+    return $hitHR;
+  };
+}
+
+#-------------------------------------------------------------------------------
+# private helpers
+
+sub _bytes {
+  my ($self, $offset, $len) = @_;
+
+  if($len == 0) { return ""; }
+  if(defined $self->{map}) { return substr(${$self->{map}}, $offset, $len); }
+
+  my $buf = "";
+  sysseek($self->{fh}, $offset, 0) || croak "ERROR unable to seek in $self->{file}: $!";
+  while(length($buf) < $len) {
+    my $nread = sysread($self->{fh}, $buf, $len - length($buf), length($buf));
+    if(! defined $nread) { croak "ERROR unable to read $self->{file}: $!"; }
+    if($nread == 0)      { croak "ERROR $self->{file} is truncated"; }
+  }
+  return $buf;
+}
+
+sub _score_bits {
+  my ($self, $pos) = @_;
+
+  my $rec = unpack("L<", $self->_bytes($self->{score_off} + (4 * $pos), 4));
+  return unpack("d<", $self->_bytes($self->{bits_off} + (8 * $rec), 8));
+}
+
+sub _seqtab {
+  my ($self, $seq) = @_;
+
+  return unpack("L< L< L<", $self->_bytes($self->{seqtab_off} + ($SEQTAB_SIZE * $seq), $SEQTAB_SIZE));
+}
+
+sub _seq_name {
+  my ($self, $seq) = @_;
+
+  my ($name_off) = $self->_seqtab($seq);
+  my ($next_off) = $self->_seqtab($seq + 1);
+  return $self->_bytes($self->{names_off} + $name_off, $next_off - $name_off);
+}
+
+sub _cmp_hits {
+  my ($hit1HR, $hit2HR) = @_;
+
+  return $hit2HR->{bits} <=> $hit1HR->{bits} || $hit1HR->{evalue} <=> $hit2HR->{evalue} ||
+      $hit1HR->{name} cmp $hit2HR->{name} || _min($hit1HR->{start}, $hit1HR->{end}) <=> _min($hit2HR->{start}, $hit2HR->{end});
+}
+
+# bit scores and E-values as cmsearch writes them in tblout files
+sub _format_bits {
+  my ($bits) = @_;
+
+  return sprintf("%.1f", $bits);
+}
+
+sub _format_evalue {
+  my ($evalue) = @_;
+
+  return sprintf("%.2g", $evalue);
+}
+
+sub _align8 {
+  my ($n) = @_;
+
+  return ($n + 7) & ~7;
+}
+
+sub _min {
+  my ($x, $y) = @_;
+
+  return ($x < $y) ? $x : $y;
+}
+
+#-------------------------------------------------------------------------------
+
+=head1 Bio::Rfam::TbloutStore::OverlapHash
+
+A tied hash over a store, for FamilyIO::_outlist_species_get_overlap_string():
+key is target sequence name, value is an array of "<start>:<end>:<bitscore>",
+like the hash filled by FamilyIO::parseTbloutForOverlapCheck(), read from the
+store one sequence at a time.
+
+  tie(my %tbloutHA, 'Bio::Rfam::TbloutStore::OverlapHash', $store);
+
+=cut
+
+package Bio::Rfam::TbloutStore::OverlapHash;
+
+use strict;
+use warnings;
+use Carp;
+
+sub TIEHASH {
+  my ($class, $store) = @_;
+
+  return bless { store => $store, name => undef, hitsA => undef }, $class;
+}
+
+sub FETCH {
+  my ($self, $name) = @_;
+
+  if(! defined $self->{name} || $self->{name} ne $name) {
+    my @hitsA = map { $_->{start} . ":" . $_->{end} . ":" . $_->{bits} } $self->{store}->sequence_hits($name);
+    $self->{name}  = $name;
+    $self->{hitsA} = (@hitsA) ? \@hitsA : undef;
+  }
+  return $self->{hitsA};
+}
+
+sub EXISTS {
+  my ($self, $name) = @_;
+
+  return defined($self->FETCH($name)) ? 1 : 0;
+}
+
+sub STORE    { croak "ERROR tblout store overlap hash is read-only"; }
+sub DELETE   { croak "ERROR tblout store overlap hash is read-only"; }
+sub CLEAR    { croak "ERROR tblout store overlap hash is read-only"; }
+sub FIRSTKEY { croak "ERROR tblout store overlap hash can't be iterated"; }
+sub NEXTKEY  { croak "ERROR tblout store overlap hash can't be iterated"; }
+
+1;
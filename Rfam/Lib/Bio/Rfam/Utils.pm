@@ -128,6 +128,12 @@ sub submit_nonmpi_job {
     else                               { $submit_cmd .= ""; }
     $submit_cmd .= " -N $jobname -o /dev/null -e $errPath $batch_opt -b y -cwd -V \"$cmd\" > /dev/null";
   }
+  elsif($config->location eq "LOCAL") {
+    # queued for the local executor, which runs as many jobs at once as fit in this machine
+    $reqMb = sprintf("%d", $reqMb);
+    if($reqMb < 1) { $reqMb = 1; } # just to be safe
+    $submit_cmd = $config->binLocation . "/rflocal.py submit \"$cmd 2> $errPath\" $ncpu $reqMb $jobname";
+  }
   # local command
   elsif($config->location eq ""){
     $submit_cmd = $cmd
@@ -144,6 +150,74 @@ sub submit_nonmpi_job {
   return;
 }
 
+#-------------------------------------------------------------------------------
+
+=head2 submit_nonmpi_job_array
+
+  Title    : submit_nonmpi_job_array()
+  Usage    : submit_nonmpi_job_array($config, $cmdAR, $jobname, $jobnameAR, $errPathAR, $ncpu, $reqMb, $exStr, $queue)
+  Function : Submits a set of non-MPI jobs, one per command in @{$cmdAR},
+           : that all require the same resources.
+           : If $config->location is "CLOUD" all commands are submitted
+           : as a single k8s Indexed job named $jobname with one call to
+           : rfkubesub.py. Pod <n> of the Indexed job runs $cmdAR->[<n>],
+           : so $jobnameAR->[<n>] should be "$jobname-<n>" for
+           : wait_for_cluster_light() to match pods to jobs. 
+           : If $config->location is "LOCAL" all commands are queued
+           : with one call to rflocal.py, as jobs "$jobname-<n>".
+           : For all other locations each command is submitted
+           : separately with submit_nonmpi_job().
+           : We do *not* wait for jobs to finish. Caller
+           : must do that, probably with wait_for_cluster_light().
+  Args     : $config:    Rfam config, with 'location' and 'scheduler'
+           : $cmdAR:     ref to array of commands to run
+           : $jobname:   name for the job array
+           : $jobnameAR: ref to array of names, one per command
+           : $errPathAR: ref to array of paths for stderr output, one per command
+           : $ncpu:      number of CPUs to run each job on
+           : $reqMb:     required number of Mb for each job (all threads combined)
+           : $exStr:     extra string to add to qsub/sub command
+           : $queue:     queue to submit to, "" for default, 'p' = "production", 'r' = "research";
+  Returns  : void
+  Dies     : If submit command fails.
+
+=cut
+
+sub submit_nonmpi_job_array {
+  my ($config, $cmdAR, $jobname, $jobnameAR, $errPathAR, $ncpu, $reqMb, $exStr, $queue) = @_;
+
+  my $n = scalar(@{$cmdAR});
+  my $i;
+  if(scalar(@{$jobnameAR}) != $n) { die "submit_nonmpi_job_array(), internal error, number of elements in cmdAR and jobnameAR differ"; }
+  if(scalar(@{$errPathAR}) != $n) { die "submit_nonmpi_job_array(), internal error, number of elements in cmdAR and errPathAR differ"; }
+
+  if($config->location eq "CLOUD" || $config->location eq "LOCAL") {
+    # write one command per line, rfkubesub.py picks the one matching each pod's completion index
+    my $cmdfile = File::Spec->rel2abs($jobname . ".cmds");
+    open(OUT, ">" . $cmdfile) || die "ERROR unable to open $cmdfile for writing";
+    # stderr of each shard goes to its own file, so it can be checked per shard
+    for($i = 0; $i < $n; $i++) { print OUT $cmdAR->[$i] . " 2> " . $errPathAR->[$i] . "\n"; }
+    close(OUT);
+
+    my $submit_cmd = "/Rfam/software/bin/rfkubesub.py --batch $cmdfile $ncpu $reqMb $jobname";
+    if($config->location eq "LOCAL") {
+      $reqMb = sprintf("%d", $reqMb);
+      if($reqMb < 1) { $reqMb = 1; } # just to be safe
+      $submit_cmd = $config->binLocation . "/rflocal.py submit --batch $cmdfile $ncpu $reqMb $jobname";
+    }
+    system($submit_cmd);
+    if($? != 0) { die "Non-MPI array submission command $submit_cmd failed"; }
+    unlink $cmdfile;
+  }
+  else {
+    for($i = 0; $i < $n; $i++) {
+      submit_nonmpi_job($config, $cmdAR->[$i], $jobnameAR->[$i], $errPathAR->[$i], $ncpu, $reqMb, $exStr, $queue);
+    }
+  }
+
+  return;
+}
+
 # -------------------------------------------------------------------------------
 
 =head2 submit_mpi_job
@@ -153,7 +227,8 @@ sub submit_nonmpi_job {
   Usage    : submit_mpi_job($config, $cmd, )
   Function : Submits MPI job defined by command $cmd.
            : MPI submission syntax depends on $config->location and 
-           : config->scheduler values.
+           : config->scheduler values. On CLOUD the job runs on
+           : several pods, see rfkubesub.py --mpi.
            : We do *not* wait for job to finish. Caller
            : must do that, probably with wait_for_cluster().
   Args     : $config:   Rfam config, with 'location' and 'scheduler'
@@ -204,7 +279,17 @@ sub submit_mpi_job {
     $submit_cmd = "qsub -N $jobname -e $errPath -o /dev/null -b y -cwd -V -pe impi $nproc " . $queue_opt . "\"mpirun -np $nproc $cmd\" > /dev/null";
   }
   elsif ($config->location eq "CLOUD"){
-  	die "ERROR: MPI unavailable on CLOUD. Consider using -cnompi option";
+    # rfkubesub.py spreads the $nproc processes over as many pods as needed, all started at once,
+    # $reqMb is split between them
+    $reqMb = sprintf("%d", $reqMb);
+    if($reqMb < 1) { $reqMb = 1; } # just to be safe
+    $submit_cmd = "/Rfam/software/bin/rfkubesub.py --mpi \"$cmd 2> $errPath\" $nproc $reqMb $jobname";
+  }
+  elsif($config->location eq "LOCAL") {
+    # one local job using $nproc cpus
+    $reqMb = sprintf("%d", $reqMb);
+    if($reqMb < 1) { $reqMb = 1; } # just to be safe
+    $submit_cmd = $config->binLocation . "/rflocal.py submit \"mpirun -np $nproc $cmd 2> $errPath\" $nproc $reqMb $jobname";
   }
   else {
     die "ERROR unknown location $config->location in submit_mpi_job()";
@@ -260,6 +345,8 @@ sub submit_mpi_job {
              : $extra_note:     extra information to output with progress, "" for none
              : $max_minutes:    max number of minutes to wait, -1 for no limit
              : $do_stdout:      1 to print updates to stdout, 0 not to
+             : $merge_plan:     CLOUD only, optional: merge plan file passed to
+             :                  wait_for_k8s_jobs(), undef for none
              :
     Returns  : Maximum number of seconds any job spent waiting in queue, rounded down to
              : nearest 10 seconds.
@@ -415,6 +502,8 @@ sub wait_for_cluster {
              : and tries to use expensive 'qstat', 'bjobs' or 'squeue' calls infrequently.
              : The non-light version (wait_for_cluster()) calls 'qstat'/'bjobs'/'squeue'
              : once every minute.
+             : On LOCAL, jobs queued with rflocal.py are waited for
+             : with wait_for_local_jobs().
              :
              : If $max_minutes is defined and != -1, we will die if all jobs
              : fail to successfully complete within $max_minutes minutes.
@@ -440,6 +529,8 @@ sub wait_for_cluster {
              : $extra_note:     extra information to output with progress, "" for none
              : $max_minutes:    max number of minutes to wait, -1 for no limit
              : $do_stdout:      1 to print updates to stdout, 0 not to
+             : $merge_plan:     CLOUD only, optional: merge plan file passed to
+             :                  wait_for_k8s_jobs(), undef for none
              :
     Returns  : Maximum number of seconds any job spent waiting in queue, rounded down to
              : nearest 10 seconds.
@@ -448,7 +539,7 @@ sub wait_for_cluster {
 =cut
 
 sub wait_for_cluster_light {
-  my ($config, $username, $jobnameAR, $outnameAR, $errnameAR, $success_string, $program, $outFH, $extra_note, $max_minutes, $do_stdout) = @_;
+  my ($config, $username, $jobnameAR, $outnameAR, $errnameAR, $success_string, $program, $outFH, $extra_note, $max_minutes, $do_stdout, $merge_plan) = @_;
 
   my $start_time = time();
   my $n = scalar(@{$jobnameAR});
@@ -474,7 +565,16 @@ sub wait_for_cluster_light {
       }
     }
   }
-  elsif(($config->location ne "JFRC") && ($config->location ne "CLOUD")) {
+  elsif($config->location eq "CLOUD") {
+    # use the watch based rfwait.py if available instead of polling kubectl
+    if(-x $config->binLocation . "/rfwait.py") { 
+      return wait_for_k8s_jobs($config, $username, $jobnameAR, $outnameAR, $success_string, $program, $outFH, $extra_note, $max_minutes, $do_stdout, $merge_plan);
+    }
+  }
+  elsif($config->location eq "LOCAL") {
+    return wait_for_local_jobs($config, $jobnameAR, $outnameAR, $success_string, $program, $outFH, $extra_note, $max_minutes, $do_stdout);
+  }
+  elsif($config->location ne "JFRC") {
     die "ERROR in wait_for_cluster_light, unrecognized location: $config->location";
   }
 
@@ -497,6 +597,10 @@ sub wait_for_cluster_light {
   my @waitingA  = ();  # [0..$n-1]: '1' if job is waiting (its error does not exists), else '0'
   my @finishedA  = (); # [0..$n-1]: '1' if job does not exist in the queue and so should be finished (revealed by 'qstat' or 'bjobs'), else '0'
 
+  # map job names to their index in $jobnameAR, used to match kubectl output lines on CLOUD
+  my %jobidxH = ();
+  for($i = 0; $i < $n; $i++) { $jobidxH{$jobnameAR->[$i]} = $i; }
+
   # initialize status buffers
   for($i = 0; $i < $n; $i++) {
     $finishedA[$i] = 0;
@@ -622,20 +726,22 @@ sub wait_for_cluster_light {
           # rfsearch-job-root-hzc28                         0/1     ContainerCreating   0          19m
 
           ($jobname, $status) = ($elA[0], $elA[2]);
-
-	  # check if any of the running jobs matches those in the job array
-          for($i = 0; $i < $n; $i++) { #5 - TODO: jobnameAR needs to be converted into a dictionary for faster processing
+          # pod names are rfsearch-job-<user>-<jobname>-<5 random chars>, pods of
+          # Indexed jobs (submit_nonmpi_job_array()) are named after "<jobname>-<index>" 
+          $jobname =~ s/^rfsearch-job-\Q$username\E-//;
+          $jobname =~ s/-[a-z0-9]{5}$//;
+
+	  # check if the pod matches any of the jobs in the job array
+          if(exists $jobidxH{$jobname}) { 
+            $i = $jobidxH{$jobname};
             if((! $successA[$i]) &&              # job didn't successfully complete already
-                 (! $ininfoA[$i]) &&               # we didn't already find this job in the queue
-                 (index($jobname, $jobnameAR->[$i]) != -1) && # jobname match
-		 ($status ne "Completed")) { # look for a substring if on CLOUD - change this to ne if eq doesn't work
-                  $ininfoA[$i] = 1; # job with jobname is still running or pending
-                  $i = $n; # skip the rest of the computations
+               (! $ininfoA[$i]) &&               # we didn't already find this job in the queue
+               ($status ne "Completed")) { 
+              $ininfoA[$i] = 1; # job with jobname is still running or pending
               # check if job is in error status, if it is, then exit
-	      #
-              if (($config->location eq "CLOUD") && ($status ne "Running" && $status ne "Pending" && $status ne "Completed" && $status ne "ContainerCreating")){ die "wait_for_cluster_light(), internal error, kubectl shows Error status: $line"; }
+              if ($status ne "Running" && $status ne "Pending" && $status ne "ContainerCreating"){ die "wait_for_cluster_light(), internal error, kubectl shows Error status: $line"; }
             } #internal if
-          } # for loop
+          }
       } # cloud segment else
     } # parse job log loop
 
@@ -824,6 +930,294 @@ sub wait_for_cluster_light {
 
 #-------------------------------------------------------------------------------
 
+=head2 wait_for_k8s_jobs
+
+    Title    : wait_for_k8s_jobs
+    Usage    : wait_for_k8s_jobs($config, $username, $jobnameAR, $outnameAR, $success_string, $program, $outFH, $extra_note, $max_minutes, $do_stdout, $merge_plan)
+    Function : Waits for specific job(s) to finish running on the k8s
+             : cluster (CLOUD) and verifies their output. Called by
+             : wait_for_cluster_light() when location is CLOUD.
+             :
+             : Job states are tracked by rfwait.py, which watches the
+             : user's k8s Jobs and Pods and returns as soon as all jobs
+             : succeed or any job fails, so there is no polling.
+             : Once all jobs have finished, we check that each job's
+             : output file includes the string $success_string,
+             : waiting up to 20 minutes for output files to become
+             : visible on the file system. Jobs rfwait.py does not find
+             : in the cluster (finished before it started watching, or
+             : never submitted because their results were reused) only
+             : count as finished if their output is already complete,
+             : so the output files are passed to rfwait.py as well.
+             :
+             : If $merge_plan is defined, rfwait.py merges the output
+             : of each job into the family level files listed in the
+             : plan as soon as the job succeeds (see rfmerge.py),
+             : validating $success_string and the job's stderr itself,
+             : so the output files are not checked here.
+             :
+    Args     : $config:         Rfam config, with 'binLocation'
+             : $username:       username the cluster jobs belong to
+             : $jobnameAR:      ref to array of list of job names on cluster
+             : $outnameAR:      ref to array of list of output file names, one per job
+             : $success_string: string expected to exist in each output file
+             : $program:        name of program running, if "": do not print updates
+             : $outFH:          output file handle for updates, if "" only print to STDOUT
+             : $extra_note:     extra information to output with progress, "" for none
+             : $max_minutes:    max number of minutes to wait, -1 for no limit
+             : $do_stdout:      1 to print updates to stdout, 0 not to
+             : $merge_plan:     merge plan file, one line per job:
+             :                  <jobname> <tblout> <searchout> <stderr> <merged tblout> <merged searchout>
+             :                  undef to not merge
+             :
+    Returns  : Maximum number of seconds any job spent waiting to start.
+    Dies     : If any job fails, if $max_minutes is reached, or if
+             : any output file does not contain $success_string.
+
+=cut
+
+sub wait_for_k8s_jobs {
+  my ($config, $username, $jobnameAR, $outnameAR, $success_string, $program, $outFH, $extra_note, $max_minutes, $do_stdout, $merge_plan) = @_;
+
+  my $start_time = time();
+  my $n = scalar(@{$jobnameAR});
+  my $max_wait_secs = 0;
+  my @failedA = ();
+  my ($i, $line);
+  if($extra_note ne "") { $extra_note = "  " . $extra_note; }
+
+  my $cmd = $config->binLocation . "/rfwait.py --user $username";
+  if(defined $max_minutes && $max_minutes != -1) { $cmd .= " --timeout " . int($max_minutes * 60); }
+  if(defined $merge_plan) { $cmd .= " --merge $merge_plan"; }
+
+  # the output of each job, for rfwait.py to check jobs it does not find in the cluster
+  my $outputs_file = "rfwait.$$.outputs";
+  open(OUTPUTS, ">", $outputs_file) || die "ERROR unable to open $outputs_file for writing";
+  for($i = 0; $i < $n; $i++) {
+    print OUTPUTS $jobnameAR->[$i] . " " . $outnameAR->[$i] . "\n";
+  }
+  close(OUTPUTS);
+  $cmd .= " --outputs $outputs_file --success-string '$success_string'";
+  $cmd .= " " . join(" ", @{$jobnameAR});
+
+  # rfwait.py prints 'progress <nsucceeded> <nrunning> <nwaiting>' lines while waiting,
+  # and one '<jobname> <phase> <reason>' line per job when it exits
+  open(WAIT, "$cmd |") || die "ERROR unable to run $cmd";
+  while($line = <WAIT>) {
+    chomp $line;
+    if($line =~ m/^progress\s+(\d+)\s+(\d+)\s+(\d+)/) {
+      my ($nsuccess, $nrunning, $nwaiting) = ($1, $2, $3);
+      if($nwaiting > 0) { $max_wait_secs = time() - $start_time; }
+      if($program ne "") {
+        my $outstr = sprintf("  %-15s  %-10s  %10s  %10s  %10s  %10s%s\n", $program, "cluster", $nsuccess, $nrunning, $nwaiting, Bio::Rfam::Utils::format_time_string(time() - $start_time), $extra_note);
+        $extra_note = ""; # only print this once
+        if($do_stdout) { print STDOUT $outstr; }
+        if($outFH ne "") { print $outFH $outstr; }
+      }
+    }
+    elsif($line =~ m/^(\S+)\s+Failed\s*(.*)$/) {
+      push(@failedA, "$1 ($2)");
+    }
+  }
+  close(WAIT);
+  my $status = $? >> 8;
+  unlink($outputs_file);
+
+  if(scalar(@failedA) > 0) { die "wait_for_k8s_jobs(), job(s) failed on the cluster: " . join(", ", @failedA); }
+  if($status == 2)         { die "wait_for_k8s_jobs(), reached maximum time limit of $max_minutes minutes, exiting."; }
+  if($status == 3)         { die "wait_for_k8s_jobs(), rfwait.py lost its watch of the cluster, the jobs may still be running."; }
+  if($status != 0)         { die "wait_for_k8s_jobs(), $cmd failed"; }
+
+  # merged output was validated by rfwait.py
+  if(defined $merge_plan) { return $max_wait_secs; }
+
+  # all jobs finished, make sure their output is complete, output files may
+  # take a while to become visible on the file system
+  for($i = 0; $i < $n; $i++) {
+    my $nsleep = 0;
+    while(! file_tail_contains($outnameAR->[$i], $success_string)) {
+      if($nsleep == 120) { 
+        die "wait_for_k8s_jobs() job $i finished according to rfwait.py, but tail of expected output file $outnameAR->[$i] does not contain: $success_string\n";
+      }
+      sleep(10);
+      $nsleep++;
+    }
+  }
+
+  return $max_wait_secs;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 wait_for_local_jobs
+
+    Title    : wait_for_local_jobs
+    Usage    : wait_for_local_jobs($config, $jobnameAR, $outnameAR, $success_string, $program, $outFH, $extra_note, $max_minutes, $do_stdout)
+    Function : Waits for specific job(s) queued with rflocal.py to
+             : finish running on this machine (LOCAL) and verifies
+             : their output. Called by wait_for_cluster_light() when
+             : location is LOCAL.
+             :
+             : 'rflocal.py wait' polls the state of the jobs in the
+             : local queue and prints progress lines as rfwait.py does,
+             : returning as soon as all jobs succeed or any job fails.
+             : Once all jobs have finished, we check that each job's
+             : output file includes the string $success_string.
+             :
+    Args     : $config:         Rfam config, with 'binLocation'
+             : $jobnameAR:      ref to array of list of job names
+             : $outnameAR:      ref to array of list of output file names, one per job
+             : $success_string: string expected to exist in each output file
+             : $program:        name of program running, if "": do not print updates
+             : $outFH:          output file handle for updates, if "" only print to STDOUT
+             : $extra_note:     extra information to output with progress, "" for none
+             : $max_minutes:    max number of minutes to wait, -1 for no limit
+             : $do_stdout:      1 to print updates to stdout, 0 not to
+             :
+    Returns  : Maximum number of seconds any job spent waiting to start.
+    Dies     : If any job fails, if $max_minutes is reached, or if
+             : any output file does not contain $success_string.
+
+=cut
+
+sub wait_for_local_jobs {
+  my ($config, $jobnameAR, $outnameAR, $success_string, $program, $outFH, $extra_note, $max_minutes, $do_stdout) = @_;
+
+  my $start_time = time();
+  my $n = scalar(@{$jobnameAR});
+  my $max_wait_secs = 0;
+  my @failedA = ();
+  my ($i, $line);
+  if($extra_note ne "") { $extra_note = "  " . $extra_note; }
+
+  my $cmd = $config->binLocation . "/rflocal.py wait";
+  if(defined $max_minutes && $max_minutes != -1) { $cmd .= " --timeout " . int($max_minutes * 60); }
+  $cmd .= " " . join(" ", @{$jobnameAR});
+
+  # rflocal.py prints 'progress <nsucceeded> <nrunning> <nwaiting>' lines while waiting,
+  # and one '<jobname> <phase> <reason>' line per job when it exits
+  open(WAIT, "$cmd |") || die "ERROR unable to run $cmd";
+  while($line = <WAIT>) {
+    chomp $line;
+    if($line =~ m/^progress\s+(\d+)\s+(\d+)\s+(\d+)/) {
+      my ($nsuccess, $nrunning, $nwaiting) = ($1, $2, $3);
+      if($nwaiting > 0) { $max_wait_secs = time() - $start_time; }
+      if($program ne "") {
+        my $outstr = sprintf("  %-15s  %-10s  %10s  %10s  %10s  %10s%s\n", $program, "local", $nsuccess, $nrunning, $nwaiting, Bio::Rfam::Utils::format_time_string(time() - $start_time), $extra_note);
+        $extra_note = ""; # only print this once
+        if($do_stdout) { print STDOUT $outstr; }
+        if($outFH ne "") { print $outFH $outstr; }
+      }
+    }
+    elsif($line =~ m/^(\S+)\s+Failed\s*(.*)$/) {
+      push(@failedA, "$1 ($2)");
+    }
+  }
+  close(WAIT);
+  my $status = $? >> 8;
+
+  if(scalar(@failedA) > 0) { die "wait_for_local_jobs(), job(s) failed: " . join(", ", @failedA); }
+  if($status == 2)         { die "wait_for_local_jobs(), reached maximum time limit of $max_minutes minutes, exiting."; }
+  if($status != 0)         { die "wait_for_local_jobs(), $cmd failed"; }
+
+  # output files are on the local file system, so they are complete once the jobs finished
+  for($i = 0; $i < $n; $i++) {
+    if(! file_tail_contains($outnameAR->[$i], $success_string)) {
+      die "wait_for_local_jobs() job $i finished according to rflocal.py, but tail of expected output file $outnameAR->[$i] does not contain: $success_string\n";
+    }
+  }
+
+  return $max_wait_secs;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 get_resumable_run_id
+
+    Title    : get_resumable_run_id
+    Usage    : get_resumable_run_id($config, $default)
+    Function : Returns the id of the last rfsearch run in the current
+             : directory that was interrupted before its cmsearch jobs
+             : finished, according to the run ledger kept by
+             : rfkubesub.py (see rfledger.py). Reusing it as the id
+             : of the new run makes rfkubesub.py submit only the
+             : searches that did not complete, and rfwait.py
+             : re-attach to the jobs that are still running.
+    Args     : $config:  Rfam config, with 'binLocation'
+             : $default: run id to return if there is nothing to resume
+    Returns  : A run id.
+
+=cut
+
+sub get_resumable_run_id {
+  my ($config, $default) = @_;
+
+  my $ledger = $config->binLocation . "/rfledger.py";
+  if(! -x $ledger) { return $default; }
+
+  my $run_id = `$ledger resume`;
+  if($? != 0) { die "get_resumable_run_id(), $ledger resume failed"; }
+  chomp $run_id;
+
+  return ($run_id ne "") ? $run_id : $default;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 finish_k8s_run
+
+    Title    : finish_k8s_run
+    Usage    : finish_k8s_run($config, $run_id)
+    Function : Marks an rfsearch run as finished in the run ledger of
+             : the current directory, once all its cmsearch jobs
+             : succeeded, so that the next rfsearch starts a new run.
+    Args     : $config: Rfam config, with 'binLocation'
+             : $run_id: id of the run
+    Returns  : void
+
+=cut
+
+sub finish_k8s_run {
+  my ($config, $run_id) = @_;
+
+  my $ledger = $config->binLocation . "/rfledger.py";
+  if(! -x $ledger) { return; }
+
+  system("$ledger finish $run_id");
+  if($? != 0) { die "finish_k8s_run(), $ledger finish $run_id failed"; }
+
+  return;
+}
+
+#-------------------------------------------------------------------------------
+
+=head2 file_tail_contains
+
+  Title    : file_tail_contains()
+  Usage    : file_tail_contains($file, $string)
+  Function : Check if any of the last 10 lines of $file
+           : contain $string.
+  Args     : $file:   file to check
+           : $string: string to look for
+  Returns  : '1' if $file exists and its tail contains $string, else '0'
+
+=cut
+
+sub file_tail_contains {
+  my ($file, $string) = @_;
+
+  if(! -s $file) { return 0; }
+
+  my $tail = `tail $file`;
+  foreach my $line (split("\n", $tail)) {
+    if($line =~ m/\Q$string/) { return 1; }
+  }
+
+  return 0;
+}
+
+#-------------------------------------------------------------------------------
+
 =head2 format_time_string
 
   Title    : format_time_string()
@@ -0,0 +1,41 @@
+#!/usr/bin/env perl 
+#
+# tblout_store.pl - convert the hits of a cmsearch tblout file (TBLOUT,
+#                   REVTBLOUT, SEEDTBLOUT) to the binary store rfmake reads,
+#                   see Bio::Rfam::TbloutStore, and list them.
+#
+# usage: perl tblout_store.pl convert TBLOUT [TBLOUT.rfs]
+#        perl tblout_store.pl top TBLOUT.rfs <bit score threshold>
+#        perl tblout_store.pl remove TBLOUT
+use strict;
+use warnings;
+use Bio::Rfam::TbloutStore;
+
+my $usage  = "usage:  perl tblout_store.pl convert <tblout> [<store>]\n";
+$usage .= "\tperl tblout_store.pl top <store> <bit score threshold>\n";
+$usage .= "\tperl tblout_store.pl remove <tblout>\n\n";
+$usage .= "\tconvert: write the store of a tblout file, default: <tblout>$Bio::Rfam::TbloutStore::STORE_SUFFIX\n";
+$usage .= "\ttop:     print the hits scoring at least the threshold, in score order\n";
+$usage .= "\tremove:  remove the store of a tblout file\n";
+
+my ($command, @argA) = @ARGV;
+if(! defined $command) { die $usage; }
+
+if($command eq "convert" && (scalar(@argA) == 1 || scalar(@argA) == 2)) { 
+  my $nhits = Bio::Rfam::TbloutStore::write_store(@argA);
+  printf("%d hits stored in %s\n", $nhits, (defined $argA[1]) ? $argA[1] : Bio::Rfam::TbloutStore::store_path($argA[0]));
+}
+elsif($command eq "top" && scalar(@argA) == 2) { 
+  my $store = Bio::Rfam::TbloutStore->new($argA[0]);
+  my $next = $store->score_iterator($argA[1]);
+  while(my $hitHR = $next->()) { 
+    print join("\t", @{$hitHR}{qw(name start end strand qstart qend trunc bits evalue)}) . "\n";
+  }
+  $store->close_store();
+}
+elsif($command eq "remove" && scalar(@argA) == 1) { 
+  Bio::Rfam::TbloutStore::remove_store($argA[0]);
+}
+else { 
+  die $usage;
+}
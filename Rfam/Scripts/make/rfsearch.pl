@@ -15,6 +15,7 @@ use Bio::Rfam::FamilyIO;
 use Bio::Rfam::Family::MSA;
 use Bio::Rfam::Infernal;
 use Bio::Rfam::QC;
+use Bio::Rfam::TbloutStore;
 use Bio::Rfam::Utils;
 
 use Bio::Easel::SqFile;
@@ -145,7 +146,11 @@ Bio::Rfam::Utils::log_output_rfam_banner($logFH, $executable, $exec_description,
 
 
 my $user;
-if ($config->location eq "CLOUD"){
+if ($config->location eq "CLOUD" && defined $ENV{"RFAM_USER"}){
+	# login pod claimed from the warm pool, see rflogin.py
+	$user = $ENV{"RFAM_USER"};
+}
+elsif ($config->location eq "CLOUD"){
 	my $host_string  = hostname;
 	my @elements = split('-', $host_string);
 	$user = $elements[3];
@@ -158,6 +163,10 @@ if (! defined $user || length($user) == 0) {
   die "FATAL: failed to run [getlogin or getpwuid($<)]!\n[$!]";
 }
 
+# id of this run, used in the names of the cmsearch jobs and their output files;
+# on CLOUD a run interrupted before its searches finished is resumed under its old id
+my $run_id = $$;
+
 # get the bsolute path of the working directory
 my $workdir = File::Spec->rel2abs();
 
@@ -448,11 +457,13 @@ $outfileH{"species.pdf"}   = "bit score histogram of all hits, colored by taxono
 $outfileH{"seed.fa"}       = "FASTA format version of SEED";
 
 # remove any of these files that currently exist, they're now invalid, since we're now rerunning the search
+# along with the binary stores rfmake reads the tblout files from (see Bio::Rfam::TbloutStore)
 my $outfile;
 foreach $outfile (@outfile_orderA) {
   if (-e $outfile) { 
     unlink $outfile; 
   } 
+  Bio::Rfam::TbloutStore::remove_store($outfile);
 }
 
 Bio::Rfam::Utils::log_output_progress_column_headings($logFH, "per-stage progress:", $do_stdout);
@@ -947,10 +958,38 @@ if ($config->location ne "CLOUD"){
   }
 # Running on cloud
 else{
-submit_or_run_cmsearch_jobs($config, $ndbfiles, "s-",  $searchopts, $cm->{cmHeader}->{w}, $cmfile, \@dbfileA, \@jobnameA, \@tblOA, \@cmsOA, \@errOA, $ssopt_str, $q_opt, $do_all_local);
-  if($rev_ndbfiles > 0) { 
-    submit_or_run_cmsearch_jobs($config, $rev_ndbfiles, "rs-", $rev_searchopts, $cm->{cmHeader}->{w}, $cmfile, \@rev_dbfileA, \@rev_jobnameA, \@rev_tblOA, \@rev_cmsOA, \@rev_errOA, $ssopt_str, $q_opt, $do_all_local);
-}
+  if($do_all_local) { 
+    submit_or_run_cmsearch_jobs($config, $ndbfiles, "s-",  $searchopts, $cm->{cmHeader}->{w}, $cmfile, \@dbfileA, \@jobnameA, \@tblOA, \@cmsOA, \@errOA, $ssopt_str, $q_opt, $do_all_local);
+    if($rev_ndbfiles > 0) { 
+      submit_or_run_cmsearch_jobs($config, $rev_ndbfiles, "rs-", $rev_searchopts, $cm->{cmHeader}->{w}, $cmfile, \@rev_dbfileA, \@rev_jobnameA, \@rev_tblOA, \@rev_cmsOA, \@rev_errOA, $ssopt_str, $q_opt, $do_all_local);
+    }
+  }
+  else { 
+    # resume the last interrupted run in this directory, if any, rfkubesub.py
+    # then only submits the searches that did not complete (see rfledger.py)
+    $run_id = Bio::Rfam::Utils::get_resumable_run_id($config, $$);
+    $ENV{"RFAM_RUN_ID"} = $run_id;
+    if($run_id ne $$) { 
+      Bio::Rfam::Utils::printToFileAndOrStdout($logFH, "# Resuming interrupted run $run_id\n", $do_stdout);
+    }
+    # shards write their output to node-local scratch space and publish it in one
+    # bundle each, which rfwait.py merges from (see rfkubesub.py --stage)
+    if(-x $config->binLocation . "/rfwait.py") { 
+      $ENV{"RFAM_STAGE_OUTPUTS"} = 1;
+    }
+    # split the database files into residue balanced work units, if configured
+    if(defined $dbconfig) { 
+      $ndbfiles = plan_search_units($config, $dbconfig, $cm->{cmHeader}->{w}, \@dbfileA);
+      if($rev_ndbfiles > 0 && defined $rev_dbconfig) { 
+        $rev_ndbfiles = plan_search_units($config, $rev_dbconfig, $cm->{cmHeader}->{w}, \@rev_dbfileA);
+      }
+    }
+    # submit each set of shards as a single k8s Indexed job
+    submit_cmsearch_job_array($config, $ndbfiles, "s-",  $searchopts, $cm->{cmHeader}->{w}, $cmfile, \@dbfileA, \@jobnameA, \@tblOA, \@cmsOA, \@errOA, $ssopt_str, $q_opt);
+    if($rev_ndbfiles > 0) { 
+      submit_cmsearch_job_array($config, $rev_ndbfiles, "rs-", $rev_searchopts, $cm->{cmHeader}->{w}, $cmfile, \@rev_dbfileA, \@rev_jobnameA, \@rev_tblOA, \@rev_cmsOA, \@rev_errOA, $ssopt_str, $q_opt);
+    }
+  }
 
 submit_or_run_cmsearch_jobs($config, 1, "ss-",  $searchopts, $cm->{cmHeader}->{w}, $cmfile, \@seed_dbfileA, \@seed_jobnameA, \@seed_tblOA, \@seed_cmsOA, \@seed_errOA, $ssopt_str, $q_opt, $do_all_local);
 }
@@ -966,14 +1005,6 @@ submit_or_run_cmsearch_jobs($config, 1, "ss-",  $searchopts, $cm->{cmHeader}->{w
   push(@all_tblOA,    @seed_tblOA);
   push(@all_errOA,    @seed_errOA);
 
-  if(! $do_all_local) { 
-    # wait for cluster jobs to finish
-    #$search_max_wait_secs = Bio::Rfam::Utils::wait_for_cluster($config->location, $user, \@all_jobnameA, \@all_tblOA, "# [ok]", "cmsearch", $logFH, "", -1, $do_stdout);
-    $search_max_wait_secs = Bio::Rfam::Utils::wait_for_cluster_light($config, $user, \@all_jobnameA, \@all_tblOA, \@all_errOA, "# [ok]", "cmsearch", $logFH, "", -1, $do_stdout);
-  }
-  $search_wall_secs     = time() - $search_start_time;
-  
-  # concatenate files (no need to validate output, we already did that in wait_for_cluster())
   my $all_errO      = "searcherr";
   my $all_tblO      = "TBLOUT";
   my $all_rev_tblO  = "REVTBLOUT";
@@ -982,6 +1013,31 @@ submit_or_run_cmsearch_jobs($config, 1, "ss-",  $searchopts, $cm->{cmHeader}->{w
   my $all_rev_cmsO  = "revsearchout";
   my $all_seed_cmsO = "seedsearchout";
 
+  # on CLOUD, merge the output of each job as soon as it succeeds while we wait for the others
+  my $merge_plan = undef;
+  if((! $do_all_local) && $config->location eq "CLOUD" && -x $config->binLocation . "/rfwait.py") { 
+    $merge_plan = "rfsearch.$$.merge";
+    open(PLAN, ">" . $merge_plan) || die "ERROR unable to open $merge_plan for writing";
+    write_merge_plan(\*PLAN, \@jobnameA, \@tblOA, \@cmsOA, \@errOA, $all_tblO, $all_cmsO);
+    if($rev_ndbfiles > 0) { 
+      write_merge_plan(\*PLAN, \@rev_jobnameA, \@rev_tblOA, \@rev_cmsOA, \@rev_errOA, $all_rev_tblO, $all_rev_cmsO);
+    }
+    write_merge_plan(\*PLAN, \@seed_jobnameA, \@seed_tblOA, \@seed_cmsOA, \@seed_errOA, $all_seed_tblO, $all_seed_cmsO);
+    close(PLAN);
+  }
+
+  if(! $do_all_local) { 
+    # wait for cluster jobs to finish
+    #$search_max_wait_secs = Bio::Rfam::Utils::wait_for_cluster($config->location, $user, \@all_jobnameA, \@all_tblOA, "# [ok]", "cmsearch", $logFH, "", -1, $do_stdout);
+    $search_max_wait_secs = Bio::Rfam::Utils::wait_for_cluster_light($config, $user, \@all_jobnameA, \@all_tblOA, \@all_errOA, "# [ok]", "cmsearch", $logFH, "", -1, $do_stdout, $merge_plan);
+    if(defined $ENV{"RFAM_RUN_ID"}) { 
+      Bio::Rfam::Utils::finish_k8s_run($config, $run_id);
+    }
+  }
+  $search_wall_secs     = time() - $search_start_time;
+  
+  # concatenate files (no need to validate output, we already did that in wait_for_cluster())
+
   # clean up completed ones
   #Bio::Rfam::Utils::delete_completed_k8s_jobs($user, "backend");
 
@@ -994,15 +1050,25 @@ submit_or_run_cmsearch_jobs($config, 1, "ss-",  $searchopts, $cm->{cmHeader}->{w
     if(! $do_dirty) { unlink $all_errO; } # this file is empty anyway
   }
 
-  # if we get here, either $do_all_local is TRUE or all err files were empty, so we keep going
-  Bio::Rfam::Utils::concatenate_files(\@tblOA,     $all_tblO,     (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
-  Bio::Rfam::Utils::concatenate_files(\@cmsOA,     $all_cmsO,     (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
-  if($rev_ndbfiles > 0) { 
-    Bio::Rfam::Utils::concatenate_files(\@rev_tblOA, $all_rev_tblO, (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
-    Bio::Rfam::Utils::concatenate_files(\@rev_cmsOA, $all_rev_cmsO, (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
+  if(defined $merge_plan) { 
+    # rfwait.py already merged (and validated) the output of each job, remove the per-job files
+    if(! $do_dirty) { 
+      foreach my $file (@all_tblOA, @cmsOA, @rev_cmsOA, @seed_cmsOA, @all_errOA, $merge_plan) { unlink $file; }
+      foreach my $file (@all_tblOA) { unlink $file . ".tgz"; }
+      foreach my $file ($all_tblO, $all_rev_tblO, $all_seed_tblO) { unlink $file . ".sorted"; unlink $file . ".merged"; }
+    }
+  }
+  else { 
+    # if we get here, either $do_all_local is TRUE or all err files were empty, so we keep going
+    Bio::Rfam::Utils::concatenate_files(\@tblOA,     $all_tblO,     (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
+    Bio::Rfam::Utils::concatenate_files(\@cmsOA,     $all_cmsO,     (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
+    if($rev_ndbfiles > 0) { 
+      Bio::Rfam::Utils::concatenate_files(\@rev_tblOA, $all_rev_tblO, (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
+      Bio::Rfam::Utils::concatenate_files(\@rev_cmsOA, $all_rev_cmsO, (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
+    }
+    Bio::Rfam::Utils::concatenate_files(\@seed_tblOA, $all_seed_tblO,  (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
+    Bio::Rfam::Utils::concatenate_files(\@seed_cmsOA, $all_seed_cmsO,  (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
   }
-  Bio::Rfam::Utils::concatenate_files(\@seed_tblOA, $all_seed_tblO,  (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
-  Bio::Rfam::Utils::concatenate_files(\@seed_cmsOA, $all_seed_cmsO,  (! $do_dirty)); # '! $do_dirty' says delete original files after concatenation, unless -dirty
 
   # update DESC with search method
   if($searchopts ne "") { $searchopts .= " "; } # add trailing single space so next line properly formats SM (and blank opts ("") will work too)
@@ -1145,13 +1211,109 @@ sub submit_or_run_cmsearch_jobs {
   my ($config, $ndbfiles, $prefix, $searchopts, $w, $cmfile, $dbfileAR, $jobnameAR, $tblOAR, $cmsOAR, $errOAR, $ssopt_str, $q_opt, $do_local) = @_;
   my ($idx, $file_idx, $dbfile);
   
-  # determine Gb of memory we need per thread based on $w:
-  # 0    <  w < 1000: 4Gb per thread
-  # 1000 <= w < 2000: 8Gb per thread
-  # 2000 <= w < 3000:12Gb per thread
-  # 3000 <= w < 4000:16Gb per thread
-  # 4000 <= w:      :20Gb per thread
+  my $gbPerThread = gb_per_thread_given_w($w);
+  
+  for($idx = 0; $idx < $ndbfiles; $idx++) { 
+    $file_idx = $idx + 1; # off-by-one w.r.t $idx, because database file names are 1..$ndbfiles, not 0..$ndbfiles-1
+    $jobnameAR->[$idx] = $prefix . "$run_id-$file_idx";  
+    $tblOAR->[$idx]    = $prefix . "$run_id-$file_idx.tbl";
+    $cmsOAR->[$idx]    = $prefix . "$run_id-$file_idx.cmsearch";
+    $errOAR->[$idx]    = $prefix . "$run_id-$file_idx.err";
+    Bio::Rfam::Infernal::cmsearch_wrapper($config, $jobnameAR->[$idx], "--tblout " . File::Spec->rel2abs($tblOAR->[$idx]) . " " . $searchopts, File::Spec->rel2abs($cmfile), $dbfileAR->[$idx], File::Spec->rel2abs($cmsOAR->[$idx]), File::Spec->rel2abs($errOAR->[$idx]), $ssopt_str, $q_opt, $do_local, $gbPerThread);  
+  }
+}
+
+######################################################################
+# submit_cmsearch_job_array(): 
+# Same as submit_or_run_cmsearch_jobs() but submits all $ndbfiles
+# searches at once with Bio::Rfam::Infernal::cmsearch_array_wrapper(),
+# as a single k8s Indexed job on CLOUD. Job names are 0-based to
+# match the completion index of each pod.
+
+sub submit_cmsearch_job_array {
+  my ($config, $ndbfiles, $prefix, $searchopts, $w, $cmfile, $dbfileAR, $jobnameAR, $tblOAR, $cmsOAR, $errOAR, $ssopt_str, $q_opt) = @_;
+  my ($idx, $file_idx);
+  my @abs_tblOA = ();
+  my @abs_cmsOA = ();
+  my @abs_errOA = ();
+  
+  my $gbPerThread = gb_per_thread_given_w($w);
   
+  for($idx = 0; $idx < $ndbfiles; $idx++) { 
+    $file_idx = $idx + 1; # off-by-one w.r.t $idx, because database file names are 1..$ndbfiles, not 0..$ndbfiles-1
+    $jobnameAR->[$idx] = $prefix . "$run_id-$idx";  
+    $tblOAR->[$idx]    = $prefix . "$run_id-$file_idx.tbl";
+    $cmsOAR->[$idx]    = $prefix . "$run_id-$file_idx.cmsearch";
+    $errOAR->[$idx]    = $prefix . "$run_id-$file_idx.err";
+    push(@abs_tblOA, File::Spec->rel2abs($tblOAR->[$idx]));
+    push(@abs_cmsOA, File::Spec->rel2abs($cmsOAR->[$idx]));
+    push(@abs_errOA, File::Spec->rel2abs($errOAR->[$idx]));
+  }
+  Bio::Rfam::Infernal::cmsearch_array_wrapper($config, $prefix . $run_id, $jobnameAR, \@abs_tblOA, $searchopts, File::Spec->rel2abs($cmfile), $dbfileAR, \@abs_cmsOA, \@abs_errOA, $ssopt_str, $q_opt, $gbPerThread);
+}
+
+######################################################################
+# write_merge_plan(): 
+# Write one merge plan line per job to $fh for rfwait.py --merge:
+# <jobname> <tblout> <searchout> <stderr> <merged tblout> <merged searchout>
+
+sub write_merge_plan {
+  my ($fh, $jobnameAR, $tblOAR, $cmsOAR, $errOAR, $all_tblO, $all_cmsO) = @_;
+
+  for(my $idx = 0; $idx < scalar(@{$jobnameAR}); $idx++) { 
+    printf $fh ("%s\t%s\t%s\t%s\t%s\t%s\n", $jobnameAR->[$idx], $tblOAR->[$idx], $cmsOAR->[$idx], $errOAR->[$idx], $all_tblO, $all_cmsO);
+  }
+}
+
+######################################################################
+# plan_search_units(): 
+# On CLOUD, replace the database files in @{$dbfileAR} with residue
+# balanced work units planned by rfshard.py (FILE:FIRST-LAST sequence
+# ranges, expanded by rfkubesub.py) so that each cmsearch takes about
+# unitTargetSecs seconds for a CM of width $w. The database files are
+# kept as they are if the db config doesn't set unitTargetSecs or
+# rfshard.py is not installed. The -Z value is unaffected.
+# Returns the number of files/units to search.
+
+sub plan_search_units {
+  my ($config, $dbconfig, $w, $dbfileAR) = @_;
+
+  my $rfshard = $config->binLocation . "/rfshard.py";
+  if((! defined $dbconfig->{"unitTargetSecs"}) || (! -x $rfshard)) { 
+    return scalar(@{$dbfileAR});
+  }
+
+  my $cmd = "$rfshard plan --width $w --target-secs " . $dbconfig->{"unitTargetSecs"};
+  if(defined $dbconfig->{"maxSearchUnits"}) { 
+    $cmd .= " --max-units " . $dbconfig->{"maxSearchUnits"};
+  }
+  $cmd .= " " . join(" ", @{$dbfileAR});
+
+  my @unitA = ();
+  open(PLAN, "$cmd |") || die "ERROR unable to run $cmd";
+  while(my $unit = <PLAN>) { 
+    chomp $unit;
+    if($unit =~ m/\S/) { push(@unitA, $unit); }
+  }
+  close(PLAN) || die "ERROR $cmd failed";
+
+  @{$dbfileAR} = @unitA;
+
+  return scalar(@unitA);
+}
+
+######################################################################
+# gb_per_thread_given_w(): 
+# determine Gb of memory we need per cmsearch thread based on $w:
+# 0    <  w < 1000: 4Gb per thread
+# 1000 <= w < 2000: 8Gb per thread
+# 2000 <= w < 3000:12Gb per thread
+# 3000 <= w < 4000:16Gb per thread
+# 4000 <= w:      :20Gb per thread
+
+sub gb_per_thread_given_w {
+  my ($w) = @_;
+
   my $gbPerThread = 4.0;
   if($w >= 4000) { # only Euk LSU (RF02543) as of Sep 2022
     $gbPerThread = 20.0; 
@@ -1165,15 +1327,8 @@ sub submit_or_run_cmsearch_jobs {
   elsif($w >= 1000) { 
     $gbPerThread = 8.0; 
   }
-  
-  for($idx = 0; $idx < $ndbfiles; $idx++) { 
-    $file_idx = $idx + 1; # off-by-one w.r.t $idx, because database file names are 1..$ndbfiles, not 0..$ndbfiles-1
-    $jobnameAR->[$idx] = $prefix . "$$-$file_idx";  
-    $tblOAR->[$idx]    = $prefix . "$$-$file_idx.tbl";
-    $cmsOAR->[$idx]    = $prefix . "$$-$file_idx.cmsearch";
-    $errOAR->[$idx]    = $prefix . "$$-$file_idx.err";
-    Bio::Rfam::Infernal::cmsearch_wrapper($config, $jobnameAR->[$idx], "--tblout " . File::Spec->rel2abs($tblOAR->[$idx]) . " " . $searchopts, File::Spec->rel2abs($cmfile), $dbfileAR->[$idx], File::Spec->rel2abs($cmsOAR->[$idx]), File::Spec->rel2abs($errOAR->[$idx]), $ssopt_str, $q_opt, $do_local, $gbPerThread);  
-  }
+
+  return $gbPerThread;
 }
 
 ######################################################################
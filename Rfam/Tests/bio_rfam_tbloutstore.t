@@ -0,0 +1,75 @@
+use strict;
+use warnings;
+use Test::More tests => 14;
+use FindBin;
+use File::Temp qw(tempdir);
+use File::Copy;
+
+BEGIN {
+  use_ok( 'Bio::Rfam::TbloutStore' ) || print "Failed to load Bio::Rfam::TbloutStore!\n";
+}
+
+my $dir = $FindBin::Bin;
+my $tmpdir = tempdir(CLEANUP => 1);
+my $tblout = "$tmpdir/TBLOUT";
+copy("$dir/data/RF00014/TBLOUT", $tblout) || die "unable to copy TBLOUT: $!";
+
+# the text rfmake used to parse
+my @sortedA = map { Bio::Rfam::TbloutStore::parse_hit_line($_) } `grep -v ^'#' $tblout | LC_ALL=C sort -k 15,15rn -k 16,16g`;
+my %tbloutHA = ();
+foreach my $hitHR (@sortedA) {
+  push(@{$tbloutHA{$hitHR->{name}}}, $hitHR->{start} . ":" . $hitHR->{end} . ":" . $hitHR->{bits});
+}
+
+my $store = Bio::Rfam::TbloutStore::open_current_store($tblout);
+isa_ok($store, 'Bio::Rfam::TbloutStore');
+ok(-e "$tblout.rfs", 'store written next to the tblout file');
+is($store->nhits, scalar(@sortedA), 'one record per hit line');
+cmp_ok(-s "$tblout.rfs", '<', (-s $tblout) / 2, 'store is smaller than the text');
+
+# score order, columns as they are in the text
+my $next = $store->score_iterator();
+my @storeSortedA = ();
+while(my $hitHR = $next->()) { push(@storeSortedA, $hitHR); }
+is_deeply(\@storeSortedA, \@sortedA, 'score iterator gives the sort -k 15,15rn -k 16,16g order');
+
+# re-thresholding
+my $nabove = grep { $_->{bits} >= 30 } @sortedA;
+is($store->nhits_above(30), $nabove, 'hits above a threshold counted from the score index');
+$next = $store->score_iterator(30);
+my $n = 0;
+while(my $hitHR = $next->()) { $n++; }
+is($n, $nabove, 'score iterator stops at the threshold');
+
+# per sequence index
+tie(my %overlapHA, 'Bio::Rfam::TbloutStore::OverlapHash', $store);
+my $same = 1;
+foreach my $name (keys %tbloutHA) {
+  if(! exists $overlapHA{$name} ||
+     join(",", sort @{$overlapHA{$name}}) ne join(",", sort @{$tbloutHA{$name}})) { $same = 0; }
+}
+ok($same, 'overlap hash gives the hits of each sequence');
+ok(! exists $overlapHA{"NOSUCHSEQ.1"}, 'no hits for an unknown sequence');
+
+# merged stores, like 'cat SEEDTBLOUT TBLOUT | sort'
+copy($tblout, "$tmpdir/SEEDTBLOUT") || die "unable to copy TBLOUT: $!";
+my $seedStore = Bio::Rfam::TbloutStore::open_current_store("$tmpdir/SEEDTBLOUT");
+my @mergedA = map { Bio::Rfam::TbloutStore::parse_hit_line($_) } `cat $tmpdir/SEEDTBLOUT $tblout | grep -v ^'#' | LC_ALL=C sort -k 15,15rn -k 16,16g`;
+my $nextHit = Bio::Rfam::TbloutStore::sorted_hit_iterator($seedStore, $store);
+my @storeMergedA = ();
+while(defined(my $hitHR = $nextHit->())) { push(@storeMergedA, $hitHR); }
+is_deeply(\@storeMergedA, \@mergedA, 'merged stores in score order');
+
+# a changed file is stored again, values that don't round trip are not stored
+open(my $fh, ">>", $tblout) || die "unable to append to $tblout: $!";
+print $fh "NEWSEQ.1 - RF00014 - cm 1 85 1 85 + no 1 0.44 0.0 12.25 1.6e-11 ! new\n";
+close($fh);
+utime(time() + 10, time() + 10, $tblout);
+ok(! $store->is_current($tblout), 'store of a changed file is not current');
+{
+  local $SIG{__WARN__} = sub { };
+  is(Bio::Rfam::TbloutStore::open_current_store($tblout), undef, 'score that does not round trip is read from the text');
+}
+
+Bio::Rfam::TbloutStore::remove_store($tblout);
+ok(! -e "$tblout.rfs", 'store removed');
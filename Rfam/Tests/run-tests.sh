@@ -8,6 +8,7 @@ for t in \
     bio_rfam_family_scores.t \
     bio_rfam_family.t \
     bio_rfam_family_tblout.t \
+    bio_rfam_tbloutstore.t \
     bio_rfam_htmlalignment.t \
     bio_rfam_infernal.t \
     bio_rfam_pair.t \
@@ -1,40 +1,343 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-import os
 import sys
-import subprocess
+import time
+import signal
 import argparse
-from subprocess import Popen, PIPE
+import threading
+import queue
+import datetime
+
+from concurrent.futures import ThreadPoolExecutor
+
+import rfwatch
+
+# -----------------------------------------------------------------------------------------
+
+LABEL_SELECTOR = "tier=backend"
+
+# number of seconds failed jobs are kept for inspection before deletion
+DEFAULT_FAILED_GRACE = 3600
+
+# number of concurrent delete requests
+DEFAULT_BATCH_SIZE = 20
+
+# number of seconds between deletion batches
+DEFAULT_FLUSH_INTERVAL = 5
+
+# -----------------------------------------------------------------------------------------
+
+def get_condition(job, condition_type):
+	"""
+	Returns a true condition of a specific type of a k8s job
+
+	job: A V1Job object
+	condition_type: The condition type (Complete, Failed)
+
+	return: A V1JobCondition object if the condition is true, None otherwise
+	"""
+
+	for condition in job.status.conditions or []:
+		if condition.type == condition_type and condition.status == "True":
+			return condition
+
+	return None
+
+# -----------------------------------------------------------------------------------------
+
+class JobSweeper(object):
+	"""
+	Keeps a cache of backend jobs fed by the watch API and deletes finished
+	jobs and orphaned pods in batches. Succeeded jobs are deleted straight
+	away, failed jobs once they have been failed for failed_grace seconds.
+	"""
+
+	def __init__(self, batch_api, core_api, namespace, failed_grace=DEFAULT_FAILED_GRACE,
+		batch_size=DEFAULT_BATCH_SIZE):
+		self.batch_api = batch_api
+		self.core_api = core_api
+		self.namespace = namespace
+		self.failed_grace = failed_grace
+		self.batch_size = batch_size
+
+		self.jobs = {} # job name -> V1Job
+		self.jobs_synced = False # True once the job cache holds all existing jobs
+		self.finished_pods = {} # pod name -> owner job name
+		self.pending = {} # (kind, name) -> counter to increment once deleted
+		self.removed = {"succeeded_jobs": 0, "failed_jobs": 0, "orphaned_pods": 0}
+
+	def observe_job(self, event_type, job):
+		"""
+		Updates the job cache and queues succeeded jobs for deletion
+
+		event_type: The watch event type (ADDED, MODIFIED, DELETED)
+		job: A V1Job object
+		"""
+
+		name = job.metadata.name
+
+		if event_type == "DELETED":
+			self.jobs.pop(name, None)
+			return
+
+		self.jobs[name] = job
+
+		# already being deleted
+		if job.metadata.deletion_timestamp is not None:
+			return
+
+		if get_condition(job, "Complete") is not None:
+			self.pending[("Job", name)] = "succeeded_jobs"
+
+	def observe_pod(self, event_type, pod):
+		"""
+		Keeps track of backend pods that finished running
+
+		event_type: The watch event type (ADDED, MODIFIED, DELETED)
+		pod: A V1Pod object
+		"""
+
+		name = pod.metadata.name
+
+		if event_type == "DELETED" or pod.metadata.deletion_timestamp is not None or \
+			pod.status.phase not in ("Succeeded", "Failed"):
+			self.finished_pods.pop(name, None)
+			return
+
+		owner = None
+		for owner_reference in pod.metadata.owner_references or []:
+			if owner_reference.kind == "Job":
+				owner = owner_reference.name
+
+		self.finished_pods[name] = owner
+
+	def queue_expired(self, now):
+		"""
+		Queues failed jobs past their grace period and finished pods without
+		an owner job for deletion
+
+		now: The current time as a timezone aware datetime
+		"""
+
+		for name, job in self.jobs.items():
+			condition = get_condition(job, "Failed")
+
+			if condition is None:
+				continue
+
+			failed_time = condition.last_transition_time
+
+			if failed_time is None or (now - failed_time).total_seconds() >= self.failed_grace:
+				self.pending[("Job", name)] = "failed_jobs"
+
+		# pods can only be told apart from orphans once all jobs are known
+		if not self.jobs_synced:
+			return
+
+		for name, owner in self.finished_pods.items():
+			if owner is None or owner not in self.jobs:
+				self.pending[("Pod", name)] = "orphaned_pods"
+
+	def delete(self, kind, name):
+		"""
+		Deletes a job or pod. Jobs are deleted with background propagation
+		so that their pods are cleaned up by the garbage collector.
+
+		kind: Job or Pod
+		name: The object name
+
+		return: True if the object was deleted or is already gone, False otherwise
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		try:
+			if kind == "Job":
+				self.batch_api.delete_namespaced_job(name, self.namespace, propagation_policy="Background")
+			else:
+				self.core_api.delete_namespaced_pod(name, self.namespace)
+
+		except ApiException as e:
+			if e.status != 404:
+				print ("ERROR: Unable to delete %s %s: %s" % (kind, name, e.reason))
+				return False
+
+		return True
+
+	def flush(self):
+		"""
+		Deletes all queued objects, running up to batch_size requests at a time.
+		Objects that could not be deleted stay queued for the next flush
+		"""
+
+		pending = list(self.pending.items())
+		self.pending = {}
+
+		if len(pending) == 0:
+			return
+
+		with ThreadPoolExecutor(max_workers=self.batch_size) as executor:
+			results = list(executor.map(lambda item: self.delete(*item[0]), pending))
+
+		for ((kind, name), counter), deleted in zip(pending, results):
+			if not deleted:
+				self.pending.setdefault((kind, name), counter)
+				continue
+
+			self.removed[counter] += 1
+			if kind == "Job":
+				self.jobs.pop(name, None)
+			else:
+				self.finished_pods.pop(name, None)
+
+	def report(self):
+		"""
+		Prints the number of objects removed so far
+		"""
+
+		print ("%s removed %d succeeded jobs, %d failed jobs, %d orphaned pods" % (
+			datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), self.removed["succeeded_jobs"],
+			self.removed["failed_jobs"], self.removed["orphaned_pods"]))
+		sys.stdout.flush()
+
+# -----------------------------------------------------------------------------------------
+
+def load_k8s_apis():
+	"""
+	Loads the k8s configuration, from the kubeconfig if available, otherwise
+	from the in-cluster service account
+
+	return: A tuple (BatchV1Api, CoreV1Api)
+	"""
+
+	from kubernetes import client, config
+
+	try:
+		config.load_kube_config()
+	except Exception:
+		config.load_incluster_config()
+
+	return (client.BatchV1Api(), client.CoreV1Api())
+
+# -----------------------------------------------------------------------------------------
+
+def sweep_once(sweeper):
+	"""
+	Lists backend jobs and pods once and deletes all finished ones, for use
+	from cron
+
+	sweeper: A JobSweeper object
+	"""
+
+	for job in sweeper.batch_api.list_namespaced_job(sweeper.namespace, label_selector=LABEL_SELECTOR).items:
+		sweeper.observe_job("ADDED", job)
+
+	sweeper.jobs_synced = True
+
+	for pod in sweeper.core_api.list_namespaced_pod(sweeper.namespace, label_selector=LABEL_SELECTOR).items:
+		sweeper.observe_pod("ADDED", pod)
+
+	sweeper.queue_expired(datetime.datetime.now(datetime.timezone.utc))
+	sweeper.flush()
+	sweeper.report()
 
 # -----------------------------------------------------------------------------------------
 
-def delete_completed_jobs():
+def sweep_forever(sweeper, flush_interval=DEFAULT_FLUSH_INTERVAL, report_interval=600):
+	"""
+	Watches backend jobs and pods and deletes finished ones in batches every
+	flush_interval seconds. Exits once a watch gives up, to be restarted with
+	fresh watches by its Deployment (manifests/rfam-job-sweeper.yaml)
+
+	sweeper: A JobSweeper object
+	flush_interval: Number of seconds between deletion batches
+	report_interval: Number of seconds between reports of removed objects
+	"""
+
+	events = queue.Queue()
+
+	for kind, list_func in (("Job", sweeper.batch_api.list_namespaced_job), ("Pod", sweeper.core_api.list_namespaced_pod)):
+		thread = threading.Thread(target=rfwatch.watch_resource,
+			args=(kind, list_func, LABEL_SELECTOR, events, sweeper.namespace))
+		thread.daemon = True
+		thread.start()
+
+	last_flush = time.time()
+	last_report = time.time()
+
+	while True:
+		try:
+			kind, event_type, obj = events.get(timeout=1)
+
+			# exit, to be restarted with fresh watches
+			if event_type == "FAILED":
+				sys.exit("ERROR: lost the %s watch of the cluster: %s" % (kind, obj))
+
+			if kind == "Job" and event_type == "SYNCED":
+				sweeper.jobs_synced = True
+
+			elif kind == "Job":
+				sweeper.observe_job(event_type, obj)
+
+			elif kind == "Pod" and event_type != "SYNCED":
+				sweeper.observe_pod(event_type, obj)
+
+		except queue.Empty:
+			pass
 
+		if time.time() - last_flush >= flush_interval:
+			sweeper.queue_expired(datetime.datetime.now(datetime.timezone.utc))
+			sweeper.flush()
+			last_flush = time.time()
+
+		if time.time() - last_report >= report_interval:
+			sweeper.report()
+			last_report = time.time()
+
+# -----------------------------------------------------------------------------------------
+
+def parse_arguments():
 	"""
-	Uses kubectl command to list all jobs and then checks and deletes
-	all completed ones to relieve the k8s scheduler
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
 	"""
-	
-	# k8s command to delete a job
-	deletion_cmd = "kubectl delete job %s"
-	
-	# k8s command to list all jobs
-	cmd_args = ["kubectl", "get", "jobs"]	
-	process = Popen(cmd_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-	output, err = process.communicate()
-	
-	job_info = output.strip().split('\n')[1:]
-	
-	# splits job info lines in its elements for easy checking of status
-	jobs = [[job_element for job_element in job_line.split(' ') if job_element!=''] for job_line in job_info]
-	
-	for job in jobs:
-		# check if job completed
-		if job[1] == '1/1':
-			subprocess.call(deletion_cmd % job[0], shell=True)
-						
+
+	parser = argparse.ArgumentParser(description='Deletes finished Rfam k8s jobs and orphaned pods')
+
+	parser.add_argument('--once', help='sweep once and exit instead of watching', action="store_true")
+	parser.add_argument('--namespace', help='k8s namespace to sweep (default: default)', action="store",
+		type=str, default="default")
+	parser.add_argument('--failed-grace', help='seconds to keep failed jobs for (default: %d)' % DEFAULT_FAILED_GRACE,
+		action="store", type=int, default=DEFAULT_FAILED_GRACE)
+	parser.add_argument('--batch-size', help='number of concurrent delete requests (default: %d)' % DEFAULT_BATCH_SIZE,
+		action="store", type=int, default=DEFAULT_BATCH_SIZE)
+	parser.add_argument('--flush-interval', help='seconds between deletion batches (default: %d)' % DEFAULT_FLUSH_INTERVAL,
+		action="store", type=int, default=DEFAULT_FLUSH_INTERVAL)
+	parser.add_argument('--report-interval', help='seconds between reports of removed objects (default: 600)',
+		action="store", type=int, default=600)
+
+	return parser
+
 # -----------------------------------------------------------------------------------------
 
 if __name__=='__main__':
 
-	delete_completed_jobs()
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	batch_api, core_api = load_k8s_apis()
+	sweeper = JobSweeper(batch_api, core_api, args.namespace, failed_grace=args.failed_grace,
+		batch_size=args.batch_size)
+
+	if args.once:
+		sweep_once(sweeper)
+
+	else:
+		# print what was removed when stopped
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+		try:
+			sweep_forever(sweeper, flush_interval=args.flush_interval, report_interval=args.report_interval)
+		finally:
+			sweeper.report()
@@ -46,11 +46,16 @@ spec:
         imagePullPolicy: Always
         ports:
         - containerPort: 9876
+        env:
+        - name: RFAM_ADMISSION_QUEUE # "1" for rfkubesub.py jobs to wait for rfadmit.py to admit them, needs manifests/rfam-admission.yaml
+          value: "0"
         volumeMounts:
         - name: rfam-login-pod-storage-USERID # this one must match the volume name of the pvc
           mountPath: /workdir
         - name: nfs-pv
           mountPath: /Rfam/rfamseq
+        - name: rfresult-pv # shared cache of cmsearch results, see rfresult.py
+          mountPath: /Rfam/rfresults
         stdin: true
         tty: true
       volumes:
@@ -60,6 +65,9 @@ spec:
       - name: nfs-pv
         persistentVolumeClaim:
           claimName: nfs-pvc
+      - name: rfresult-pv
+        persistentVolumeClaim:
+          claimName: rfresult-pvc
       restartPolicy: Always"""
 
 # manifest to sign user certificates
@@ -0,0 +1,340 @@
+import os
+import sys
+import time
+import queue
+import threading
+
+# the list and watch loop is shared with the rfsearch tools in kubernetes/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import rfwatch
+
+# --------------------------------------------------------------------------------------------
+
+NAMESPACE = "default"
+
+# label selectors of the objects cached for each kind: the login pods, jobs,
+# pvc and warm login pods not claimed yet (see rflogin.py) of one user
+# (%(user)s), and the login deployments
+LABEL_SELECTORS = {"pods": "user=%(user)s,tier=frontend",
+	"jobs": "user=%(user)s,tier=backend",
+	"pvcs": "user=%(user)s",
+	"deployments": "tier=frontend",
+	"pool_pods": "app=rfam-login-pool,user=%(user)s"}
+
+# --------------------------------------------------------------------------------------------
+
+class WatchError(Exception):
+	"""
+	Raised to callers waiting on a kind of object whose watch gave up
+	"""
+
+# --------------------------------------------------------------------------------------------
+
+class K8sStateCache(object):
+	"""
+	In-memory cache of Rfam k8s objects (pods, deployments, jobs, pvcs and pool pods)
+	kept up to date by one list and watch stream per kind, and per user for
+	the kinds selected by user, started the first time they are queried.
+	Queries are answered from the cache and wait_until() blocks on watch
+	events rather than polling the API server.
+	"""
+
+	def __init__(self, core_api, apps_api, batch_api, namespace=NAMESPACE):
+		self.core_api = core_api
+		self.apps_api = apps_api
+		self.batch_api = batch_api
+		self.namespace = namespace
+		self.list_funcs = {"pods": core_api.list_namespaced_pod,
+			"jobs": batch_api.list_namespaced_job,
+			"pvcs": core_api.list_namespaced_persistent_volume_claim,
+			"deployments": apps_api.list_namespaced_deployment,
+			"pool_pods": core_api.list_namespaced_pod}
+
+		self.objects = {} # (kind, user) -> name -> object
+		self.synced = set()
+		self.errors = {} # (kind, user) -> message of the watch failure
+		self.watching = set()
+		self.condition = threading.Condition()
+
+	def watch(self, key):
+		"""
+		Lists and then watches the objects of a kind (see
+		rfwatch.watch_resource), and applies the events to the cache. Runs
+		until the watch gives up, in a background thread.
+
+		key: A tuple (kind, user), kind one of pods, jobs, pvcs, deployments, pool_pods,
+		     user None for the kinds not selected by user
+		"""
+
+		kind, user = key
+		events = queue.Queue()
+
+		thread = threading.Thread(target=rfwatch.watch_resource, args=(kind, self.list_funcs[kind],
+			LABEL_SELECTORS[kind] % {"user": user}, events, self.namespace))
+		thread.daemon = True
+		thread.start()
+
+		self.apply_events(key, events)
+
+	def apply_events(self, key, events):
+		"""
+		Applies watch events to the cached objects of a kind, until the watch
+		gives up
+
+		key: A tuple (kind, user), see watch
+		events: A queue of (kind, event type, object) watch events
+		"""
+
+		while True:
+			kind, event_type, obj = events.get()
+
+			with self.condition:
+				if event_type == "SYNCED":
+					# the listing drops objects deleted while the watch was re-listing
+					self.objects[key] = dict((item.metadata.name, item) for item in obj)
+					self.synced.add(key)
+
+				elif event_type == "FAILED":
+					# let callers know, the next query watches again
+					self.errors[key] = obj
+					self.synced.discard(key)
+					self.watching.discard(key)
+
+				elif event_type == "DELETED":
+					self.objects.setdefault(key, {}).pop(obj.metadata.name, None)
+
+				else:
+					self.objects.setdefault(key, {})[obj.metadata.name] = obj
+
+				self.condition.notify_all()
+
+			if event_type == "FAILED":
+				return
+
+	def start(self, kind, user=None):
+		"""
+		Starts watching a kind of object, if not already, and waits for the
+		initial listing
+
+		kind: One of pods, jobs, pvcs, deployments, pool_pods
+		user: The user whose objects are watched, for the kinds selected by user
+
+		return: The key of the cached objects, see watch
+
+		raises: WatchError if the watch gave up
+		"""
+
+		key = (kind, user)
+
+		with self.condition:
+			if key not in self.watching:
+				self.errors.pop(key, None)
+				self.watching.add(key)
+				thread = threading.Thread(target=self.watch, args=(key,))
+				thread.daemon = True
+				thread.start()
+
+			while key not in self.synced:
+				self.check_watch(key)
+				self.condition.wait()
+
+		return key
+
+	def check_watch(self, key):
+		"""
+		Raises the failure of a watch to the caller, with the condition held
+
+		raises: WatchError if the watch of key gave up
+		"""
+
+		if key in self.errors:
+			raise WatchError("lost the %s watch of the cluster: %s" % (key[0], self.errors[key]))
+
+	def list(self, kind, user=None, labels=None):
+		"""
+		Returns the cached objects of a kind matching all of labels
+
+		kind: One of pods, jobs, pvcs, deployments, pool_pods
+		user: The user whose objects are listed, for the kinds selected by user
+		labels: A dictionary of label name -> value, None for all objects
+
+		return: A list of k8s objects, sorted by name
+		"""
+
+		key = self.start(kind, user)
+
+		with self.condition:
+			return self.select(key, labels)
+
+	def select(self, key, labels):
+		"""
+		Same as list(), for use with the condition held
+		"""
+
+		items = []
+		objects = self.objects.get(key, {})
+
+		for name in sorted(objects):
+			obj = objects[name]
+			obj_labels = obj.metadata.labels or {}
+
+			if all(obj_labels.get(label) == value for label, value in (labels or {}).items()):
+				items.append(obj)
+
+		return items
+
+	def wait_until(self, kind, predicate, user=None, labels=None, timeout=None):
+		"""
+		Blocks until predicate returns a true value for the cached objects of
+		a kind matching labels, re-evaluating it on each watch event
+
+		kind: One of pods, jobs, pvcs, deployments, pool_pods
+		predicate: A function of a list of k8s objects
+		user: The user whose objects are watched, for the kinds selected by user
+		labels: A dictionary of label name -> value, None for all objects
+		timeout: Maximum number of seconds to wait, None for no limit
+
+		return: The value returned by predicate, None on timeout
+
+		raises: WatchError if the watch gave up
+		"""
+
+		key = self.start(kind, user)
+		deadline = time.time() + timeout if timeout is not None else None
+
+		with self.condition:
+			while True:
+				result = predicate(self.select(key, labels))
+
+				if result:
+					return result
+
+				self.check_watch(key)
+
+				if deadline is not None and time.time() >= deadline:
+					return None
+
+				self.condition.wait(None if deadline is None else deadline - time.time())
+
+	# typed queries
+
+	def get_login_pods(self, username):
+		"""
+		return: The login pods of a user, as a list of V1Pod objects
+		"""
+
+		return self.list("pods", username)
+
+	def get_running_login_pod(self, username):
+		"""
+		return: The running login pod of a user, None if there is none
+		"""
+
+		return get_running_pod(self.get_login_pods(username))
+
+	def get_login_deployment(self, username):
+		"""
+		return: The login deployment of a user as a V1Deployment object, None if there is none
+		"""
+
+		for deployment in self.list("deployments"):
+			if deployment.metadata.name == "rfam-login-pod-%s" % username:
+				return deployment
+
+		return None
+
+	def get_user_jobs(self, username):
+		"""
+		return: The backend jobs of a user, as a list of V1Job objects
+		"""
+
+		return self.list("jobs", username)
+
+	def get_user_pvc(self, username):
+		"""
+		return: The persistent volume claim of a user as a V1PersistentVolumeClaim object, None if there is none
+		"""
+
+		pvcs = self.list("pvcs", username)
+
+		return pvcs[0] if len(pvcs) > 0 else None
+
+	# wait helpers
+
+	def wait_for_login_pod(self, username, timeout=None):
+		"""
+		Waits for a login pod of the user to be running
+
+		return: The running V1Pod object, None on timeout
+		"""
+
+		return self.wait_until("pods", get_running_pod, username, timeout=timeout)
+
+	def wait_for_pool_pod(self, username, timeout=None):
+		"""
+		Waits for a warm login pod of the user to be running in the pool
+
+		return: The running V1Pod object, None on timeout
+		"""
+
+		return self.wait_until("pool_pods", get_running_pod, username, timeout=timeout)
+
+	def wait_for_pvc_bound(self, username, timeout=None):
+		"""
+		Waits for the persistent volume claim of a user to be bound
+
+		return: The bound V1PersistentVolumeClaim object, None on timeout
+		"""
+
+		def get_bound_pvc(pvcs):
+			for pvc in pvcs:
+				if pvc.status.phase == "Bound":
+					return pvc
+			return None
+
+		return self.wait_until("pvcs", get_bound_pvc, username, timeout=timeout)
+
+# --------------------------------------------------------------------------------------------
+
+def get_running_pod(pods):
+	"""
+	return: The first running pod of a list that is not being deleted, None if there is none
+	"""
+
+	for pod in pods:
+		if pod.status.phase == "Running" and pod.metadata.deletion_timestamp is None:
+			return pod
+
+	return None
+
+# --------------------------------------------------------------------------------------------
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache(namespace=NAMESPACE):
+	"""
+	Returns the state cache shared by all callers in this process, creating
+	it on first use from the kubeconfig, or the in-cluster service account
+	when running in a pod
+
+	namespace: The k8s namespace to cache
+
+	return: A K8sStateCache object
+	"""
+
+	global _cache
+
+	with _cache_lock:
+		if _cache is None:
+			from kubernetes import client, config
+
+			try:
+				config.load_kube_config()
+			except Exception:
+				config.load_incluster_config()
+
+			_cache = K8sStateCache(client.CoreV1Api(), client.AppsV1Api(), client.BatchV1Api(), namespace=namespace)
+
+	return _cache
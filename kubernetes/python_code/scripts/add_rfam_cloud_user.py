@@ -5,11 +5,16 @@ import sys
 import string
 import random
 import subprocess
+import time
 import argparse
 import smtplib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 import rfcloud
 import lib.k8s_manifests as k8s_lib
+import lib.k8s_state as k8s_state
 
 #from email.message import EmailMessage
 from subprocess import Popen, PIPE
@@ -22,6 +27,18 @@ ACCOUNT_SIZE = {"beginner": 1,
 		"expert": 2,
 		"guru": 5}
 
+# number of users provisioned concurrently in batch mode
+DEFAULT_WORKERS = 8
+
+# number of attempts at each provisioning step before a user is reported as failed
+DEFAULT_ATTEMPTS = 3
+
+# number of seconds to wait for a PVC to be bound or a login pod to be running
+DEFAULT_WAIT_TIMEOUT = 900
+
+# useradd locks /etc/passwd, so accounts are created one at a time
+useradd_lock = threading.Lock()
+
 # ----------------------------------------------------------------------------------------------------------------
 
 def generate_random_password(length=10):
@@ -140,15 +157,10 @@ def create_user_pvc(username, size=2):
 		
 		# check if pvc was created
 		if str(response).find("created") != -1:
-			# need an infinite loop here to check when the pvc will change status from
-			# Pending to Bound
 			print ("PVC for user %s has been created" % username)		
 			
-			# check if newly created PVC is bound
-			response = False			
-			# keep checking while the pvc is not Bound
-			while(not response):
-				response = check_pvc_exists(username)
+			# wait for the newly created PVC to change status from Pending to Bound
+			k8s_state.get_cache().wait_for_pvc_bound(username)
 
 			print ("PVC of user %s is Bound!" % username)
 		else:
@@ -175,11 +187,9 @@ def check_pvc_exists(username):
 	return: Boolean
 	"""
 	
-	cmd_args = ["kubectl", "get", "pvc", "--selector=user=%s" % username]
-	process = Popen(cmd_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-	response, err = process.communicate()
+	pvc = k8s_state.get_cache().get_user_pvc(username)
 
-	if str(response).find("Bound") != -1:
+	if pvc is not None and pvc.status.phase == "Bound":
 		return True
 
 	return False
@@ -196,12 +206,12 @@ def create_new_user_login_deployment(username, multi=False):
 	"""
 
 	# check if login pod already exists
-	login_pod_exists = check_k8s_login_deployment_exists(username)
+	login_pod_exists = rfcloud.check_k8s_login_deployment_exists(username)
 
 	if login_pod_exists is True:
 		if multi is True:
 			print("User %s login pod already exists" % username)
-			return get_k8s_login_pod_id(username)
+			return rfcloud.get_k8s_login_pod_id(username)
 		# if single user print message and exit
 		else:
 			sys.exit("User %s login pod already exists" % username)
@@ -210,11 +220,8 @@ def create_new_user_login_deployment(username, multi=False):
 		# create a new login pod for user 
 		rfcloud.create_new_user_login_pod(username)
 		
-		check_pod_exists = check_k8s_login_deployment_exists(username)
-
-		# keep checking until the pod gets created
-		while (not check_pod_exists):
-			check_pod_exists = check_k8s_login_deployment_exists(username)
+		# wait until the pod is running
+		k8s_state.get_cache().wait_for_login_pod(username)
 
 		print ("Login pod for user %s has been created!\n" % username)
  
@@ -235,6 +242,165 @@ def email_new_rfam_user_account_credentials(username, password, email):
 
 	pass
 	
+# ----------------------------------------------------------------------------------
+
+def read_user_list(user_list_file):
+	"""
+	Reads a tab delimited file of users to create, one user per line:
+	username, curation level, expire date (YYYY-MM-DD)
+
+	user_list_file: Path to the user list file
+
+	return: A list of (username, curation_level, expire_date) tuples
+	"""
+
+	users = []
+
+	fp = open(user_list_file, 'r')
+	for user_line in fp:
+		# TODO username\tuid\tcuration_level\texpire_date\group
+		# username, curation_level,expire_date for now
+		user_info = user_line.strip().split('\t')
+		if len(user_info) < 3:
+			continue
+		users.append((user_info[0], user_info[1], user_info[2]))
+	fp.close()
+
+	return users
+
+# ----------------------------------------------------------------------------------
+
+def create_k8s_object(create_func, namespace, manifest_str):
+	"""
+	Creates a k8s object from a manifest through the API. Objects that
+	already exist are left as they are, so that reruns resume.
+
+	create_func: The k8s API create function (e.g. CoreV1Api.create_namespaced_persistent_volume_claim)
+	namespace: The k8s namespace to create the object in
+	manifest_str: The object manifest as a YAML string
+
+	return: True if the object was created, False if it already existed
+	"""
+
+	import yaml
+	from kubernetes.client.rest import ApiException
+
+	try:
+		create_func(namespace, yaml.safe_load(manifest_str))
+	except ApiException as e:
+		if e.status != 409:
+			raise
+		return False
+
+	return True
+
+# ----------------------------------------------------------------------------------
+
+def run_step(status, step, func, attempts=DEFAULT_ATTEMPTS):
+	"""
+	Runs a provisioning step of a user, retrying it with an increasing
+	delay if it fails
+
+	status: The user's status dictionary, updated with the outcome of the step
+	step: The name of the step, a key of status
+	func: A function running the step, returning a true value on success
+	attempts: Maximum number of attempts
+
+	return: True if the step succeeded
+	"""
+
+	for attempt in range(attempts):
+		try:
+			if func():
+				status[step] = "ok"
+				return True
+			status[step] = "failed"
+
+		except Exception as e:
+			status[step] = "failed"
+			status["message"] = "%s: %s" % (step, str(e).strip().split('\n')[0])
+
+		if attempt < attempts - 1:
+			time.sleep(5 * 2 ** attempt)
+
+	return False
+
+# ----------------------------------------------------------------------------------
+
+def provision_user(username, curation_level, expire_date, attempts=DEFAULT_ATTEMPTS, wait_timeout=DEFAULT_WAIT_TIMEOUT):
+	"""
+	Creates the account, PVC and login deployment of a user, skipping those
+	that already exist, and waits for the PVC to be bound and the login pod
+	to be running, on the watch streams of the k8s state cache.
+
+	username: A valid non existing username
+	curation_level: One of the ACCOUNT_SIZE levels
+	expire_date: The date the user account will expire (YYYY-MM-DD)
+	attempts: Maximum number of attempts at each step
+	wait_timeout: Number of seconds to wait for the PVC and the login pod
+
+	return: A status dictionary with the outcome of each step
+	"""
+
+	cache = k8s_state.get_cache()
+	status = {"username": username, "account": "-", "pvc": "-", "login": "-", "message": ""}
+
+	if curation_level not in ACCOUNT_SIZE:
+		status["message"] = "unknown curation level %s" % curation_level
+		return status
+
+	def create_account():
+		with useradd_lock:
+			return create_new_rfam_user(username, expire_date, "")
+
+	def create_pvc():
+		if cache.get_user_pvc(username) is None:
+			create_k8s_object(cache.core_api.create_namespaced_persistent_volume_claim, cache.namespace,
+				k8s_lib.user_pvc_manifest % (username, username, ACCOUNT_SIZE[curation_level]))
+		return cache.wait_for_pvc_bound(username, timeout=wait_timeout) is not None
+
+	def create_login():
+		if cache.get_login_deployment(username) is None:
+			create_k8s_object(cache.apps_api.create_namespaced_deployment, cache.namespace,
+				k8s_lib.user_login_deployment_str.replace("USERID", username))
+		return cache.wait_for_login_pod(username, timeout=wait_timeout) is not None
+
+	for step, func in (("account", create_account), ("pvc", create_pvc), ("login", create_login)):
+		if not run_step(status, step, func, attempts=attempts):
+			if status["message"] == "":
+				status["message"] = "%s: not ready after %d attempts" % (step, attempts)
+			break
+
+	return status
+
+# ----------------------------------------------------------------------------------
+
+def provision_users(users, workers=DEFAULT_WORKERS, attempts=DEFAULT_ATTEMPTS, wait_timeout=DEFAULT_WAIT_TIMEOUT):
+	"""
+	Provisions users concurrently, up to workers at a time, and prints a
+	status table once all are done. Users already provisioned are skipped
+	step by step, so rerunning a partial run resumes it.
+
+	users: A list of (username, curation_level, expire_date) tuples
+	workers: Maximum number of users provisioned at the same time
+	attempts: Maximum number of attempts at each step
+	wait_timeout: Number of seconds to wait for each PVC and login pod
+
+	return: True if all users were provisioned, False otherwise
+	"""
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		statuses = list(executor.map(lambda user: provision_user(user[0], user[1], user[2], attempts=attempts,
+			wait_timeout=wait_timeout), users))
+
+	print ("\n%-20s %-8s %-8s %-8s %s" % ("user", "account", "pvc", "login", "message"))
+
+	for status in statuses:
+		print ("%-20s %-8s %-8s %-8s %s" % (status["username"], status["account"], status["pvc"], status["login"],
+			status["message"]))
+
+	return all(status["login"] == "ok" for status in statuses)
+
 # ------------------------------------------------------------------
 
 def is_file(param):
@@ -265,6 +431,12 @@ def parse_arguments():
 
 	parser.add_argument('-f', help='a file containing all necessary information to create Rfam cloud user accounts', 
 		action="store", type = is_file, metavar="FILE")
+	parser.add_argument('--workers', help='number of users to provision concurrently (default: %d)' % DEFAULT_WORKERS,
+		action="store", type=int, default=DEFAULT_WORKERS)
+	parser.add_argument('--attempts', help='number of attempts at each provisioning step (default: %d)' % DEFAULT_ATTEMPTS,
+		action="store", type=int, default=DEFAULT_ATTEMPTS)
+	parser.add_argument('--wait-timeout', help='seconds to wait for each PVC to be bound and login pod to run (default: %d)' % DEFAULT_WAIT_TIMEOUT,
+		action="store", type=int, default=DEFAULT_WAIT_TIMEOUT)
 	
 	return parser
 
@@ -282,8 +454,8 @@ def activate_login_pod_in_user_home(username):
 	user_login_pod_id = ""
 
 	# check login pod exists and get its id
-	if check_k8s_login_deployment_exists(username):
-		user_login_pod_id = get_k8s_login_pod_id(username)
+	if rfcloud.check_k8s_login_deployment_exists(username):
+		user_login_pod_id = rfcloud.get_k8s_login_pod_id(username)
 	else:
 		sys.exit("ERROR: Login pod of user %s does not exist" % username)
 
@@ -320,38 +492,10 @@ if __name__=='__main__':
 	args = parser.parse_args()
 
 	if args.f:
-		user_list_fp = open(args.f, 'r')
-	
-		for user_line in user_list_fp:
-			# TODO username\tuid\tcuration_level\texpire_date\group
-			# username, curation_level,expire_date for now
-			user_info = user_line.strip().split('\t')
-			username = user_info[0]
-			curation_level = user_info[1]
-			expire_date = user_info[2]
-
-			# create a new Rfam cloud user account
-			new_account_status = create_new_rfam_user(username, expire_date, "")
-
-			# check if account was created successfully or account already exists
-			if new_account_status is True:
-				user_pvc_exists = check_pvc_exists(username)
-
-				# create a new pvc if none exists
-				if not user_pvc_exists:
-					pvc_size = ACCOUNT_SIZE[curation_level]
-					pvc_success = create_user_pvc(username, size=pvc_size)
-					
-					# check if pvc creation was successful
-					if not pvc_success:
-						print ("ERROR: PVC for user %s could not be created" % username)
-					
-					# wait until pvc is bound
-					while (not user_pvc_exists):
-						user_pvc_exists = check_pvc_exists(username)
-
-			else:
-				print ("ERROR: Account for user %s could not be created" % username)
-
-
-		user_list_fp.close()			
+		users = read_user_list(args.f)
+
+		success = provision_users(users, workers=args.workers, attempts=args.attempts,
+			wait_timeout=args.wait_timeout)
+
+		if not success:
+			sys.exit(1)
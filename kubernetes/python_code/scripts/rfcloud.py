@@ -2,13 +2,64 @@
 
 import os
 import sys
+import json
+import time
+import calendar
 import argparse
 import subprocess
 import getpass
 import socket
 
 import lib.k8s_manifests as k8s_lib
+import lib.k8s_state as k8s_state
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+
+# --------------------------------------------------------------------------------------------
+
+# number of parallel tar streams used by --sync
+SYNC_STREAMS = 4
+
+# python script listing the files under a path as a json manifest of
+# relative path -> [size, mtime], or if relative paths are passed on stdin,
+# relative path -> sha1 of those files. Runs the same way on the edge node
+# and in the login pod, so it must work with python 2 and 3
+MANIFEST_SCRIPT = """
+import os, sys, json, hashlib
+root, item = sys.argv[1], sys.argv[2]
+paths = [line.rstrip("\\n") for line in sys.stdin if line.strip()]
+manifest = {}
+if paths:
+	for path in paths:
+		sha1 = hashlib.sha1()
+		fp = open(os.path.join(root, path), "rb")
+		for chunk in iter(lambda: fp.read(1048576), b""):
+			sha1.update(chunk)
+		fp.close()
+		manifest[path] = sha1.hexdigest()
+elif os.path.isfile(os.path.join(root, item)):
+	st = os.stat(os.path.join(root, item))
+	manifest[item] = [st.st_size, int(st.st_mtime)]
+else:
+	for dirpath, dirnames, filenames in os.walk(os.path.join(root, item)):
+		for filename in filenames:
+			path = os.path.join(dirpath, filename)
+			if os.path.isfile(path) and not os.path.islink(path):
+				st = os.stat(path)
+				manifest[os.path.relpath(path, root)] = [st.st_size, int(st.st_mtime)]
+sys.stdout.write(json.dumps(manifest))
+"""
+
+# settings of the warm login pod pool kept by rflogin.py, listing the users
+# whose sessions start from the pool
+LOGIN_POOL_CONFIG_MAP = "rfam-login-pool"
+
+# set on login pods claimed from the pool
+POOLED_LABEL = "rfam.org/pooled"
+
+# the hostname of a claimed pod does not name the user, its pool sets the
+# username in this environment variable (see rfkubesub.get_username)
+USER_VAR = "RFAM_USER"
 
 # --------------------------------------------------------------------------------------------
 
@@ -44,7 +95,7 @@ def create_new_user_login_pod(username):
 def check_k8s_login_deployment_exists(username):
 
 	"""
-	Uses kubectl to check if a login pod for a specific user exists.
+	Checks if a running login pod for a specific user exists.
 	Returns True if the login pod exists, False otherwise
 
 	username: A valid Rfam cloud account username
@@ -52,23 +103,14 @@ def check_k8s_login_deployment_exists(username):
 	return: Boolean
 	"""
 	
-	k8s_cmd_args = ["kubectl", "get", "pods", "--selector=user=%s,tier=frontend" % username]	
-	process = Popen(k8s_cmd_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-	output, err = process.communicate()
-
-	login_pod = output.strip().split('\n')[1:]
-
-	if len(login_pod) == 0 or login_pod[0].find("Running") == -1:
-		return False
-
-	return True
+	return k8s_state.get_cache().get_running_login_pod(username) is not None
 
 # --------------------------------------------------------------------------------------------
 
 def get_k8s_login_pod_id(username):
 	"""
-	This function uses kubectl command to fetch the login pod_id of a specific user of
-	the Rfam cloud infrastructure. It returns the the user's login pod_id, otherwise it
+	This function fetches the login pod_id of a specific user of the Rfam
+	cloud infrastructure. It returns the the user's login pod_id, otherwise it
 	returns None.
 
 	username: A valid Rfam cloud account username
@@ -76,15 +118,10 @@ def get_k8s_login_pod_id(username):
 	return: The user login pod_id if it exists, None otherwise
 	"""
 
-	k8s_cmd_args = ["kubectl", "get", "pods", "--selector=user=%s,tier=frontend" % username]
-	process = Popen(k8s_cmd_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-	output, err = process.communicate()
+	login_pods = k8s_state.get_cache().get_login_pods(username)
 
-	login_pod_line = output.strip().split('\n')[1:]
-
-	if len(login_pod_line) != 0:
-		login_pod_id = [x for x in login_pod_line[0].split(' ') if x!=''][0]
-		return login_pod_id
+	if len(login_pods) != 0:
+		return login_pods[0].metadata.name
 
 	return None
 
@@ -93,8 +130,10 @@ def get_k8s_login_pod_id(username):
 def get_interactive_rfam_cloud_session(username):
 	"""
 	This function allows a user to login to their interactive login pod and get access to
-	the Rfam cloud curation pipeline. If the login pod does not exist, a new one will be
-	created and the function waits until the pod is in running state.
+	the Rfam cloud curation pipeline. If the login pod does not exist, a warm one is
+	claimed from the pool for users whose sessions start from it, otherwise the user's
+	login deployment is created, or scaled back up if it was stopped while idle, and
+	the function waits until the pod is in running state.
 
 	username: A valid Rfam cloud account username
 
@@ -102,28 +141,89 @@ def get_interactive_rfam_cloud_session(username):
 	"""
 	
 	# variable declarations
-	user_login_pod_id = ""
 	exec_cmd = "kubectl exec -it %s bash"
 	
 	# check if the user login pod exists
-	login_exists = check_k8s_login_deployment_exists(username)
-	
-	if login_exists:
-		user_login_pod_id = get_k8s_login_pod_id(username)
+	login_pod = k8s_state.get_cache().get_running_login_pod(username)
 
-	else:
-		# create a new user login pod
-		create_new_user_login_pod(username)
+	if login_pod is None:
+		if username in get_login_pool_users():
+			claim_pooled_login_pod(username)
+
+		elif k8s_state.get_cache().get_login_deployment(username) is not None:
+			# scaled to zero by rflogin.py after being idle
+			subprocess.call("kubectl scale deployment rfam-login-pod-%s --replicas=1" % username, shell=True)
+
+		else:
+			# create a new user login pod
+			create_new_user_login_pod(username)
 		
-		# wait while login pod is being created
-		while (not login_exists):
-			login_exists = check_k8s_login_deployment_exists(username)
+		# wait while login pod is being created, on the watch stream of the state cache
+		login_pod = k8s_state.get_cache().wait_for_login_pod(username)
+
+	# if it reaches this point it means the login pod was created
+	# and we can login to it
+	subprocess.call(exec_cmd % login_pod.metadata.name, shell=True)
+
+# --------------------------------------------------------------------------------------------
+
+def get_login_pool_users():
+	"""
+	Fetches the users whose sessions start from the warm login pod pool
+
+	return: A list of usernames, empty if there is no pool
+	"""
+
+	k8s_cmd_args = ["kubectl", "get", "configmap", LOGIN_POOL_CONFIG_MAP, "-o", "json"]
+	process = Popen(k8s_cmd_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+	output, err = process.communicate()
 
-		# if it reaches this point it means the login pod was created
-		# and we can login to it
-		user_login_pod_id = get_k8s_login_pod_id(username)
+	if process.returncode != 0:
+		return []
 
-	subprocess.call(exec_cmd % user_login_pod_id, shell=True)
+	return json.loads(json.loads(output)["data"].get("users", "[]"))
+
+# --------------------------------------------------------------------------------------------
+
+def claim_pooled_login_pod(username):
+	"""
+	Claims a warm login pod from the user's pool, waiting for one if the
+	pool is empty. The pods of a user's pool mount only their directory of
+	the shared home volume as /workdir (see rflogin.py). The pod is relabeled
+	as the user's login pod, which takes it out of the pool deployment so
+	that a replacement is started in the background. Pods are relabeled only
+	if they did not change since they were listed, so that two sessions
+	never claim the same pod.
+
+	username: A valid Rfam cloud account username
+
+	return: The name of the claimed pod
+	"""
+
+	from kubernetes.client.rest import ApiException
+
+	cache = k8s_state.get_cache()
+	labels = {"app": "rfam-family-builder-%s" % username, "user": username, "tier": "frontend", POOLED_LABEL: "true"}
+
+	while True:
+		for pod in cache.list("pool_pods", username):
+			if k8s_state.get_running_pod([pod]) is None:
+				continue
+
+			body = {"metadata": {"labels": labels, "resourceVersion": pod.metadata.resource_version}}
+
+			try:
+				cache.core_api.patch_namespaced_pod(pod.metadata.name, cache.namespace, body)
+			except ApiException as e:
+				# claimed by someone else, or gone
+				if e.status in (404, 409):
+					continue
+				raise
+
+			return pod.metadata.name
+
+		print ("Waiting for a login pod from the pool...")
+		cache.wait_for_pool_pod(username)
 
 # --------------------------------------------------------------------------------------------
 
@@ -141,6 +241,10 @@ def get_username():
 	if hostname.find("master") != -1 or hostname.find("edge") != -1:
 		username = getpass.getuser()
 
+	# check if in a pod claimed from the login pool
+	elif os.environ.get(USER_VAR):
+		username = os.environ[USER_VAR]
+
 	# check if in pod
 	elif hostname.find("login") != -1:
 		username = hostname.split('-')[3]
@@ -154,14 +258,71 @@ def get_username():
 
 def get_user_jobs(username):
 	"""
-	Function to fetch the jobs of a user
+	Function to print the jobs of a user
 	
 	return: void
 	"""
 	
-	k8s_cmd = "kubectl get jobs --selector=user=%s --selector=tier=backend"
+	jobs = k8s_state.get_cache().get_user_jobs(username)
+
+	if len(jobs) == 0:
+		print ("No jobs found.")
+		return
+
+	print ("%-50s %-12s %-10s" % ("NAME", "COMPLETIONS", "AGE"))
 
-	subprocess.call(k8s_cmd % username, shell=True)
+	for job in jobs:
+		completions = "%d/%d" % (job.status.succeeded or 0, job.spec.completions or 1)
+		age = format_age(job.metadata.creation_timestamp)
+		print ("%-50s %-12s %-10s" % (job.metadata.name, completions, age))
+
+# --------------------------------------------------------------------------------------------
+
+def format_age(timestamp):
+	"""
+	Formats the time since a k8s timestamp as kubectl does (e.g. 45s, 12m, 3h, 2d)
+
+	timestamp: A timezone aware datetime
+
+	return: The age as a string
+	"""
+
+	seconds = int(time.time() - calendar.timegm(timestamp.utctimetuple()))
+
+	for unit, length in (("d", 86400), ("h", 3600), ("m", 60)):
+		if seconds >= length:
+			return "%d%s" % (seconds / length, unit)
+
+	return "%ds" % seconds
+
+# --------------------------------------------------------------------------------------------
+
+def get_admission_queue_status():
+	"""
+	Prints the job admission queue depth and wait times of all users, as
+	published by the rfadmit.py admission controller
+
+	return: void
+	"""
+
+	k8s_cmd_args = ["kubectl", "get", "configmap", "rfam-admission-status", "-o", "json"]
+	process = Popen(k8s_cmd_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+	output, err = process.communicate()
+
+	if process.returncode != 0:
+		sys.exit("\nUnable to fetch the admission queue status. Is rfadmit.py running?\n")
+
+	data = json.loads(output)["data"]
+	users = json.loads(data["users"])
+
+	print ("%-15s %12s %12s %13s %17s" % ("user", "queued jobs", "queued pods", "running pods", "oldest wait (s)"))
+
+	for user in sorted(users):
+		status = users[user]
+		print ("%-15s %12d %12d %13d %17d" % (user, status["queued_jobs"], status["queued_pods"],
+			status["running_pods"], status["oldest_wait_secs"]))
+
+	print ("\nMean wait before admission over the last hour: %ss (updated %s)" % (data["mean_wait_secs"], data["updated"]))
 
 # --------------------------------------------------------------------------------------------
 
@@ -217,6 +378,183 @@ def copy_items_between_home_pod(item, direction='to'):
 
 # --------------------------------------------------------------------------------------------
 
+def get_sync_manifest(root, item, login_pod_id=None, hash_paths=None):
+	"""
+	Runs MANIFEST_SCRIPT on the edge node, or in the login pod if login_pod_id
+	is set, to list the files of item or to hash some of them
+
+	root: The directory item is relative to
+	item: A file or directory relative to root
+	login_pod_id: The login pod to run in, None to run locally
+	hash_paths: A list of paths relative to root to hash, None to list item
+
+	return: A dictionary of relative path -> [size, mtime] or sha1, empty if item does not exist
+	"""
+
+	cmd_args = ["python", "-c", MANIFEST_SCRIPT, root, item]
+
+	if login_pod_id is not None:
+		cmd_args = ["kubectl", "exec", "-i", login_pod_id, "--"] + cmd_args
+
+	process = Popen(cmd_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+	output, err = process.communicate(("\n".join(hash_paths or []) + "\n").encode())
+
+	if process.returncode != 0:
+		sys.exit("\nUnable to list %s: %s\n" % (os.path.join(root, item), err.decode().strip()))
+
+	return json.loads(output.decode())
+
+# --------------------------------------------------------------------------------------------
+
+def get_changed_files(src_manifest, dest_manifest, src_hashes, dest_hashes):
+	"""
+	Compares source and destination manifests and returns the files to transfer:
+	those missing or of a different size at the destination, and those with a
+	different mtime whose content hashes differ
+
+	src_manifest: Source manifest of relative path -> [size, mtime]
+	dest_manifest: Destination manifest of relative path -> [size, mtime]
+	src_hashes: A function hashing a list of source paths
+	dest_hashes: A function hashing a list of destination paths
+
+	return: A list of relative paths to transfer
+	"""
+
+	changed = []
+	touched = []
+
+	for path, (size, mtime) in src_manifest.items():
+		if path not in dest_manifest or dest_manifest[path][0] != size:
+			changed.append(path)
+		elif dest_manifest[path][1] != mtime:
+			touched.append(path)
+
+	# same size, different mtime: compare contents
+	if len(touched) > 0:
+		src_sha1 = src_hashes(touched)
+		dest_sha1 = dest_hashes(touched)
+		changed.extend([path for path in touched if src_sha1[path] != dest_sha1[path]])
+
+	return changed
+
+# --------------------------------------------------------------------------------------------
+
+def split_into_streams(paths, sizes, streams):
+	"""
+	Splits files into groups of about the same total size, largest first
+
+	paths: A list of relative paths
+	sizes: A dictionary of relative path -> [size, mtime]
+	streams: Number of groups
+
+	return: A list of non empty lists of relative paths
+	"""
+
+	groups = [[] for i in range(streams)]
+	totals = [0] * streams
+
+	for path in sorted(paths, key=lambda path: sizes[path][0], reverse=True):
+		smallest = totals.index(min(totals))
+		groups[smallest].append(path)
+		totals[smallest] += sizes[path][0]
+
+	return [group for group in groups if len(group) > 0]
+
+# --------------------------------------------------------------------------------------------
+
+def transfer_files(paths, local_root, pod_root, login_pod_id, direction):
+	"""
+	Transfers files between the edge node and the login pod as a gzip
+	compressed tar stream. tar restores mtimes only once a file is complete,
+	so files cut off by an interruption are picked up again on the next sync.
+
+	paths: A list of paths relative to both roots
+	local_root: The local directory
+	pod_root: The directory in the login pod
+	login_pod_id: The user's login pod
+	direction: to: from home to pod, from: from pod to home
+
+	return: True if the transfer was successful, False otherwise
+	"""
+
+	file_list = "\n".join(paths) + "\n"
+
+	pack_cmd = "tar -C %s -cf - -T - | gzip -1"
+	unpack_cmd = "mkdir -p %s && gzip -dc | tar -C %s -xpf -"
+
+	if direction == "to":
+		cmd = "%s | kubectl exec -i %s -- sh -c '%s'" % (pack_cmd % local_root, login_pod_id,
+			unpack_cmd % (pod_root, pod_root))
+	else:
+		cmd = "kubectl exec -i %s -- sh -c '%s' | (%s)" % (login_pod_id, pack_cmd % pod_root,
+			unpack_cmd % (local_root, local_root))
+
+	process = Popen(cmd, shell=True, stdin=PIPE)
+	process.communicate(file_list.encode())
+
+	return process.returncode == 0
+
+# --------------------------------------------------------------------------------------------
+
+def sync_items_between_home_pod(item, direction='to', streams=SYNC_STREAMS):
+	"""
+	Synchronizes a file or directory between a user's home directory and
+	the workdir in their login pod, transferring only the files that
+	changed, compressed and in parallel streams. Rerunning an interrupted
+	sync resumes it.
+
+	item: The file or directory to be synchronized, relative to the home
+	directory and the workdir
+	direction: to: from home to pod, from: from pod to home
+	streams: Number of parallel transfer streams
+
+	return: void
+	"""
+
+	username = get_username()
+	login_pod_id = get_k8s_login_pod_id(username)
+
+	if login_pod_id is None:
+		sys.exit("\nUnable to detect interactive session. Try using --start option.\n")
+
+	item = os.path.normpath(item)
+	if item.startswith("workdir" + os.sep):
+		item = item[len("workdir" + os.sep):]
+
+	local_root = os.path.dirname(item) or "."
+	pod_root = os.path.join("workdir", os.path.dirname(item))
+	item = os.path.basename(item)
+
+	local = lambda hash_paths=None: get_sync_manifest(local_root, item, hash_paths=hash_paths)
+	remote = lambda hash_paths=None: get_sync_manifest(pod_root, item, login_pod_id, hash_paths=hash_paths)
+
+	src, dest = (local, remote) if direction == "to" else (remote, local)
+
+	src_manifest = src()
+	if len(src_manifest) == 0:
+		sys.exit("\nItem %s does not exist or is empty!\n" % item)
+
+	changed = get_changed_files(src_manifest, dest(), src, dest)
+
+	if len(changed) == 0:
+		print ("Item %s is up to date." % item)
+		return
+
+	total_size = sum([src_manifest[path][0] for path in changed])
+	print ("Transferring %d of %d files (%.1f MB)..." % (len(changed), len(src_manifest), total_size / 1048576.0))
+
+	groups = split_into_streams(changed, src_manifest, streams)
+	pool = ThreadPool(len(groups))
+	results = pool.map(lambda group: transfer_files(group, local_root, pod_root, login_pod_id, direction), groups)
+	pool.close()
+
+	if not all(results):
+		sys.exit("\nSync of %s was interrupted. Run the same command again to resume.\n" % item)
+
+	print ("Item %s synchronized." % item)
+
+# --------------------------------------------------------------------------------------------
+
 def parse_arguments():
 	"""
 	Uses python's argparse to parse the command line arguments
@@ -237,8 +575,20 @@ def parse_arguments():
 	mutually_exclusive.add_argument("--copy-from", help='copies an existing file/dir from workdir', action="store",
 		type = str, metavar="FILE/DIR")
 
+	mutually_exclusive.add_argument("--sync-to", help='syncs changed files of a file/dir to workdir', action="store",
+		type = str, metavar="FILE/DIR")
+
+	mutually_exclusive.add_argument("--sync-from", help='syncs changed files of a file/dir from workdir', action="store",
+		type = str, metavar="FILE/DIR")
+
+	parser.add_argument("--streams", help='number of parallel streams used by --sync-to/--sync-from (default: %d)' % SYNC_STREAMS,
+		action="store", type=int, default=SYNC_STREAMS)
+
 	mutually_exclusive.add_argument("--get-jobs", help='get all k8s jobs of a user', action="store_true")
 
+	mutually_exclusive.add_argument("--queue", help='show job admission queue depth and wait times per user',
+		action="store_true")
+
 	return parser
 
 # --------------------------------------------------------------------------------------------
@@ -259,6 +609,15 @@ if __name__ == "__main__":
 	elif args.copy_from:
 		copy_items_between_home_pod(args.copy_from, direction='from')
 	
+	elif args.sync_to:
+		sync_items_between_home_pod(args.sync_to, direction='to', streams=args.streams)
+
+	elif args.sync_from:
+		sync_items_between_home_pod(args.sync_from, direction='from', streams=args.streams)
+
 	elif args.get_jobs:
 		username = get_username()
 		get_user_jobs(username)
+
+	elif args.queue:
+		get_admission_queue_status()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import signal
+import argparse
+import datetime
+
+import rfkubesub
+
+# -----------------------------------------------------------------------------------
+
+LABEL_SELECTOR = "tier=backend"
+
+# ConfigMap holding per-user weights and caps, read every cycle:
+#   weights: {"<user>": <weight>, ...}  (default 1)
+#   caps:    {"<user>": <max pods>, ...} (default --user-cap)
+CONFIG_MAP = "rfam-admission"
+
+# ConfigMap the controller publishes the queue state to, read by rfcloud.py --queue
+STATUS_CONFIG_MAP = rfkubesub.ADMISSION_STATUS_CONFIG_MAP
+
+ADMITTED_ANNOTATION = "rfam.org/admitted-at"
+
+# job name prefixes of interactive searches, admitted before bulk fan-outs
+INTERACTIVE_PREFIXES = ("ss-",)
+
+# priority classes, lower is admitted first
+INTERACTIVE = 0
+BULK = 1
+
+DEFAULT_USER_CAP = 100
+DEFAULT_INTERVAL = 5
+
+# number of seconds admission wait times are averaged over
+WAIT_WINDOW = 3600
+
+# -----------------------------------------------------------------------------------
+
+def parse_quantity(quantity):
+	"""
+	Converts a k8s cpu or memory quantity to a float, in cores or bytes
+
+	quantity: A quantity string (e.g. 500m, 4, 24Gi, 1000Mi)
+
+	return: A float
+	"""
+
+	suffixes = {"m": 1e-3, "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12,
+		"Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40}
+
+	quantity = str(quantity)
+
+	for suffix in sorted(suffixes, key=len, reverse=True):
+		if quantity.endswith(suffix):
+			return float(quantity[:-len(suffix)]) * suffixes[suffix]
+
+	return float(quantity)
+
+# -----------------------------------------------------------------------------------
+
+def get_pod_requests(pod_spec):
+	"""
+	Sums the cpu and memory requests of the containers of a pod spec
+
+	pod_spec: A V1PodSpec object
+
+	return: A tuple (cpu cores, memory bytes)
+	"""
+
+	cpu = 0.0
+	memory = 0.0
+
+	for container in pod_spec.containers:
+		requests = (container.resources.requests if container.resources is not None else None) or {}
+		cpu += parse_quantity(requests.get("cpu", 0))
+		memory += parse_quantity(requests.get("memory", 0))
+
+	return (cpu, memory)
+
+# -----------------------------------------------------------------------------------
+
+class QueuedJob(object):
+	"""
+	Admission state of a backend job: how many of its pods may run
+	(parallelism, 0 while suspended) and how many still need to.
+	"""
+
+	def __init__(self, job, now):
+		labels = job.metadata.labels or {}
+
+		self.name = job.metadata.name
+		self.user = labels.get("user", "")
+		self.created = job.metadata.creation_timestamp
+		self.suspended = bool(job.spec.suspend)
+		self.completions = job.spec.completions or 1
+		self.remaining = max(0, self.completions - (job.status.succeeded or 0))
+		self.parallelism = 0 if self.suspended else (job.spec.parallelism if job.spec.parallelism is not None else 1)
+		self.admitted = self.parallelism
+		self.cpu, self.memory = get_pod_requests(job.spec.template.spec)
+		self.gang = rfkubesub.MPI_PODS_ANNOTATION in (job.metadata.annotations or {})
+
+		job_index = rfkubesub.get_job_index(self.user, self.name) or ""
+		if self.completions == 1 or job_index.startswith(INTERACTIVE_PREFIXES):
+			self.priority = INTERACTIVE
+		else:
+			self.priority = BULK
+
+		self.wait_secs = (now - self.created).total_seconds() if self.created is not None else 0
+
+	def running(self):
+		"""
+		return: Number of pods of this job that are admitted and not done
+		"""
+
+		return min(self.admitted, self.remaining)
+
+	def queued(self):
+		"""
+		return: Number of pods of this job waiting for admission
+		"""
+
+		return max(0, self.remaining - self.admitted)
+
+	def step(self):
+		"""
+		return: Number of pods of this job to admit at once: all of them for MPI
+		jobs, which only run once all their pods do, one for other jobs
+		"""
+
+		return self.queued() if self.gang else 1
+
+# -----------------------------------------------------------------------------------
+
+class AdmissionController(object):
+	"""
+	Admits suspended backend jobs, pod by pod, while the cluster has room
+	for them. Interactive jobs go first, then the user with the lowest
+	weighted share of the cluster's cpus, then the oldest job. No user
+	gets more than their cap of running pods. The pods of MPI jobs are
+	admitted all at once, or not at all.
+	"""
+
+	def __init__(self, batch_api, core_api, namespace, user_cap=DEFAULT_USER_CAP):
+		self.batch_api = batch_api
+		self.core_api = core_api
+		self.namespace = namespace
+		self.user_cap = user_cap
+
+		self.waits = [] # (admission time, seconds waited) of recent admissions
+
+	def read_settings(self):
+		"""
+		return: A tuple (weights, caps) of per-user dictionaries
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		try:
+			data = self.core_api.read_namespaced_config_map(CONFIG_MAP, self.namespace).data or {}
+		except ApiException as e:
+			if e.status != 404:
+				raise
+			data = {}
+
+		return (json.loads(data.get("weights", "{}")), json.loads(data.get("caps", "{}")))
+
+	def get_free_capacity(self, jobs):
+		"""
+		Computes the cpu and memory left on schedulable nodes once the
+		requests of all pods that are not done are accounted for. Pods
+		admitted in earlier cycles that the job controller has not created
+		yet are accounted for too.
+
+		jobs: A list of QueuedJob objects
+
+		return: A tuple (cpu cores, memory bytes)
+		"""
+
+		cpu = 0.0
+		memory = 0.0
+
+		for node in self.core_api.list_node().items:
+			if node.spec.unschedulable:
+				continue
+			cpu += parse_quantity(node.status.allocatable["cpu"])
+			memory += parse_quantity(node.status.allocatable["memory"])
+
+		pods = self.core_api.list_pod_for_all_namespaces(
+			field_selector="status.phase!=Succeeded,status.phase!=Failed").items
+
+		existing = {}
+		for pod in pods:
+			pod_cpu, pod_memory = get_pod_requests(pod.spec)
+			cpu -= pod_cpu
+			memory -= pod_memory
+
+			job_name = (pod.metadata.labels or {}).get("jobname")
+			existing[job_name] = existing.get(job_name, 0) + 1
+
+		for job in jobs:
+			missing = max(0, job.running() - existing.get(job.name, 0))
+			cpu -= missing * job.cpu
+			memory -= missing * job.memory
+
+		return (cpu, memory)
+
+	def plan(self, jobs, free_cpu, free_memory, weights, caps):
+		"""
+		Decides how many more pods of each job to admit.
+
+		jobs: A list of QueuedJob objects, updated in place
+		free_cpu: Free cpu cores
+		free_memory: Free memory in bytes
+		weights: Dictionary of user -> fair share weight
+		caps: Dictionary of user -> maximum number of running pods
+
+		return: A list of QueuedJob objects whose admission changed
+		"""
+
+		usage = {}
+		running = {}
+		for job in jobs:
+			usage[job.user] = usage.get(job.user, 0.0) + job.running() * job.cpu
+			running[job.user] = running.get(job.user, 0) + job.running()
+
+		changed = {}
+
+		while True:
+			candidates = [job for job in jobs if job.queued() > 0 and
+				running.get(job.user, 0) + job.step() <= caps.get(job.user, self.user_cap) and
+				job.cpu * job.step() <= free_cpu and job.memory * job.step() <= free_memory]
+
+			if len(candidates) == 0:
+				break
+
+			job = min(candidates, key=lambda j: (j.priority,
+				usage.get(j.user, 0.0) / float(weights.get(j.user, 1)), j.wait_secs * -1))
+
+			npods = job.step()
+			job.admitted += npods
+			free_cpu -= job.cpu * npods
+			free_memory -= job.memory * npods
+			usage[job.user] = usage.get(job.user, 0.0) + job.cpu * npods
+			running[job.user] = running.get(job.user, 0) + npods
+			changed[job.name] = job
+
+		return list(changed.values())
+
+	def admit(self, job, now):
+		"""
+		Unsuspends a job and sets its parallelism to the number of pods admitted
+
+		job: A QueuedJob object
+		now: The current time as a timezone aware datetime
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		body = {"spec": {"suspend": False, "parallelism": job.admitted}}
+
+		if job.suspended:
+			body["metadata"] = {"annotations": {ADMITTED_ANNOTATION: now.isoformat()}}
+
+		try:
+			self.batch_api.patch_namespaced_job(job.name, self.namespace, body)
+		except ApiException as e:
+			if e.status != 404:
+				print ("ERROR: Unable to admit job %s: %s" % (job.name, e.reason))
+			return
+
+		if job.suspended:
+			self.waits.append((time.time(), job.wait_secs))
+
+	def publish_status(self, jobs, now):
+		"""
+		Writes the queue depth and wait times per user to the status ConfigMap
+
+		jobs: A list of QueuedJob objects
+		now: The current time as a timezone aware datetime
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		self.waits = [w for w in self.waits if time.time() - w[0] < WAIT_WINDOW]
+
+		status = {}
+		for job in jobs:
+			user_status = status.setdefault(job.user, {"queued_jobs": 0, "queued_pods": 0, "running_pods": 0,
+				"oldest_wait_secs": 0})
+			user_status["queued_pods"] += job.queued()
+			user_status["running_pods"] += job.running()
+
+			if job.admitted == 0 and job.remaining > 0:
+				user_status["queued_jobs"] += 1
+				user_status["oldest_wait_secs"] = max(user_status["oldest_wait_secs"], int(job.wait_secs))
+
+		mean_wait = sum(w[1] for w in self.waits) / len(self.waits) if len(self.waits) > 0 else 0
+
+		body = {"metadata": {"name": STATUS_CONFIG_MAP},
+			"data": {"updated": now.isoformat(), "users": json.dumps(status, sort_keys=True),
+				"mean_wait_secs": "%d" % mean_wait}}
+
+		try:
+			self.core_api.replace_namespaced_config_map(STATUS_CONFIG_MAP, self.namespace, body)
+		except ApiException as e:
+			if e.status != 404:
+				raise
+			self.core_api.create_namespaced_config_map(self.namespace, body)
+
+	def cycle(self):
+		"""
+		Runs one admission cycle
+		"""
+
+		now = datetime.datetime.now(datetime.timezone.utc)
+		weights, caps = self.read_settings()
+
+		jobs = [QueuedJob(job, now) for job in
+			self.batch_api.list_namespaced_job(self.namespace, label_selector=LABEL_SELECTOR).items]
+
+		free_cpu, free_memory = self.get_free_capacity(jobs)
+
+		for job in self.plan(jobs, free_cpu, free_memory, weights, caps):
+			self.admit(job, now)
+
+		self.publish_status(jobs, now)
+
+	def run(self, interval=DEFAULT_INTERVAL):
+		"""
+		Runs admission cycles every interval seconds
+		"""
+
+		while True:
+			try:
+				self.cycle()
+			except Exception as e:
+				print ("ERROR: Admission cycle failed: %s" % e)
+				sys.stdout.flush()
+
+			time.sleep(interval)
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Fair share admission of Rfam k8s jobs')
+
+	parser.add_argument('--namespace', help='k8s namespace of the jobs (default: default)', action="store",
+		type=str, default="default")
+	parser.add_argument('--user-cap', help='maximum number of running pods per user (default: %d)' % DEFAULT_USER_CAP,
+		action="store", type=int, default=DEFAULT_USER_CAP)
+	parser.add_argument('--interval', help='seconds between admission cycles (default: %d)' % DEFAULT_INTERVAL,
+		action="store", type=int, default=DEFAULT_INTERVAL)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	from kubernetes import client, config
+
+	try:
+		config.load_kube_config()
+	except Exception:
+		config.load_incluster_config()
+
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	controller = AdmissionController(client.BatchV1Api(), client.CoreV1Api(), args.namespace, user_cap=args.user_cap)
+	controller.run(interval=args.interval)
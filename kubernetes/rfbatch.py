@@ -0,0 +1,804 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import math
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import rfshard
+import rfmerge
+import rfkubesub
+
+# -----------------------------------------------------------------------------------
+
+RFBATCH_CMD = "/Rfam/software/bin/rfbatch.py"
+RFKUBESUB_CMD = "/Rfam/software/bin/rfkubesub.py"
+RFWAIT_CMD = "/Rfam/software/bin/rfwait.py"
+CMSEARCH = "/Rfam/software/bin/cmsearch"
+ESL_REFORMAT = "/Rfam/software/bin/esl-reformat"
+
+# the config rfsearch.pl reads, Rfam/Conf/rfam_cloud.conf in the cloud images
+CONFIG_FILE = os.environ.get("RFAM_CONFIG", "/Rfam/rfam-family-pipeline/Rfam/Conf/rfam.conf")
+
+# database searched, as rfsearch.pl -dbchoice, with its reversed mate
+DEFAULT_DB = "rfamseq"
+
+# scratch space requested per pod, for the uncompressed copy of its shard
+# (both strands count in the database size) and the outputs of its searches
+SCRATCH_MARGIN = 1.25
+
+# rfsearch.pl -scpu default, and the maximum number of CPUs per k8s job
+DEFAULT_CPUS = 4
+MAX_CPUS = 8
+
+# CMs searched by each pod, one after the other on the same copy of a shard
+DEFAULT_MAX_MODELS = 20
+
+# written in the batch work directory
+PLAN_FILE = "rfbatch.json"
+MERGE_PLAN_FILE = "rfbatch.merge"
+
+# searches of each batch: of the database, of the reversed database and of
+# the SEED of each family, with the family files rfsearch.pl merges them in
+SEARCHES = (("s", "TBLOUT", "searchout"), ("rs", "REVTBLOUT", "revsearchout"), ("ss", "SEEDTBLOUT", "seedsearchout"))
+
+# comment lines naming the CM searched in the tblout and the output of a
+# cmsearch run, and the last line of the output of a run
+TBLOUT_QUERY = "# Query file:"
+SEARCHOUT_QUERY = "# query CM file:"
+SEARCHOUT_SUCCESS_STRING = "[ok]"
+
+# -----------------------------------------------------------------------------------
+
+def read_config(config_file):
+	"""
+	Reads an Rfam config file (Config::General format, as Bio::Rfam::Config)
+	into nested dictionaries, one per <block>
+
+	config_file: Path to the config file
+
+	return: A dictionary of key -> value or block dictionary
+	"""
+
+	config = {}
+	blocks = [config]
+
+	fp = open(config_file, 'r')
+	for line in fp:
+		line = line.split('#', 1)[0].strip()
+
+		if line == "":
+			continue
+
+		if line.startswith("</"):
+			blocks.pop()
+
+		elif line.startswith("<"):
+			block = {}
+			blocks[-1][line.strip("<>").strip()] = block
+			blocks.append(block)
+
+		else:
+			fields = line.split(None, 1)
+			blocks[-1][fields[0]] = fields[1] if len(fields) > 1 else ""
+	fp.close()
+
+	return config
+
+def read_search_db(config_file=CONFIG_FILE, db=DEFAULT_DB):
+	"""
+	Reads the files and size of a database and its reversed mate from the
+	config, as rfsearch.pl does
+
+	config_file: Path to the Rfam config file
+	db: Name of the database in the seqdb block
+
+	return: A dictionary with the database files, size (Mb, for -Z), and the files and size of the
+	        reversed database, no files if it has none
+	"""
+
+	config = read_config(config_file)
+	db_config = config["seqdb"][db]
+	search_db = {"files": get_search_files(db_config), "size": db_config["dbSize"],
+		"nfiles": int(db_config["nSearchFiles"]), "rev_files": [], "rev_size": None, "rev_nfiles": 0}
+
+	if "revMate" in db_config:
+		rev_config = config["revseqdb"][db_config["revMate"]]
+		search_db.update({"rev_files": get_search_files(rev_config), "rev_size": rev_config["dbSize"],
+			"rev_nfiles": int(rev_config["nSearchFiles"])})
+
+	return search_db
+
+def get_search_files(db_config):
+	"""
+	return: The search files of a database config block, <searchPathPrefix><1..nSearchFiles><searchPathSuffix>
+	"""
+
+	return ["%s%d%s" % (db_config["searchPathPrefix"], i + 1, db_config["searchPathSuffix"])
+		for i in range(int(db_config["nSearchFiles"]))]
+
+def get_scratch_mb(db_size, nfiles):
+	"""
+	Returns the scratch space a pod needs for its copy of one search file
+	of a database and the outputs of its searches
+
+	db_size: The database size in Mb, counting both strands
+	nfiles: The number of search files of the database
+
+	return: The scratch space in Mb
+	"""
+
+	return int(math.ceil(float(db_size) / 2 / nfiles * SCRATCH_MARGIN))
+
+# -----------------------------------------------------------------------------------
+
+def strip_default_options_from_sm(sm):
+	"""
+	Removes the options rfsearch.pl sets itself from a DESC SM line, as
+	strip_default_options_from_sm() in rfsearch.pl
+
+	sm: The SM line of a DESC file
+
+	return: The remaining options
+	"""
+
+	options = sm
+	for pattern in (r'\s*-Z\s+\S+\s*', r'\s*--FZ\s+\S+\s*', r'\s*--cpu\s+\d+\s*', r'\s*--verbose\s*',
+		r'\s*--nohmmonly\s*', r'\s*--hmmonly\s*', r'\s*CM\s*', r'\s*SEQDB\s*'):
+		options = re.sub(pattern, ' ', options, count=1)
+
+	return options.replace("cmsearch", "", 1)
+
+# -----------------------------------------------------------------------------------
+
+def read_search_threshold(desc_path):
+	"""
+	Reads the bit score reporting threshold of a family from the SM line of
+	its DESC file
+
+	desc_path: Path to a DESC file
+
+	return: The threshold as rfsearch.pl formats it (-T %.2f)
+	"""
+
+	sm = None
+	fp = open(desc_path, 'r')
+	for line in fp:
+		fields = line.split(None, 1)
+		if len(fields) == 2 and fields[0] == "SM":
+			sm = fields[1].strip()
+			break
+	fp.close()
+
+	if sm is None:
+		raise ValueError("no SM line in %s" % desc_path)
+
+	options = strip_default_options_from_sm(sm)
+	t_sm = re.search(r'\s*-T\s+(\S+)\s+', options)
+	e_sm = re.search(r'\s*-E\s+(\S+)\s+', options)
+
+	if e_sm is not None:
+		raise ValueError("E-value threshold in SM, run rfsearch.pl")
+	if t_sm is None:
+		raise ValueError("no threshold in SM, run rfsearch.pl")
+
+	return "%.2f" % float(t_sm.group(1))
+
+# -----------------------------------------------------------------------------------
+
+def read_cm_header(cm_path):
+	"""
+	Reads the header of the first model of a CM file
+
+	cm_path: Path to a CM file
+
+	return: A tuple (dictionary of header tag -> value, number of models in the file)
+	"""
+
+	header = {}
+	nmodels = 0
+	in_header = True
+
+	fp = open(cm_path, 'r')
+	for line in fp:
+		if line.startswith("INFERNAL1/"):
+			nmodels += 1
+		# end of the CM header
+		elif in_header and line.startswith("CM"):
+			in_header = False
+		elif in_header and nmodels == 1:
+			fields = line.split(None, 1)
+			if len(fields) == 2:
+				header.setdefault(fields[0], fields[1].strip())
+	fp.close()
+
+	return (header, nmodels)
+
+# -----------------------------------------------------------------------------------
+
+def read_family(family_dir):
+	"""
+	Reads what a batched search needs from a family directory
+
+	family_dir: Path to a family directory with SEED, CM and DESC files
+
+	return: A dictionary with the family directory, CM path and name, W and threshold
+	"""
+
+	family_dir = os.path.abspath(family_dir)
+	cm_path = os.path.join(family_dir, "CM")
+
+	for name in ("SEED", "CM", "DESC"):
+		if not os.path.exists(os.path.join(family_dir, name)):
+			raise ValueError("no %s file" % name)
+
+	header, nmodels = read_cm_header(cm_path)
+
+	if nmodels != 1:
+		raise ValueError("CM file has %d models" % nmodels)
+	if "ECMLI" not in header:
+		raise ValueError("CM is not calibrated")
+
+	return {"dir": family_dir, "cm": cm_path, "name": header["NAME"], "width": int(header["W"]),
+		"threshold": read_search_threshold(os.path.join(family_dir, "DESC"))}
+
+# -----------------------------------------------------------------------------------
+
+def get_gb_per_thread(width):
+	"""
+	Memory to request per thread for searching a CM, as gb_per_thread_given_w()
+	in rfsearch.pl
+
+	width: The CM window length (W)
+
+	return: Gb per thread
+	"""
+
+	for max_width, gb in ((1000, 4.0), (2000, 8.0), (3000, 12.0), (4000, 16.0)):
+		if width < max_width:
+			return gb
+
+	return 20.0
+
+# -----------------------------------------------------------------------------------
+
+def plan_batches(families, max_models=DEFAULT_MAX_MODELS):
+	"""
+	Groups families in batches of CMs searched by the same pods. Batches
+	only hold CMs of the same memory class, widest first, and never two CMs
+	of the same name, whose outputs could not be told apart.
+
+	families: Families as returned by read_family
+	max_models: Maximum number of CMs per batch
+
+	return: A list of batches, each a list of families
+	"""
+
+	batches = []
+
+	for family in sorted(families, key=lambda family: (-family["width"], family["dir"])):
+		gb = get_gb_per_thread(family["width"])
+
+		for batch in batches:
+			if (len(batch) < max_models and get_gb_per_thread(batch[0]["width"]) == gb and
+				family["name"] not in [other["name"] for other in batch]):
+				batch.append(family)
+				break
+		else:
+			batches.append([family])
+
+	return batches
+
+# -----------------------------------------------------------------------------------
+
+def build_search_options(cpus, threshold, dbsize, filter_dbsize=None):
+	"""
+	Builds the cmsearch options rfsearch.pl uses for a family
+
+	cpus: Number of cmsearch threads
+	threshold: Bit score reporting threshold (%.2f)
+	dbsize: Database size in Mb (-Z)
+	filter_dbsize: Filter database size in Mb (--FZ), for reversed searches
+
+	return: The options as a string
+	"""
+
+	options = "--cpu %d --verbose --nohmmonly -T %s -Z %s" % (cpus, threshold, dbsize)
+
+	if filter_dbsize is not None:
+		options += " --FZ %s" % filter_dbsize
+
+	return options
+
+# -----------------------------------------------------------------------------------
+
+def write_seed_fasta(family):
+	"""
+	Writes the SEED sequences of a family to seed.fa in its directory, the
+	file rfsearch.pl searches for SEEDTBLOUT
+
+	family: A family as returned by read_family
+
+	return: Path to the fasta file
+	"""
+
+	seed_fasta = os.path.join(family["dir"], "seed.fa")
+
+	fp = open(seed_fasta, 'w')
+	subprocess.check_call([ESL_REFORMAT, "fasta", os.path.join(family["dir"], "SEED")], stdout=fp)
+	fp.close()
+
+	return seed_fasta
+
+# -----------------------------------------------------------------------------------
+
+def write_models(models_file, models):
+	"""
+	Writes the searches a batch pod runs on its shard, one per line:
+	<cm path>\t<cmsearch options>[\t<sequence file>]
+
+	models_file: Path to write to
+	models: List of tuples (cm path, options, sequence file or None for the shard)
+	"""
+
+	fp = open(models_file, 'w')
+	for cm, options, seqfile in models:
+		fp.write("\t".join([cm, options] + ([seqfile] if seqfile is not None else [])) + "\n")
+	fp.close()
+
+def read_models(models_file):
+	"""
+	Reads a file written by write_models
+
+	return: List of tuples (cm path, options, sequence file or None)
+	"""
+
+	models = []
+
+	fp = open(models_file, 'r')
+	for line in fp:
+		fields = line.rstrip("\n").split("\t")
+		if len(fields) >= 2:
+			models.append((fields[0], fields[1], fields[2] if len(fields) > 2 else None))
+	fp.close()
+
+	return models
+
+# -----------------------------------------------------------------------------------
+
+def build_batch_shards(batch, workdir, search_db, cpus=DEFAULT_CPUS):
+	"""
+	Builds the shards of a batch: one per database and reversed database
+	file, searched with every CM of the batch, and one searching each CM
+	against the SEED of its family. Each CM is searched with the options
+	rfsearch.pl would use for its family.
+
+	batch: A dictionary with the batch name and families
+	workdir: Directory for the models files and shard outputs
+	search_db: The database searched, as returned by read_search_db
+	cpus: Number of cmsearch threads
+
+	return: A list of shard dictionaries with the job name, search kind (s, rs, ss),
+	        command and tblout, searchout and stderr paths
+	"""
+
+	db_size = search_db["size"]
+	searches = [
+		("s", [(family["cm"], build_search_options(cpus, family["threshold"], db_size), None)
+			for family in batch["families"]], search_db["files"]),
+		("rs", [(family["cm"], build_search_options(cpus, family["threshold"], search_db["rev_size"], db_size), None)
+			for family in batch["families"]], search_db["rev_files"]),
+		("ss", [(family["cm"], build_search_options(cpus, family["threshold"], db_size), family["seed"])
+			for family in batch["families"]], [None])]
+
+	shards = []
+
+	for kind, models, seqfiles in searches:
+		if len(seqfiles) == 0:
+			continue
+
+		models_file = os.path.join(workdir, "%s.%s.models" % (batch["name"], kind))
+		write_models(models_file, models)
+
+		for seqfile in seqfiles:
+			job_name = "%s-%d" % (batch["name"], len(shards))
+			shard = {"job": job_name, "kind": kind,
+				"tblout": os.path.join(workdir, job_name + ".tbl"),
+				"searchout": os.path.join(workdir, job_name + ".cmsearch"),
+				"stderr": os.path.join(workdir, job_name + ".err")}
+
+			shard["cmd"] = "%s search --tblout %s %s%s > %s 2> %s" % (RFBATCH_CMD, shard["tblout"], models_file,
+				" " + seqfile if seqfile is not None else "", shard["searchout"], shard["stderr"])
+			shards.append(shard)
+
+	return shards
+
+# -----------------------------------------------------------------------------------
+
+def copy_seqfile(seqfile):
+	"""
+	Copies a, possibly gzipped, fasta file uncompressed to local disk, in
+	the scratch volume if the pod has one
+
+	seqfile: Path to a fasta file
+
+	return: Path to the local copy
+	"""
+
+	scratch_dir = rfkubesub.SCRATCH_DIR if os.path.isdir(rfkubesub.SCRATCH_DIR) else None
+	fd, local_seqfile = tempfile.mkstemp(prefix="rfbatch.", suffix=".fa", dir=scratch_dir)
+
+	out = os.fdopen(fd, 'w')
+	fp = rfshard.open_seqfile(seqfile)
+	shutil.copyfileobj(fp, out, 1 << 20)
+	fp.close()
+	out.close()
+
+	return local_seqfile
+
+def restore_paths(line, paths):
+	"""
+	Replaces local paths by the paths they stand for in a comment line
+
+	line: A line of cmsearch output
+	paths: List of tuples (local path, path)
+
+	return: The line
+	"""
+
+	if line.startswith('#'):
+		for local_path, path in paths:
+			line = line.replace(local_path, path)
+
+	return line
+
+def search_models(tblout, models_file, seqfile=None, out=sys.stdout):
+	"""
+	Runs the searches of a batch pod (rfbatch.py search): the sequence file
+	is read and decompressed once, to local disk, then each CM is searched
+	against the copy with its own options. The output of the runs is
+	written to out one after the other, and their tblout files to tblout
+	once all ran, both as if the shard had been searched directly.
+
+	tblout: Path of the tblout file to write
+	models_file: Searches to run, see write_models
+	seqfile: Sequence file of the shard, None if each search has its own
+	out: A file object to write the cmsearch outputs to
+
+	return: 0 on success, the exit status of the first failed cmsearch otherwise
+	"""
+
+	models = read_models(models_file)
+	local_seqfile = None
+	tblouts = []
+
+	try:
+		if seqfile is not None:
+			local_seqfile = copy_seqfile(seqfile)
+
+		for i, (cm, options, model_seqfile) in enumerate(models):
+			model_tblout = "%s.%d" % (tblout, i)
+			paths = [(model_tblout, tblout)]
+			if model_seqfile is None:
+				paths.append((local_seqfile, seqfile))
+			tblouts.append((model_tblout, paths))
+
+			cmd = [CMSEARCH, "--tblout", model_tblout] + options.split() + [cm, model_seqfile or local_seqfile]
+			process = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+			for line in process.stdout:
+				out.write(restore_paths(line, paths))
+			status = process.wait()
+
+			if status != 0:
+				return status
+
+		out.flush()
+
+		# written last, so that it is only complete once every CM was searched
+		fp = open(tblout, 'w')
+		for model_tblout, paths in tblouts:
+			model_fp = open(model_tblout, 'r')
+			for line in model_fp:
+				fp.write(restore_paths(line, paths))
+			model_fp.close()
+		fp.close()
+
+	except (IOError, OSError) as e:
+		sys.stderr.write("ERROR: Unable to search %s: %s\n" % (seqfile or models_file, e))
+		return 1
+
+	finally:
+		for path in [local_seqfile] + [model_tblout for model_tblout, paths in tblouts]:
+			if path is not None and os.path.exists(path):
+				os.remove(path)
+
+	return 0
+
+# -----------------------------------------------------------------------------------
+
+def write_merge_plan(plan, merge_plan_file):
+	"""
+	Writes the rfwait.py merge plan of all batches: the shards of each
+	search kind of a batch are merged into one file per kind, in the work
+	directory, which split_batch later splits between the families
+
+	plan: The batch plan
+	merge_plan_file: Path to write to
+	"""
+
+	fp = open(merge_plan_file, 'w')
+	for batch in plan["batches"]:
+		for shard in batch["shards"]:
+			merged_tblout, merged_searchout = get_merged_paths(plan["workdir"], batch, shard["kind"])
+			fp.write("%s %s %s %s %s %s\n" % (shard["job"], shard["tblout"], shard["searchout"], shard["stderr"],
+				merged_tblout, merged_searchout))
+	fp.close()
+
+def get_merged_paths(workdir, batch, kind):
+	"""
+	return: A tuple (merged tblout, merged searchout) of a search kind of a batch
+	"""
+
+	for search_kind, tblout_name, searchout_name in SEARCHES:
+		if search_kind == kind:
+			return (os.path.join(workdir, "%s.%s" % (batch["name"], tblout_name)),
+				os.path.join(workdir, "%s.%s" % (batch["name"], searchout_name)))
+
+	raise ValueError("unknown search kind %s" % kind)
+
+# -----------------------------------------------------------------------------------
+
+def split_runs(merged_path, query_prefix, success_string, outputs):
+	"""
+	Splits a merged tblout or cmsearch output between families. The file is
+	a series of complete cmsearch runs, each ending with success_string and
+	naming its CM in a query_prefix comment line.
+
+	merged_path: Path to the merged file
+	query_prefix: Start of the line naming the CM of a run
+	success_string: Last line of a run
+	outputs: Dictionary of CM path -> file object to write its runs to
+	"""
+
+	run = []
+	cm = None
+
+	fp = open(merged_path, 'r')
+	for line in fp:
+		run.append(line)
+		if line.startswith(query_prefix):
+			cm = line[len(query_prefix):].strip()
+
+		if line.rstrip("\n") == success_string:
+			if cm not in outputs:
+				raise ValueError("%s has a run of an unknown CM %s" % (merged_path, cm))
+			outputs[cm].writelines(run)
+			run = []
+			cm = None
+	fp.close()
+
+	if len(run) > 0:
+		raise ValueError("%s ends with an incomplete run" % merged_path)
+
+def split_batch(plan, batch):
+	"""
+	Writes the TBLOUT, searchout, REVTBLOUT, revsearchout, SEEDTBLOUT and
+	seedsearchout files of each family of a batch from its merged files
+
+	plan: The batch plan
+	batch: A batch of the plan
+	"""
+
+	kinds = set(shard["kind"] for shard in batch["shards"])
+
+	for kind, tblout_name, searchout_name in SEARCHES:
+		if kind not in kinds:
+			continue
+
+		merged_tblout, merged_searchout = get_merged_paths(plan["workdir"], batch, kind)
+
+		for merged_path, name, query_prefix, success_string in (
+			(merged_tblout, tblout_name, TBLOUT_QUERY, rfmerge.SUCCESS_STRING),
+			(merged_searchout, searchout_name, SEARCHOUT_QUERY, SEARCHOUT_SUCCESS_STRING)):
+			outputs = dict((family["cm"], open(os.path.join(family["dir"], name), 'w')) for family in batch["families"])
+			try:
+				split_runs(merged_path, query_prefix, success_string, outputs)
+			finally:
+				for fp in outputs.values():
+					fp.close()
+
+# -----------------------------------------------------------------------------------
+
+def read_families(family_dirs):
+	"""
+	Reads the families to batch, reporting those that cannot be
+
+	family_dirs: List of family directories
+
+	return: List of families as returned by read_family
+	"""
+
+	families = []
+
+	for family_dir in family_dirs:
+		try:
+			families.append(read_family(family_dir))
+		except (IOError, ValueError, KeyError) as e:
+			print ("Not batched %s: %s" % (family_dir, e))
+
+	return families
+
+def create_plan(families, workdir, run_id, search_db, cpus=DEFAULT_CPUS, max_models=DEFAULT_MAX_MODELS, search_rev=True):
+	"""
+	Batches families and writes the files their shards read
+
+	families: Families as returned by read_family
+	workdir: Work directory of the batched search
+	run_id: Identifier of the run, part of the job names
+	search_db: The database searched, as returned by read_search_db
+	cpus: Number of cmsearch threads per pod
+	max_models: Maximum number of CMs per batch
+	search_rev: Whether to search the reversed database
+
+	return: The batch plan, a dictionary with the work directory, scratch space per pod (Mb) and batches
+	"""
+
+	if not search_rev:
+		search_db = dict(search_db, rev_files=[], rev_nfiles=0)
+
+	scratch_mb = get_scratch_mb(search_db["size"], search_db["nfiles"])
+	if search_db["rev_nfiles"] > 0:
+		scratch_mb = max(scratch_mb, get_scratch_mb(search_db["rev_size"], search_db["rev_nfiles"]))
+
+	plan = {"workdir": workdir, "cpus": cpus, "scratch_mb": scratch_mb, "batches": []}
+
+	for i, batch_families in enumerate(plan_batches(families, max_models)):
+		for family in batch_families:
+			family["seed"] = write_seed_fasta(family)
+
+		batch = {"name": "b%d-%s" % (i, run_id), "families": batch_families,
+			"gb_per_thread": get_gb_per_thread(batch_families[0]["width"])}
+		batch["shards"] = build_batch_shards(batch, workdir, search_db, cpus=cpus)
+		plan["batches"].append(batch)
+
+	return plan
+
+def submit_batch(batch, workdir, cpus, scratch_mb):
+	"""
+	Submits the shards of a batch as a single Indexed job, with scratch
+	space for the uncompressed copy of each pod's shard
+
+	return: The rfkubesub.py exit status
+	"""
+
+	cmd_file = os.path.join(workdir, batch["name"] + ".cmds")
+
+	fp = open(cmd_file, 'w')
+	for shard in batch["shards"]:
+		fp.write(shard["cmd"] + "\n")
+	fp.close()
+
+	ncpu = max(1, min(cpus, MAX_CPUS))
+	memory = int(ncpu * batch["gb_per_thread"] * 1000)
+
+	return subprocess.call([RFKUBESUB_CMD, "--batch", cmd_file, str(ncpu), str(memory), batch["name"],
+		"--scratch", str(scratch_mb)])
+
+def search(family_dirs, workdir=None, cpus=DEFAULT_CPUS, max_models=DEFAULT_MAX_MODELS, search_rev=True, timeout=None,
+	db=DEFAULT_DB):
+	"""
+	Searches many families in batches and writes the search outputs of each
+	family in its directory, for rfmake.pl
+
+	return: 0 on success, the rfkubesub.py or rfwait.py exit status otherwise
+	"""
+
+	run_id = str(os.getpid())
+	workdir = os.path.abspath(workdir or "rfbatch.%s" % run_id)
+	if not os.path.exists(workdir):
+		os.makedirs(workdir)
+
+	plan = create_plan(read_families(family_dirs), workdir, run_id, read_search_db(db=db), cpus=cpus, max_models=max_models,
+		search_rev=search_rev)
+
+	fp = open(os.path.join(workdir, PLAN_FILE), 'w')
+	json.dump(plan, fp, indent=1)
+	fp.close()
+
+	merge_plan_file = os.path.join(workdir, MERGE_PLAN_FILE)
+	write_merge_plan(plan, merge_plan_file)
+
+	for batch in plan["batches"]:
+		print ("Batch %s: %d families, %d shards" % (batch["name"], len(batch["families"]), len(batch["shards"])))
+		status = submit_batch(batch, workdir, cpus, plan["scratch_mb"])
+		if status != 0:
+			print ("ERROR: Unable to submit batch %s" % batch["name"])
+			return status
+
+	sys.stdout.flush()
+
+	cmd = [RFWAIT_CMD, "--merge", merge_plan_file]
+	if timeout is not None:
+		cmd += ["--timeout", str(timeout)]
+	status = subprocess.call(cmd + [shard["job"] for batch in plan["batches"] for shard in batch["shards"]])
+
+	if status != 0:
+		print ("ERROR: Batched search did not complete, outputs are in %s" % workdir)
+		return status
+
+	for batch in plan["batches"]:
+		split_batch(plan, batch)
+
+	return 0
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Searches many Rfam families in batches of CMs sharing each read of rfamseq')
+	subparsers = parser.add_subparsers(dest="command")
+
+	run = subparsers.add_parser("run", help='search families and write their search outputs, as rfsearch.pl -nobuild')
+	run.add_argument('family_dirs', help='family directories (SEED, CM, DESC with a -T threshold in SM)', nargs='+', metavar="FAMILY_DIR")
+	run.add_argument('--workdir', help='directory for the batch files (default: rfbatch.<pid>)', action="store", type=str)
+	run.add_argument('--cpu', help='cmsearch threads per pod (default: %d)' % DEFAULT_CPUS,
+		action="store", type=int, default=DEFAULT_CPUS)
+	run.add_argument('--max-models', help='maximum number of CMs per batch (default: %d)' % DEFAULT_MAX_MODELS,
+		action="store", type=int, default=DEFAULT_MAX_MODELS)
+	run.add_argument('--norev', help='do not search the reversed database', action="store_true", default=False)
+	run.add_argument('--dbchoice', help='database of the config ($RFAM_CONFIG) to search, as rfsearch.pl (default: %s)' % DEFAULT_DB,
+		action="store", type=str, default=DEFAULT_DB)
+	run.add_argument('--timeout', help='seconds to wait for the searches', action="store", type=int)
+
+	plan = subparsers.add_parser("plan", help='print the batches families would be searched in')
+	plan.add_argument('family_dirs', help='family directories', nargs='+', metavar="FAMILY_DIR")
+	plan.add_argument('--max-models', help='maximum number of CMs per batch (default: %d)' % DEFAULT_MAX_MODELS,
+		action="store", type=int, default=DEFAULT_MAX_MODELS)
+
+	split = subparsers.add_parser("split", help='write the family outputs of a completed batched search again')
+	split.add_argument('workdir', help='work directory of the batched search')
+
+	search_cmd = subparsers.add_parser("search", help='search a shard with the CMs of a batch (run in job pods)')
+	search_cmd.add_argument('--tblout', help='tblout file to write', action="store", type=str, required=True)
+	search_cmd.add_argument('models', help='searches to run, written by rfbatch.py run')
+	search_cmd.add_argument('seqfile', help='shard sequence file', nargs='?')
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	if args.command == "run":
+		sys.exit(search(args.family_dirs, workdir=args.workdir, cpus=args.cpu, max_models=args.max_models,
+			search_rev=not args.norev, timeout=args.timeout, db=args.dbchoice))
+
+	elif args.command == "plan":
+		for i, batch in enumerate(plan_batches(read_families(args.family_dirs), args.max_models)):
+			print ("b%d\t%s" % (i, " ".join(os.path.basename(family["dir"]) for family in batch)))
+
+	elif args.command == "split":
+		fp = open(os.path.join(args.workdir, PLAN_FILE), 'r')
+		plan = json.load(fp)
+		fp.close()
+		for batch in plan["batches"]:
+			split_batch(plan, batch)
+
+	elif args.command == "search":
+		sys.exit(search_models(args.tblout, args.models, args.seqfile))
+
+	else:
+		parser.print_help()
@@ -0,0 +1,1160 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import argparse
+import datetime
+import threading
+import queue
+import contextlib
+import multiprocessing
+
+try:
+	from urllib.request import urlopen
+	from urllib.parse import urlparse, parse_qs
+	from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+	sys.exit("rfbench.py requires python 3.7 or later")
+
+import rfkubesub
+import rfkubesubd
+import rfwait
+import k8s_job_sweeper
+
+# -----------------------------------------------------------------------------------
+
+# owner of the benchmark jobs
+BENCH_USER = "bench"
+
+# lifecycle defaults of simulated pods, in seconds
+DEFAULT_SCHEDULE_DELAY = 0.5
+DEFAULT_START_DELAY = 0.5
+DEFAULT_RUNTIME = 2.0
+
+# maximum number of pods running at the same time, more stay Pending
+DEFAULT_CAPACITY = 500
+
+DEFAULT_JOBS = 1000
+
+# relative slowdown of a metric over its baseline value reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+# metrics for which higher values are better, all others are better lower
+HIGHER_IS_BETTER = ("jobs_per_sec", "shards_per_sec", "removed_per_sec")
+
+# -----------------------------------------------------------------------------------
+
+def format_timestamp(timestamp):
+	"""
+	return: A unix timestamp in the RFC 3339 format used by the k8s API
+	"""
+
+	return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# -----------------------------------------------------------------------------------
+
+def format_index_set(indexes):
+	"""
+	Formats a set of completion indexes as in the completedIndexes status
+	field of Indexed jobs (e.g. "0-3,5,7-9"). This is the reverse of
+	rfwait.parse_index_set.
+
+	indexes: A set of integers
+
+	return: The index string
+	"""
+
+	ranges = []
+
+	for index in sorted(indexes):
+		if len(ranges) > 0 and ranges[-1][1] == index - 1:
+			ranges[-1][1] = index
+		else:
+			ranges.append([index, index])
+
+	return ','.join(str(start) if start == end else "%d-%d" % (start, end) for start, end in ranges)
+
+# -----------------------------------------------------------------------------------
+
+def match_labels(labels, label_selector):
+	"""
+	Checks if labels match an equality based label selector (e.g. user=x,tier=backend)
+	or an existence selector (e.g. user)
+
+	labels: A dictionary of label name -> value
+	label_selector: A k8s label selector string, None or empty for all objects
+
+	return: Boolean
+	"""
+
+	for requirement in (label_selector or "").split(','):
+		if requirement == "":
+			continue
+
+		if '=' in requirement:
+			key, value = requirement.split('=', 1)
+			if labels.get(key) != value:
+				return False
+
+		elif requirement not in labels:
+			return False
+
+	return True
+
+# -----------------------------------------------------------------------------------
+
+class FakeCluster(object):
+	"""
+	In-memory stand-in for the Jobs and Pods of a k8s cluster. Pods of the
+	jobs created go through Pending (unscheduled, then scheduled), Running
+	and Succeeded or Failed following configurable delays, and every change
+	is recorded as a watch event. Failed pods are restarted in place until
+	the job's backoffLimit, or the backoffLimitPerIndex of their completion
+	index, is reached.
+	"""
+
+	def __init__(self, schedule_delay=DEFAULT_SCHEDULE_DELAY, start_delay=DEFAULT_START_DELAY,
+		runtime=DEFAULT_RUNTIME, failure_rate=0.0, capacity=DEFAULT_CAPACITY, seed=None):
+		self.schedule_delay = schedule_delay
+		self.start_delay = start_delay
+		self.runtime = runtime
+		self.failure_rate = failure_rate
+		self.capacity = capacity
+		self.random = random.Random(seed)
+
+		self.objects = {"jobs": {}, "pods": {}} # kind -> name -> object dictionary
+		self.events = {"jobs": [], "pods": []} # kind -> list of (resourceVersion, labels, event json)
+		self.resource_version = 0
+		self.condition = threading.Condition()
+
+		self.timers = [] # heap of (time, sequence, function, args)
+		self.sequence = 0
+		self.running = 0
+		self.unscheduled = [] # pods waiting for capacity
+		self.finished = {} # job name -> {completion index -> time the pod finished}
+
+	def record(self, kind, event_type, obj):
+		"""
+		Bumps the resourceVersion of an object and records a watch event,
+		with the condition held
+		"""
+
+		self.resource_version += 1
+		obj["metadata"]["resourceVersion"] = str(self.resource_version)
+		self.events[kind].append((self.resource_version, obj["metadata"].get("labels", {}),
+			json.dumps({"type": event_type, "object": obj})))
+		self.condition.notify_all()
+
+	def schedule(self, delay, func, *args):
+		"""
+		Calls func(*args) in delay seconds, from run()
+		"""
+
+		self.sequence += 1
+		heapq.heappush(self.timers, (time.time() + delay, self.sequence, func, args))
+
+	def delay(self, mean):
+		"""
+		return: A random delay, exponentially distributed around mean
+		"""
+
+		return self.random.expovariate(1.0 / mean) if mean > 0 else 0
+
+	def run(self):
+		"""
+		Moves pods through their lifecycle, forever
+		"""
+
+		while True:
+			with self.condition:
+				while len(self.timers) > 0 and self.timers[0][0] <= time.time():
+					timer, sequence, func, args = heapq.heappop(self.timers)
+					func(*args)
+
+			time.sleep(0.01)
+
+	# API operations, called with the condition held
+
+	def create_job(self, namespace, manifest):
+		"""
+		Creates a job and its pods
+
+		return: The job object, None if a job with the same name exists
+		"""
+
+		name = manifest["metadata"]["name"]
+
+		if name in self.objects["jobs"]:
+			return None
+
+		job = json.loads(json.dumps(manifest))
+		job["metadata"].update({"namespace": namespace, "uid": "uid-%s" % name,
+			"creationTimestamp": format_timestamp(time.time())})
+		job["status"] = {"active": 0, "succeeded": 0, "failed": 0, "startTime": format_timestamp(time.time())}
+
+		spec = job["spec"]
+		indexed = spec.get("completionMode") == "Indexed"
+		self.finished[name] = {}
+
+		self.objects["jobs"][name] = job
+		self.record("jobs", "ADDED", job)
+
+		if not spec.get("suspend"):
+			for i in range(spec.get("completions") or 1):
+				self.create_pod(job, i if indexed else None)
+
+		return job
+
+	def create_pod(self, job, completion_index, phase="Pending"):
+		"""
+		Creates a pod of a job, waiting to be scheduled if Pending
+
+		job: The job object
+		completion_index: The completion index of the pod, None if the job is not Indexed
+		phase: The pod phase, pods created in other phases than Pending are left as they are
+
+		return: The pod object
+		"""
+
+		template = job["spec"]["template"]
+		name = "%s-%s" % (job["metadata"]["name"], completion_index if completion_index is not None else 0)
+
+		labels = dict(template["metadata"].get("labels", {}))
+		labels["job-name"] = job["metadata"]["name"]
+		annotations = dict(template["metadata"].get("annotations", {}))
+
+		if completion_index is not None:
+			annotations[rfwait.COMPLETION_INDEX_ANNOTATION] = str(completion_index)
+
+		pod = {"apiVersion": "v1", "kind": "Pod",
+			"metadata": {"name": name, "namespace": job["metadata"]["namespace"], "uid": "uid-%s" % name,
+				"labels": labels, "annotations": annotations,
+				"creationTimestamp": format_timestamp(time.time()),
+				"ownerReferences": [{"apiVersion": "batch/v1", "kind": "Job", "name": job["metadata"]["name"],
+					"uid": job["metadata"]["uid"], "controller": True}]},
+			"spec": template["spec"],
+			"status": {"phase": phase}}
+
+		self.objects["pods"][name] = pod
+		self.record("pods", "ADDED", pod)
+
+		if phase == "Pending":
+			job["status"]["active"] += 1
+			self.record("jobs", "MODIFIED", job)
+
+			self.unscheduled.append((name, completion_index))
+			self.schedule_pods()
+
+		return pod
+
+	def schedule_pods(self):
+		"""
+		Binds waiting pods to nodes while there is capacity
+		"""
+
+		while len(self.unscheduled) > 0 and self.running < self.capacity:
+			name, completion_index = self.unscheduled.pop(0)
+			self.running += 1
+			self.schedule(self.delay(self.schedule_delay), self.bind_pod, name, completion_index)
+
+	def bind_pod(self, name, completion_index):
+		pod = self.objects["pods"].get(name)
+
+		if pod is None:
+			self.running -= 1
+			return
+
+		pod["spec"]["nodeName"] = "bench-node-%d" % (hash(name) % 16)
+		pod["status"]["conditions"] = [{"type": "PodScheduled", "status": "True"}]
+		self.record("pods", "MODIFIED", pod)
+
+		self.schedule(self.delay(self.start_delay), self.start_pod, name, completion_index)
+
+	def start_pod(self, name, completion_index):
+		pod = self.objects["pods"].get(name)
+
+		if pod is None:
+			self.running -= 1
+			return
+
+		restart_count = pod["status"].get("containerStatuses", [{}])[0].get("restartCount", 0)
+		pod["status"].update({"phase": "Running", "startTime": format_timestamp(time.time()),
+			"containerStatuses": [{"name": pod["spec"]["containers"][0]["name"], "image": rfkubesub.IMAGE,
+				"imageID": rfkubesub.IMAGE, "ready": True, "restartCount": restart_count,
+				"state": {"running": {"startedAt": format_timestamp(time.time())}}}]})
+		self.record("pods", "MODIFIED", pod)
+
+		self.schedule(self.delay(self.runtime), self.finish_pod, name, completion_index)
+
+	def finish_pod(self, name, completion_index):
+		pod = self.objects["pods"].get(name)
+		job = self.objects["jobs"].get(pod["metadata"]["ownerReferences"][0]["name"]) if pod is not None else None
+
+		if pod is None or job is None:
+			self.running -= 1
+			self.schedule_pods()
+			return
+
+		status = job["status"]
+
+		if self.random.random() < self.failure_rate:
+			status["failed"] += 1
+			self.record("jobs", "MODIFIED", job)
+			restart_count = pod["status"]["containerStatuses"][0]["restartCount"]
+			per_index = job["spec"].get("backoffLimitPerIndex")
+
+			if per_index is not None and completion_index is not None:
+				retry = restart_count < per_index
+			else:
+				retry = status["failed"] <= job["spec"].get("backoffLimit", 6)
+
+			if retry:
+				# restarted in place by the kubelet, or replaced by the job controller
+				pod["status"]["containerStatuses"][0]["restartCount"] += 1
+				self.record("pods", "MODIFIED", pod)
+				self.schedule(self.delay(self.start_delay), self.start_pod, name, completion_index)
+				return
+
+			pod["status"]["phase"] = "Failed"
+			self.record("pods", "MODIFIED", pod)
+			self.running -= 1
+			status["active"] -= 1
+
+			if per_index is not None and completion_index is not None:
+				failed = rfwait.parse_index_set(status.get("failedIndexes"))
+				failed.add(completion_index)
+				status["failedIndexes"] = format_index_set(failed)
+				self.finish_indexes(job)
+			else:
+				self.finish_job(job, "Failed", "BackoffLimitExceeded")
+
+			self.schedule_pods()
+			return
+
+		pod["status"]["phase"] = "Succeeded"
+		pod["status"]["containerStatuses"][0]["state"] = {"terminated": {"exitCode": 0,
+			"finishedAt": format_timestamp(time.time())}}
+		self.record("pods", "MODIFIED", pod)
+		self.running -= 1
+
+		self.finished[job["metadata"]["name"]][completion_index] = time.time()
+		status["active"] -= 1
+		status["succeeded"] += 1
+
+		if completion_index is not None:
+			completed = rfwait.parse_index_set(status.get("completedIndexes"))
+			completed.add(completion_index)
+			status["completedIndexes"] = format_index_set(completed)
+
+		self.finish_indexes(job)
+		self.schedule_pods()
+
+	def finish_indexes(self, job):
+		"""
+		Finishes a job once all of its completion indexes succeeded or
+		failed, as Failed if any did
+		"""
+
+		status = job["status"]
+		nfailed = len(rfwait.parse_index_set(status.get("failedIndexes")))
+
+		if status["succeeded"] + nfailed < (job["spec"].get("completions") or 1):
+			self.record("jobs", "MODIFIED", job)
+		elif nfailed > 0:
+			self.finish_job(job, "Failed", "FailedIndexes")
+		else:
+			self.finish_job(job, "Complete", None)
+
+	def finish_job(self, job, condition_type, reason):
+		"""
+		Sets the Complete or Failed condition of a job and schedules its
+		deletion if it has a ttlSecondsAfterFinished
+		"""
+
+		if any(c["status"] == "True" for c in job["status"].get("conditions", [])):
+			return
+
+		job["status"]["conditions"] = [{"type": condition_type, "status": "True", "reason": reason,
+			"lastTransitionTime": format_timestamp(time.time())}]
+		job["status"]["active"] = 0
+
+		if condition_type == "Complete":
+			job["status"]["completionTime"] = format_timestamp(time.time())
+
+		self.record("jobs", "MODIFIED", job)
+
+		ttl = job["spec"].get("ttlSecondsAfterFinished")
+
+		if ttl is not None:
+			self.schedule(ttl, self.delete, "jobs", job["metadata"]["name"])
+
+	def delete(self, kind, name):
+		"""
+		Deletes an object. Pods of deleted jobs are deleted with them, as the
+		garbage collector does with background propagation.
+
+		return: True if the object existed, False otherwise
+		"""
+
+		obj = self.objects[kind].pop(name, None)
+
+		if obj is None:
+			return False
+
+		self.record(kind, "DELETED", obj)
+
+		if kind == "jobs":
+			for pod_name, pod in list(self.objects["pods"].items()):
+				if pod["metadata"]["ownerReferences"][0]["name"] == name:
+					self.delete("pods", pod_name)
+
+			self.unscheduled = [(n, i) for n, i in self.unscheduled if n in self.objects["pods"]]
+
+		return True
+
+	def populate_finished(self, njobs, failure_rate, orphans):
+		"""
+		Adds finished jobs, each with a finished pod, and finished pods
+		without a job, for the sweeper to delete. Failed jobs have been
+		failed long enough to be past any grace period.
+
+		njobs: Number of finished jobs
+		failure_rate: Fraction of the jobs that failed
+		orphans: Number of finished pods without a job
+		"""
+
+		long_ago = time.time() - 86400 * 7
+
+		for i in range(njobs):
+			failed = self.random.random() < failure_rate
+			manifest = rfkubesub.build_job_manifest(BENCH_USER, "sweep-%d" % i, "true", 1, 1000)
+			del manifest["spec"]["ttlSecondsAfterFinished"]
+			manifest["spec"]["suspend"] = True
+			job = self.create_job(rfkubesub.NAMESPACE, manifest)
+
+			self.create_pod(job, None, phase="Failed" if failed else "Succeeded")
+			self.finish_job(job, "Failed" if failed else "Complete", None)
+			job["status"]["conditions"][0]["lastTransitionTime"] = format_timestamp(long_ago)
+
+		for i in range(orphans):
+			name = "rfsearch-job-%s-orphan-%d-0" % (BENCH_USER, i)
+			pod = {"apiVersion": "v1", "kind": "Pod",
+				"metadata": {"name": name, "namespace": rfkubesub.NAMESPACE, "uid": "uid-%s" % name,
+					"labels": {"user": BENCH_USER, "tier": "backend"},
+					"creationTimestamp": format_timestamp(long_ago),
+					"ownerReferences": [{"apiVersion": "batch/v1", "kind": "Job", "name": "gone-%d" % i,
+						"uid": "uid-gone-%d" % i, "controller": True}]},
+				"spec": {"containers": [{"name": "rfsearch"}]},
+				"status": {"phase": "Succeeded"}}
+			self.objects["pods"][name] = pod
+			self.record("pods", "ADDED", pod)
+
+# -----------------------------------------------------------------------------------
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+	"""
+	Serves the subset of the k8s REST API used by rfkubesub, rfwait and
+	k8s_job_sweeper.py (create, list, watch and delete of Jobs and Pods)
+	from a FakeCluster, plus /bench/ endpoints to control the benchmark.
+	Requests are counted by verb and resource.
+	"""
+
+	# keep connections alive, as the real API server does
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, code, data):
+		body = json.dumps(data).encode("utf-8")
+		self.send_response(code)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		self.server.count("bytes", len(body))
+
+	def send_status(self, code, reason, message):
+		self.send_json(code, {"kind": "Status", "apiVersion": "v1", "status": "Failure", "code": code,
+			"reason": reason, "message": message})
+
+	def parse_path(self):
+		"""
+		return: A tuple (kind, namespace, name, query), kind is None for unknown paths
+		"""
+
+		url = urlparse(self.path)
+		query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+		parts = url.path.strip('/').split('/')
+
+		# /api/v1/namespaces/NS/pods[/NAME], /apis/batch/v1/namespaces/NS/jobs[/NAME]
+		if parts[:2] == ["api", "v1"]:
+			parts = parts[2:]
+		elif parts[:3] == ["apis", "batch", "v1"]:
+			parts = parts[3:]
+		else:
+			return (None, None, None, query)
+
+		if len(parts) < 3 or parts[0] != "namespaces" or parts[2] not in ("jobs", "pods"):
+			return (None, None, None, query)
+
+		return (parts[2], parts[1], parts[3] if len(parts) > 3 else None, query)
+
+	def read_body(self):
+		"""
+		return: The request body as a string
+		"""
+
+		return self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+
+	def api_latency(self):
+		if self.server.latency > 0:
+			time.sleep(self.server.latency)
+
+	def do_GET(self):
+		if self.path == "/bench/stats":
+			return self.send_json(200, self.server.get_stats())
+
+		kind, namespace, name, query = self.parse_path()
+
+		if kind is None:
+			return self.send_status(404, "NotFound", self.path)
+
+		self.api_latency()
+		cluster = self.server.cluster
+
+		if query.get("watch") in ("true", "1"):
+			self.server.count("watch %s" % kind)
+			return self.watch(kind, query)
+
+		self.server.count("list %s" % kind)
+
+		with cluster.condition:
+			items = [obj for obj in cluster.objects[kind].values()
+				if match_labels(obj["metadata"].get("labels", {}), query.get("labelSelector"))]
+			listing = {"apiVersion": "v1", "kind": "List", "items": items,
+				"metadata": {"resourceVersion": str(cluster.resource_version)}}
+			# serialize with the condition held, objects change under us otherwise
+			body = json.dumps(listing).encode("utf-8")
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		self.server.count("bytes", len(body))
+
+	def watch(self, kind, query):
+		"""
+		Streams the watch events of a kind after resourceVersion, one JSON
+		object per line, until timeoutSeconds
+		"""
+
+		cluster = self.server.cluster
+		label_selector = query.get("labelSelector")
+		deadline = time.time() + int(query.get("timeoutSeconds", 300))
+		resource_version = int(query.get("resourceVersion") or 0)
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+
+		position = 0
+
+		try:
+			while time.time() < deadline:
+				with cluster.condition:
+					events = cluster.events[kind]
+
+					# skip the events the client has already seen
+					while position < len(events) and events[position][0] <= resource_version:
+						position += 1
+
+					if position == len(events):
+						cluster.condition.wait(min(1, deadline - time.time()))
+						continue
+
+					new_events = events[position:]
+					position = len(events)
+
+				lines = []
+
+				for event_resource_version, labels, event_json in new_events:
+					resource_version = event_resource_version
+					if match_labels(labels, label_selector):
+						lines.append(event_json)
+
+				if len(lines) > 0:
+					data = ('\n'.join(lines) + '\n').encode("utf-8")
+					self.wfile.write(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+					self.wfile.flush()
+					self.server.count("bytes", len(data))
+					self.server.count("events streamed", len(lines))
+
+			self.wfile.write(b"0\r\n\r\n")
+
+		except (BrokenPipeError, ConnectionResetError):
+			self.close_connection = True
+
+	def do_POST(self):
+		kind, namespace, name, query = self.parse_path()
+
+		if kind != "jobs" or name is not None:
+			return self.send_status(405, "MethodNotAllowed", self.path)
+
+		manifest = json.loads(self.read_body())
+
+		self.api_latency()
+		self.server.count("create jobs")
+
+		if self.server.random.random() < self.server.throttle_rate:
+			self.server.count("throttled")
+			return self.send_status(429, "TooManyRequests", "throttled by rfbench")
+
+		with self.server.cluster.condition:
+			job = self.server.cluster.create_job(namespace, manifest)
+			body = json.dumps(job) if job is not None else None
+
+		if body is None:
+			return self.send_status(409, "AlreadyExists", "job %s already exists" % manifest["metadata"]["name"])
+
+		self.send_response(201)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body.encode("utf-8"))
+
+	def do_DELETE(self):
+		kind, namespace, name, query = self.parse_path()
+		self.read_body()
+
+		if kind is None or name is None:
+			return self.send_status(405, "MethodNotAllowed", self.path)
+
+		self.api_latency()
+		self.server.count("delete %s" % kind)
+
+		with self.server.cluster.condition:
+			obj = self.server.cluster.objects[kind].get(name)
+			self.server.cluster.delete(kind, name)
+
+		if obj is None:
+			return self.send_status(404, "NotFound", "%s %s not found" % (kind, name))
+
+		# the deleted object is returned, as for objects deleted straight away
+		self.send_json(200, obj)
+
+# -----------------------------------------------------------------------------------
+
+class FakeApiServer(ThreadingHTTPServer):
+
+	daemon_threads = True
+	request_queue_size = 1024
+
+	def __init__(self, port, cluster, latency=0.0, throttle_rate=0.0):
+		self.cluster = cluster
+		self.latency = latency
+		self.throttle_rate = throttle_rate
+		self.random = random.Random(0)
+		self.counts = {}
+		self.counts_lock = threading.Lock()
+		ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), FakeApiHandler)
+
+	def count(self, key, n=1):
+		with self.counts_lock:
+			self.counts[key] = self.counts.get(key, 0) + n
+
+	def get_stats(self):
+		"""
+		return: The request counts, the number of objects left and the time
+		each pod finished, keyed by job name and completion index
+		"""
+
+		with self.counts_lock:
+			counts = dict(self.counts)
+
+		with self.cluster.condition:
+			return {"counts": counts,
+				"objects": dict((kind, len(objects)) for kind, objects in self.cluster.objects.items()),
+				"finished": dict((name, dict((str(i), t) for i, t in indexes.items()))
+					for name, indexes in self.cluster.finished.items())}
+
+# -----------------------------------------------------------------------------------
+
+# fake API server processes started
+servers = []
+
+def serve_fake_api(port, cluster_options, latency, throttle_rate, populate=None, ready=None):
+	"""
+	Runs a fake API server until killed
+
+	port: The port to listen on, on localhost
+	cluster_options: A dictionary of FakeCluster keyword arguments
+	latency: Number of seconds added to each request
+	throttle_rate: Fraction of job creations answered with 429
+	populate: Arguments of FakeCluster.populate_finished, None to start empty
+	ready: A multiprocessing Event set once the server is listening
+	"""
+
+	cluster = FakeCluster(**cluster_options)
+
+	if populate is not None:
+		with cluster.condition:
+			cluster.populate_finished(*populate)
+
+	server = FakeApiServer(port, cluster, latency=latency, throttle_rate=throttle_rate)
+
+	thread = threading.Thread(target=cluster.run)
+	thread.daemon = True
+	thread.start()
+
+	if ready is not None:
+		ready.set()
+
+	server.serve_forever()
+
+# -----------------------------------------------------------------------------------
+
+def start_fake_api(args, populate=None):
+	"""
+	Starts a fake API server in a separate process, so that it doesn't
+	compete for the GIL with the code being measured, and points the
+	kubernetes client at it. Servers are left running until we exit, as
+	the watch threads of the tools measured can't be stopped, and each
+	listens on a new port.
+
+	args: The parsed command line arguments
+	populate: Arguments of FakeCluster.populate_finished, None to start empty
+
+	return: The base URL of the server
+	"""
+
+	from kubernetes import client, config
+
+	cluster_options = {"schedule_delay": args.schedule_delay, "start_delay": args.start_delay,
+		"runtime": args.runtime, "failure_rate": args.failure_rate, "capacity": args.capacity, "seed": args.seed}
+
+	port = args.port + len(servers)
+	ready = multiprocessing.Event()
+	process = multiprocessing.Process(target=serve_fake_api, args=(port, cluster_options, args.api_latency,
+		args.throttle_rate, populate, ready))
+	process.daemon = True
+	process.start()
+	servers.append(process)
+
+	if not ready.wait(60):
+		process.terminate()
+		sys.exit("ERROR: The fake API server did not start")
+
+	url = "http://127.0.0.1:%d" % port
+
+	configuration = client.Configuration()
+	configuration.host = url
+	configuration.connection_pool_maxsize = 64
+	client.Configuration.set_default(configuration)
+
+	# the tools load their configuration on each call, keep ours instead
+	config.load_incluster_config = lambda *a, **kw: None
+	config.load_kube_config = lambda *a, **kw: None
+
+	return url
+
+# -----------------------------------------------------------------------------------
+
+def get_stats(url):
+	"""
+	return: The statistics of a fake API server, see FakeApiServer.get_stats
+	"""
+
+	return json.loads(urlopen(url + "/bench/stats").read().decode("utf-8"))
+
+# -----------------------------------------------------------------------------------
+
+def count_requests(before, after, prefix):
+	"""
+	return: The number of requests whose key starts with prefix between two get_stats() results
+	"""
+
+	return sum(n - before["counts"].get(key, 0) for key, n in after["counts"].items()
+		if key.startswith(prefix))
+
+# -----------------------------------------------------------------------------------
+
+def build_manifests(njobs, shards, prefix="s-bench"):
+	"""
+	Builds rfsearch job manifests as rfkubesub does
+
+	njobs: Number of jobs
+	shards: Number of shards per job, each job is Indexed if more than 1
+	prefix: The rfsearch job name prefix
+
+	return: A list of (rfsearch job names, manifest) tuples
+	"""
+
+	manifests = []
+
+	for i in range(njobs):
+		job_index = "%s-%d" % (prefix, i)
+
+		if shards > 1:
+			cmd = rfkubesub.build_indexed_command(["true"] * shards)
+			names = ["%s-%d" % (job_index, shard) for shard in range(shards)]
+			manifest = rfkubesub.build_job_manifest(BENCH_USER, job_index, cmd, 1, 1000, completions=shards)
+		else:
+			names = [job_index]
+			manifest = rfkubesub.build_job_manifest(BENCH_USER, job_index, "true", 1, 1000)
+
+		manifests.append((names, manifest))
+
+	return manifests
+
+# -----------------------------------------------------------------------------------
+
+def submit_manifests(manifests, mode, concurrency, qps):
+	"""
+	Submits job manifests either one at a time through rfkubesub.submit_job,
+	as separate rfkubesub.py processes do, or concurrently through a single
+	rfkubesubd.JobSubmitter, as the submission daemon does
+
+	manifests: A list of (rfsearch job names, manifest) tuples
+	mode: direct or daemon
+	concurrency: Number of concurrent submissions in daemon mode
+	qps: Rate limit of the daemon mode submitter
+
+	return: The number of seconds taken
+	"""
+
+	start = time.time()
+
+	if mode == "direct":
+		for names, manifest in manifests:
+			rfkubesub.submit_job(manifest)
+
+	else:
+		from concurrent.futures import ThreadPoolExecutor
+
+		submitter = rfkubesubd.JobSubmitter(qps=qps, burst=concurrency)
+
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			list(executor.map(lambda item: submitter.submit(item[1]), manifests))
+
+	return time.time() - start
+
+# -----------------------------------------------------------------------------------
+
+def bench_submit(args):
+	"""
+	Measures job submission throughput and API calls per job
+
+	return: A dictionary of metric -> value
+	"""
+
+	manifests = build_manifests(args.jobs, args.shards)
+
+	url = start_fake_api(args)
+
+	before = get_stats(url)
+	elapsed = submit_manifests(manifests, args.mode, args.concurrency, args.qps)
+	after = get_stats(url)
+
+	njobs = len(manifests)
+
+	return {"jobs": njobs,
+		"seconds": elapsed,
+		"jobs_per_sec": njobs / elapsed,
+		"shards_per_sec": njobs * args.shards / elapsed,
+		"api_calls_per_job": count_requests(before, after, "create") / float(njobs),
+		"throttled": count_requests(before, after, "throttled")}
+
+# -----------------------------------------------------------------------------------
+
+class TimedJobTracker(rfwait.JobTracker):
+	"""
+	JobTracker recording when each job first reached a terminal phase
+	"""
+
+	def __init__(self, user, job_names):
+		rfwait.JobTracker.__init__(self, user, job_names)
+		self.detected = {}
+
+	def set_phase(self, job_name, phase, reason=None):
+		rfwait.JobTracker.set_phase(self, job_name, phase, reason)
+
+		if phase in rfwait.TERMINAL_PHASES and job_name in self.phases and job_name not in self.detected:
+			self.detected[job_name] = time.time()
+
+# -----------------------------------------------------------------------------------
+
+def percentile(values, fraction):
+	"""
+	return: The value at fraction (0-1) of a list of values, 0 if it is empty
+	"""
+
+	if len(values) == 0:
+		return 0
+
+	values = sorted(values)
+
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# -----------------------------------------------------------------------------------
+
+def bench_wait(args):
+	"""
+	Submits jobs, then waits for them the way the CLOUD branch of
+	wait_for_cluster_light does through rfwait.py, and measures how long
+	after each pod finished the tracker saw its job succeed
+
+	return: A dictionary of metric -> value
+	"""
+
+	manifests = build_manifests(args.jobs, args.shards)
+	job_names = [name for names, manifest in manifests for name in names]
+
+	url = start_fake_api(args)
+	elapsed = submit_manifests(manifests, args.mode, args.concurrency, args.qps)
+
+	# rfsearch starts waiting once all its jobs are submitted
+	before = get_stats(url)
+	start = time.time()
+
+	tracker = TimedJobTracker(BENCH_USER, job_names)
+	events = queue.Queue()
+	rfwait.start_watches(BENCH_USER, events)
+
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		status = rfwait.wait_for_jobs(tracker, events, timeout=args.timeout, progress_interval=30)
+
+	wait_seconds = time.time() - start
+	after = get_stats(url)
+
+	latencies = []
+
+	for names, manifest in manifests:
+		finished = after["finished"].get(manifest["metadata"]["name"], {})
+		indexed = manifest["spec"].get("completionMode") == "Indexed"
+
+		for i, name in enumerate(names):
+			finish_time = finished.get(str(i) if indexed else "None")
+
+			if finish_time is not None and name in tracker.detected:
+				latencies.append(max(0, tracker.detected[name] - finish_time))
+
+	return {"jobs": len(job_names),
+		"status": {rfwait.SUCCESS: "success", rfwait.JOB_FAILED: "job failed", rfwait.TIMEOUT: "timeout",
+			rfwait.WATCH_FAILED: "watch failed"}[status],
+		"submit_seconds": elapsed,
+		"wait_seconds": wait_seconds,
+		"detect_latency_p50": percentile(latencies, 0.5),
+		"detect_latency_p99": percentile(latencies, 0.99),
+		"detect_latency_max": percentile(latencies, 1),
+		"watch_events_per_job": count_requests(before, after, "events streamed") / float(len(job_names)),
+		"api_calls_per_job": (count_requests(before, after, "list") + count_requests(before, after, "watch ")) /
+			float(len(job_names)),
+		"mb_received": count_requests(before, after, "bytes") / 1048576.0}
+
+# -----------------------------------------------------------------------------------
+
+def bench_sweep(args):
+	"""
+	Measures how long k8s_job_sweeper.py takes to delete finished jobs and
+	orphaned pods, once (cron) and watching, and how many API calls it makes
+
+	return: A dictionary of metric -> value
+	"""
+
+	results = {}
+	orphans = args.jobs // 10
+	populate = (args.jobs, args.failure_rate, orphans)
+	nobjects = args.jobs + orphans
+
+	url = start_fake_api(args, populate=populate)
+	batch_api, core_api = k8s_job_sweeper.load_k8s_apis()
+	sweeper = k8s_job_sweeper.JobSweeper(batch_api, core_api, rfkubesub.NAMESPACE, failed_grace=0)
+
+	before = get_stats(url)
+	start = time.time()
+
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		k8s_job_sweeper.sweep_once(sweeper)
+
+	elapsed = time.time() - start
+	after = get_stats(url)
+
+	results.update({"objects": nobjects,
+		"once_seconds": elapsed,
+		"removed_per_sec": sum(sweeper.removed.values()) / elapsed,
+		"once_api_calls": count_requests(before, after, "list") + count_requests(before, after, "delete"),
+		"once_left": after["objects"]["jobs"] + after["objects"]["pods"]})
+
+	# the watching sweeper never returns, run it in the background until the cluster is empty
+	url = start_fake_api(args, populate=populate)
+	batch_api, core_api = k8s_job_sweeper.load_k8s_apis()
+	sweeper = k8s_job_sweeper.JobSweeper(batch_api, core_api, rfkubesub.NAMESPACE, failed_grace=0)
+
+	before = get_stats(url)
+	start = time.time()
+
+	thread = threading.Thread(target=k8s_job_sweeper.sweep_forever, args=(sweeper,),
+		kwargs={"flush_interval": 1, "report_interval": 10 ** 9})
+	thread.daemon = True
+	thread.start()
+
+	while True:
+		after = get_stats(url)
+		if after["objects"]["jobs"] + after["objects"]["pods"] == 0 or time.time() - start > args.timeout:
+			break
+		time.sleep(0.1)
+
+	results.update({"watch_seconds": time.time() - start,
+		"watch_api_calls": count_requests(before, after, "list") + count_requests(before, after, "watch ") +
+			count_requests(before, after, "delete"),
+		"watch_left": after["objects"]["jobs"] + after["objects"]["pods"]})
+
+	return results
+
+# -----------------------------------------------------------------------------------
+
+def compare_to_baseline(results, baseline, tolerance):
+	"""
+	Compares benchmark results to those of a previous run
+
+	results: A dictionary of benchmark -> metric -> value
+	baseline: Same as results, from a previous run
+	tolerance: Relative slowdown reported as a regression (e.g. 0.2 for 20%)
+
+	return: A list of regression messages
+	"""
+
+	regressions = []
+
+	for benchmark, metrics in results.items():
+		for metric, value in metrics.items():
+			base = baseline.get(benchmark, {}).get(metric)
+
+			if not isinstance(value, (int, float)) or not isinstance(base, (int, float)) or base == 0:
+				continue
+
+			if metric in HIGHER_IS_BETTER:
+				change = (base - value) / float(base)
+			else:
+				change = (value - base) / float(base)
+
+			if change > tolerance:
+				regressions.append("%s %s: %.3f, baseline %.3f (%.0f%% worse)" % (benchmark, metric, value, base,
+					change * 100))
+
+	return regressions
+
+# -----------------------------------------------------------------------------------
+
+def print_results(results):
+	"""
+	Prints benchmark results as a table
+	"""
+
+	for benchmark, metrics in results.items():
+		print ("%s:" % benchmark)
+
+		for metric, value in metrics.items():
+			if isinstance(value, float):
+				print ("  %-24s %12.3f" % (metric, value))
+			else:
+				print ("  %-24s %12s" % (metric, value))
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Benchmarks rfkubesub, rfwait and k8s_job_sweeper.py against a fake k8s API server')
+
+	parser.add_argument('benchmarks', help='benchmarks to run: submit, wait, sweep (default: all)', nargs='*',
+		default=["submit", "wait", "sweep"])
+	parser.add_argument('--jobs', help='number of jobs (default: %d)' % DEFAULT_JOBS, action="store",
+		type=int, default=DEFAULT_JOBS)
+	parser.add_argument('--shards', help='number of shards per Indexed job, 1 for single pod jobs (default: 1)',
+		action="store", type=int, default=1)
+	parser.add_argument('--mode', help='submit jobs one at a time (direct) or through a shared submitter (daemon)',
+		action="store", choices=["direct", "daemon"], default="direct")
+	parser.add_argument('--concurrency', help='number of concurrent submissions in daemon mode (default: 40)',
+		action="store", type=int, default=40)
+	parser.add_argument('--qps', help='submission rate limit in daemon mode (default: unlimited)',
+		action="store", type=float, default=10 ** 6)
+	parser.add_argument('--schedule-delay', help='mean seconds before a pod is scheduled (default: %s)' % DEFAULT_SCHEDULE_DELAY,
+		action="store", type=float, default=DEFAULT_SCHEDULE_DELAY)
+	parser.add_argument('--start-delay', help='mean seconds from scheduling to running (default: %s)' % DEFAULT_START_DELAY,
+		action="store", type=float, default=DEFAULT_START_DELAY)
+	parser.add_argument('--runtime', help='mean seconds a pod runs for (default: %s)' % DEFAULT_RUNTIME,
+		action="store", type=float, default=DEFAULT_RUNTIME)
+	parser.add_argument('--failure-rate', help='probability of a pod run failing (default: 0)',
+		action="store", type=float, default=0.0)
+	parser.add_argument('--capacity', help='maximum number of pods running at once (default: %d)' % DEFAULT_CAPACITY,
+		action="store", type=int, default=DEFAULT_CAPACITY)
+	parser.add_argument('--api-latency', help='seconds added to each API request (default: 0)',
+		action="store", type=float, default=0.0)
+	parser.add_argument('--throttle-rate', help='fraction of job creations answered with 429 (default: 0)',
+		action="store", type=float, default=0.0)
+	parser.add_argument('--timeout', help='maximum seconds to wait for jobs or the sweeper (default: 600)',
+		action="store", type=int, default=600)
+	parser.add_argument('--seed', help='random seed of the simulated cluster', action="store", type=int, default=None)
+	parser.add_argument('--port', help='port of the fake API server (default: 18080)', action="store",
+		type=int, default=18080)
+	parser.add_argument('--json', help='write the results to a JSON file', action="store", type=str,
+		default=None, metavar="FILE")
+	parser.add_argument('--baseline', help='compare to the results of a previous run and exit with status 1 on regressions',
+		action="store", type=str, default=None, metavar="FILE")
+	parser.add_argument('--tolerance', help='relative slowdown reported as a regression (default: %s)' % DEFAULT_TOLERANCE,
+		action="store", type=float, default=DEFAULT_TOLERANCE)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	benchmarks = {"submit": bench_submit, "wait": bench_wait, "sweep": bench_sweep}
+	results = {}
+
+	for name in args.benchmarks:
+		if name not in benchmarks:
+			parser.error("unknown benchmark %s" % name)
+
+	for name in args.benchmarks:
+		results[name] = benchmarks[name](args)
+
+	print_results(results)
+
+	if args.json is not None:
+		with open(args.json, 'w') as fp:
+			json.dump(results, fp, indent=2, sort_keys=True)
+
+	status = 0
+
+	if args.baseline is not None:
+		with open(args.baseline) as fp:
+			regressions = compare_to_baseline(results, json.load(fp), args.tolerance)
+
+		for regression in regressions:
+			print ("REGRESSION %s" % regression)
+
+		if len(regressions) > 0:
+			status = 1
+
+	# exit without waiting for the watch threads of the tools, whose servers are going away
+	sys.stdout.flush()
+	for process in servers:
+		process.terminate()
+	os._exit(status)
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+# -----------------------------------------------------------------------------------
+
+NAMESPACE = "default"
+
+RFCACHE_CMD = "/Rfam/software/bin/rfcache.py"
+
+# read-only NFS mount of the search database in all rfam pods
+NFS_DIR = "/Rfam/rfamseq"
+
+# node-local cache directory, a hostPath mounted at the same location in the
+# cache agent and the job pods
+CACHE_DIR = "/var/cache/rfamseq"
+
+# ConfigMap holding the manifest of files to cache, written by rfcache.py prewarm
+CONFIG_MAP = "rfamseq-cache"
+
+# nodes get one label per cached file: rfamseq-cache.rfam.org/<file name>=<checksum prefix>
+LABEL_PREFIX = "rfamseq-cache.rfam.org/"
+RELEASE_ANNOTATION = "rfamseq-cache.rfam.org/release"
+
+# marks a cached file as verified, holds its sha256 checksum
+VERIFIED_SUFFIX = ".sha256"
+
+DEFAULT_SYNC_INTERVAL = 300
+
+# fraction of the cache file system to leave free
+DEFAULT_RESERVE = 0.1
+
+# search files referenced in shell commands
+NFS_PATH_RE = re.compile(r'%s/([A-Za-z0-9][-A-Za-z0-9_.]*[A-Za-z0-9])' % re.escape(NFS_DIR))
+
+# -----------------------------------------------------------------------------------
+
+def sha256sum(path, copy_to=None):
+	"""
+	Computes the sha256 checksum of a file, optionally copying it at the same time
+
+	path: Path to the file
+	copy_to: Path to copy the file to, None to only read it
+
+	return: The hex digest as a string
+	"""
+
+	checksum = hashlib.sha256()
+	fp = open(path, 'rb')
+	out = open(copy_to, 'wb') if copy_to is not None else None
+
+	while True:
+		chunk = fp.read(4 * 1024 * 1024)
+		if not chunk:
+			break
+		checksum.update(chunk)
+		if out is not None:
+			out.write(chunk)
+
+	fp.close()
+	if out is not None:
+		out.close()
+
+	return checksum.hexdigest()
+
+# -----------------------------------------------------------------------------------
+
+def get_label(filename):
+	"""
+	return: The node label key advertising that filename is cached
+	"""
+
+	return LABEL_PREFIX + filename
+
+# -----------------------------------------------------------------------------------
+
+def get_cached_path(nfs_path, cache_dir=CACHE_DIR):
+	"""
+	Returns the node-local copy of a search file if it has been cached and
+	verified on this node, the NFS path otherwise
+
+	nfs_path: Path to a search file on the NFS volume
+	cache_dir: The node-local cache directory
+
+	return: A path as a string
+	"""
+
+	cached_path = os.path.join(cache_dir, os.path.basename(nfs_path))
+
+	if os.path.exists(cached_path) and os.path.exists(cached_path + VERIFIED_SUFFIX):
+		return cached_path
+
+	return nfs_path
+
+# -----------------------------------------------------------------------------------
+
+def cache_command(cmd):
+	"""
+	Rewrites the search files of a shell command so that the job pod reads
+	its node-local copy when there is one
+
+	cmd: A shell command
+
+	return: The shell command to run
+	"""
+
+	return NFS_PATH_RE.sub(lambda m: '"$(%s path %s)"' % (RFCACHE_CMD, m.group(0)), cmd)
+
+# -----------------------------------------------------------------------------------
+
+def node_affinity(commands):
+	"""
+	Builds a preferred node affinity for a job running commands, so that its
+	pods land on nodes caching the search files they read. All pods of an
+	Indexed job share the same affinity, so there is no per-shard locality:
+	each pod of a batch prefers the nodes caching more of the batch's files,
+	whichever file its own shard reads, and with a hundred files or more all
+	terms weigh the same. Only jobs reading one or a few files (single
+	searches, or batches of shards of the same file) are placed by the
+	file they read; the other pods read the NFS copy of uncached files.
+
+	commands: A list of shell commands
+
+	return: A k8s affinity as a dictionary, None if the commands don't read search files
+	"""
+
+	filenames = []
+	for cmd in commands:
+		for filename in NFS_PATH_RE.findall(cmd):
+			if filename not in filenames:
+				filenames.append(filename)
+
+	if len(filenames) == 0:
+		return None
+
+	# the scheduler adds up the weights of all matching terms
+	weight = max(1, 100 // len(filenames))
+
+	terms = [{"weight": weight,
+		"preference": {"matchExpressions": [{"key": get_label(filename), "operator": "Exists"}]}}
+		for filename in filenames]
+
+	return {"nodeAffinity": {"preferredDuringSchedulingIgnoredDuringExecution": terms}}
+
+# -----------------------------------------------------------------------------------
+
+def load_k8s_api():
+	"""
+	Loads the k8s configuration, from the kubeconfig if available, otherwise
+	from the in-cluster service account
+
+	return: A CoreV1Api object
+	"""
+
+	from kubernetes import client, config
+
+	try:
+		config.load_kube_config()
+	except Exception:
+		config.load_incluster_config()
+
+	return client.CoreV1Api()
+
+# -----------------------------------------------------------------------------------
+
+def read_manifest(core_api, namespace=NAMESPACE):
+	"""
+	Reads the cache manifest from the rfamseq-cache ConfigMap
+
+	core_api: A CoreV1Api object
+	namespace: The k8s namespace of the ConfigMap
+
+	return: A tuple (release, dictionary of file name -> {sha256, size}), (None, {}) if there is no manifest
+	"""
+
+	from kubernetes.client.rest import ApiException
+
+	try:
+		config_map = core_api.read_namespaced_config_map(CONFIG_MAP, namespace)
+	except ApiException as e:
+		if e.status == 404:
+			return (None, {})
+		raise
+
+	data = config_map.data or {}
+
+	return (data.get("release"), json.loads(data.get("manifest", "{}")))
+
+# -----------------------------------------------------------------------------------
+
+def select_files(manifest, node_name, capacity):
+	"""
+	Selects the files of the manifest this node caches. Files are ranked
+	per node by rendezvous hashing so that nodes without room for the whole
+	database hold different subsets of it.
+
+	manifest: A dictionary of file name -> {sha256, size}
+	node_name: The name of this node
+	capacity: Number of bytes available for the cache
+
+	return: A list of file names
+	"""
+
+	ranked = sorted(manifest, key=lambda filename:
+		hashlib.sha256(("%s/%s" % (node_name, filename)).encode("utf-8")).hexdigest())
+
+	selected = []
+	used = 0
+	for filename in ranked:
+		if used + manifest[filename]["size"] <= capacity:
+			selected.append(filename)
+			used += manifest[filename]["size"]
+
+	return selected
+
+# -----------------------------------------------------------------------------------
+
+class CacheAgent(object):
+	"""
+	Keeps a node's cache directory in sync with the manifest: stages files
+	from NFS onto local disk, verifies them by checksum, removes files that
+	are no longer in the manifest and advertises the cached files as node
+	labels.
+	"""
+
+	def __init__(self, core_api, node_name, cache_dir=CACHE_DIR, nfs_dir=NFS_DIR, reserve=DEFAULT_RESERVE,
+		namespace=NAMESPACE):
+		self.core_api = core_api
+		self.node_name = node_name
+		self.cache_dir = cache_dir
+		self.nfs_dir = nfs_dir
+		self.reserve = reserve
+		self.namespace = namespace
+
+		# file name -> checksum of the verified copy
+		self.cached = {}
+
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+	def verify_existing(self):
+		"""
+		Checks the files left in the cache directory by a previous agent,
+		keeping the verified ones
+		"""
+
+		for filename in os.listdir(self.cache_dir):
+			if filename.endswith(VERIFIED_SUFFIX) or filename.endswith(".tmp"):
+				continue
+
+			path = os.path.join(self.cache_dir, filename)
+			verified_path = path + VERIFIED_SUFFIX
+
+			if os.path.exists(verified_path) and sha256sum(path) == open(verified_path).read().strip():
+				self.cached[filename] = open(verified_path).read().strip()
+			else:
+				self.remove(filename)
+
+	def remove(self, filename):
+		"""
+		Removes a file from the cache, marker first so that pods stop using it
+		"""
+
+		path = os.path.join(self.cache_dir, filename)
+
+		for remove_path in (path + VERIFIED_SUFFIX, path):
+			if os.path.exists(remove_path):
+				os.remove(remove_path)
+
+		self.cached.pop(filename, None)
+
+	def stage(self, filename, checksum):
+		"""
+		Copies a file from NFS to the cache, verifying its checksum
+
+		filename: The file name
+		checksum: The expected sha256 checksum
+
+		return: True if the file was staged, False otherwise
+		"""
+
+		path = os.path.join(self.cache_dir, filename)
+
+		copied_checksum = sha256sum(os.path.join(self.nfs_dir, filename), copy_to=path + ".tmp")
+
+		if copied_checksum != checksum:
+			print ("ERROR: Checksum mismatch for %s, not caching it" % filename)
+			os.remove(path + ".tmp")
+			return False
+
+		os.rename(path + ".tmp", path)
+		fp = open(path + VERIFIED_SUFFIX, 'w')
+		fp.write(checksum + '\n')
+		fp.close()
+
+		self.cached[filename] = checksum
+
+		return True
+
+	def get_capacity(self):
+		"""
+		return: Number of bytes the cache may use, including the files already cached
+		"""
+
+		usage = shutil.disk_usage(self.cache_dir)
+		cached_bytes = sum(os.path.getsize(os.path.join(self.cache_dir, filename)) for filename in self.cached)
+
+		return int(usage.free + cached_bytes - usage.total * self.reserve)
+
+	def label_node(self, release):
+		"""
+		Replaces this node's cache labels with the files currently cached
+		"""
+
+		node = self.core_api.read_node(self.node_name)
+
+		labels = {}
+		for key in (node.metadata.labels or {}):
+			if key.startswith(LABEL_PREFIX):
+				labels[key] = None
+
+		for filename, checksum in self.cached.items():
+			labels[get_label(filename)] = checksum[:12]
+
+		self.core_api.patch_node(self.node_name, {"metadata": {"labels": labels,
+			"annotations": {RELEASE_ANNOTATION: release}}})
+
+	def sync(self):
+		"""
+		Brings the cache in line with the manifest
+		"""
+
+		release, manifest = read_manifest(self.core_api, self.namespace)
+
+		if release is None:
+			return
+
+		selected = select_files(manifest, self.node_name, self.get_capacity())
+
+		# drop stale files first to make room, and advertise it
+		stale = [filename for filename in self.cached if filename not in selected or \
+			self.cached[filename] != manifest[filename]["sha256"]]
+
+		for filename in stale:
+			self.remove(filename)
+
+		if len(stale) > 0:
+			self.label_node(release)
+
+		for filename in selected:
+			if filename not in self.cached and self.stage(filename, manifest[filename]["sha256"]):
+				# advertise files as they become available
+				self.label_node(release)
+
+		self.label_node(release)
+
+	def run(self, sync_interval=DEFAULT_SYNC_INTERVAL):
+		"""
+		Syncs the cache every sync_interval seconds
+		"""
+
+		self.verify_existing()
+
+		while True:
+			try:
+				self.sync()
+			except Exception as e:
+				print ("ERROR: Cache sync failed: %s" % e)
+			sys.stdout.flush()
+
+			time.sleep(sync_interval)
+
+# -----------------------------------------------------------------------------------
+
+def prewarm(core_api, release, seqfiles, namespace=NAMESPACE):
+	"""
+	Computes the checksums of a new set of search files and publishes them
+	as the cache manifest, which the cache agents pick up on their next sync
+
+	core_api: A CoreV1Api object
+	release: A name for the rfamseq release (e.g. 14.10)
+	seqfiles: A list of search files on the NFS volume
+	namespace: The k8s namespace of the ConfigMap
+	"""
+
+	from kubernetes.client.rest import ApiException
+
+	manifest = {}
+	for seqfile in seqfiles:
+		manifest[os.path.basename(seqfile)] = {"sha256": sha256sum(seqfile), "size": os.path.getsize(seqfile)}
+		print ("%s\t%s" % (seqfile, manifest[os.path.basename(seqfile)]["sha256"]))
+
+	body = {"metadata": {"name": CONFIG_MAP},
+		"data": {"release": release, "manifest": json.dumps(manifest, sort_keys=True)}}
+
+	try:
+		core_api.replace_namespaced_config_map(CONFIG_MAP, namespace, body)
+	except ApiException as e:
+		if e.status != 404:
+			raise
+		core_api.create_namespaced_config_map(namespace, body)
+
+# -----------------------------------------------------------------------------------
+
+def print_status(core_api):
+	"""
+	Prints the cache release and number of files cached on every node
+	"""
+
+	for node in core_api.list_node().items:
+		labels = node.metadata.labels or {}
+		annotations = node.metadata.annotations or {}
+		ncached = len([key for key in labels if key.startswith(LABEL_PREFIX)])
+
+		print ("%s\t%s\t%d files" % (node.metadata.name, annotations.get(RELEASE_ANNOTATION, "-"), ncached))
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Node-local cache of the rfamseq search files')
+	subparsers = parser.add_subparsers(dest="command")
+
+	agent = subparsers.add_parser("agent", help='run the cache agent (DaemonSet)')
+	agent.add_argument('--node', help='node name (default: $NODE_NAME)', action="store", type=str,
+		default=os.environ.get("NODE_NAME"))
+	agent.add_argument('--sync-interval', help='seconds between syncs (default: %d)' % DEFAULT_SYNC_INTERVAL,
+		action="store", type=int, default=DEFAULT_SYNC_INTERVAL)
+	agent.add_argument('--reserve', help='fraction of the disk to leave free (default: %.1f)' % DEFAULT_RESERVE,
+		action="store", type=float, default=DEFAULT_RESERVE)
+
+	prewarm_parser = subparsers.add_parser("prewarm", help='publish a new set of search files to cache on all nodes')
+	prewarm_parser.add_argument('release', help='rfamseq release name')
+	prewarm_parser.add_argument('seqfiles', help='search files on the NFS volume', nargs='+', metavar="SEQFILE")
+
+	subparsers.add_parser("status", help='print the files cached on each node')
+
+	path = subparsers.add_parser("path", help='print the path to read a search file from (run in job pods)')
+	path.add_argument('nfs_path', help='path to a search file on the NFS volume')
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	if args.command == "path":
+		print (get_cached_path(args.nfs_path))
+
+	elif args.command == "agent":
+		if args.node is None:
+			sys.exit("ERROR: Node name required, use --node or set NODE_NAME")
+
+		agent = CacheAgent(load_k8s_api(), args.node, reserve=args.reserve)
+		agent.run(sync_interval=args.sync_interval)
+
+	elif args.command == "prewarm":
+		prewarm(load_k8s_api(), args.release, args.seqfiles)
+
+	elif args.command == "status":
+		print_status(load_k8s_api())
+
+	else:
+		parser.print_help()
@@ -2,106 +2,893 @@
 
 import sys
 import os
-import getpass
+import re
+import math
+import time
+import shlex
+import argparse
 import socket
+import datetime
 
-from kubernetes import client, config, utils
+import rfkubesubd
+import rfsizing
+import rfshard
+import rfcache
+import rfresult
+import rfpool
+import rfledger
+import rfmerge
+import rfprofile
+
+# -----------------------------------------------------------------------------------
+
+NAMESPACE = "default"
+IMAGE = "rfam/cloud:kubes"
+
+# maximum resources to be used in the docker container
+CPU_LIMIT = "8000m"
+MEMORY_LIMIT = "24Gi"
+
+# number of retries of each shard of an indexed job before the shard is
+# marked as failed, in a new pod each time (spec.backoffLimitPerIndex, needs
+# Kubernetes 1.29 or later), and of single pod jobs
+BACKOFF_LIMIT_PER_INDEX = 6
+
+# shell variable holding the shard index in indexed (batch) jobs
+SHARD_INDEX_VAR = "RFAM_SHARD_INDEX"
+
+# jobs are created suspended, for rfadmit.py to admit them, when this
+# environment variable is set to 1 (see the login pod deployment)
+ADMISSION_QUEUE_VAR = "RFAM_ADMISSION_QUEUE"
+
+# ConfigMap rfadmit.py updates on every admission cycle, jobs are not
+# created suspended if it was not updated for ADMITTER_STALE_SECS
+ADMISSION_STATUS_CONFIG_MAP = "rfam-admission-status"
+ADMITTER_STALE_SECS = 120
+
+# tasks are queued for the user's pool of warm workers instead of being
+# submitted as jobs when this environment variable is set to 1 (see rfpool.py)
+WORKER_POOL_VAR = "RFAM_WORKER_POOL"
+
+# rfsearch job index of each completion index, set on Indexed jobs from
+# which shards with cached results were left out (see rfresult.py)
+SHARD_INDEXES_ANNOTATION = "rfam.org/shard-indexes"
+
+# rfsearch job name of jobs whose k8s job name has a suffix, set on jobs
+# submitted again when an interrupted search is resumed (see rfledger.py)
+JOB_INDEX_ANNOTATION = "rfam.org/job-index"
+
+# MPI jobs (--mpi) run this many MPI processes per pod, one per cpu of CPU_LIMIT
+MPI_SLOTS_PER_POD = 8
+
+# port of the ssh daemon mpirun starts the processes of other pods through
+MPI_SSH_PORT = 2222
+
+# number of seconds the pods of an MPI job wait for each other to start
+MPI_STARTUP_TIMEOUT = 900
+
+# number of pods of an MPI job, set on the job and its pods. rfadmit.py
+# admits all of them at once and rfwait.py tracks them as a single job
+MPI_PODS_ANNOTATION = "rfam.org/mpi-pods"
+
+# shard outputs are written to files unique to the pod (HOSTNAME is the pod
+# name) and renamed once complete, see build_atomic_command
+TMP_OUTPUT_SUFFIX = ".$HOSTNAME.tmp"
+
+# shard outputs are written to node-local scratch space and published to the
+# user's volume in one bundle per shard when this environment variable is set
+# to 1 (rfsearch sets it when it merges from bundles), see build_staged_command
+STAGE_OUTPUTS_VAR = "RFAM_STAGE_OUTPUTS"
+
+# mount point of the emptyDir volume staged outputs are written to
+SCRATCH_DIR = "/scratch"
+
+# username of sessions on login pods claimed from the warm pool (see
+# rflogin.py), whose hostname does not name the user
+USER_VAR = "RFAM_USER"
+
+# the workdir of users whose sessions start from the warm pool is their
+# directory on the shared home volume, which their login and job pods
+# mount as a subPath
+WORKDIR = "/workdir"
+HOME_VOLUME_CLAIM = "rfhome-pvc"
+
+# environment variables a submission depends on, passed along with the
+# command line and working directory to the submission daemon (rfkubesubd.py)
+SUBMISSION_ENV_VARS = (ADMISSION_QUEUE_VAR, WORKER_POOL_VAR, STAGE_OUTPUTS_VAR, USER_VAR, rfledger.RUN_ID_VAR)
+
+# -----------------------------------------------------------------------------------
+
+def get_username():
+	"""
+	Fetches the username of an Rfam cloud user from USER_VAR on login pods
+	claimed from the warm pool, or from the login pod hostname
+	(rfam-login-pod-USERID-...)
+
+	return: The username as a string
+	"""
+
+	if os.environ.get(USER_VAR):
+		return os.environ[USER_VAR]
+
+	hostname = socket.gethostname()
+
+	return hostname.split('-')[3]
+
+# -----------------------------------------------------------------------------------
+
+def get_workdir_claim(user):
+	"""
+	Finds the volume holding the user's workdir: their own volume, or their
+	directory on the shared home volume when their login pod was claimed
+	from the warm pool, which sets USER_VAR (see rflogin.py)
+
+	user: A valid Rfam cloud account username
+
+	return: A tuple (pvc name, sub path), where sub path is None for the whole volume
+	"""
+
+	if os.environ.get(USER_VAR) == user:
+		return (HOME_VOLUME_CLAIM, user)
+
+	return ("rfam-pvc-%s" % user, None)
+
+# -----------------------------------------------------------------------------------
+
+def get_job_name(user, job_index):
+	"""
+	Returns the k8s job name of an rfsearch job
+
+	user: A valid Rfam cloud account username
+	job_index: The rfsearch job name (e.g. s-1234-1)
+
+	return: The k8s job name as a string
+	"""
+
+	return "rfsearch-job-%s-%s" % (user, job_index)
+
+# -----------------------------------------------------------------------------------
+
+def get_job_index(user, job_name, annotations=None):
+	"""
+	Returns the rfsearch job name of a k8s job created by rfkubesub. This is
+	the reverse of get_job_name.
+
+	user: A valid Rfam cloud account username
+	job_name: The k8s job name
+	annotations: The annotations of the job or of one of its pods, None to rely on job_name only
+
+	return: The rfsearch job name as a string, None if job_name was not created by rfkubesub
+	"""
+
+	prefix = get_job_name(user, '')
+
+	if not job_name.startswith(prefix):
+		return None
+
+	if annotations is not None and JOB_INDEX_ANNOTATION in annotations:
+		return annotations[JOB_INDEX_ANNOTATION]
+
+	return job_name[len(prefix):]
+
+# -----------------------------------------------------------------------------------
+
+def build_job_manifest(user, job_index, cmd, cpus, memory, completions=None, limits=None, affinity=None,
+	suspend=False, shard_indexes=None, name_suffix=None, scratch=False, scratch_mb=None):
+	"""
+	Builds an rfsearch k8s job manifest as a python dictionary. If completions
+	is set, an Indexed job is created with one pod per completion index, in
+	which case cmd is expected to select its work from JOB_COMPLETION_INDEX.
+
+	user: A valid Rfam cloud account username
+	job_index: The rfsearch job name (e.g. s-1234-1)
+	cmd: The shell command to run in the container
+	cpus: Number of cpus to request
+	memory: Memory to request in Mb
+	completions: Number of indexed pods to create, None for a single pod job
+	limits: A dictionary of container limits (cpu, memory), None for CPU_LIMIT and MEMORY_LIMIT
+	affinity: A k8s affinity dictionary, None for no affinity
+	suspend: True to create the job suspended, to be admitted by rfadmit.py
+	shard_indexes: A list of the shard index of each completion index, None if they are the same
+	name_suffix: A suffix making the k8s job name unique, None for no suffix
+	scratch: True to mount an emptyDir volume at SCRATCH_DIR, for staged outputs
+	scratch_mb: Scratch space to request in Mb, as ephemeral storage of the SCRATCH_DIR
+	            volume, None to request none
+
+	return: A k8s job manifest as a dictionary
+	"""
+
+	job_name = get_job_name(user, job_index) + (name_suffix or "")
+	pod_name = "rfsearch-pod-%s-%s" % (user, job_index)
+	volume_name = "rfam-pod-storage-%s" % user
+	pvc_name, workdir_subpath = get_workdir_claim(user)
+
+	if limits is None:
+		limits = {"cpu": CPU_LIMIT, "memory": MEMORY_LIMIT}
+
+	container = {"name": pod_name,
+		"image": IMAGE,
+		"resources": {
+			"limits": limits,
+			# convert cpus to milicores
+			"requests": {"cpu": "%sm" % (int(cpus) * 1000), "memory": "%sMi" % memory}},
+		"command": ["sh", "-c", cmd],
+		"imagePullPolicy": "Always",
+		"volumeMounts": [
+			{"name": "nfs-pv", "mountPath": "/Rfam/rfamseq"},
+			# shared cache of cmsearch results, see rfresult.py
+			{"name": "rfresult-pv", "mountPath": rfresult.RESULT_VOLUME_DIR},
+			# node-local copies of the search files, see rfcache.py
+			{"name": "rfamseq-cache", "mountPath": rfcache.CACHE_DIR, "readOnly": True},
+			# this one must match the volume name of the pvc
+			{"name": volume_name, "mountPath": WORKDIR}]}
+
+	if workdir_subpath is not None:
+		container["volumeMounts"][-1]["subPath"] = workdir_subpath
+
+	pod_template = {"metadata": {
+			"name": pod_name,
+			"labels": {"app": "family-builder",
+				"user": user,
+				"tier": "backend",
+				"jobname": job_name}},
+		"spec": {
+			"containers": [container],
+			"volumes": [
+				{"name": volume_name, "persistentVolumeClaim": {"claimName": pvc_name}},
+				{"name": "nfs-pv", "persistentVolumeClaim": {"claimName": "nfs-pvc"}},
+				{"name": "rfresult-pv", "persistentVolumeClaim": {"claimName": "rfresult-pvc"}},
+				{"name": "rfamseq-cache", "hostPath": {"path": rfcache.CACHE_DIR, "type": "DirectoryOrCreate"}}],
+			"restartPolicy": "OnFailure"}}
+
+	if affinity is not None:
+		pod_template["spec"]["affinity"] = affinity
+
+	if scratch or scratch_mb is not None:
+		container["volumeMounts"].append({"name": "scratch", "mountPath": SCRATCH_DIR})
+		pod_template["spec"]["volumes"].append({"name": "scratch", "emptyDir": {}})
+
+	# schedule pods on nodes with room for what they write to scratch space,
+	# which is evicted past the limit instead of filling the node's disk
+	if scratch_mb is not None:
+		container["resources"]["requests"]["ephemeral-storage"] = "%dMi" % scratch_mb
+		pod_template["spec"]["volumes"][-1]["emptyDir"]["sizeLimit"] = "%dMi" % scratch_mb
+
+	job_spec = {"ttlSecondsAfterFinished": 10,
+		"template": pod_template}
+
+	metadata = {"name": job_name, "namespace": NAMESPACE, "labels": {"user": user, "tier": "backend"}}
+
+	annotations = {}
+
+	if shard_indexes is not None:
+		annotations[SHARD_INDEXES_ANNOTATION] = ','.join(str(x) for x in shard_indexes)
+
+	if name_suffix is not None:
+		annotations[JOB_INDEX_ANNOTATION] = job_index
+
+	if len(annotations) > 0:
+		metadata["annotations"] = annotations
+		pod_template["metadata"]["annotations"] = annotations
+
+	if suspend:
+		job_spec["suspend"] = True
+
+	if completions is not None:
+		job_spec["completionMode"] = "Indexed"
+		job_spec["completions"] = completions
+		job_spec["parallelism"] = completions
+		# a failing shard does not use up the retries of the others, which
+		# needs failed pods to be replaced instead of restarted in place
+		job_spec["backoffLimitPerIndex"] = BACKOFF_LIMIT_PER_INDEX
+		pod_template["spec"]["restartPolicy"] = "Never"
+
+	return {"apiVersion": "batch/v1",
+		"kind": "Job",
+		"metadata": metadata,
+		"spec": job_spec}
+
+# -----------------------------------------------------------------------------------
+
+def build_indexed_command(commands):
+	"""
+	Builds a shell script that runs the command matching the pod's
+	JOB_COMPLETION_INDEX, so that a list of shard commands can be
+	submitted as a single Indexed job.
+
+	commands: A list of shell commands, one per completion index
+
+	return: A shell script as a string
+	"""
+
+	script = ["case \"$JOB_COMPLETION_INDEX\" in"]
+
+	for index, cmd in enumerate(commands):
+		script.append("%d) %s ;;" % (index, cmd))
+
+	script.append("*) echo \"Unknown completion index $JOB_COMPLETION_INDEX\" >&2; exit 1 ;;")
+	script.append("esac")
+
+	return '\n'.join(script)
+
+# -----------------------------------------------------------------------------------
+
+def build_atomic_command(cmd, outputs):
+	"""
+	Makes the outputs of a shard command atomic, so that copies of a shard
+	can run at the same time (see rfwait.py). They are written to files
+	unique to the pod and renamed to their final path once the command
+	succeeds, tblout last. The command is not run if the tblout is already
+	complete, and the outputs of a copy finishing after another one are
+	discarded.
+
+	cmd: The shell command to run
+	outputs: A tuple (tblout, searchout, stderr) of the shard's output paths, as returned
+	by rfresult.parse_output_paths, where stderr may be None
+
+	return: The shell command to run, cmd if the output paths need quoting
+	"""
+
+	tblout, searchout, stderr = outputs
+	paths = [path for path in (stderr, searchout, tblout) if path is not None]
+
+	if any(shlex.quote(path) != path for path in paths):
+		return cmd
+
+	for path in paths:
+		cmd = re.sub(re.escape(path) + r'(?=[\s;&|)]|$)', lambda m: m.group(0) + TMP_OUTPUT_SUFFIX, cmd)
+
+	complete = "tail -n 10 %s 2> /dev/null | grep -qF %s" % (tblout, shlex.quote(rfmerge.SUCCESS_STRING))
+	tmp_paths = ' '.join(path + TMP_OUTPUT_SUFFIX for path in paths)
+	renames = " && ".join("mv -f %s%s %s" % (path, TMP_OUTPUT_SUFFIX, path) for path in paths)
+	on_failure = "rm -f %s%s %s%s" % (searchout, TMP_OUTPUT_SUFFIX, tblout, TMP_OUTPUT_SUFFIX)
+
+	# keep the stderr of a failed copy for the user, unless another copy completed
+	if stderr is not None:
+		on_failure = "mv -f %s%s %s; %s" % (stderr, TMP_OUTPUT_SUFFIX, stderr, on_failure)
+
+	script = ["%s && exit 0" % complete,
+		"(%s)" % cmd,
+		"rc=$?",
+		"if %s; then rm -f %s; exit 0; fi" % (complete, tmp_paths),
+		"if [ $rc -ne 0 ]; then %s; exit $rc; fi" % on_failure,
+		renames]
+
+	return '; '.join(script)
+
+# -----------------------------------------------------------------------------------
+
+def build_staged_command(cmd, outputs):
+	"""
+	Stages the outputs of a shard command in node-local scratch space
+	(SCRATCH_DIR, an emptyDir volume) instead of writing them to the user's
+	volume as they are produced. Once the command succeeds they are
+	published in a single gzipped tar file next to the tblout, written
+	under a name unique to the pod and renamed into place, which rfmerge.py
+	merges from directly. The command is not run if the bundle already
+	exists, and the bundle of a copy finishing after another one is
+	discarded. The stderr of a failed command is copied to its path on the
+	user's volume.
+
+	cmd: The shell command to run
+	outputs: A tuple (tblout, searchout, stderr) of the shard's output paths, as returned
+	by rfresult.parse_output_paths, where stderr may be None
+
+	return: The shell command to run, cmd if the output paths need quoting
+	"""
+
+	tblout, searchout, stderr = outputs
+	members = [(tblout, rfmerge.BUNDLE_TBLOUT), (searchout, rfmerge.BUNDLE_SEARCHOUT)]
+
+	if stderr is not None:
+		members.append((stderr, rfmerge.BUNDLE_STDERR))
+
+	if any(shlex.quote(path) != path for path, name in members):
+		return cmd
+
+	for path, name in members:
+		cmd = re.sub(re.escape(path) + r'(?=[\s;&|)]|$)', lambda m: "%s/%s" % (SCRATCH_DIR, name), cmd)
+
+	bundle = rfmerge.get_bundle_path(tblout)
+	tmp_bundle = bundle + TMP_OUTPUT_SUFFIX
+	names = ' '.join(name for path, name in members)
+
+	# keep the stderr of a failed command for the user, unless another copy completed
+	on_failure = "exit $rc"
+	if stderr is not None:
+		on_failure = "cp -f %s/%s %s; exit $rc" % (SCRATCH_DIR, rfmerge.BUNDLE_STDERR, stderr)
+
+	script = ["[ -f %s ] && exit 0" % bundle,
+		# left by an earlier run of the container in this pod
+		"rm -f %s" % ' '.join("%s/%s" % (SCRATCH_DIR, name) for path, name in members),
+		"(%s)" % cmd,
+		"rc=$?",
+		"[ -f %s ] && exit 0" % bundle,
+		"if [ $rc -ne 0 ]; then %s; fi" % on_failure,
+		"tar -czf %s -C %s %s || { rm -f %s; exit 1; }" % (tmp_bundle, SCRATCH_DIR, names, tmp_bundle),
+		"mv -f %s %s" % (tmp_bundle, bundle)]
+
+	return '; '.join(script)
+
+# -----------------------------------------------------------------------------------
+
+def remove_outputs(outputs):
+	"""
+	Removes the tblout and bundle of shards, so that those left complete by
+	an earlier submission are not taken for the new one's
+
+	outputs: A list of output paths per shard, as returned by rfresult.parse_output_paths
+	"""
+
+	for output in outputs:
+		if output is None:
+			continue
+
+		for path in (output[0], rfmerge.get_bundle_path(output[0])):
+			if os.path.exists(path):
+				os.remove(path)
+
+def wrap_output_commands(commands, outputs, stage=False):
+	"""
+	Makes the outputs of shard commands atomic, or stages them in scratch
+	space, see build_atomic_command and build_staged_command
+
+	commands: A list of shell commands
+	outputs: A list of output paths per command, as returned by rfresult.parse_output_paths
+	stage: True to stage the outputs in SCRATCH_DIR
+
+	return: A list of shell commands to run, commands without outputs are unchanged
+	"""
+
+	build_command = build_staged_command if stage else build_atomic_command
+
+	return [build_command(c, o) if o is not None else c for c, o in zip(commands, outputs)]
+
+# -----------------------------------------------------------------------------------
+
+def get_mpi_layout(nproc):
+	"""
+	Spreads the processes of an MPI job over as few pods as possible
+
+	nproc: Number of MPI processes
+
+	return: A tuple (number of pods, number of processes per pod)
+	"""
+
+	npods = int(math.ceil(nproc / float(MPI_SLOTS_PER_POD)))
+
+	return (npods, int(math.ceil(nproc / float(npods))))
+
+# -----------------------------------------------------------------------------------
+
+def build_mpi_command(cmd, job_name, nproc, npods, slots, mpi_dir):
+	"""
+	Builds the shell script run by each pod of an MPI job, an Indexed job
+	whose pods are reachable as <job name>-<index>.<job name> through a
+	headless service. Every pod starts an ssh daemon accepting a key the
+	launcher (pod 0) generates in mpi_dir, on the shared volume. Once all
+	pods are up the launcher writes the hostfile and runs cmd with mpirun,
+	while the other pods wait for it to finish. Pods give up if the others
+	don't start within MPI_STARTUP_TIMEOUT seconds, or if the launcher stops.
+
+	cmd: The MPI command, its output redirections apply to mpirun
+	job_name: The k8s job name, also the name of the headless service
+	nproc: Number of MPI processes
+	npods: Number of pods
+	slots: Number of MPI processes per pod
+	mpi_dir: A directory on the shared volume, removed once cmd finishes
+
+	return: A shell script as a string
+	"""
+
+	ssh_options = "-p %d -i %s/id -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR" % (
+		MPI_SSH_PORT, mpi_dir)
+
+	sshd_options = ' '.join(["-f /dev/null", "-p %d" % MPI_SSH_PORT, "-h /tmp/rfam_mpi_host_key",
+		"-o AuthorizedKeysFile=%s/id.pub" % mpi_dir, "-o PidFile=/tmp/rfam_mpi_sshd.pid",
+		"-o StrictModes=no", "-o UsePAM=no", "-o UsePrivilegeSeparation=no"])
+
+	script = ["D=%s" % mpi_dir,
+		"wait_for() { t=0; while [ ! -e \"$1\" ]; do sleep 2; t=$((t + 2)); "
+			"if [ $t -ge %d ]; then echo \"ERROR: MPI pods did not start, timed out waiting for $1\" >&2; exit 1; fi; done; }"
+			% MPI_STARTUP_TIMEOUT,
+		"mkdir -p $D",
+		"if [ \"$JOB_COMPLETION_INDEX\" = 0 ] && [ ! -e $D/id ]; then "
+			"ssh-keygen -q -t rsa -N '' -f $D/tmp-id && mv $D/tmp-id $D/id && mv $D/tmp-id.pub $D/id.pub || exit 1; fi",
+		"wait_for $D/id.pub",
+		"ssh-keygen -q -t rsa -N '' -f /tmp/rfam_mpi_host_key < /dev/null > /dev/null 2>&1",
+		"/usr/sbin/sshd %s || exit 1" % sshd_options,
+		"touch $D/ready.$JOB_COMPLETION_INDEX",
+		"if [ \"$JOB_COMPLETION_INDEX\" != 0 ]; then "
+			"while [ -e $D/id.pub ] && [ ! -e $D/done ]; do sleep 10; "
+			"if [ -n \"$(find $D/heartbeat -mmin +5 2> /dev/null)\" ]; then echo \"ERROR: MPI launcher stopped\" >&2; exit 1; fi; done; "
+			"exit 0; fi",
+		": > $D/hostfile",
+		"i=0; while [ $i -lt %d ]; do wait_for $D/ready.$i; echo \"%s-$i.%s slots=%d\" >> $D/hostfile; i=$((i + 1)); done"
+			% (npods, job_name, job_name, slots),
+		"(while [ ! -e $D/done ]; do touch $D/heartbeat; sleep 30; done) &",
+		"mpirun --hostfile $D/hostfile -np %d -x PATH --mca plm_rsh_agent ssh --mca plm_rsh_args %s %s"
+			% (nproc, shlex.quote(ssh_options), cmd),
+		"rc=$?",
+		"echo $rc > $D/done",
+		"sleep 15; rm -rf $D",
+		"exit $rc"]
+
+	return '\n'.join(script)
+
+# -----------------------------------------------------------------------------------
+
+def submit_mpi_job(user, job_index, cmd, nproc, memory, suspend=False):
+	"""
+	Submits an MPI job spreading nproc processes over several pods, as an
+	Indexed job that only succeeds if its launcher (pod 0) does, with a
+	headless service giving each pod a DNS name. The service is deleted
+	with the job. The job fails as a whole if any pod fails.
+
+	The job ends on the launcher's exit on any Kubernetes version: the other
+	pods exit once the launcher writes its exit status (see
+	build_mpi_command). Its successPolicy, which completes the job as soon
+	as the launcher succeeds, needs Kubernetes 1.31 or later (1.30 with the
+	JobSuccessPolicy feature gate), older API servers drop it.
+
+	user: A valid Rfam cloud account username
+	job_index: The rfsearch job name (e.g. c-1234)
+	cmd: The MPI command, run with mpirun
+	nproc: Number of MPI processes
+	memory: Memory to request for all processes in Mb
+	suspend: True to create the job suspended, to be admitted by rfadmit.py
+	"""
+
+	from kubernetes import client, config
+
+	npods, slots = get_mpi_layout(nproc)
+	pod_memory = int(math.ceil(float(memory) / npods))
+	job_name = get_job_name(user, job_index)
+	mpi_dir = os.path.join(os.getcwd(), "%s.mpi" % job_index)
+
+	# the memory requested for a calibration is already twice its forecast
+	limits = {"cpu": CPU_LIMIT, "memory": "%dMi" % pod_memory}
+
+	manifest = build_job_manifest(user, job_index, build_mpi_command(cmd, job_name, nproc, npods, slots, mpi_dir),
+		slots, pod_memory, completions=npods, limits=limits, suspend=suspend)
+
+	annotations = {MPI_PODS_ANNOTATION: str(npods)}
+	manifest["metadata"]["annotations"] = annotations
+	manifest["spec"]["template"]["metadata"]["annotations"] = annotations
+	manifest["spec"]["template"]["spec"]["subdomain"] = job_name
+	del manifest["spec"]["backoffLimitPerIndex"]
+	manifest["spec"]["backoffLimit"] = 0
+	# Kubernetes 1.31 or later, otherwise the job completes once the other pods exit
+	manifest["spec"]["successPolicy"] = {"rules": [{"succeededIndexes": "0"}]}
+
+	job = submit_job(manifest)
+
+	service = {"apiVersion": "v1",
+		"kind": "Service",
+		"metadata": {"name": job_name,
+			"namespace": NAMESPACE,
+			"labels": {"user": user, "tier": "backend"},
+			"ownerReferences": [{"apiVersion": "batch/v1", "kind": "Job", "name": job_name,
+				"uid": job.metadata.uid}]},
+		"spec": {"clusterIP": "None",
+			"selector": {"jobname": job_name},
+			# pods must resolve each other before they are ready
+			"publishNotReadyAddresses": True}}
+
+	config.load_incluster_config()
+	client.CoreV1Api().create_namespaced_service(namespace=NAMESPACE, body=service)
+
+# -----------------------------------------------------------------------------------
+
+def build_template_command(template, first_index):
+	"""
+	Builds a shell script that substitutes the shard index derived from
+	JOB_COMPLETION_INDEX in a command template. Every {index} in the template
+	is replaced with the shard index, starting from first_index.
+
+	template: A shell command containing {index} placeholders
+	first_index: The shard index of completion index 0
+
+	return: A shell script as a string
+	"""
+
+	export_index = "%s=$((JOB_COMPLETION_INDEX + %d)); " % (SHARD_INDEX_VAR, first_index)
+
+	return export_index + template.replace("{index}", "${%s}" % SHARD_INDEX_VAR)
+
+# -----------------------------------------------------------------------------------
+
+def read_batch_commands(cmd_file):
+	"""
+	Reads a file of shard commands, one shell command per line. Empty lines
+	are skipped.
+
+	cmd_file: Path to a file of shell commands
+
+	return: A list of commands
+	"""
+
+	fp = open(cmd_file, 'r')
+	commands = [line.strip() for line in fp if line.strip() != '']
+	fp.close()
+
+	if len(commands) == 0:
+		sys.exit("ERROR: No commands found in %s" % cmd_file)
+
+	return commands
+
+# -----------------------------------------------------------------------------------
+
+def parse_index_range(index_range):
+	"""
+	Parses an inclusive index range of the form START-END
+
+	index_range: A string of the form START-END (e.g. 1-100)
+
+	return: A tuple (first_index, number_of_indexes)
+	"""
+
+	try:
+		start, end = [int(x) for x in index_range.split('-')]
+	except ValueError:
+		raise argparse.ArgumentTypeError("Index range must be of the form START-END")
+
+	if end < start:
+		raise argparse.ArgumentTypeError("Index range end must be greater or equal to start")
+
+	return (start, end - start + 1)
+
+# -----------------------------------------------------------------------------------
+
+def submit_job(manifest):
+	"""
+	Creates a k8s job in a single API call
+
+	manifest: A k8s job manifest as a dictionary
+
+	return: The V1Job object returned by the API server
+	"""
+
+	# imported here so that submissions through rfkubesubd don't pay for it
+	from kubernetes import client, config
+
+	# Configs can be set in Configuration class directly or using helper
+	# utility. If no argument provided, the config will be loaded from
+	# default location.
+	config.load_incluster_config()
+	batch_api = client.BatchV1Api()
+
+	return batch_api.create_namespaced_job(namespace=NAMESPACE, body=manifest)
+
+# -----------------------------------------------------------------------------------
+
+def get_admitter_update_time():
+	"""
+	return: The time rfadmit.py last updated its status (seconds since the epoch), None if it never did
+	"""
+
+	from kubernetes import client, config
+	from kubernetes.client.rest import ApiException
+
+	config.load_incluster_config()
+
+	try:
+		config_map = client.CoreV1Api().read_namespaced_config_map(ADMISSION_STATUS_CONFIG_MAP, NAMESPACE)
+	except ApiException as e:
+		if e.status == 404:
+			return None
+		raise
+
+	updated = (config_map.data or {}).get("updated")
+
+	if updated is None:
+		return None
+
+	return datetime.datetime.fromisoformat(updated).timestamp()
+
+# -----------------------------------------------------------------------------------
+
+def use_admission_queue():
+	"""
+	Tells whether jobs are to be created suspended for rfadmit.py to admit
+	them, which is opt-in with ADMISSION_QUEUE_VAR. Exits if rfadmit.py is
+	not running, as suspended jobs would never start.
+
+	return: True to create jobs suspended
+	"""
+
+	if os.environ.get(ADMISSION_QUEUE_VAR) != "1":
+		return False
+
+	updated = get_admitter_update_time()
+
+	if updated is None or time.time() - updated > ADMITTER_STALE_SECS:
+		sys.exit("ERROR: %s is set to 1 but rfadmit.py is not running (no update of the %s ConfigMap in the last %d seconds). "
+			"Deploy manifests/rfam-admission.yaml, or unset %s to submit jobs directly." % (ADMISSION_QUEUE_VAR,
+			ADMISSION_STATUS_CONFIG_MAP, ADMITTER_STALE_SECS, ADMISSION_QUEUE_VAR))
+
+	return True
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Submits rfsearch jobs to the Rfam k8s cluster')
+
+	parser.add_argument('cmd', help='command to run, a file of commands (--batch) or a command template (--range)')
+	parser.add_argument('cpus', help='number of cpus to request per pod, of MPI processes with --mpi', type=int)
+	parser.add_argument('memory', help='memory to request per pod in Mb, for all MPI processes with --mpi')
+	parser.add_argument('job_index', help='job name (e.g. s-1234-1)')
+
+	mutually_exclusive = parser.add_mutually_exclusive_group()
+	mutually_exclusive.add_argument('--batch', help='cmd is a file with one shard command per line, submitted as a single Indexed job',
+		action="store_true")
+	mutually_exclusive.add_argument('--mpi', help='cmd is an MPI command, run with mpirun on cpus processes spread over several pods',
+		action="store_true")
+	mutually_exclusive.add_argument('--range', help='cmd is a template with {index} placeholders, submitted as a single Indexed job over START-END',
+		action="store", type=parse_index_range, metavar="START-END", dest="index_range")
+	parser.add_argument('--no-sizing', help='request exactly cpus and memory instead of sizing cmsearch jobs from past runs',
+		action="store_true")
+	parser.add_argument('--no-result-cache', help='run cmsearch commands even if their results are cached',
+		action="store_true")
+	parser.add_argument('--no-profile', help='do not write a resource and phase profile next to the output of each shard (see rfprofile.py)',
+		action="store_true")
+	parser.add_argument('--pool', help='queue commands for the warm worker pool if they fit its pods (see rfpool.py)',
+		action="store_true")
+	parser.add_argument('--stage', help='write cmsearch outputs to node-local scratch space and publish them in one bundle per shard (also set by %s=1)' % STAGE_OUTPUTS_VAR,
+		action="store_true")
+	parser.add_argument('--scratch', help='request MB of node-local scratch space (%s) per pod, e.g. for local copies of the search files' % SCRATCH_DIR,
+		action="store", type=int, metavar="MB", dest="scratch_mb", default=None)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+def prepare_job(args, user):
+	"""
+	Plans the submission of an rfkubesub.py command line: leaves out shards
+	that already ran or have cached results, queues the shards for the warm
+	worker pool, or sizes, wraps and records them and builds their job.
+	MPI jobs are submitted directly. Relative paths are resolved from the
+	current working directory.
+
+	args: The parsed command line arguments (see parse_arguments)
+	user: A valid Rfam cloud account username
+
+	return: A k8s job manifest as a dictionary, None if there is no job left to submit
+	"""
+
+	if args.mpi:
+		submit_mpi_job(user, args.job_index, args.cmd, args.cpus, args.memory,
+			suspend=use_admission_queue())
+		return None
+
+	completions = None
+	limits = None
+	affinity = None
+	scratch = False
+	shard_indexes = None
+	name_suffix = None
+	cpus = args.cpus
+	memory = args.memory
+
+	if args.index_range is not None:
+		first_index, completions = args.index_range
+		cmd = build_template_command(args.cmd, first_index)
+
+	else:
+		shard_commands = read_batch_commands(args.cmd) if args.batch else [args.cmd]
+		ncommands = len(shard_commands)
+
+		# leave out the shards an interrupted run of the same rfsearch already ran or is
+		# still running, rfwait.py checks the output of jobs that were not submitted again
+		commands, indexes, name_suffix = rfledger.resume_shards(user, args.job_index, shard_commands, args.batch)
+
+		# write out the results of searches identical to past ones instead of running them
+		if not args.no_result_cache and len(commands) > 0:
+			ntodo = len(commands)
+			commands, kept = rfresult.reuse_results(commands)
+			indexes = [indexes[i] for i in kept]
+
+			if len(commands) < ntodo:
+				print ("Reused cached results of %d of %d searches" % (ntodo - len(commands), ncommands))
+
+		if len(commands) == 0:
+			return None
+
+		if len(commands) < ncommands:
+			shard_indexes = indexes
+
+		# the ledger compares shards by the command rfsearch gave us
+		submitted_commands = [shard_commands[i] for i in indexes]
+		outputs = [rfresult.parse_output_paths(c) for c in submitted_commands]
+
+		# a complete tblout or bundle left by an earlier submission would be taken for this one's
+		remove_outputs(outputs)
+		stage = args.stage or os.environ.get(STAGE_OUTPUTS_VAR) == "1"
+
+		# run on warm workers that already have the volumes mounted, skipping pod startup
+		if (args.pool or os.environ.get(WORKER_POOL_VAR) == "1") and rfpool.fits_pool(cpus, memory):
+			commands = [rfcache.cache_command(rfshard.expand_unit_command(c)) for c in commands]
+			commands = wrap_output_commands(commands, outputs, stage)
+
+			if args.batch:
+				names = ["%s-%d" % (args.job_index, i) for i in indexes]
+			else:
+				names = [args.job_index]
+
+			rfledger.record_shards(user, None, args.job_index, submitted_commands, indexes, args.batch)
+			rfpool.submit_tasks(user, list(zip(names, commands)), cpus, memory)
+			return None
+
+		# size cmsearch jobs from the resources used by similar past jobs
+		if not args.no_sizing:
+			cpus, memory, limits, commands = rfsizing.right_size(commands, cpus, memory)
+
+		# stream units of sequences (FILE:FIRST-LAST) planned by rfshard to cmsearch
+		commands = [rfshard.expand_unit_command(c) for c in commands]
+
+		# prefer nodes caching the search files and read them from there, for the
+		# job as a whole: pods of a batch are not placed by their own shard's file
+		affinity = rfcache.node_affinity(commands)
+		commands = [rfcache.cache_command(c) for c in commands]
+
+		scratch = stage
+		commands = wrap_output_commands(commands, outputs, stage)
+
+		# record the resources and phases of each shard next to its outputs, see rfprofile.py
+		if not args.no_profile:
+			commands = [rfprofile.build_profiled_command(c, o[0], cpus, memory) if o is not None else c
+				for c, o in zip(commands, outputs)]
+
+		if args.batch:
+			completions = len(commands)
+			cmd = build_indexed_command(commands)
+		else:
+			cmd = commands[0]
+
+	manifest = build_job_manifest(user, args.job_index, cmd, cpus, memory, completions, limits, affinity,
+		suspend=use_admission_queue(), shard_indexes=shard_indexes, name_suffix=name_suffix, scratch=scratch,
+		scratch_mb=args.scratch_mb)
+
+	# recorded first, so that a job running shards is never missing from the ledger
+	if args.index_range is None:
+		rfledger.record_shards(user, manifest["metadata"]["name"], args.job_index, submitted_commands, indexes,
+			args.batch)
+
+	return manifest
 
 # -----------------------------------------------------------------------------------
 
 def main():
 
-    # Configs can be set in Configuration class directly or using helper
-    # utility. If no argument provided, the config will be loaded from
-    # default location.
-    
-    config.load_incluster_config()
-    k8s_client = client.ApiClient()
-    
-    cmd = sys.argv[1]
-    cpus = int(sys.argv[2])
-    memory = sys.argv[3]
-    job_index = sys.argv[4]
-
-    #convert to milicores
-    cpus = cpus * 1000
-    hostname = socket.gethostname()
-    user = hostname.split('-')[3] # fetch username from pod hostname
-    job_name = "rfsearch-job-%s-%s" % (user, job_index)
-    pod_name = "rfsearch-pod-%s-%s" % (user, job_index) # check if a uuid is needed
-    volume_name = "rfam-pod-storage-%s" % user
-    pvc_name = "rfam-pvc-%s" % user
-    
-    # rfsearch job manifest
-    rfam_k8s_job = ("apiVersion: batch/v1\n"
-    	"kind: Job\n"
-    	"metadata:\n"
-    	"  name: %s\n"
-    	"spec:\n"
-        #"  activeDeadlineSeconds: 30\n"
-        "  ttlSecondsAfterFinished: 10\n"
-    	"  template:\n"
-    	"    metadata:\n"
-    	"      name: %s\n" 
-    	"      labels:\n"
-    	"        app: family-builder\n"
-    	"        user: %s\n"
-    	"        tier: backend\n"
-        "        jobname: %s\n"
-    	"    spec:\n"
-        "      volumes:\n"
-        "        - name: nfs-volue\n"
-        "          nfs:\n"
-        "            server: 193.62.55.16\n"
-        "            path: /nfs2\n"
-        "            port: \"2049\"\n"
-    	"      containers:\n"
-    	"      - name: %s\n"
-    	"        image: rfam/cloud:kubes\n"
-    	"        resources:\n"
-    	"          limits:\n"
-    	"            cpu: \"8000m\"\n" # maximum number of cpus to be used in the docker container
-        "            memory: \"24Gi\"\n" # maximum memory to be used in the docker container
-    	"          requests:\n"
-    	"            cpu: \"%sm\"\n"
-        "            memory: \"%sMi\"\n"
-        #"        args:\n"
-        #"        - -cpus\n"
-        #"        - \"%s\"\n"
-    	"        command: [\"sh\", \"-c\", \"%s\"]\n"
-    	"        imagePullPolicy: Always\n"
-    	"        volumeMounts:\n"
-                "        - name: nfs-pv\n"
-                "          mountPath: /Rfam/rfamseq\n"
-		"        - name: %s\n" # this one must match the volume name of the pvc
-		"          mountPath: /workdir\n"
-		"      volumes:\n"
-		"      - name: %s\n"
-		"        persistentVolumeClaim:\n"
-		"          claimName: %s\n"
-                "      - name: nfs-pv\n"
-                "        persistentVolumeClaim:\n"
-                "          claimName: nfs-pvc\n"
-		"      restartPolicy: OnFailure")
-
-    
-    # create a new k8s job yaml file
-    rfjob_manifest = os.path.join("/tmp", "rfjob.yaml") # does not need to be deleted 
-    fp = open(rfjob_manifest, 'w')
-    fp.write(rfam_k8s_job % (job_name, pod_name, user, job_name, pod_name, cpus, memory, cmd, volume_name, volume_name, pvc_name))
-    fp.close()
-    
-    #print rfam_k8s_job %(job_name, pod_name, user, job_name, pod_name, cpus, cmd, volume_name, volume_name, pvc_name)
-    
-    # this will be generated
-    k8s_api = utils.create_from_yaml(k8s_client, rfjob_manifest)
-
-    # create unique namespace for each user
-    #deps = k8s_api.read_namespaced_deployment(job_name, "default")
-
-    #print("Deployment {0} created".format(deps.metadata.name))
-    
-    
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	# hand the whole submission to the submission daemon if one is running on
+	# this pod, it has the modules and the k8s client loaded already
+	request = {"argv": sys.argv[1:], "cwd": os.getcwd(),
+		"env": dict((var, os.environ[var]) for var in SUBMISSION_ENV_VARS if var in os.environ)}
+	response = rfkubesubd.submit_to_daemon(request)
+
+	if response is None:
+		manifest = prepare_job(args, get_username())
+
+		if manifest is not None:
+			submit_job(manifest)
+
+		return
+
+	sys.stdout.write(response.get("output", ""))
+
+	if response["status"] != "ok":
+		sys.exit("ERROR: Job %s could not be submitted: %s" % (args.job_index, response["message"]))
+
 # -----------------------------------------------------------------------------------
 
 if __name__ == '__main__':
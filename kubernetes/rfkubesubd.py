@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import threading
+import contextlib
+import socketserver
+
+# -----------------------------------------------------------------------------------
+
+# HTTP status codes returned by the API server that are worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+DEFAULT_NAMESPACE = "default"
+
+DEFAULT_QPS = 20
+DEFAULT_BURST = 40
+DEFAULT_MAX_RETRIES = 5
+
+# -----------------------------------------------------------------------------------
+
+class TokenBucket(object):
+	"""
+	Client side rate limiter shared by all submission threads. Allows bursts
+	of up to burst requests and qps requests per second on average.
+	"""
+
+	def __init__(self, qps, burst):
+		self.qps = float(qps)
+		self.burst = float(burst)
+		self.tokens = float(burst)
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		"""
+		Blocks until a token is available
+		"""
+
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.last) * self.qps)
+				self.last = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				wait = (1 - self.tokens) / self.qps
+
+			time.sleep(wait)
+
+# -----------------------------------------------------------------------------------
+
+class JobSubmitter(object):
+	"""
+	Holds a single authenticated BatchV1Api client, whose connection pool is
+	shared by all submission threads, and submits job manifests through it.
+	"""
+
+	def __init__(self, qps=DEFAULT_QPS, burst=DEFAULT_BURST, max_retries=DEFAULT_MAX_RETRIES, batch_api=None):
+		if batch_api is None:
+			from kubernetes import client, config
+
+			config.load_incluster_config()
+			configuration = client.Configuration.get_default_copy()
+			# allow one pooled connection per concurrent submission
+			configuration.connection_pool_maxsize = int(burst)
+
+			batch_api = client.BatchV1Api(client.ApiClient(configuration))
+
+		self.batch_api = batch_api
+		self.rate_limiter = TokenBucket(qps, burst)
+		self.max_retries = max_retries
+
+	def submit(self, manifest):
+		"""
+		Creates a k8s job, retrying with exponential backoff if the API
+		server is throttling (429) or unavailable (5xx). A retry finding the
+		job already there (409) succeeds if it is the job an earlier attempt
+		created without us hearing back.
+
+		manifest: A k8s job manifest as a dictionary
+
+		return: The name of the job created
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		attempt = 0
+
+		while True:
+			self.rate_limiter.acquire()
+
+			try:
+				namespace = manifest["metadata"].get("namespace", DEFAULT_NAMESPACE)
+				job = self.batch_api.create_namespaced_job(namespace=namespace, body=manifest)
+				return job.metadata.name
+
+			except ApiException as e:
+				if e.status == 409 and attempt > 0 and self.is_created(namespace, manifest):
+					return manifest["metadata"]["name"]
+
+				if e.status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+					raise
+
+				retry_after = None
+				if e.headers is not None:
+					retry_after = e.headers.get("Retry-After")
+
+				if retry_after is not None and retry_after.isdigit():
+					delay = int(retry_after)
+				else:
+					delay = 0.5 * (2 ** attempt)
+
+				attempt += 1
+				time.sleep(delay)
+
+	def is_created(self, namespace, manifest):
+		"""
+		Tells whether the existing job of a manifest's name runs the
+		manifest's command, i.e. was created from the manifest
+
+		namespace: The k8s namespace of the job
+		manifest: A k8s job manifest as a dictionary
+
+		return: Boolean
+		"""
+
+		self.rate_limiter.acquire()
+		job = self.batch_api.read_namespaced_job(manifest["metadata"]["name"], namespace)
+
+		return job.spec.template.spec.containers[0].command == manifest["spec"]["template"]["spec"]["containers"][0]["command"]
+
+# -----------------------------------------------------------------------------------
+
+def set_environment(env, names):
+	"""
+	Sets the given environment variables to their values in env, and unsets
+	those missing from it
+
+	env: A dictionary of variable name -> value
+	names: The names of the variables to set or unset
+	"""
+
+	for name in names:
+		if env.get(name) is not None:
+			os.environ[name] = env[name]
+		else:
+			os.environ.pop(name, None)
+
+# -----------------------------------------------------------------------------------
+
+class SubmissionHandler(socketserver.StreamRequestHandler):
+	"""
+	Reads a single JSON encoded request per connection, either an
+	rfkubesub.py command line (argv, cwd and env) or a job manifest, and
+	replies with a JSON status message.
+	"""
+
+	def handle(self):
+		try:
+			request = json.loads(self.rfile.readline().decode("utf-8"))
+
+			if "argv" in request:
+				response = self.server.run_rfkubesub(request)
+			else:
+				job_name = self.server.submitter.submit(request)
+				response = {"status": "ok", "job": job_name}
+
+		# rfkubesub.py exits on errors such as an admission queue without admitter
+		except (Exception, SystemExit) as e:
+			response = {"status": "error", "message": str(e)}
+
+		self.wfile.write((json.dumps(response) + '\n').encode("utf-8"))
+
+# -----------------------------------------------------------------------------------
+
+class SubmissionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+	daemon_threads = True
+	# rfsearch can submit many jobs at once, don't refuse connections
+	request_queue_size = 256
+
+	def __init__(self, socket_path, submitter):
+		self.submitter = submitter
+		# the working directory and environment are shared by all threads
+		self.prepare_lock = threading.Lock()
+		socketserver.UnixStreamServer.__init__(self, socket_path, SubmissionHandler)
+
+	def run_rfkubesub(self, request):
+		"""
+		Runs an rfkubesub.py command line for a client. The job is prepared
+		in the client's working directory and environment, one request at a
+		time, and submitted concurrently with the others.
+
+		request: A dictionary with the command line arguments (argv), working directory (cwd) and
+		         environment variables (env, see rfkubesub.SUBMISSION_ENV_VARS) of the client
+
+		return: A response dictionary, with the output rfkubesub.py printed
+		"""
+
+		import rfkubesub
+
+		output = io.StringIO()
+
+		with self.prepare_lock:
+			cwd = os.getcwd()
+			saved_env = dict((name, os.environ.get(name)) for name in rfkubesub.SUBMISSION_ENV_VARS)
+
+			try:
+				os.chdir(request["cwd"])
+				set_environment(request["env"], rfkubesub.SUBMISSION_ENV_VARS)
+
+				with contextlib.redirect_stdout(output):
+					args = rfkubesub.parse_arguments().parse_args(request["argv"])
+					manifest = rfkubesub.prepare_job(args, rfkubesub.get_username())
+
+			finally:
+				os.chdir(cwd)
+				set_environment(saved_env, rfkubesub.SUBMISSION_ENV_VARS)
+
+		job_name = self.submitter.submit(manifest) if manifest is not None else None
+
+		return {"status": "ok", "job": job_name, "output": output.getvalue()}
+
+# -----------------------------------------------------------------------------------
+
+def get_socket_path():
+	"""
+	Returns the path of the submission daemon socket. Can be set using the
+	RFKUBESUBD_SOCKET environment variable.
+
+	return: A path as a string
+	"""
+
+	return os.environ.get("RFKUBESUBD_SOCKET", os.path.join("/tmp", "rfkubesubd-%s.sock" % os.getuid()))
+
+# -----------------------------------------------------------------------------------
+
+def submit_to_daemon(request, socket_path=None, timeout=300):
+	"""
+	Sends a job manifest or an rfkubesub.py command line (see
+	SubmissionHandler) to a running submission daemon. Returns None if no
+	daemon is listening on socket_path so that the caller can fall back to
+	submitting the job directly. A daemon that does not reply in time is
+	reported as an error, not as missing, as the job may still be created.
+
+	request: A k8s job manifest or rfkubesub.py request as a dictionary
+	socket_path: Path to the daemon socket, None for the default location
+	timeout: Maximum number of seconds to wait for the daemon to reply
+
+	return: The daemon's response as a dictionary, None if the daemon is not running
+	"""
+
+	if socket_path is None:
+		socket_path = get_socket_path()
+
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.settimeout(timeout)
+
+	try:
+		sock.connect(socket_path)
+	except (socket.error, OSError):
+		sock.close()
+		return None
+
+	try:
+		sock.sendall((json.dumps(request) + '\n').encode("utf-8"))
+		fp = sock.makefile('r')
+		response = fp.readline()
+		fp.close()
+	except socket.timeout:
+		return {"status": "error", "message": "No response from submission daemon in %d seconds" % timeout}
+	finally:
+		sock.close()
+
+	if response == '':
+		return {"status": "error", "message": "No response from submission daemon"}
+
+	return json.loads(response)
+
+# -----------------------------------------------------------------------------------
+
+def daemon_is_running(socket_path):
+	"""
+	Checks if a submission daemon is already listening on socket_path
+
+	socket_path: Path to the daemon socket
+
+	return: Boolean
+	"""
+
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+	try:
+		sock.connect(socket_path)
+		return True
+	except (socket.error, OSError):
+		return False
+	finally:
+		sock.close()
+
+# -----------------------------------------------------------------------------------
+
+def run_daemon(socket_path, qps, burst, max_retries):
+	"""
+	Starts the submission daemon and serves requests until killed
+
+	socket_path: Path to the unix socket to listen on
+	qps: Maximum average number of API requests per second
+	burst: Maximum number of API requests in a burst
+	max_retries: Maximum number of retries per submission
+	"""
+
+	# remove stale socket left by a daemon that was killed
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
+
+	submitter = JobSubmitter(qps=qps, burst=burst, max_retries=max_retries)
+	server = SubmissionServer(socket_path, submitter)
+	os.chmod(socket_path, 0o600)
+
+	# make sure the socket gets removed when the daemon is stopped
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='rfkubesub submission daemon')
+
+	parser.add_argument('--socket', help='unix socket to listen on', action="store",
+		type=str, default=None)
+	parser.add_argument('--qps', help='maximum number of API requests per second (default: %d)' % DEFAULT_QPS,
+		action="store", type=float, default=DEFAULT_QPS)
+	parser.add_argument('--burst', help='maximum number of API requests in a burst (default: %d)' % DEFAULT_BURST,
+		action="store", type=int, default=DEFAULT_BURST)
+	parser.add_argument('--max-retries', help='maximum number of retries on 429/5xx (default: %d)' % DEFAULT_MAX_RETRIES,
+		action="store", type=int, default=DEFAULT_MAX_RETRIES)
+	parser.add_argument('--daemonize', help='fork to the background, exit if a daemon is already running',
+		action="store_true")
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	socket_path = args.socket if args.socket is not None else get_socket_path()
+
+	if daemon_is_running(socket_path):
+		if args.daemonize:
+			sys.exit(0)
+		sys.exit("rfkubesubd is already running on %s" % socket_path)
+
+	if args.daemonize:
+		if os.fork() != 0:
+			sys.exit(0)
+		os.setsid()
+
+	run_daemon(socket_path, args.qps, args.burst, args.max_retries)
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+import rfmerge
+import rfresult
+import rfsizing
+
+# -----------------------------------------------------------------------------------
+
+# ledger of the searches run from a family directory, written by rfkubesub.py
+LEDGER_FILE = "rfsearch.ledger"
+
+# rfsearch sets this environment variable to the id of the search it runs,
+# the id of an interrupted search being resumed or its own pid otherwise
+RUN_ID_VAR = "RFAM_RUN_ID"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+	run_id TEXT PRIMARY KEY,
+	started REAL NOT NULL,
+	finished REAL
+);
+CREATE TABLE IF NOT EXISTS shards (
+	job_name TEXT PRIMARY KEY,
+	run_id TEXT NOT NULL,
+	k8s_job TEXT,
+	completion_index INTEGER,
+	command TEXT NOT NULL,
+	cm_checksum TEXT,
+	tblout TEXT,
+	searchout TEXT,
+	stderr TEXT,
+	submit_time REAL NOT NULL,
+	verified_time REAL
+);
+"""
+
+# shard states returned by RunLedger.plan_resume
+SUBMIT = "submit"
+VERIFIED = "verified"
+REATTACH = "reattach"
+
+# -----------------------------------------------------------------------------------
+
+def get_cm_checksum(cmd, checksums):
+	"""
+	Returns the checksum of the CM searched by a cmsearch command, so that
+	shards of a search whose CM was rebuilt are not taken for done
+
+	cmd: A cmsearch shell command
+	checksums: A dictionary of CM path -> checksum, to compute each one once
+
+	return: The sha256 of the CM file, None if cmd is not a cmsearch command
+	"""
+
+	parsed = rfsizing.parse_cmsearch_command(cmd)
+
+	if parsed is None or not os.path.isfile(parsed[0]):
+		return None
+
+	cm_path = parsed[0]
+
+	if cm_path not in checksums:
+		checksums[cm_path] = rfresult.sha256sum(cm_path)
+
+	return checksums[cm_path]
+
+# -----------------------------------------------------------------------------------
+
+def get_k8s_job_states(k8s_jobs):
+	"""
+	Looks up k8s jobs
+
+	k8s_jobs: A list of k8s job names
+
+	return: A dictionary of job name -> active, finished or None if the job does not exist
+	"""
+
+	from kubernetes import client, config
+	from kubernetes.client.rest import ApiException
+
+	import rfkubesub
+
+	config.load_incluster_config()
+	batch_api = client.BatchV1Api()
+	states = {}
+
+	for k8s_job in k8s_jobs:
+		try:
+			job = batch_api.read_namespaced_job(k8s_job, rfkubesub.NAMESPACE)
+		except ApiException as e:
+			if e.status != 404:
+				raise
+			states[k8s_job] = None
+			continue
+
+		conditions = job.status.conditions or []
+		finished = any(c.type in ("Complete", "Failed") and c.status == "True" for c in conditions)
+		states[k8s_job] = "finished" if finished or job.metadata.deletion_timestamp is not None else "active"
+
+	return states
+
+# -----------------------------------------------------------------------------------
+
+def delete_k8s_jobs(k8s_jobs, timeout=60):
+	"""
+	Deletes k8s jobs and their pods, and waits for the jobs to be gone so
+	that rfwait.py does not see them
+
+	k8s_jobs: A list of k8s job names
+	timeout: Maximum number of seconds to wait for the jobs to be gone
+	"""
+
+	from kubernetes import client, config
+	from kubernetes.client.rest import ApiException
+
+	import rfkubesub
+
+	config.load_incluster_config()
+	batch_api = client.BatchV1Api()
+
+	for k8s_job in k8s_jobs:
+		try:
+			batch_api.delete_namespaced_job(k8s_job, rfkubesub.NAMESPACE, propagation_policy="Background")
+		except ApiException as e:
+			if e.status != 404:
+				raise
+
+	deadline = time.time() + timeout
+
+	for k8s_job in k8s_jobs:
+		while time.time() < deadline:
+			try:
+				batch_api.read_namespaced_job(k8s_job, rfkubesub.NAMESPACE)
+			except ApiException as e:
+				if e.status != 404:
+					raise
+				break
+			time.sleep(1)
+
+# -----------------------------------------------------------------------------------
+
+class RunLedger(object):
+	"""
+	SQLite ledger of the shards of the searches run from a family directory:
+	the job running each shard, its command and output files, when it was
+	submitted and when its output was verified complete. An interrupted
+	search resumed with the same run id only submits the shards with no
+	verified output that are not still running.
+	"""
+
+	def __init__(self, path=LEDGER_FILE):
+		self.path = path
+		self.db = sqlite3.connect(path, timeout=60)
+		self.db.row_factory = sqlite3.Row
+		self.db.executescript(SCHEMA)
+
+	def close(self):
+		self.db.close()
+
+	def get_shard(self, job_name):
+		"""
+		return: The ledger row of a shard as a sqlite3.Row, None if it was never submitted
+		"""
+
+		return self.db.execute("SELECT * FROM shards WHERE job_name = ?", (job_name,)).fetchone()
+
+	def record_submission(self, run_id, k8s_job, shards):
+		"""
+		Records the submission of shards, replacing earlier submissions of
+		the same shards
+
+		run_id: The rfsearch run id
+		k8s_job: The name of the k8s job running the shards, None if they are not run as a k8s job
+		shards: A list of (job name, completion index, command, cm checksum) tuples, where
+		completion index is None for single pod jobs
+		"""
+
+		now = time.time()
+
+		with self.db:
+			self.db.execute("INSERT OR IGNORE INTO runs (run_id, started) VALUES (?, ?)", (run_id, now))
+
+			for job_name, completion_index, command, cm_checksum in shards:
+				outputs = rfresult.parse_output_paths(command) or (None, None, None)
+				self.db.execute("INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+					(job_name, run_id, k8s_job, completion_index, command, cm_checksum, outputs[0],
+					outputs[1], outputs[2], now))
+
+	def verify(self, job_names):
+		"""
+		Checks the output of shards, recording those found complete: tblout
+		ending with the cmsearch success trailer and no errors in stderr
+
+		job_names: A list of shard job names
+
+		return: The set of job names whose output is verified
+		"""
+
+		verified = set()
+		now = time.time()
+
+		with self.db:
+			for job_name in job_names:
+				row = self.get_shard(job_name)
+
+				if row is None or row["tblout"] is None:
+					continue
+
+				bundle = rfmerge.get_bundle_path(row["tblout"])
+
+				if row["verified_time"] is None:
+					# staged outputs are checked when they are merged from their bundle
+					if not os.path.exists(bundle) and (not rfmerge.tail_contains(row["tblout"], rfmerge.SUCCESS_STRING) or \
+						not os.path.exists(row["searchout"]) or \
+						(row["stderr"] is not None and rfmerge.check_stderr(row["stderr"]) is not None)):
+						continue
+
+					self.db.execute("UPDATE shards SET verified_time = ? WHERE job_name = ?", (now, job_name))
+
+				# files can be removed once merged
+				elif not os.path.exists(row["tblout"]) and not os.path.exists(bundle):
+					continue
+
+				verified.add(job_name)
+
+		return verified
+
+	def plan_resume(self, job_names, commands, cm_checksums, k8s_job_states):
+		"""
+		Decides what to do with each shard of a job being submitted: shards
+		submitted before with the same command and CM are left alone if
+		their output is verified or if the job running them is still active,
+		the others are submitted. Finished jobs that ran shards to submit
+		again and active jobs that ran a shard whose command changed are
+		returned for deletion, so that rfwait.py doesn't report their stale
+		state for the new submission.
+
+		job_names: The shard job names
+		commands: The command of each shard
+		cm_checksums: The checksum of the CM searched by each shard
+		k8s_job_states: A function taking a list of k8s job names and returning
+		a dictionary of job name -> active, finished or None (see get_k8s_job_states)
+
+		return: A tuple (states, stale_jobs) of a list of SUBMIT, VERIFIED or REATTACH
+		per shard and a list of k8s jobs to delete
+		"""
+
+		rows = [self.get_shard(job_name) for job_name in job_names]
+		verified = self.verify([row["job_name"] for row in rows if row is not None])
+		states = []
+
+		for job_name, cmd, cm_checksum, row in zip(job_names, commands, cm_checksums, rows):
+			if row is None or row["command"] != cmd or row["cm_checksum"] != cm_checksum:
+				states.append(SUBMIT)
+			elif job_name in verified:
+				states.append(VERIFIED)
+			else:
+				states.append(REATTACH)
+
+		old_jobs = set(row["k8s_job"] for row in rows if row is not None and row["k8s_job"] is not None)
+		job_states = k8s_job_states(sorted(old_jobs)) if len(old_jobs) > 0 else {}
+		stale_jobs = set()
+
+		for state, row in zip(states, rows):
+			if row is None or row["k8s_job"] is None:
+				continue
+
+			job_state = job_states.get(row["k8s_job"])
+
+			if state == SUBMIT and job_state is not None:
+				stale_jobs.add(row["k8s_job"])
+
+			elif state == REATTACH and job_state == "finished":
+				stale_jobs.add(row["k8s_job"])
+
+		# shards of stale or vanished jobs that are not verified have to run again
+		for i, row in enumerate(rows):
+			if states[i] == REATTACH and (row["k8s_job"] is None or row["k8s_job"] in stale_jobs or
+				job_states.get(row["k8s_job"]) is None):
+				states[i] = SUBMIT
+
+		return (states, sorted(stale_jobs))
+
+	def get_resumable_run(self):
+		"""
+		return: The id of the most recent run that did not finish, None if there is none
+		"""
+
+		row = self.db.execute("SELECT run_id FROM runs WHERE finished IS NULL ORDER BY started DESC LIMIT 1").fetchone()
+
+		return row["run_id"] if row is not None else None
+
+	def finish_run(self, run_id):
+		"""
+		Marks a run as finished, it will not be resumed
+		"""
+
+		with self.db:
+			self.db.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (time.time(), run_id))
+
+	def print_status(self):
+		"""
+		Prints the number of submitted and verified shards of each run
+		"""
+
+		print ("%-12s %-20s %-10s %10s %10s" % ("run", "started", "status", "shards", "verified"))
+
+		for row in self.db.execute("SELECT runs.run_id, started, finished, COUNT(job_name), COUNT(verified_time) "
+			"FROM runs LEFT JOIN shards ON runs.run_id = shards.run_id GROUP BY runs.run_id ORDER BY started"):
+			print ("%-12s %-20s %-10s %10d %10d" % (row[0], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[1])),
+				"finished" if row[2] is not None else "open", row[3], row[4]))
+
+# -----------------------------------------------------------------------------------
+
+def resume_shards(user, job_index, commands, batch):
+	"""
+	Drops the shards of an rfsearch job that a previous submission of the
+	same run already completed or is still running, deleting stale k8s jobs,
+	when rfsearch set a run id. Used by rfkubesub.py before submitting.
+
+	user: A valid Rfam cloud account username
+	job_index: The rfsearch job name (e.g. s-1234)
+	commands: The command of each shard
+	batch: True if the shards are submitted as an Indexed job, named <job_index>-<shard index>
+
+	return: A tuple (commands, indexes, suffix) of the commands left to submit,
+	their index in commands and a suffix to make the new k8s job name unique,
+	None if the job was never submitted before
+	"""
+
+	run_id = os.environ.get(RUN_ID_VAR)
+
+	if run_id is None:
+		return (commands, list(range(len(commands))), None)
+
+	job_names = ["%s-%d" % (job_index, i) for i in range(len(commands))] if batch else [job_index]
+	checksums = {}
+	cm_checksums = [get_cm_checksum(cmd, checksums) for cmd in commands]
+
+	ledger = RunLedger()
+
+	try:
+		states, stale_jobs = ledger.plan_resume(job_names, commands, cm_checksums, get_k8s_job_states)
+		resumed = any(ledger.get_shard(job_name) is not None for job_name in job_names)
+	finally:
+		ledger.close()
+
+	if len(stale_jobs) > 0:
+		delete_k8s_jobs(stale_jobs)
+
+	nverified = states.count(VERIFIED)
+	nreattached = states.count(REATTACH)
+
+	if nverified + nreattached > 0:
+		print ("Resuming run %s: %d of %d searches already done, %d still running" % (run_id, nverified,
+			len(commands), nreattached))
+
+	indexes = [i for i, state in enumerate(states) if state == SUBMIT]
+
+	# the k8s jobs of earlier submissions may still be running
+	suffix = "-r%d" % time.time() if resumed else None
+
+	return ([commands[i] for i in indexes], indexes, suffix)
+
+# -----------------------------------------------------------------------------------
+
+def record_shards(user, k8s_job, job_index, commands, indexes, batch):
+	"""
+	Records submitted shards in the ledger of the family directory, when
+	rfsearch set a run id
+
+	user: A valid Rfam cloud account username
+	k8s_job: The name of the k8s job running the shards, None if they are not run as a k8s job
+	job_index: The rfsearch job name (e.g. s-1234)
+	commands: The command of each shard submitted, as given to rfkubesub.py
+	indexes: The shard index of each command
+	batch: True if the shards are submitted as an Indexed job
+	"""
+
+	run_id = os.environ.get(RUN_ID_VAR)
+
+	if run_id is None:
+		return
+
+	checksums = {}
+	shards = []
+
+	for completion_index, (shard_index, cmd) in enumerate(zip(indexes, commands)):
+		job_name = "%s-%d" % (job_index, shard_index) if batch else job_index
+		shards.append((job_name, completion_index if batch else None, cmd, get_cm_checksum(cmd, checksums)))
+
+	ledger = RunLedger()
+
+	try:
+		ledger.record_submission(run_id, k8s_job, shards)
+	finally:
+		ledger.close()
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Ledger of the rfsearch runs of a family directory')
+	parser.add_argument('--ledger', help='path to the ledger (default: %s)' % LEDGER_FILE, action="store",
+		type=str, default=LEDGER_FILE)
+
+	subparsers = parser.add_subparsers(dest="command")
+
+	subparsers.add_parser("resume", help='print the id of the last run that did not finish, if any')
+
+	finish_parser = subparsers.add_parser("finish", help='mark a run as finished')
+	finish_parser.add_argument('run_id', help='the rfsearch run id')
+
+	verify_parser = subparsers.add_parser("verify", help='record the shards whose output is complete')
+	verify_parser.add_argument('job_names', help='shard job names', nargs='+', metavar="JOBNAME")
+
+	subparsers.add_parser("status", help='print the runs in the ledger')
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	if args.command is None:
+		parser.print_help()
+		sys.exit(1)
+
+	# nothing to resume or show in a directory where nothing was submitted
+	if not os.path.exists(args.ledger):
+		sys.exit(0)
+
+	ledger = RunLedger(args.ledger)
+
+	if args.command == "resume":
+		run_id = ledger.get_resumable_run()
+		if run_id is not None:
+			print (run_id)
+
+	elif args.command == "finish":
+		ledger.finish_run(args.run_id)
+
+	elif args.command == "verify":
+		ledger.verify(args.job_names)
+
+	elif args.command == "status":
+		ledger.print_status()
+
+	ledger.close()
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import math
+import time
+import fcntl
+import signal
+import argparse
+import subprocess
+
+import rfpool
+import rfkubesub
+
+# -----------------------------------------------------------------------------------
+
+# the queue is private to the machine, and shared by all rfsearch runs of the
+# user on it so that they share its cpus and memory
+QUEUE_DIR = os.environ.get("RFAM_LOCAL_QUEUE_DIR", os.path.join(os.path.expanduser("~"), ".rflocal"))
+
+# the executor holds an exclusive lock on this file, in the queue directory
+LOCK_FILE = "executor.lock"
+LOG_FILE = "executor.log"
+
+# resources the executor packs tasks into, all cpus the process may run on
+# and the memory available when it starts by default
+LOCAL_CPUS = int(os.environ.get("RFAM_LOCAL_CPUS", 0))
+LOCAL_MEMORY = int(os.environ.get("RFAM_LOCAL_MEMORY", 0))
+
+# seconds between looks at the queue and the running tasks
+POLL_INTERVAL = 0.2
+
+# the executor exits once the queue has been empty for this many seconds
+DEFAULT_IDLE_TIMEOUT = 300
+
+# smaller tasks are started ahead of the oldest pending one while it does not
+# fit, unless it has been waiting for this many seconds, after which nothing
+# else is started until enough resources are free for it
+MAX_BACKFILL_SECS = 600
+
+# exit statuses of wait, as for rfwait.py
+SUCCESS = 0
+JOB_FAILED = 1
+TIMEOUT = 2
+
+# -----------------------------------------------------------------------------------
+
+def get_capacity(cpus=LOCAL_CPUS, memory=LOCAL_MEMORY):
+	"""
+	Returns the resources tasks are packed into
+
+	cpus: Number of cpus to use, 0 for all cpus this process may run on
+	memory: Memory to use in Mb, 0 for the memory available now
+
+	return: A tuple (list of cpu ids, memory in Mb)
+	"""
+
+	cpu_ids = sorted(os.sched_getaffinity(0))
+	if cpus > 0:
+		cpu_ids = cpu_ids[:cpus]
+
+	if memory <= 0:
+		meminfo = {}
+		for line in open("/proc/meminfo", 'r'):
+			fields = line.split()
+			meminfo[fields[0].rstrip(':')] = int(fields[1])
+
+		memory = meminfo.get("MemAvailable", meminfo["MemTotal"]) // 1024
+
+	return (cpu_ids, memory)
+
+# -----------------------------------------------------------------------------------
+
+class LocalExecutor(object):
+	"""
+	Runs the tasks of a rfpool.TaskQueue as local processes, as many at a
+	time as fit in the machine. Each task is given its cpus and memory
+	Mb out of the free ones, oldest task first, and runs pinned to its
+	cpus. Tasks asking for more than the whole machine are given all of it.
+	"""
+
+	def __init__(self, task_queue, cpu_ids, memory):
+		self.task_queue = task_queue
+		self.cpu_ids = cpu_ids
+		self.memory = memory
+		self.free_cpus = set(cpu_ids)
+		self.free_memory = memory
+		self.running = {} # task file name -> (task, process, cpu ids, memory)
+
+	def get_request(self, task):
+		"""
+		return: A tuple (number of cpus, memory in Mb) a task is given
+		"""
+
+		cpus = min(max(1, int(task["cpus"])), len(self.cpu_ids))
+		memory = min(int(math.ceil(float(task["memory"]))), self.memory)
+
+		return (cpus, memory)
+
+	def fits(self, task):
+		"""
+		return: True if there are enough free resources to start a task
+		"""
+
+		cpus, memory = self.get_request(task)
+
+		return cpus <= len(self.free_cpus) and memory <= self.free_memory
+
+	def start_tasks(self):
+		"""
+		Starts pending tasks while there are resources for them
+
+		return: Number of tasks started
+		"""
+
+		nstarted = 0
+		skipped = []
+
+		def fits(task):
+			# don't let smaller tasks starve the oldest one
+			if len(skipped) > 0 and time.time() - skipped[0]["submitted"] > MAX_BACKFILL_SECS:
+				return False
+			if not self.fits(task):
+				skipped.append(task)
+				return False
+			return True
+
+		while True:
+			del skipped[:]
+			claimed = self.task_queue.claim("local-%d" % os.getpid(), fits=fits)
+
+			if claimed is None:
+				return nstarted
+
+			self.start(*claimed)
+			nstarted += 1
+
+	def start(self, file_name, task):
+		"""
+		Starts a claimed task pinned to the lowest numbered free cpus
+
+		file_name: The task file name
+		task: The task dictionary
+		"""
+
+		cpus, memory = self.get_request(task)
+		cpu_ids = sorted(self.free_cpus)[:cpus]
+
+		self.free_cpus.difference_update(cpu_ids)
+		self.free_memory -= memory
+
+		def pin():
+			os.setsid()
+			os.sched_setaffinity(0, cpu_ids)
+
+		try:
+			process = subprocess.Popen(["sh", "-c", task["cmd"]], cwd=task.get("cwd"), preexec_fn=pin,
+				stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+		except OSError as e:
+			print ("Task %s could not be started: %s" % (task["name"], e))
+			self.free_cpus.update(cpu_ids)
+			self.free_memory += memory
+			self.task_queue.complete(file_name, task, -1)
+			return
+
+		self.running[file_name] = (task, process, cpu_ids, memory)
+
+	def reap_tasks(self):
+		"""
+		Records the tasks that finished and frees their resources
+
+		return: Number of tasks that finished
+		"""
+
+		nfinished = 0
+
+		for file_name in list(self.running):
+			task, process, cpu_ids, memory = self.running[file_name]
+
+			if process.poll() is None:
+				continue
+
+			self.task_queue.complete(file_name, task, process.returncode)
+			self.free_cpus.update(cpu_ids)
+			self.free_memory += memory
+			del self.running[file_name]
+			nfinished += 1
+
+		return nfinished
+
+	def heartbeat(self):
+		"""
+		Refreshes the claims on the running tasks
+		"""
+
+		for file_name in self.running:
+			self.task_queue.heartbeat(file_name)
+
+	def stop(self):
+		"""
+		Terminates the running tasks. Their claims are no longer refreshed,
+		so they are queued again by the next executor.
+		"""
+
+		for task, process, cpu_ids, memory in self.running.values():
+			try:
+				os.killpg(process.pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+	def run(self, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+		"""
+		Runs queued tasks until the queue has been empty for idle_timeout seconds
+
+		idle_timeout: Number of idle seconds after which to return
+
+		return: Number of tasks run
+		"""
+
+		ntasks = 0
+		last_active = time.time()
+		last_heartbeat = time.time()
+		last_requeue = 0
+
+		while len(self.running) > 0 or time.time() - last_active < idle_timeout:
+			if time.time() - last_requeue >= rfpool.STALE_SECS:
+				self.task_queue.requeue_stale()
+				self.task_queue.expire_done()
+				last_requeue = time.time()
+
+			if time.time() - last_heartbeat >= rfpool.HEARTBEAT_INTERVAL:
+				self.heartbeat()
+				last_heartbeat = time.time()
+
+			ntasks += self.reap_tasks()
+			self.start_tasks()
+
+			if len(self.running) > 0:
+				last_active = time.time()
+
+			time.sleep(POLL_INTERVAL)
+
+		return ntasks
+
+# -----------------------------------------------------------------------------------
+
+def lock_executor(queue_dir):
+	"""
+	Takes the lock held by the executor of a queue
+
+	queue_dir: The queue directory
+
+	return: The open lock file, None if an executor is running
+	"""
+
+	fp = open(os.path.join(queue_dir, LOCK_FILE), 'a')
+
+	try:
+		fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except (IOError, OSError):
+		fp.close()
+		return None
+
+	return fp
+
+# -----------------------------------------------------------------------------------
+
+def serve(task_queue, cpus=LOCAL_CPUS, memory=LOCAL_MEMORY, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+	"""
+	Runs the executor of a queue, unless one is already running
+
+	task_queue: A rfpool.TaskQueue object
+	cpus: Number of cpus to use, 0 for all
+	memory: Memory to use in Mb, 0 for the memory available now
+	idle_timeout: Number of idle seconds after which to exit
+	"""
+
+	lock = lock_executor(task_queue.queue_dir)
+
+	if lock is None:
+		return
+
+	cpu_ids, memory = get_capacity(cpus, memory)
+	executor = LocalExecutor(task_queue, cpu_ids, memory)
+
+	print ("Executor %d running tasks on cpus %s and %d Mb" % (os.getpid(), ",".join(map(str, cpu_ids)), memory))
+	sys.stdout.flush()
+
+	try:
+		while True:
+			executor.run(idle_timeout=idle_timeout)
+
+			# tasks queued while we were deciding to exit are run by us if their
+			# submitter saw the lock still held, otherwise it starts a new executor
+			fcntl.flock(lock, fcntl.LOCK_UN)
+
+			if task_queue.depth()[0] == 0:
+				return
+
+			try:
+				fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except (IOError, OSError):
+				return
+	finally:
+		executor.stop()
+		lock.close()
+
+# -----------------------------------------------------------------------------------
+
+def ensure_executor(queue_dir):
+	"""
+	Starts an executor for a queue in the background if none is running
+
+	queue_dir: The queue directory
+	"""
+
+	lock = lock_executor(queue_dir)
+
+	if lock is None:
+		return
+
+	lock.close()
+
+	log = open(os.path.join(queue_dir, LOG_FILE), 'a')
+	subprocess.Popen([sys.executable, os.path.abspath(__file__), "--queue-dir", queue_dir, "serve"],
+		stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+	log.close()
+
+# -----------------------------------------------------------------------------------
+
+def submit_tasks(task_queue, tasks, cpus, memory):
+	"""
+	Queues tasks for the local executor, starting it if needed
+
+	task_queue: A rfpool.TaskQueue object
+	tasks: A list of (name, command) tuples
+	cpus: Number of cpus each command uses
+	memory: Memory each command uses in Mb
+	"""
+
+	for name, cmd in tasks:
+		task_queue.put(name, cmd, cpus, memory, cwd=os.getcwd())
+
+	# queued first, so that an executor that is about to exit still sees them
+	ensure_executor(task_queue.queue_dir)
+
+# -----------------------------------------------------------------------------------
+
+def get_phases(task_queue, job_names):
+	"""
+	Looks up the phases of tasks, as rfwait.py reports the phases of jobs
+
+	task_queue: A rfpool.TaskQueue object
+	job_names: A list of task names
+
+	return: A dictionary of task name -> (phase, reason), the phase being one
+		of Pending, Running, Succeeded or Failed
+	"""
+
+	states = task_queue.get_states(job_names)
+	phases = {}
+
+	for job_name in job_names:
+		state, exit_status = states.get(job_name, (None, None))
+
+		if state == rfpool.PENDING:
+			phases[job_name] = ("Pending", "")
+		elif state == rfpool.RUNNING:
+			phases[job_name] = ("Running", "")
+		elif state == rfpool.DONE and exit_status == 0:
+			phases[job_name] = ("Succeeded", "")
+		elif state == rfpool.DONE:
+			phases[job_name] = ("Failed", "exit status %d" % exit_status)
+		else:
+			phases[job_name] = ("Failed", "not queued")
+
+	return phases
+
+# -----------------------------------------------------------------------------------
+
+def count_phases(phases):
+	"""
+	return: A tuple (number succeeded, number running, number pending)
+	"""
+
+	counts = dict((phase, 0) for phase in ("Succeeded", "Running", "Pending"))
+
+	for phase, reason in phases.values():
+		if phase in counts:
+			counts[phase] += 1
+
+	return (counts["Succeeded"], counts["Running"], counts["Pending"])
+
+# -----------------------------------------------------------------------------------
+
+def wait_for_tasks(task_queue, job_names, timeout=None, progress_interval=30):
+	"""
+	Polls the queue until all tasks finished, any task failed or the
+	timeout is reached, printing progress lines as rfwait.py does:
+	progress <nsucceeded> <nrunning> <nwaiting>
+
+	task_queue: A rfpool.TaskQueue object
+	job_names: A list of task names
+	timeout: Maximum number of seconds to wait, None for no limit
+	progress_interval: Minimum number of seconds between progress lines
+
+	return: A tuple (one of SUCCESS, JOB_FAILED or TIMEOUT, dictionary of task name -> (phase, reason))
+	"""
+
+	start_time = time.time()
+	last_counts = None
+	last_print = 0
+
+	while True:
+		phases = get_phases(task_queue, job_names)
+		counts = count_phases(phases)
+
+		if counts != last_counts and time.time() - last_print >= progress_interval:
+			print ("progress %d %d %d" % counts)
+			sys.stdout.flush()
+			last_counts = counts
+			last_print = time.time()
+
+		if any(phase == "Failed" for phase, reason in phases.values()):
+			return (JOB_FAILED, phases)
+
+		if counts[0] == len(job_names):
+			return (SUCCESS, phases)
+
+		if timeout is not None and time.time() - start_time > timeout:
+			return (TIMEOUT, phases)
+
+		# in case the executor was killed
+		if counts[2] > 0:
+			ensure_executor(task_queue.queue_dir)
+
+		time.sleep(1)
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Runs rfsearch jobs as local processes, packed into the cpus and memory of this machine')
+	parser.add_argument('--queue-dir', help='queue directory (default: %s)' % QUEUE_DIR, action="store",
+		type=str, default=QUEUE_DIR)
+	subparsers = parser.add_subparsers(dest="command")
+
+	submit = subparsers.add_parser("submit", help='queue a job, with the arguments of rfkubesub.py')
+	submit.add_argument('cmd', help='command to run, or a file of commands (--batch)')
+	submit.add_argument('cpus', help='number of cpus the command uses', type=int)
+	submit.add_argument('memory', help='memory the command uses in Mb')
+	submit.add_argument('job_index', help='job name (e.g. s-1234-1)')
+	submit.add_argument('--batch', help='cmd is a file with one shard command per line, queued as jobs <job_index>-<line number from 0>',
+		action="store_true", default=False)
+
+	serve = subparsers.add_parser("serve", help='run queued jobs (started by submit when needed)')
+	serve.add_argument('--cpus', help='number of cpus to use (default: all)', action="store", type=int, default=LOCAL_CPUS)
+	serve.add_argument('--memory', help='memory to use in Mb (default: available memory)', action="store",
+		type=int, default=LOCAL_MEMORY)
+	serve.add_argument('--idle-timeout', help='seconds without jobs after which to exit (default: %d)' % DEFAULT_IDLE_TIMEOUT,
+		action="store", type=int, default=DEFAULT_IDLE_TIMEOUT)
+
+	status = subparsers.add_parser("status", help='print "<jobname> <phase> <reason>" for each job, or the state of the queue')
+	status.add_argument('job_names', help='job names', nargs='*', metavar="JOBNAME")
+
+	wait = subparsers.add_parser("wait", help='wait for jobs to finish, printing progress as rfwait.py does')
+	wait.add_argument('job_names', help='job names', nargs='+', metavar="JOBNAME")
+	wait.add_argument('--timeout', help='maximum number of seconds to wait', action="store", type=int, default=None)
+	wait.add_argument('--progress-interval', help='minimum number of seconds between progress lines (default: 30)',
+		action="store", type=int, default=30)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	task_queue = rfpool.TaskQueue(args.queue_dir)
+
+	if args.command == "submit":
+		if args.batch:
+			commands = rfkubesub.read_batch_commands(args.cmd)
+			names = ["%s-%d" % (args.job_index, i) for i in range(len(commands))]
+		else:
+			commands = [args.cmd]
+			names = [args.job_index]
+
+		submit_tasks(task_queue, list(zip(names, commands)), args.cpus, args.memory)
+
+	elif args.command == "serve":
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+		serve(task_queue, cpus=args.cpus, memory=args.memory, idle_timeout=args.idle_timeout)
+
+	elif args.command == "status" and len(args.job_names) > 0:
+		phases = get_phases(task_queue, args.job_names)
+
+		for job_name in args.job_names:
+			print ("%s %s %s" % (job_name, phases[job_name][0], phases[job_name][1]))
+
+	elif args.command == "status":
+		rfpool.print_status(task_queue)
+
+	elif args.command == "wait":
+		status, phases = wait_for_tasks(task_queue, args.job_names, timeout=args.timeout,
+			progress_interval=args.progress_interval)
+
+		print ("progress %d %d %d" % count_phases(phases))
+
+		for job_name in sorted(phases):
+			print ("%s %s %s" % (job_name, phases[job_name][0], phases[job_name][1]))
+
+		sys.exit(status)
+
+	else:
+		parser.print_help()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import signal
+import argparse
+
+import rfkubesub
+
+# -----------------------------------------------------------------------------------
+
+# ConfigMap holding the pool settings, read every cycle:
+#   size:         number of warm login pods to keep ready per pool user (default DEFAULT_POOL_SIZE)
+#   idle_timeout: seconds after which idle login pods are scaled to zero (default DEFAULT_IDLE_TIMEOUT)
+#   users:        ["<user>", ...] users whose sessions start from the pool, read by rfcloud.py --start
+CONFIG_MAP = "rfam-login-pool"
+
+# deployment of the warm login pods of a pool user, which mount only the
+# user's directory of the shared home volume. Claimed pods are relabeled out
+# of its selector, so it replaces them at once
+POOL_DEPLOYMENT = "rfam-login-pool-%s"
+
+# labels of the warm login pods, and of their deployments
+POOL_LABELS = {"app": "rfam-login-pool", "tier": "pool"}
+
+# set to "true" on login pods claimed from the pool by rfcloud.py
+POOLED_LABEL = "rfam.org/pooled"
+
+# login pods of users, claimed from the pool or created by their own deployment
+LOGIN_LABEL_SELECTOR = "user,tier=frontend"
+
+DEFAULT_POOL_SIZE = 1
+DEFAULT_IDLE_TIMEOUT = 3600
+DEFAULT_INTERVAL = 60
+
+# lists the pid and stat line of every process of a login pod, the first
+# line being the pid of the shell running it
+PROCESS_PROBE = "echo $$; cat /proc/[0-9]*/stat 2> /dev/null"
+
+# -----------------------------------------------------------------------------------
+
+def count_user_processes(probe_output):
+	"""
+	Counts the processes of a login pod other than its init process, from
+	the output of PROCESS_PROBE: interactive sessions (kubectl exec) and
+	anything they started, including background runs left behind
+
+	probe_output: The output of PROCESS_PROBE
+
+	return: The number of processes
+	"""
+
+	lines = probe_output.strip().split('\n')
+	probe_pid = int(lines[0])
+	count = 0
+
+	for line in lines[1:]:
+		# the command name is in parentheses and may contain spaces
+		pid = int(line.split(' ', 1)[0])
+		ppid = int(line[line.rindex(')') + 2:].split()[1])
+
+		if pid not in (1, probe_pid) and ppid != probe_pid:
+			count += 1
+
+	return count
+
+# -----------------------------------------------------------------------------------
+
+def build_pool_deployment(user, size):
+	"""
+	Builds the deployment of the warm login pods of a pool user. Its pods
+	mount the user's directory of the shared home volume as /workdir, the
+	same way as the jobs they submit (see rfkubesub.get_workdir_claim), and
+	never the directories of other users
+
+	user: A valid Rfam cloud account username
+	size: Number of warm login pods
+
+	return: A k8s deployment manifest as a dictionary
+	"""
+
+	labels = dict(POOL_LABELS, user=user)
+
+	container = {"name": "rfam-login-pod", "image": "rfam/cloud:kubes", "imagePullPolicy": "Always",
+		"ports": [{"containerPort": 9876}],
+		"env": [{"name": rfkubesub.USER_VAR, "value": user}, {"name": rfkubesub.ADMISSION_QUEUE_VAR, "value": "0"}],
+		"volumeMounts": [{"name": "rfhome-pv", "mountPath": rfkubesub.WORKDIR, "subPath": user},
+			{"name": "nfs-pv", "mountPath": "/Rfam/rfamseq"},
+			{"name": "rfresult-pv", "mountPath": "/Rfam/rfresults"}],
+		"stdin": True, "tty": True}
+
+	volumes = [{"name": "rfhome-pv", "persistentVolumeClaim": {"claimName": rfkubesub.HOME_VOLUME_CLAIM}},
+		{"name": "nfs-pv", "persistentVolumeClaim": {"claimName": "nfs-pvc"}},
+		{"name": "rfresult-pv", "persistentVolumeClaim": {"claimName": "rfresult-pvc"}}]
+
+	return {"apiVersion": "apps/v1", "kind": "Deployment",
+		"metadata": {"name": POOL_DEPLOYMENT % user, "labels": labels},
+		"spec": {"replicas": size, "selector": {"matchLabels": labels},
+			"template": {"metadata": {"labels": labels},
+				"spec": {"containers": [container], "volumes": volumes, "restartPolicy": "Always"}}}}
+
+# -----------------------------------------------------------------------------------
+
+class LoginPoolManager(object):
+	"""
+	Keeps the warm login pods of each pool user at the configured size, and scales the
+	login pods of users to zero once no process ran in them for the idle
+	timeout: pods claimed from the pool are deleted, and the deployments
+	of the other users are scaled to 0 replicas, for rfcloud.py --start to
+	scale back up.
+	"""
+
+	def __init__(self, core_api, apps_api, namespace):
+		self.core_api = core_api
+		self.apps_api = apps_api
+		self.namespace = namespace
+
+		self.idle_since = {} # login pod name -> time it was first found idle
+
+	def read_settings(self):
+		"""
+		return: A tuple (size, idle_timeout, users)
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		try:
+			data = self.core_api.read_namespaced_config_map(CONFIG_MAP, self.namespace).data or {}
+		except ApiException as e:
+			if e.status != 404:
+				raise
+			data = {}
+
+		return (int(data.get("size", DEFAULT_POOL_SIZE)), int(data.get("idle_timeout", DEFAULT_IDLE_TIMEOUT)),
+			json.loads(data.get("users", "[]")))
+
+	def resize_pool(self, size, users):
+		"""
+		Keeps a pool deployment of size warm login pods for each pool user,
+		and deletes those of users no longer in the pool
+
+		size: Number of warm login pods per user
+		users: A list of pool usernames
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		selector = ",".join("%s=%s" % item for item in sorted(POOL_LABELS.items()))
+		deployments = self.apps_api.list_namespaced_deployment(self.namespace, label_selector=selector).items
+		replicas = dict((deployment.metadata.labels["user"], deployment.spec.replicas) for deployment in deployments)
+
+		for user in users:
+			if user not in replicas:
+				self.apps_api.create_namespaced_deployment(self.namespace, build_pool_deployment(user, size))
+				print ("Created the login pool of %s" % user)
+			elif replicas[user] != size:
+				self.apps_api.patch_namespaced_deployment_scale(POOL_DEPLOYMENT % user, self.namespace,
+					{"spec": {"replicas": size}})
+
+		for user in replicas:
+			if user not in users:
+				try:
+					self.apps_api.delete_namespaced_deployment(POOL_DEPLOYMENT % user, self.namespace)
+				except ApiException as e:
+					if e.status != 404:
+						raise
+				print ("Deleted the login pool of %s" % user)
+
+	def count_processes(self, pod):
+		"""
+		Counts the processes running in a login pod, see count_user_processes
+
+		pod: A V1Pod object
+
+		return: The number of processes, None if they could not be listed
+		"""
+
+		from kubernetes.stream import stream
+		from kubernetes.client.rest import ApiException
+
+		try:
+			output = stream(self.core_api.connect_get_namespaced_pod_exec, pod.metadata.name, self.namespace,
+				command=["sh", "-c", PROCESS_PROBE], stderr=False, stdin=False, stdout=True, tty=False)
+		except (ApiException, ValueError) as e:
+			print ("ERROR: Unable to list the processes of %s: %s" % (pod.metadata.name, e))
+			return None
+
+		return count_user_processes(output)
+
+	def scale_to_zero(self, pod):
+		"""
+		Stops an idle login pod
+
+		pod: A V1Pod object
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		labels = pod.metadata.labels or {}
+
+		try:
+			if labels.get(POOLED_LABEL) == "true":
+				self.core_api.delete_namespaced_pod(pod.metadata.name, self.namespace)
+			else:
+				self.apps_api.patch_namespaced_deployment_scale("rfam-login-pod-%s" % labels["user"], self.namespace,
+					{"spec": {"replicas": 0}})
+		except ApiException as e:
+			if e.status != 404:
+				print ("ERROR: Unable to stop login pod %s: %s" % (pod.metadata.name, e.reason))
+			return
+
+		print ("Stopped idle login pod %s of %s" % (pod.metadata.name, labels["user"]))
+
+	def cycle(self):
+		"""
+		Runs one management cycle
+		"""
+
+		size, idle_timeout, users = self.read_settings()
+		self.resize_pool(size, users)
+
+		now = time.time()
+		pods = self.core_api.list_namespaced_pod(self.namespace, label_selector=LOGIN_LABEL_SELECTOR).items
+		running = [pod for pod in pods if pod.status.phase == "Running" and pod.metadata.deletion_timestamp is None]
+
+		for pod in running:
+			name = pod.metadata.name
+
+			if self.count_processes(pod) != 0:
+				self.idle_since.pop(name, None)
+				continue
+
+			self.idle_since.setdefault(name, now)
+
+			if now - self.idle_since[name] >= idle_timeout:
+				self.scale_to_zero(pod)
+				del self.idle_since[name]
+
+		names = set(pod.metadata.name for pod in running)
+		self.idle_since = dict((name, since) for name, since in self.idle_since.items() if name in names)
+
+	def run(self, interval=DEFAULT_INTERVAL):
+		"""
+		Runs management cycles every interval seconds
+		"""
+
+		while True:
+			try:
+				self.cycle()
+			except Exception as e:
+				print ("ERROR: Login pool cycle failed: %s" % e)
+
+			sys.stdout.flush()
+			time.sleep(interval)
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Keeps a pool of warm Rfam login pods and stops idle ones')
+
+	parser.add_argument('--namespace', help='k8s namespace of the login pods (default: %s)' % rfkubesub.NAMESPACE,
+		action="store", type=str, default=rfkubesub.NAMESPACE)
+	parser.add_argument('--interval', help='seconds between management cycles (default: %d)' % DEFAULT_INTERVAL,
+		action="store", type=int, default=DEFAULT_INTERVAL)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	from kubernetes import client, config
+
+	try:
+		config.load_kube_config()
+	except Exception:
+		config.load_incluster_config()
+
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	manager = LoginPoolManager(client.CoreV1Api(), client.AppsV1Api(), args.namespace)
+	manager.run(interval=args.interval)
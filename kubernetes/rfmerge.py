@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import time
+import heapq
+import shutil
+import tarfile
+import argparse
+import threading
+import queue
+
+# -----------------------------------------------------------------------------------
+
+# string cmsearch writes at the end of complete --tblout files
+SUCCESS_STRING = "# [ok]"
+
+# suffix of the score sorted hit index written next to each merged TBLOUT
+SORTED_SUFFIX = ".sorted"
+
+# suffix of the list of shards appended to each merged TBLOUT, one job name per line
+MERGED_SUFFIX = ".merged"
+
+# shards run with staged outputs (see rfkubesub.build_staged_command)
+# publish them in a single gzipped tar file named after the tblout,
+# with the tblout, searchout and stderr as these members
+BUNDLE_SUFFIX = ".tgz"
+BUNDLE_TBLOUT = "tblout"
+BUNDLE_SEARCHOUT = "searchout"
+BUNDLE_STDERR = "stderr"
+
+# maximum number of seconds to wait for a finished shard's output to
+# become visible on the shared file system
+DEFAULT_VISIBILITY_TIMEOUT = 1200
+
+# minimum number of seconds between rewrites of the sorted hit indexes
+DEFAULT_INDEX_INTERVAL = 30
+
+# -----------------------------------------------------------------------------------
+
+def read_merge_plan(plan_file):
+	"""
+	Reads a merge plan written by rfsearch, one shard per line:
+	<jobname> <tblout> <searchout> <stderr> <merged tblout> <merged searchout>
+
+	plan_file: Path to the merge plan
+
+	return: A dictionary of job name -> tuple of the 5 paths
+	"""
+
+	plan = {}
+
+	fp = open(plan_file, 'r')
+	for line in fp:
+		fields = line.split()
+		if len(fields) == 6:
+			plan[fields[0]] = tuple(fields[1:])
+	fp.close()
+
+	return plan
+
+# -----------------------------------------------------------------------------------
+
+def tail_contains(path, string, nbytes=4096):
+	"""
+	Checks if the end of a file contains a string
+
+	path: Path to the file
+	string: The string to look for
+	nbytes: Number of bytes at the end of the file to look at
+
+	return: Boolean
+	"""
+
+	if not os.path.exists(path) or os.path.getsize(path) == 0:
+		return False
+
+	fp = open(path, 'rb')
+	fp.seek(max(0, os.path.getsize(path) - nbytes))
+	tail = fp.read().decode("utf-8", "replace")
+	fp.close()
+
+	return string in tail
+
+# -----------------------------------------------------------------------------------
+
+def get_bundle_path(tblout):
+	"""
+	tblout: Path to a shard's tblout
+
+	return: Path to the bundle the shard's outputs are published in when staged
+	"""
+
+	return tblout + BUNDLE_SUFFIX
+
+# -----------------------------------------------------------------------------------
+
+def output_complete(tblout, string=SUCCESS_STRING):
+	"""
+	Checks if a shard's output is complete: its tblout ends with the
+	success string, or its outputs were published in a bundle, which only
+	happens once the shard succeeded
+
+	tblout: Path to the shard's tblout
+	string: The string a complete tblout ends with
+
+	return: Boolean
+	"""
+
+	return tail_contains(tblout, string) or os.path.exists(get_bundle_path(tblout))
+
+# -----------------------------------------------------------------------------------
+
+def find_stderr_error(lines):
+	"""
+	Looks for errors in the lines of a shard's stderr, lines other than
+	warnings are errors (see Bio::Rfam::Utils::checkStderrFile)
+
+	lines: An iterable of lines
+
+	return: The first error line, None if there are none
+	"""
+
+	for line in lines:
+		if not line.startswith("Warning"):
+			return line.strip()
+
+	return None
+
+# -----------------------------------------------------------------------------------
+
+def check_stderr(path):
+	"""
+	Checks a shard's stderr file
+
+	path: Path to the stderr file, which may not exist
+
+	return: The first error line, None if there are none
+	"""
+
+	if not os.path.exists(path):
+		return None
+
+	fp = open(path, 'r')
+	error = find_stderr_error(fp)
+	fp.close()
+
+	return error
+
+# -----------------------------------------------------------------------------------
+
+def open_bundle_member(bundle, name):
+	"""
+	Opens a member of a shard's output bundle for reading as text
+
+	bundle: An open tarfile.TarFile
+	name: One of BUNDLE_TBLOUT, BUNDLE_SEARCHOUT or BUNDLE_STDERR
+
+	return: A file object, None if the bundle has no such member
+	"""
+
+	try:
+		member = bundle.extractfile(name)
+	except KeyError:
+		return None
+
+	return io.TextIOWrapper(member, encoding="utf-8", errors="replace")
+
+# -----------------------------------------------------------------------------------
+
+def hit_sort_key(line):
+	"""
+	Sort key of a TBLOUT hit line: decreasing bit score, then increasing
+	E-value, as in sort -k 15,15rn -k 16,16g
+
+	line: A TBLOUT hit line
+
+	return: A tuple
+	"""
+
+	fields = line.split()
+
+	return (-float(fields[14]), float(fields[15]))
+
+# -----------------------------------------------------------------------------------
+
+class ShardMerger(object):
+	"""
+	Appends the output of each shard to the family level TBLOUT and
+	searchout files as soon as its job succeeds, after checking that its
+	tblout is complete and its stderr is clean, and keeps a score sorted
+	index of the hits merged so far in <merged tblout>.sorted. Shards are
+	merged in the background, one at a time. The shards appended to each
+	merged tblout are listed in <merged tblout>.merged, so that merging
+	into existing files skips them. The outputs of staged shards are read
+	from their bundle (<tblout>.tgz).
+	"""
+
+	def __init__(self, plan, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, index_interval=DEFAULT_INDEX_INTERVAL,
+		truncate=True):
+		"""
+		plan: A merge plan, as returned by read_merge_plan
+		visibility_timeout: Maximum number of seconds to wait for a shard's output
+		index_interval: Minimum number of seconds between rewrites of the sorted hit indexes
+		truncate: True to start from empty merged files, False to add to the existing ones
+		"""
+
+		self.plan = plan
+		self.visibility_timeout = visibility_timeout
+		self.index_interval = index_interval
+
+		self.submitted = set()
+		self.merged = set()
+		self.failures = {} # job name -> reason
+		self.hits = {} # merged tblout -> score sorted list of hit lines
+		self.last_index = 0
+		self.previously_merged = set()
+		self.lock = threading.Lock()
+		self.jobs = queue.Queue()
+
+		for tblout, searchout, stderr, merged_tblout, merged_searchout in plan.values():
+			if merged_tblout in self.hits:
+				continue
+
+			if truncate or not os.path.exists(merged_tblout):
+				for path in (merged_tblout, merged_searchout, merged_tblout + MERGED_SUFFIX):
+					open(path, 'w').close()
+				self.hits[merged_tblout] = []
+				continue
+
+			# the existing hits go in the sorted index as well
+			fp = open(merged_tblout, 'r')
+			self.hits[merged_tblout] = sorted((line for line in fp if not line.startswith('#')), key=hit_sort_key)
+			fp.close()
+
+			if os.path.exists(merged_tblout + MERGED_SUFFIX):
+				fp = open(merged_tblout + MERGED_SUFFIX, 'r')
+				self.previously_merged.update(line.strip() for line in fp)
+				fp.close()
+
+		thread = threading.Thread(target=self.run)
+		thread.daemon = True
+		thread.start()
+
+	def submit(self, job_name):
+		"""
+		Queues a finished shard for merging, jobs not in the plan and shards
+		already queued are ignored
+
+		job_name: The rfsearch job name
+		"""
+
+		if job_name not in self.plan or job_name in self.submitted:
+			return
+
+		self.submitted.add(job_name)
+		self.jobs.put(job_name)
+
+	def done(self):
+		"""
+		return: True if all shards in the plan were merged
+		"""
+
+		with self.lock:
+			return len(self.merged) == len(self.plan)
+
+	def failed(self):
+		"""
+		return: A dictionary of job name -> reason for shards that could not be merged
+		"""
+
+		with self.lock:
+			return dict(self.failures)
+
+	def run(self):
+		while True:
+			job_name = self.jobs.get()
+
+			try:
+				reason = self.merge(job_name)
+			except (IOError, OSError, ValueError, IndexError) as e:
+				reason = "merge failed: %s" % e
+
+			# rewrite the indexes once caught up with finished shards
+			if reason is None and (self.jobs.empty() or time.time() - self.last_index >= self.index_interval):
+				self.write_indexes()
+
+			with self.lock:
+				if reason is None:
+					self.merged.add(job_name)
+				else:
+					self.failures[job_name] = reason
+
+	def merge(self, job_name):
+		"""
+		Validates and appends a shard's output to the merged files
+
+		job_name: The rfsearch job name
+
+		return: None on success, the reason the shard could not be merged otherwise
+		"""
+
+		tblout, searchout, stderr, merged_tblout, merged_searchout = self.plan[job_name]
+
+		if job_name in self.previously_merged:
+			return None
+
+		start_time = time.time()
+		while not output_complete(tblout):
+			if time.time() - start_time > self.visibility_timeout:
+				return "%s does not end with %s" % (tblout, SUCCESS_STRING)
+			time.sleep(10)
+
+		bundle = get_bundle_path(tblout)
+
+		# staged outputs are read straight from their bundle
+		if os.path.exists(bundle):
+			tar = tarfile.open(bundle, 'r:gz')
+			reason = self.append(job_name, open_bundle_member(tar, BUNDLE_TBLOUT),
+				open_bundle_member(tar, BUNDLE_SEARCHOUT), open_bundle_member(tar, BUNDLE_STDERR), bundle)
+			tar.close()
+
+			return reason
+
+		error = check_stderr(stderr)
+		if error is not None:
+			return "error output in %s: %s" % (stderr, error)
+
+		return self.append(job_name, open(tblout, 'r'), open(searchout, 'r'), None, tblout)
+
+	def append(self, job_name, tblout_fp, searchout_fp, stderr_fp, source):
+		"""
+		Appends a shard's tblout and searchout to the merged files, and its
+		hits to the sorted index. The files are closed.
+
+		job_name: The rfsearch job name
+		tblout_fp: The shard's tblout, open for reading
+		searchout_fp: The shard's searchout, open for reading
+		stderr_fp: The shard's stderr open for reading, None if it was checked already
+		source: Path of the shard's output, for error messages
+
+		return: None on success, the reason the shard could not be merged otherwise
+		"""
+
+		merged_tblout, merged_searchout = self.plan[job_name][3:]
+
+		if tblout_fp is None or searchout_fp is None:
+			return "%s is missing the %s or %s" % (source, BUNDLE_TBLOUT, BUNDLE_SEARCHOUT)
+
+		if stderr_fp is not None:
+			error = find_stderr_error(stderr_fp)
+			stderr_fp.close()
+
+			if error is not None:
+				return "error output in %s: %s" % (source, error)
+
+		# the whole tblout is checked before anything is appended
+		lines = tblout_fp.readlines()
+		tblout_fp.close()
+
+		if SUCCESS_STRING not in ''.join(lines[-10:]):
+			searchout_fp.close()
+			return "%s does not end with %s" % (source, SUCCESS_STRING)
+
+		shard_hits = [line for line in lines if not line.startswith('#')]
+
+		out = open(merged_tblout, 'a')
+		out.writelines(lines)
+		out.close()
+
+		out = open(merged_searchout, 'a')
+		shutil.copyfileobj(searchout_fp, out)
+		out.close()
+		searchout_fp.close()
+
+		out = open(merged_tblout + MERGED_SUFFIX, 'a')
+		out.write(job_name + "\n")
+		out.close()
+
+		shard_hits.sort(key=hit_sort_key)
+		self.hits[merged_tblout] = list(heapq.merge(self.hits[merged_tblout], shard_hits, key=hit_sort_key))
+
+		return None
+
+	def write_indexes(self):
+		"""
+		Writes the score sorted hits merged so far next to each merged tblout
+		"""
+
+		for merged_tblout, hits in self.hits.items():
+			sorted_path = merged_tblout + SORTED_SUFFIX
+			fp = open(sorted_path + ".tmp", 'w')
+			fp.writelines(hits)
+			fp.close()
+			os.rename(sorted_path + ".tmp", sorted_path)
+
+		self.last_index = time.time()
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Merges the output of finished rfsearch shards')
+
+	parser.add_argument('plan', help='merge plan written by rfsearch')
+	parser.add_argument('job_names', help='finished jobs to merge, all jobs in the plan by default. Given jobs are added to the existing merged files, skipping jobs already merged',
+		nargs='*', metavar="JOBNAME")
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	plan = read_merge_plan(args.plan)
+	# start over only when merging the whole plan
+	merger = ShardMerger(plan, visibility_timeout=0, truncate=len(args.job_names) == 0)
+
+	for job_name in args.job_names or sorted(plan):
+		merger.submit(job_name)
+
+	while len(merger.merged) + len(merger.failures) < len(merger.submitted):
+		time.sleep(0.1)
+
+	for job_name, reason in sorted(merger.failed().items()):
+		print ("%s Failed %s" % (job_name, reason))
+
+	sys.exit(1 if len(merger.failures) > 0 else 0)
@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import time
+import signal
+import argparse
+import datetime
+import threading
+import queue
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rfwatch
+import rfadmit
+import rfkubesub
+
+# -----------------------------------------------------------------------------------
+
+LABEL_SELECTOR = "tier=backend"
+
+DEFAULT_PORT = 9110
+
+# bucket upper bounds in seconds of the phase duration histograms
+BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 43200, 86400)
+
+# rfsearch job name prefixes, calibration jobs are named c-<pid>
+JOB_PREFIXES = (("rs-", "rs-"), ("ss-", "ss-"), ("s-", "s-"), ("c-", "calibrate"))
+
+# kubelet Pulled event messages, e.g.
+# Successfully pulled image "rfam/cloud:kubes" in 2.345s (2.345s including waiting)
+PULLED_RE = re.compile(r'Successfully pulled image .* in ((?:[0-9.]+(?:h|m|s|ms|us|µs|ns))+)')
+GO_DURATION_RE = re.compile(r'([0-9.]+)(h|ms|m|s|us|µs|ns)')
+GO_DURATION_UNITS = {"h": 3600, "m": 60, "s": 1, "ms": 1e-3, "us": 1e-6, "µs": 1e-6, "ns": 1e-9}
+
+# pods whose state has not changed for this many seconds are forgotten
+POD_EXPIRY = 6 * 3600
+
+# -----------------------------------------------------------------------------------
+
+def get_job_prefix(job_index):
+	"""
+	Classifies an rfsearch job name by the search it is part of
+
+	job_index: The rfsearch job name (e.g. s-1234-5)
+
+	return: One of s-, rs-, ss-, calibrate or other
+	"""
+
+	for prefix, name in JOB_PREFIXES:
+		if job_index.startswith(prefix):
+			return name
+
+	return "other"
+
+# -----------------------------------------------------------------------------------
+
+def parse_go_duration(duration):
+	"""
+	Converts a Go duration string (e.g. 1m2.5s, 350ms) to seconds
+
+	return: A float
+	"""
+
+	return sum(float(value) * GO_DURATION_UNITS[unit] for value, unit in GO_DURATION_RE.findall(duration))
+
+# -----------------------------------------------------------------------------------
+
+def get_pod_condition_time(pod, condition_type):
+	"""
+	return: The last transition time of a true pod condition, None if it is not true
+	"""
+
+	for condition in pod.status.conditions or []:
+		if condition.type == condition_type and condition.status == "True":
+			return condition.last_transition_time
+
+	return None
+
+# -----------------------------------------------------------------------------------
+
+def format_labels(names, values):
+	"""
+	return: A Prometheus label set string, e.g. {user="x",node="y"}
+	"""
+
+	pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values)]
+
+	return "{" + ",".join(pairs) + "}"
+
+# -----------------------------------------------------------------------------------
+
+class Histogram(object):
+	"""
+	A Prometheus histogram with one series per label value tuple
+	"""
+
+	def __init__(self, name, documentation, label_names, buckets=BUCKETS):
+		self.name = name
+		self.documentation = documentation
+		self.label_names = label_names
+		self.buckets = buckets
+		self.series = {} # label values -> [bucket counts, sum, count]
+
+	def observe(self, label_values, value):
+		series = self.series.setdefault(tuple(label_values), [[0] * len(self.buckets), 0.0, 0])
+
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				series[0][i] += 1
+
+		series[1] += value
+		series[2] += 1
+
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+
+		for label_values, (counts, total, count) in sorted(self.series.items()):
+			for bound, bucket_count in zip(self.buckets, counts):
+				lines.append("%s_bucket%s %d" % (self.name,
+					format_labels(self.label_names + ("le",), label_values + (bound,)), bucket_count))
+
+			lines.append("%s_bucket%s %d" % (self.name, format_labels(self.label_names + ("le",), label_values + ("+Inf",)), count))
+			lines.append("%s_sum%s %f" % (self.name, format_labels(self.label_names, label_values), total))
+			lines.append("%s_count%s %d" % (self.name, format_labels(self.label_names, label_values), count))
+
+		return lines
+
+# -----------------------------------------------------------------------------------
+
+class Counter(object):
+	"""
+	A Prometheus counter, or gauge if metric_type is gauge, with one series per
+	label value tuple
+	"""
+
+	def __init__(self, name, documentation, label_names, metric_type="counter"):
+		self.name = name
+		self.documentation = documentation
+		self.label_names = label_names
+		self.metric_type = metric_type
+		self.series = {} # label values -> value
+
+	def inc(self, label_values, value=1):
+		self.series[tuple(label_values)] = self.series.get(tuple(label_values), 0) + value
+
+	def reset(self):
+		self.series = {}
+
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.metric_type)]
+
+		for label_values, value in sorted(self.series.items()):
+			lines.append("%s%s %s" % (self.name, format_labels(self.label_names, label_values), value))
+
+		return lines
+
+# -----------------------------------------------------------------------------------
+
+class PodTimeline(object):
+	"""
+	What is known about the life of a backend pod, and which of its phase
+	durations were already observed
+	"""
+
+	def __init__(self, user, job_name, prefix):
+		self.user = user
+		self.job_name = job_name
+		self.prefix = prefix
+		self.node = ""
+		self.phase = "Pending"
+		self.restarts = 0
+		self.pull_secs = None # from the kubelet's Pulled event
+		self.observed = set()
+		self.updated = time.time()
+
+# -----------------------------------------------------------------------------------
+
+class MetricsCollector(object):
+	"""
+	Derives the time rfsearch jobs spend in each phase of their life from
+	watch events of backend Pods, Jobs and kubelet Pulled events:
+
+	admission:       Job created -> admitted by rfadmit.py (suspended jobs only)
+	queued:          pod created -> PodScheduled
+	sandbox:         PodScheduled -> Initialized (pod sandbox and volume mounts)
+	image_pull:      duration reported by the kubelet Pulled event
+	container_start: Initialized -> container started, less the image pull
+	run:             container started -> container terminated (e.g. cmsearch)
+	completion_lag:  last pod of a Job terminated -> Job Complete condition,
+	                 which is when rfwait.py (wait_for_cluster_light) is told
+
+	Durations are labelled by user, job prefix (s-, rs-, ss-, calibrate) and
+	node. Each duration is observed once per pod.
+	"""
+
+	LABELS = ("user", "prefix", "node")
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.pods = {} # pod name -> PodTimeline
+		self.pulls = {} # pod name -> image pull seconds, for Pulled events seen before their pod
+		self.job_finished = {} # k8s job name -> time its last pod terminated
+		self.jobs_observed = set()
+		self.jobs_admitted = set()
+
+		self.phase_seconds = Histogram("rfam_job_phase_seconds",
+			"Time rfsearch pods spend in each phase of their life", ("phase",) + self.LABELS)
+		self.pods_total = Counter("rfam_pods_total", "Backend pods that finished, by result",
+			self.LABELS + ("result",))
+		self.restarts_total = Counter("rfam_pod_restarts_total", "Container restarts of finished backend pods",
+			self.LABELS)
+		self.jobs_total = Counter("rfam_jobs_total", "Backend jobs that finished, by result",
+			("user", "prefix", "result"))
+		self.pods_current = Counter("rfam_pods", "Backend pods by phase", ("user", "prefix", "phase"),
+			metric_type="gauge")
+
+	def get_timeline(self, pod):
+		"""
+		return: The PodTimeline of a backend pod, None if it was not created by rfkubesub
+		"""
+
+		name = pod.metadata.name
+
+		if name in self.pods:
+			return self.pods[name]
+
+		labels = pod.metadata.labels or {}
+		user = labels.get("user", "")
+		job_name = labels.get("jobname", labels.get("job-name", ""))
+		job_index = rfkubesub.get_job_index(user, job_name)
+
+		if job_index is None:
+			return None
+
+		timeline = PodTimeline(user, job_name, get_job_prefix(job_index))
+		timeline.pull_secs = self.pulls.pop(name, None)
+		self.pods[name] = timeline
+
+		return timeline
+
+	def observe_phase(self, timeline, phase, start, end):
+		"""
+		Observes a phase duration once per pod, if both ends are known
+		"""
+
+		if phase in timeline.observed or start is None or end is None:
+			return
+
+		timeline.observed.add(phase)
+		self.phase_seconds.observe((phase, timeline.user, timeline.prefix, timeline.node),
+			max(0.0, (end - start).total_seconds()))
+
+	def observe_pod(self, event_type, pod):
+		"""
+		Updates phase durations from a k8s Pod
+
+		event_type: The watch event type (ADDED, MODIFIED, DELETED)
+		pod: A V1Pod object
+		"""
+
+		with self.lock:
+			timeline = self.get_timeline(pod)
+
+			if timeline is None:
+				return
+
+			timeline.updated = time.time()
+			timeline.node = pod.spec.node_name or ""
+			timeline.phase = pod.status.phase
+
+			scheduled = get_pod_condition_time(pod, "PodScheduled")
+			initialized = get_pod_condition_time(pod, "Initialized")
+
+			self.observe_phase(timeline, "queued", pod.metadata.creation_timestamp, scheduled)
+			self.observe_phase(timeline, "sandbox", scheduled, initialized)
+
+			started = None
+			finished = None
+			for container_status in pod.status.container_statuses or []:
+				timeline.restarts = container_status.restart_count or 0
+				state = container_status.state
+
+				if state is None:
+					continue
+				if state.running is not None:
+					started = state.running.started_at
+				elif state.terminated is not None:
+					started = state.terminated.started_at
+					finished = state.terminated.finished_at
+
+			# the first start, restarted containers do not pull the image again
+			if started is not None and "container_start" not in timeline.observed and initialized is not None:
+				pull_secs = timeline.pull_secs or 0.0
+				if timeline.pull_secs is not None:
+					self.phase_seconds.observe(("image_pull", timeline.user, timeline.prefix, timeline.node), pull_secs)
+					timeline.observed.add("image_pull")
+
+				timeline.observed.add("container_start")
+				self.phase_seconds.observe(("container_start", timeline.user, timeline.prefix, timeline.node),
+					max(0.0, (started - initialized).total_seconds() - pull_secs))
+
+			if pod.status.phase in ("Succeeded", "Failed") and "finished" not in timeline.observed:
+				self.observe_phase(timeline, "run", started, finished)
+				timeline.observed.add("finished")
+
+				labels = (timeline.user, timeline.prefix, timeline.node)
+				self.pods_total.inc(labels + (pod.status.phase.lower(),))
+				self.restarts_total.inc(labels, timeline.restarts)
+
+				if finished is not None:
+					last = self.job_finished.get(timeline.job_name)
+					self.job_finished[timeline.job_name] = finished if last is None else max(last, finished)
+
+			if event_type == "DELETED":
+				self.pods.pop(pod.metadata.name, None)
+
+	def observe_job(self, event_type, job):
+		"""
+		Updates job results and the completion lag from a k8s Job
+
+		event_type: The watch event type (ADDED, MODIFIED, DELETED)
+		job: A V1Job object
+		"""
+
+		with self.lock:
+			name = job.metadata.name
+			labels = job.metadata.labels or {}
+			user = labels.get("user", "")
+			job_index = rfkubesub.get_job_index(user, name)
+
+			if job_index is None:
+				return
+
+			if event_type == "DELETED":
+				self.job_finished.pop(name, None)
+				self.jobs_observed.discard(job.metadata.uid)
+				self.jobs_admitted.discard(job.metadata.uid)
+				return
+
+			prefix = get_job_prefix(job_index)
+			admitted = (job.metadata.annotations or {}).get(rfadmit.ADMITTED_ANNOTATION)
+
+			if admitted is not None and job.metadata.uid not in self.jobs_admitted:
+				self.jobs_admitted.add(job.metadata.uid)
+				admitted_time = datetime.datetime.fromisoformat(admitted)
+				self.phase_seconds.observe(("admission", user, prefix, ""),
+					max(0.0, (admitted_time - job.metadata.creation_timestamp).total_seconds()))
+
+			if job.metadata.uid in self.jobs_observed:
+				return
+
+			for condition in job.status.conditions or []:
+				if condition.status != "True" or condition.type not in ("Complete", "Failed"):
+					continue
+
+				self.jobs_observed.add(job.metadata.uid)
+				self.jobs_total.inc((user, prefix, "succeeded" if condition.type == "Complete" else "failed"))
+
+				finished = self.job_finished.pop(name, None)
+				if condition.type == "Complete" and finished is not None:
+					self.phase_seconds.observe(("completion_lag", user, prefix, ""),
+						max(0.0, (condition.last_transition_time - finished).total_seconds()))
+				break
+
+	def observe_event(self, event_type, event):
+		"""
+		Records the image pull time reported by a kubelet Pulled event
+
+		event_type: The watch event type (ADDED, MODIFIED, DELETED)
+		event: A CoreV1Event object
+		"""
+
+		if event_type == "DELETED" or event.involved_object.kind != "Pod":
+			return
+
+		message = event.message or ""
+		if "already present on machine" in message:
+			pull_secs = 0.0
+		else:
+			match = PULLED_RE.search(message)
+			if match is None:
+				return
+			pull_secs = parse_go_duration(match.group(1))
+
+		with self.lock:
+			name = event.involved_object.name
+			if name in self.pods:
+				if self.pods[name].pull_secs is None:
+					self.pods[name].pull_secs = pull_secs
+			else:
+				self.pulls[name] = pull_secs
+
+	def expire(self):
+		"""
+		Forgets pods and pull times that have not been updated for a while, in
+		case their deletion was missed
+		"""
+
+		with self.lock:
+			for name, timeline in list(self.pods.items()):
+				if time.time() - timeline.updated > POD_EXPIRY:
+					del self.pods[name]
+
+			# pull times of pods that never showed up
+			if len(self.pulls) > 10000:
+				self.pulls = {}
+
+	def render(self):
+		"""
+		return: All metrics in the Prometheus text exposition format
+		"""
+
+		with self.lock:
+			self.pods_current.reset()
+			for timeline in self.pods.values():
+				self.pods_current.inc((timeline.user, timeline.prefix, timeline.phase))
+
+			lines = []
+			for metric in (self.phase_seconds, self.pods_total, self.restarts_total, self.jobs_total, self.pods_current):
+				lines.extend(metric.render())
+
+		return "\n".join(lines) + "\n"
+
+# -----------------------------------------------------------------------------------
+
+def load_k8s_apis(api_server=None):
+	"""
+	Loads the k8s configuration from the kubeconfig if available, otherwise
+	from the in-cluster service account. An API server URL can be given
+	instead, e.g. kubectl proxy or a local stand-in API server for testing.
+
+	api_server: URL of an API server not requiring authentication, None to use the k8s configuration
+
+	return: A tuple (BatchV1Api, CoreV1Api)
+	"""
+
+	from kubernetes import client, config
+
+	if api_server is not None:
+		configuration = client.Configuration()
+		configuration.host = api_server
+		api_client = client.ApiClient(configuration)
+
+		return (client.BatchV1Api(api_client), client.CoreV1Api(api_client))
+
+	try:
+		config.load_kube_config()
+	except Exception:
+		config.load_incluster_config()
+
+	return (client.BatchV1Api(), client.CoreV1Api())
+
+# -----------------------------------------------------------------------------------
+
+def start_watches(batch_api, core_api, namespace, events):
+	"""
+	Starts background threads watching backend Jobs and Pods and Pulled events
+
+	batch_api: A BatchV1Api object
+	core_api: A CoreV1Api object
+	namespace: The k8s namespace to watch
+	events: A queue to put watch events on
+	"""
+
+	watches = (("Job", batch_api.list_namespaced_job, LABEL_SELECTOR, None),
+		("Pod", core_api.list_namespaced_pod, LABEL_SELECTOR, None),
+		("Event", core_api.list_namespaced_event, "", "reason=Pulled"))
+
+	for kind, list_func, label_selector, field_selector in watches:
+		thread = threading.Thread(target=rfwatch.watch_resource,
+			args=(kind, list_func, label_selector, events, namespace, field_selector))
+		thread.daemon = True
+		thread.start()
+
+# -----------------------------------------------------------------------------------
+
+def serve_metrics(collector, port):
+	"""
+	Serves the metrics of a collector on http://0.0.0.0:port/metrics in a
+	background thread
+
+	collector: A MetricsCollector object
+	port: The port to listen on
+
+	return: The ThreadingHTTPServer object
+	"""
+
+	class MetricsHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path.split('?')[0] != "/metrics":
+				self.send_error(404)
+				return
+
+			body = collector.render().encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", "text/plain; version=0.0.4")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = ThreadingHTTPServer(("", port), MetricsHandler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	return server
+
+# -----------------------------------------------------------------------------------
+
+def collect_forever(collector, events, expire_interval=600):
+	"""
+	Feeds watch events to a collector. Exits once a watch gives up (see
+	rfwatch.watch_resource) rather than serving metrics that stopped
+	changing: the rfam-metrics Deployment (manifests/rfam-metrics.yaml)
+	restarts it with fresh watches, and Prometheus treats the counters
+	starting over from zero as a counter reset
+
+	collector: A MetricsCollector object
+	events: A queue of watch events
+	expire_interval: Number of seconds between expiries of stale pods
+	"""
+
+	last_expire = time.time()
+
+	while True:
+		try:
+			kind, event_type, obj = events.get(timeout=1)
+
+			# exit, to be restarted with fresh watches
+			if event_type == "FAILED":
+				sys.exit("ERROR: lost the %s watch of the cluster: %s" % (kind, obj))
+
+			if event_type == "SYNCED":
+				pass
+			elif kind == "Job":
+				collector.observe_job(event_type, obj)
+			elif kind == "Pod":
+				collector.observe_pod(event_type, obj)
+			else:
+				collector.observe_event(event_type, obj)
+
+		except queue.Empty:
+			pass
+
+		if time.time() - last_expire >= expire_interval:
+			collector.expire()
+			last_expire = time.time()
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Prometheus exporter of Rfam k8s job phase durations')
+
+	parser.add_argument('--namespace', help='k8s namespace of the jobs (default: default)', action="store",
+		type=str, default="default")
+	parser.add_argument('--port', help='port to serve /metrics on (default: %d)' % DEFAULT_PORT, action="store",
+		type=int, default=DEFAULT_PORT)
+	parser.add_argument('--api-server', help='URL of an unauthenticated API server to watch instead of the configured '
+		'cluster (e.g. kubectl proxy or a local stand-in for testing)', action="store", type=str, default=None)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	batch_api, core_api = load_k8s_apis(args.api_server)
+	collector = MetricsCollector()
+	events = queue.Queue()
+
+	start_watches(batch_api, core_api, args.namespace, events)
+	serve_metrics(collector, args.port)
+	collect_forever(collector, events)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import signal
+import argparse
+import subprocess
+
+import rfkubesub
+
+# -----------------------------------------------------------------------------------
+
+RFPOOL_CMD = "/Rfam/software/bin/rfpool.py"
+
+# the queue lives on the user's volume, which both the login pod and the
+# pool workers mount, so every user has their own pool
+QUEUE_DIR = os.environ.get("RFAM_POOL_QUEUE_DIR", os.path.join("/workdir", ".rfpool"))
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+
+# label selector of pool worker jobs
+POOL_LABEL = "app=rfam-pool"
+
+# resources of each worker pod, tasks needing more run as regular jobs
+POOL_CPUS = int(os.environ.get("RFAM_POOL_CPUS", 4))
+POOL_MEMORY = int(os.environ.get("RFAM_POOL_MEMORY", 12000))
+
+DEFAULT_MAX_WORKERS = 20
+
+# seconds between looks at the queue by idle workers
+POLL_INTERVAL = 0.2
+
+# workers exit once the queue has been empty for this many seconds
+DEFAULT_IDLE_TIMEOUT = 300
+
+# running tasks refresh their claim this often, and are given back to the
+# queue if their claim is older than STALE_SECS (the worker died)
+HEARTBEAT_INTERVAL = 30
+STALE_SECS = 180
+
+# number of times a task is given back to the queue before it fails
+MAX_ATTEMPTS = 3
+
+# records of finished tasks are removed after this many seconds
+DONE_EXPIRY = 7 * 24 * 3600
+
+# -----------------------------------------------------------------------------------
+
+class TaskQueue(object):
+	"""
+	File backed queue of shell command tasks. A task is a JSON file named
+	<submission time>-<task name>.json that moves from pending/ to running/
+	when a worker claims it, with an atomic rename so that only one worker
+	gets it, and is recorded in done/ with its exit status once finished.
+	Any directory works, so a local one can stand in for the user volume.
+	"""
+
+	def __init__(self, queue_dir=QUEUE_DIR):
+		self.queue_dir = queue_dir
+
+		for state in (PENDING, RUNNING, DONE):
+			path = os.path.join(queue_dir, state)
+			if not os.path.isdir(path):
+				os.makedirs(path)
+
+	def get_path(self, state, file_name):
+		return os.path.join(self.queue_dir, state, file_name)
+
+	def write_task(self, state, file_name, task):
+		"""
+		Writes a task file with a rename, so that it is never seen partially written
+		"""
+
+		tmp_path = os.path.join(self.queue_dir, ".%s.%s.%d" % (file_name, socket.gethostname(), os.getpid()))
+		fp = open(tmp_path, 'w')
+		json.dump(task, fp, sort_keys=True)
+		fp.close()
+		os.rename(tmp_path, self.get_path(state, file_name))
+
+	def put(self, name, cmd, cpus=1, memory=0, cwd=None):
+		"""
+		Queues a task, replacing the record of a finished task of the same name
+
+		name: The task name (e.g. the rfsearch job name s-1234-5)
+		cmd: The shell command to run
+		cpus: Number of cpus the command uses
+		memory: Memory the command uses in Mb
+		cwd: Directory to run the command in, None for the worker's
+		"""
+
+		done_path = self.get_path(DONE, name + ".json")
+		if os.path.exists(done_path):
+			os.remove(done_path)
+
+		task = {"name": name, "cmd": cmd, "cpus": cpus, "memory": memory, "submitted": time.time(), "attempts": 0}
+		if cwd is not None:
+			task["cwd"] = cwd
+		self.write_task(PENDING, "%017.6f-%s.json" % (task["submitted"], name), task)
+
+	def list_tasks(self, state):
+		"""
+		return: A list of the task file names in a state, oldest first
+		"""
+
+		return sorted(f for f in os.listdir(os.path.join(self.queue_dir, state)) if f.endswith(".json"))
+
+	def depth(self):
+		"""
+		return: A tuple (number of pending tasks, number of running tasks)
+		"""
+
+		return (len(self.list_tasks(PENDING)), len(self.list_tasks(RUNNING)))
+
+	def claim(self, worker, fits=None):
+		"""
+		Takes the oldest pending task
+
+		worker: Name of the claiming worker
+		fits: A function of a pending task dictionary, returning False for
+			tasks the worker has no room for, None to take any task
+
+		return: A tuple (task file name, task dictionary), None if the queue is empty
+		"""
+
+		for file_name in self.list_tasks(PENDING):
+			if fits is not None:
+				try:
+					if not fits(json.load(open(self.get_path(PENDING, file_name), 'r'))):
+						continue
+				except (IOError, OSError, ValueError):
+					# claimed by another worker
+					continue
+
+			try:
+				os.rename(self.get_path(PENDING, file_name), self.get_path(RUNNING, file_name))
+			except OSError:
+				# claimed by another worker
+				continue
+
+			task = json.load(open(self.get_path(RUNNING, file_name), 'r'))
+			task["worker"] = worker
+			task["started"] = time.time()
+			task["attempts"] += 1
+			self.write_task(RUNNING, file_name, task)
+
+			return (file_name, task)
+
+		return None
+
+	def heartbeat(self, file_name):
+		"""
+		Refreshes the claim on a running task
+		"""
+
+		os.utime(self.get_path(RUNNING, file_name), None)
+
+	def complete(self, file_name, task, exit_status):
+		"""
+		Records a finished task and removes it from the running tasks
+
+		file_name: The task file name
+		task: The task dictionary
+		exit_status: The exit status of the task's command
+		"""
+
+		task["finished"] = time.time()
+		task["exit_status"] = exit_status
+		self.write_task(DONE, task["name"] + ".json", task)
+		os.remove(self.get_path(RUNNING, file_name))
+
+	def requeue_stale(self):
+		"""
+		Gives tasks of workers that stopped refreshing their claim back to the
+		queue, or fails them after MAX_ATTEMPTS
+
+		return: Number of tasks requeued or failed
+		"""
+
+		nstale = 0
+
+		for file_name in self.list_tasks(RUNNING):
+			path = self.get_path(RUNNING, file_name)
+
+			try:
+				if time.time() - os.path.getmtime(path) < STALE_SECS:
+					continue
+				task = json.load(open(path, 'r'))
+			except (OSError, ValueError):
+				continue
+
+			nstale += 1
+
+			if task["attempts"] >= MAX_ATTEMPTS:
+				self.complete(file_name, task, -1)
+				continue
+
+			try:
+				os.rename(path, self.get_path(PENDING, file_name))
+			except OSError:
+				continue
+
+		return nstale
+
+	def get_states(self, names):
+		"""
+		Looks up the state of tasks
+
+		names: A list of task names
+
+		return: A dictionary of task name -> (state, exit status or None) for tasks found in the queue
+		"""
+
+		names = set(names)
+		states = {}
+
+		for state in (PENDING, RUNNING):
+			for file_name in self.list_tasks(state):
+				name = file_name[:-len(".json")].split('-', 1)[1]
+				if name in names:
+					states[name] = (state, None)
+
+		for name in names:
+			if name in states:
+				continue
+			try:
+				task = json.load(open(self.get_path(DONE, name + ".json"), 'r'))
+			except (IOError, OSError, ValueError):
+				continue
+			states[name] = (DONE, task["exit_status"])
+
+		return states
+
+	def expire_done(self):
+		"""
+		Removes records of tasks that finished more than DONE_EXPIRY seconds ago
+		"""
+
+		for file_name in self.list_tasks(DONE):
+			path = self.get_path(DONE, file_name)
+			try:
+				if time.time() - os.path.getmtime(path) > DONE_EXPIRY:
+					os.remove(path)
+			except OSError:
+				continue
+
+# -----------------------------------------------------------------------------------
+
+def run_worker(task_queue, worker, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+	"""
+	Runs queued tasks one at a time until the queue has been empty for
+	idle_timeout seconds
+
+	task_queue: A TaskQueue object
+	worker: Name of this worker, for the task records
+	idle_timeout: Number of idle seconds after which to exit
+
+	return: Number of tasks run
+	"""
+
+	ntasks = 0
+	last_task = time.time()
+	last_requeue = 0
+
+	while time.time() - last_task < idle_timeout:
+		if time.time() - last_requeue >= STALE_SECS:
+			task_queue.requeue_stale()
+			task_queue.expire_done()
+			last_requeue = time.time()
+
+		claimed = task_queue.claim(worker)
+
+		if claimed is None:
+			time.sleep(POLL_INTERVAL)
+			continue
+
+		file_name, task = claimed
+		process = subprocess.Popen(["sh", "-c", task["cmd"]], cwd=task.get("cwd"))
+
+		while process.poll() is None:
+			try:
+				process.wait(timeout=HEARTBEAT_INTERVAL)
+			except subprocess.TimeoutExpired:
+				task_queue.heartbeat(file_name)
+
+		task_queue.complete(file_name, task, process.returncode)
+		ntasks += 1
+		last_task = time.time()
+
+	return ntasks
+
+# -----------------------------------------------------------------------------------
+
+def build_pool_manifest(user, workers, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+	"""
+	Builds the manifest of a pool of worker pods, as a k8s work queue job:
+	workers run until the queue is drained and exit successfully, after
+	which the job does not start new pods and completes once all are done.
+
+	user: A valid Rfam cloud account username
+	workers: Number of worker pods
+	idle_timeout: Number of idle seconds after which workers exit
+
+	return: A k8s job manifest as a dictionary
+	"""
+
+	pool_index = "pool-%d" % int(time.time())
+	cmd = "python3 %s worker --idle-timeout %d" % (RFPOOL_CMD, idle_timeout)
+	# tasks may stage their outputs in scratch space, see rfkubesub.build_staged_command
+	manifest = rfkubesub.build_job_manifest(user, pool_index, cmd, POOL_CPUS, POOL_MEMORY, scratch=True)
+
+	name = "rfam-pool-%s-%s" % (user, pool_index)
+	labels = {"app": "rfam-pool", "user": user, "tier": "pool"}
+
+	manifest["metadata"]["name"] = name
+	manifest["metadata"]["labels"] = labels
+	manifest["spec"]["parallelism"] = workers
+	manifest["spec"]["template"]["metadata"]["labels"] = dict(labels, jobname=name)
+
+	return manifest
+
+# -----------------------------------------------------------------------------------
+
+def scale_pool(user, needed, max_workers=DEFAULT_MAX_WORKERS):
+	"""
+	Makes sure the user's pool has enough workers for needed tasks. The pool
+	job is scaled up while none of its workers retired, otherwise a new pool
+	is started, as a work queue job does not replace retired workers.
+
+	user: A valid Rfam cloud account username
+	needed: Number of pending and running tasks
+	max_workers: Maximum number of workers
+	"""
+
+	from kubernetes import client, config
+
+	config.load_incluster_config()
+	batch_api = client.BatchV1Api()
+
+	workers = min(max_workers, needed)
+	active = 0
+
+	for job in batch_api.list_namespaced_job(rfkubesub.NAMESPACE, label_selector="%s,user=%s" % (POOL_LABEL, user)).items:
+		if job.status.succeeded or job.status.completion_time is not None:
+			# retiring, its workers finish their tasks and exit
+			active += job.status.active or 0
+			continue
+
+		if job.spec.parallelism < workers:
+			batch_api.patch_namespaced_job(job.metadata.name, rfkubesub.NAMESPACE, {"spec": {"parallelism": workers}})
+		return
+
+	if workers > active:
+		batch_api.create_namespaced_job(namespace=rfkubesub.NAMESPACE, body=build_pool_manifest(user, workers - active))
+
+# -----------------------------------------------------------------------------------
+
+def submit_tasks(user, tasks, cpus, memory, max_workers=DEFAULT_MAX_WORKERS):
+	"""
+	Queues tasks for the user's worker pool and scales it with the queue depth
+
+	user: A valid Rfam cloud account username
+	tasks: A list of (name, command) tuples
+	cpus: Number of cpus each command uses
+	memory: Memory each command uses in Mb
+	max_workers: Maximum number of workers
+	"""
+
+	task_queue = TaskQueue()
+
+	for name, cmd in tasks:
+		task_queue.put(name, cmd, cpus, memory)
+
+	pending, running = task_queue.depth()
+	scale_pool(user, pending + running, max_workers=max_workers)
+
+# -----------------------------------------------------------------------------------
+
+def fits_pool(cpus, memory):
+	"""
+	return: True if a task needing cpus and memory Mb can run on a pool worker
+	"""
+
+	return int(cpus) <= POOL_CPUS and int(math.ceil(float(memory))) <= POOL_MEMORY
+
+# -----------------------------------------------------------------------------------
+
+def print_status(task_queue):
+	"""
+	Prints the number of tasks in each state
+	"""
+
+	pending, running = task_queue.depth()
+	done = task_queue.list_tasks(DONE)
+
+	print ("%s: %d pending, %d running, %d finished" % (task_queue.queue_dir, pending, running, len(done)))
+
+	for file_name in task_queue.list_tasks(RUNNING):
+		task = json.load(open(task_queue.get_path(RUNNING, file_name), 'r'))
+		print ("%-20s running on %s for %ds" % (task["name"], task.get("worker", ""), time.time() - task.get("started", time.time())))
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Pool of warm worker pods running queued rfsearch tasks')
+	parser.add_argument('--queue-dir', help='queue directory (default: %s)' % QUEUE_DIR, action="store",
+		type=str, default=QUEUE_DIR)
+	subparsers = parser.add_subparsers(dest="command")
+
+	worker = subparsers.add_parser("worker", help='run queued tasks (run in pool pods)')
+	worker.add_argument('--idle-timeout', help='seconds without tasks after which to exit (default: %d)' % DEFAULT_IDLE_TIMEOUT,
+		action="store", type=int, default=DEFAULT_IDLE_TIMEOUT)
+
+	subparsers.add_parser("status", help='print the state of the queue')
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	task_queue = TaskQueue(args.queue_dir)
+
+	if args.command == "worker":
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+		run_worker(task_queue, socket.gethostname(), idle_timeout=args.idle_timeout)
+
+	elif args.command == "status":
+		print_status(task_queue)
+
+	else:
+		parser.print_help()
@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import argparse
+import threading
+import subprocess
+
+# -----------------------------------------------------------------------------------
+
+RFPROFILE_CMD = "/Rfam/software/bin/rfprofile.py"
+
+# each pod running a shard writes <tblout>.<pod name>.profile.json, so that
+# retries and speculative copies of a shard keep their own profile
+PROFILE_SUFFIX = ".profile.json"
+
+CGROUP_DIR = "/sys/fs/cgroup"
+PROC_DIR = "/proc"
+
+# seconds between samples of the cgroup and of the processes of the shard,
+# which is also the resolution of the phase times
+DEFAULT_INTERVAL = 1.0
+
+# the search phase of a shard is the time cmsearch processes are running,
+# what runs before it is waiting on input (search file lookup, copy or
+# decompression) and what runs after it is writing out the outputs
+SEARCH_PROGRAM = "cmsearch"
+
+MB = 1024.0 * 1024.0
+
+# -----------------------------------------------------------------------------------
+
+def read_counters(path):
+	"""
+	Reads a file of "<key> <value>" lines, such as cpu.stat, or of
+	"<key>: <value>" lines, such as /proc/<pid>/io
+
+	path: Path to the file
+
+	return: A dictionary of key -> integer value, empty if the file does not exist
+	"""
+
+	counters = {}
+
+	if not os.path.exists(path):
+		return counters
+
+	fp = open(path, 'r')
+	for line in fp:
+		fields = line.split()
+		if len(fields) == 2 and fields[1].isdigit():
+			counters[fields[0].rstrip(':')] = int(fields[1])
+	fp.close()
+
+	return counters
+
+def read_value(path):
+	"""
+	return: The integer in a single value cgroup file, None if it does not exist or is "max"
+	"""
+
+	if not os.path.exists(path):
+		return None
+
+	value = open(path, 'r').read().strip()
+
+	return int(value) if value.isdigit() else None
+
+# -----------------------------------------------------------------------------------
+
+class CgroupReader(object):
+	"""
+	Reads the CPU, memory and block I/O counters of the container's cgroup,
+	v2 or v1. Unlike rfsizing.read_cgroup_usage, which only records the
+	totals sizing needs once a search ended, it reads the current values of
+	every counter, for sampling during the run.
+	"""
+
+	def __init__(self, cgroup_dir=CGROUP_DIR):
+		self.cgroup_dir = cgroup_dir
+		self.v2 = os.path.exists(os.path.join(cgroup_dir, "cgroup.controllers"))
+
+	def read(self):
+		"""
+		return: A dictionary of cpu_usec, throttled_usec, nr_throttled, memory_bytes,
+		        memory_peak_bytes, io_read_bytes and io_write_bytes, None for the
+		        counters that could not be read
+		"""
+
+		if self.v2:
+			return self.read_v2()
+
+		return self.read_v1()
+
+	def read_v2(self):
+		cpu = read_counters(os.path.join(self.cgroup_dir, "cpu.stat"))
+		io_read, io_write = self.read_io_stat(os.path.join(self.cgroup_dir, "io.stat"))
+
+		return {"cpu_usec": cpu.get("usage_usec"),
+			"throttled_usec": cpu.get("throttled_usec"),
+			"nr_throttled": cpu.get("nr_throttled"),
+			"memory_bytes": read_value(os.path.join(self.cgroup_dir, "memory.current")),
+			# not available before Linux 5.19, the sampled maximum is used then
+			"memory_peak_bytes": read_value(os.path.join(self.cgroup_dir, "memory.peak")),
+			"io_read_bytes": io_read,
+			"io_write_bytes": io_write}
+
+	def read_v1(self):
+		cpu_usage = read_value(os.path.join(self.cgroup_dir, "cpuacct", "cpuacct.usage"))
+		cpu = read_counters(os.path.join(self.cgroup_dir, "cpu", "cpu.stat"))
+		io_read, io_write = self.read_blkio(os.path.join(self.cgroup_dir, "blkio", "blkio.throttle.io_service_bytes"))
+
+		return {"cpu_usec": cpu_usage // 1000 if cpu_usage is not None else None,
+			"throttled_usec": cpu["throttled_time"] // 1000 if "throttled_time" in cpu else None,
+			"nr_throttled": cpu.get("nr_throttled"),
+			"memory_bytes": read_value(os.path.join(self.cgroup_dir, "memory", "memory.usage_in_bytes")),
+			"memory_peak_bytes": read_value(os.path.join(self.cgroup_dir, "memory", "memory.max_usage_in_bytes")),
+			"io_read_bytes": io_read,
+			"io_write_bytes": io_write}
+
+	def read_io_stat(self, path):
+		"""
+		Sums the bytes read and written over all devices of a v2 io.stat file,
+		e.g. "8:0 rbytes=1459200 wbytes=314773504 rios=192 wios=353 ..."
+
+		return: A tuple (bytes read, bytes written), None for both if the file does not exist
+		"""
+
+		if not os.path.exists(path):
+			return (None, None)
+
+		totals = {"rbytes": 0, "wbytes": 0}
+
+		fp = open(path, 'r')
+		for line in fp:
+			for field in line.split()[1:]:
+				key, _, value = field.partition('=')
+				if key in totals:
+					totals[key] += int(value)
+		fp.close()
+
+		return (totals["rbytes"], totals["wbytes"])
+
+	def read_blkio(self, path):
+		"""
+		Sums the bytes read and written over all devices of a v1
+		blkio.throttle.io_service_bytes file, e.g. "8:0 Read 1459200"
+
+		return: A tuple (bytes read, bytes written), None for both if the file does not exist
+		"""
+
+		if not os.path.exists(path):
+			return (None, None)
+
+		totals = {"Read": 0, "Write": 0}
+
+		fp = open(path, 'r')
+		for line in fp:
+			fields = line.split()
+			if len(fields) == 3 and fields[1] in totals:
+				totals[fields[1]] += int(fields[2])
+		fp.close()
+
+		return (totals["Read"], totals["Write"])
+
+# -----------------------------------------------------------------------------------
+
+def list_descendants(pid, proc_dir=PROC_DIR):
+	"""
+	Lists the processes started, directly or not, by a process
+
+	pid: The process id
+	proc_dir: Mount point of procfs
+
+	return: A dictionary of pid -> command name
+	"""
+
+	parents = {}
+	names = {}
+
+	for stat_path in glob.glob(os.path.join(proc_dir, "[0-9]*", "stat")):
+		try:
+			line = open(stat_path, 'r').read()
+		except (IOError, OSError):
+			# the process exited
+			continue
+
+		# the command name is in parentheses and may contain spaces
+		child = int(line.split(' ', 1)[0])
+		names[child] = line[line.index('(') + 1:line.rindex(')')]
+		parents[child] = int(line[line.rindex(')') + 2:].split()[1])
+
+	descendants = {}
+	found = True
+	while found:
+		found = False
+		for child, parent in parents.items():
+			if child not in descendants and (parent == pid or parent in descendants):
+				descendants[child] = names[child]
+				found = True
+
+	return descendants
+
+def read_process_io(pid, proc_dir=PROC_DIR):
+	"""
+	Reads the bytes a process read and wrote through system calls, which
+	unlike the cgroup block I/O counters include NFS reads
+
+	return: A tuple (rchar, wchar), None if the process exited
+	"""
+
+	try:
+		counters = read_counters(os.path.join(proc_dir, str(pid), "io"))
+	except (IOError, OSError):
+		return None
+
+	if "rchar" not in counters:
+		return None
+
+	return (counters["rchar"], counters.get("wchar", 0))
+
+# -----------------------------------------------------------------------------------
+
+class ShardProfiler(object):
+	"""
+	Samples the container's cgroup and the processes of a shard command
+	while it runs, and summarizes them in a profile: the resources used,
+	and the time spent waiting on input, searching and writing outputs.
+	"""
+
+	def __init__(self, cgroup=None, proc_dir=PROC_DIR, interval=DEFAULT_INTERVAL):
+		self.cgroup = cgroup or CgroupReader()
+		self.proc_dir = proc_dir
+		self.interval = interval
+
+		self.first = None
+		self.last = None
+		self.max_memory_bytes = 0
+		self.search_start = None
+		self.search_end = None
+		self.process_io = {} # pid -> (rchar, wchar) last read
+		self.stopped = threading.Event()
+
+	def sample(self, pid):
+		"""
+		Takes one sample of the cgroup and of the processes started by pid
+		"""
+
+		now = time.time()
+		counters = self.cgroup.read()
+
+		if self.first is None:
+			self.first = counters
+		self.last = counters
+
+		if counters["memory_bytes"] is not None:
+			self.max_memory_bytes = max(self.max_memory_bytes, counters["memory_bytes"])
+
+		descendants = list_descendants(pid, self.proc_dir)
+
+		if SEARCH_PROGRAM in descendants.values():
+			if self.search_start is None:
+				self.search_start = now
+			self.search_end = now
+
+		for child in list(descendants) + [pid]:
+			io = read_process_io(child, self.proc_dir)
+			if io is not None:
+				self.process_io[child] = io
+
+	def run(self, cmd):
+		"""
+		Runs a shell command, sampling every interval seconds
+
+		cmd: The shell command
+
+		return: A tuple (exit status, start time, end time)
+		"""
+
+		start = time.time()
+		process = subprocess.Popen(["sh", "-c", cmd])
+
+		def sample_until_stopped():
+			while True:
+				try:
+					self.sample(process.pid)
+				except (IOError, OSError, ValueError) as e:
+					sys.stderr.write("WARNING: rfprofile.py sample failed: %s\n" % e)
+				if self.stopped.wait(self.interval):
+					break
+
+		thread = threading.Thread(target=sample_until_stopped)
+		thread.daemon = True
+		thread.start()
+
+		status = process.wait()
+		end = time.time()
+
+		self.stopped.set()
+		thread.join()
+		self.last = self.cgroup.read()
+
+		# killed by a signal, as the shell reports it
+		if status < 0:
+			status = 128 - status
+
+		return (status, start, end)
+
+	def build_profile(self, start, end, exit_status):
+		"""
+		Summarizes the samples of a run
+
+		start: Start time of the command (seconds since the epoch)
+		end: End time of the command
+		exit_status: Exit status of the command
+
+		return: The profile as a dictionary
+		"""
+
+		def delta(key, scale=1.0):
+			if self.first is None or self.first[key] is None or self.last[key] is None:
+				return None
+			return (self.last[key] - self.first[key]) / scale
+
+		wall_secs = max(end - start, 1e-3)
+
+		if self.search_start is None:
+			input_secs, search_secs, output_secs = (wall_secs, 0.0, 0.0)
+		else:
+			input_secs = max(0.0, self.search_start - start)
+			search_secs = max(0.0, min(self.search_end, end) - self.search_start)
+			output_secs = max(0.0, wall_secs - input_secs - search_secs)
+
+		peak_bytes = self.last["memory_peak_bytes"] if self.last is not None else None
+		if peak_bytes is None and self.max_memory_bytes > 0:
+			peak_bytes = self.max_memory_bytes
+
+		return {"start": start,
+			"end": end,
+			"exit_status": exit_status,
+			"wall_secs": wall_secs,
+			"input_secs": input_secs,
+			"search_secs": search_secs,
+			"output_secs": output_secs,
+			"cpu_secs": delta("cpu_usec", 1e6),
+			"throttled_secs": delta("throttled_usec", 1e6),
+			"nr_throttled": delta("nr_throttled"),
+			"peak_mb": peak_bytes / MB if peak_bytes is not None else None,
+			"io_read_mb": delta("io_read_bytes", MB),
+			"io_write_mb": delta("io_write_bytes", MB),
+			"read_mb": sum(io[0] for io in self.process_io.values()) / MB,
+			"write_mb": sum(io[1] for io in self.process_io.values()) / MB}
+
+# -----------------------------------------------------------------------------------
+
+def get_profile_path(tblout, pod=None):
+	"""
+	return: Path of the profile a pod writes for the shard writing tblout
+	"""
+
+	return "%s.%s%s" % (tblout, pod or os.uname()[1], PROFILE_SUFFIX)
+
+def write_profile(profile_path, profile):
+	"""
+	Writes a profile, renamed into place so that a partial file is never read
+	"""
+
+	fp = open(profile_path + ".tmp", 'w')
+	json.dump(profile, fp, indent=1, sort_keys=True)
+	fp.close()
+	os.rename(profile_path + ".tmp", profile_path)
+
+def profile_command(cmd, tblout, cpus, memory, interval=DEFAULT_INTERVAL, profiler=None):
+	"""
+	Runs a shard command and writes its profile next to its tblout. A
+	profile that could not be written is reported on stderr only, the exit
+	status is always the command's.
+
+	cmd: The shard's shell command
+	tblout: The shard's tblout path
+	cpus: Number of cpus requested by the pod
+	memory: Memory requested by the pod in Mb
+	interval: Seconds between samples
+
+	return: The exit status of the command
+	"""
+
+	profiler = profiler or ShardProfiler(interval=interval)
+	status, start, end = profiler.run(cmd)
+
+	try:
+		profile = profiler.build_profile(start, end, status)
+		profile.update({"tblout": tblout,
+			"pod": os.uname()[1],
+			"completion_index": os.environ.get("JOB_COMPLETION_INDEX"),
+			"cpus_requested": cpus,
+			"memory_requested_mb": memory})
+		write_profile(get_profile_path(tblout), profile)
+
+	except (IOError, OSError, TypeError, ValueError) as e:
+		sys.stderr.write("WARNING: Unable to write the profile of %s: %s\n" % (tblout, e))
+
+	return status
+
+def build_profiled_command(cmd, tblout, cpus, memory):
+	"""
+	Wraps a shard command so that the job pod profiles it, see profile_command
+
+	cmd: The shell command to run
+	tblout: The shard's tblout path
+	cpus: Number of cpus requested by the pod
+	memory: Memory requested by the pod in Mb
+
+	return: The wrapped shell command
+	"""
+
+	return "%s run --tblout %s --cpus %d --memory %d %s" % (RFPROFILE_CMD, shlex.quote(tblout), int(cpus),
+		int(float(memory)), shlex.quote(cmd))
+
+# -----------------------------------------------------------------------------------
+
+def find_profiles(paths, run_id=None):
+	"""
+	Finds the profiles of a run
+
+	paths: Profile files or directories holding them
+	run_id: rfsearch run id (process id) the shards must belong to, None for any run
+
+	return: A list of profile paths
+	"""
+
+	profiles = []
+
+	for path in paths:
+		if os.path.isdir(path):
+			profiles.extend(sorted(glob.glob(os.path.join(path, "*" + PROFILE_SUFFIX))))
+		else:
+			profiles.append(path)
+
+	if run_id is not None:
+		profiles = [path for path in profiles if "-%s-" % run_id in os.path.basename(path)]
+
+	return profiles
+
+def format_value(value, format_string, scale=1.0):
+	return format_string % (value * scale) if value is not None else "-"
+
+def build_report(profiles):
+	"""
+	Builds the per-shard efficiency report of a set of profiles: the phase
+	times of each shard, how much of its requested CPU and memory it used,
+	and what it read. Totals weigh each shard by its wall time.
+
+	profiles: A list of profiles
+
+	return: The report lines
+	"""
+
+	header = "%-28s %4s %8s %8s %8s %8s %6s %6s %8s %9s %6s %9s" % ("shard", "exit", "wall", "input", "search",
+		"output", "cpus", "cpu%", "thrott", "peak_mb", "mem%", "read_mb")
+	lines = [header]
+
+	cpu_requested = 0.0
+	cpu_used = 0.0
+	phases = {"input_secs": 0.0, "search_secs": 0.0, "output_secs": 0.0}
+
+	for profile in sorted(profiles, key=lambda profile: (os.path.basename(profile["tblout"]), profile["start"])):
+		wall = profile["wall_secs"]
+		cpus_used = profile["cpu_secs"] / wall if profile["cpu_secs"] is not None else None
+		cpu_eff = cpus_used / float(profile["cpus_requested"]) if cpus_used is not None else None
+		mem_eff = profile["peak_mb"] / float(profile["memory_requested_mb"]) if profile["peak_mb"] is not None else None
+
+		lines.append("%-28s %4d %8.0f %8.0f %8.0f %8.0f %6s %6s %8s %9s %6s %9s" % (os.path.basename(profile["tblout"]),
+			profile["exit_status"], wall, profile["input_secs"], profile["search_secs"], profile["output_secs"],
+			format_value(cpus_used, "%.2f"), format_value(cpu_eff, "%.0f", 100), format_value(profile["throttled_secs"], "%.0f"),
+			format_value(profile["peak_mb"], "%.0f"), format_value(mem_eff, "%.0f", 100), format_value(profile["read_mb"], "%.0f")))
+
+		cpu_requested += float(profile["cpus_requested"]) * wall
+		if profile["cpu_secs"] is not None:
+			cpu_used += profile["cpu_secs"]
+		for phase in phases:
+			phases[phase] += profile[phase]
+
+	total_wall = sum(phases.values())
+
+	if total_wall > 0:
+		lines.append("")
+		lines.append("%d profiles, %.1f cpu hours requested, %.1f used (%.0f%%)" % (len(profiles), cpu_requested / 3600.0,
+			cpu_used / 3600.0, 100.0 * cpu_used / cpu_requested))
+		lines.append("wall time: %.0f%% input, %.0f%% search, %.0f%% output" % tuple(100.0 * phases[phase] / total_wall
+			for phase in ("input_secs", "search_secs", "output_secs")))
+
+		peaks = [profile["peak_mb"] for profile in profiles if profile["peak_mb"] is not None]
+		if len(peaks) > 0:
+			lines.append("peak memory: %.0fMb max, %sMb requested" % (max(peaks),
+				"/".join(sorted(set(str(profile["memory_requested_mb"]) for profile in profiles)))))
+
+	return lines
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Resource and phase profiles of rfsearch k8s shards')
+	subparsers = parser.add_subparsers(dest="command")
+
+	run = subparsers.add_parser("run", help='run a shard command and write its profile next to its tblout (run in job pods)')
+	run.add_argument('--tblout', help='tblout path of the shard', action="store", type=str, required=True)
+	run.add_argument('--cpus', help='cpus requested by the pod', action="store", type=int, required=True)
+	run.add_argument('--memory', help='memory requested by the pod in Mb', action="store", type=int, required=True)
+	run.add_argument('--interval', help='seconds between samples (default: %.0f)' % DEFAULT_INTERVAL,
+		action="store", type=float, default=DEFAULT_INTERVAL)
+	run.add_argument('cmd', help='shell command of the shard')
+
+	report = subparsers.add_parser("report", help='print the per-shard efficiency report of a run')
+	report.add_argument('paths', help='profiles or directories holding them (default: .)', nargs='*', default=["."],
+		metavar="PATH")
+	report.add_argument('--run', help='rfsearch run id (process id) to report on', action="store", type=str)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	if args.command == "run":
+		sys.exit(profile_command(args.cmd, args.tblout, args.cpus, args.memory, interval=args.interval))
+
+	elif args.command == "report":
+		profiles = []
+		for path in find_profiles(args.paths, args.run):
+			try:
+				profiles.append(json.load(open(path)))
+			except ValueError:
+				print ("Skipping unreadable profile %s" % path)
+
+		if len(profiles) == 0:
+			sys.exit("No profiles found")
+
+		for line in build_report(profiles):
+			print (line)
+
+	else:
+		parser.print_help()
@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import shlex
+import shutil
+import hashlib
+import argparse
+import subprocess
+
+import rfshard
+import rfmerge
+import rfsizing
+
+# -----------------------------------------------------------------------------------
+
+RFRESULT_CMD = "/Rfam/software/bin/rfresult.py"
+
+# results are shared by all users, so they live on a read-write volume
+# mounted by both login and job pods (manifests/rfresult-pv.yaml), the
+# search file volume being read-only. Results are not cached if there is none
+RESULT_VOLUME_DIR = "/Rfam/rfresults"
+RESULT_DIR = os.environ.get("RFAM_RESULT_CACHE_DIR", RESULT_VOLUME_DIR)
+
+# least recently used entries are evicted beyond this size
+DEFAULT_MAX_GB = 200
+
+# once over the limit, entries are evicted down to this fraction of it
+EVICT_TARGET = 0.9
+
+# name of the file remembering the checksum of each search file, by path, size and mtime
+CHECKSUMS_FILE = "checksums.json"
+
+# files of a cache entry
+TBLOUT_FILE = "tblout"
+SEARCHOUT_FILE = "searchout"
+META_FILE = "meta.json"
+
+INFERNAL_VERSION_RE = re.compile(r'INFERNAL (\S+)')
+
+# -----------------------------------------------------------------------------------
+
+def parse_output_paths(cmd):
+	"""
+	Finds the output files of a cmsearch command, as built by Bio::Rfam::Infernal
+
+	cmd: A shell command (e.g. cmsearch --tblout s.tbl --cpu 4 CM db.fa > s.out 2> s.err)
+
+	return: A tuple (tblout, searchout, stderr) where stderr may be None, None if
+	the command does not write both a tblout and a searchout file
+	"""
+
+	try:
+		tokens = shlex.split(cmd)
+	except ValueError:
+		return None
+
+	tblout = None
+	searchout = None
+	stderr = None
+
+	for i in range(len(tokens) - 1):
+		if tokens[i] == "--tblout":
+			tblout = tokens[i + 1]
+		elif tokens[i] == ">":
+			searchout = tokens[i + 1]
+		elif tokens[i] == "2>":
+			stderr = tokens[i + 1]
+
+	if tblout is None or searchout is None or searchout == "/dev/null":
+		return None
+
+	return (tblout, searchout, stderr)
+
+# -----------------------------------------------------------------------------------
+
+def get_infernal_version(cmsearch_path):
+	"""
+	Reads the Infernal version from the cmsearch help banner
+
+	cmsearch_path: Path to the cmsearch executable
+
+	return: The version as a string, None if it could not be found
+	"""
+
+	try:
+		output = subprocess.check_output([cmsearch_path, "-h"], universal_newlines=True, stderr=subprocess.STDOUT)
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+	match = INFERNAL_VERSION_RE.search(output)
+
+	return match.group(1) if match is not None else None
+
+# -----------------------------------------------------------------------------------
+
+def sha256sum(path):
+	"""
+	return: The hexadecimal sha256 digest of a file
+	"""
+
+	digest = hashlib.sha256()
+
+	fp = open(path, 'rb')
+	for block in iter(lambda: fp.read(1024 * 1024), b""):
+		digest.update(block)
+	fp.close()
+
+	return digest.hexdigest()
+
+# -----------------------------------------------------------------------------------
+
+class ResultCache(object):
+	"""
+	Content addressed store of cmsearch outputs. An entry is keyed by the
+	checksum of the CM, the path, size, checksum and sequence range of the
+	search file, the cmsearch options and the Infernal version, so that
+	identical searches by any user share it. Entries are directories
+	<result dir>/<key[:2]>/<key> whose mtime is refreshed on every hit, and
+	the least recently used are evicted once the cache grows over max_bytes.
+	"""
+
+	def __init__(self, result_dir=RESULT_DIR, max_bytes=DEFAULT_MAX_GB * 2 ** 30):
+		self.result_dir = result_dir
+		self.max_bytes = max_bytes
+
+		self.checksums = None # "<path> <size> <mtime>" -> sha256, loaded on first use
+		self.new_checksums = False
+		self.versions = {} # cmsearch path -> Infernal version
+
+	def get_entry_path(self, key):
+		"""
+		return: The directory of the cache entry with the given key
+		"""
+
+		return os.path.join(self.result_dir, key[:2], key)
+
+	def get_checksum(self, path):
+		"""
+		Returns the sha256 of a file, computed once per path, size and mtime
+		and remembered in the cache directory for all users, as search files
+		are too large to checksum on every submission
+
+		path: Path to the file
+
+		return: The sha256 digest as a string
+		"""
+
+		if self.checksums is None:
+			self.checksums = self.read_checksums()
+
+		stat = os.stat(path)
+		memo_key = "%s %d %d" % (os.path.abspath(path), stat.st_size, int(stat.st_mtime))
+
+		if memo_key not in self.checksums:
+			self.checksums[memo_key] = sha256sum(path)
+			self.new_checksums = True
+
+		return self.checksums[memo_key]
+
+	def read_checksums(self):
+		"""
+		return: The dictionary of remembered search file checksums
+		"""
+
+		checksums_path = os.path.join(self.result_dir, CHECKSUMS_FILE)
+
+		if not os.path.exists(checksums_path):
+			return {}
+
+		try:
+			return json.load(open(checksums_path, 'r'))
+		except ValueError:
+			return {}
+
+	def save_checksums(self):
+		"""
+		Adds the checksums computed by this process to the remembered ones
+		"""
+
+		if not self.new_checksums:
+			return
+
+		checksums = self.read_checksums()
+		checksums.update(self.checksums)
+
+		checksums_path = os.path.join(self.result_dir, CHECKSUMS_FILE)
+		tmp_path = "%s.%d.tmp" % (checksums_path, os.getpid())
+		fp = open(tmp_path, 'w')
+		json.dump(checksums, fp, sort_keys=True)
+		fp.close()
+		os.rename(tmp_path, checksums_path)
+
+		self.new_checksums = False
+
+	def get_key(self, cmd):
+		"""
+		Computes the cache key of a cmsearch command
+
+		cmd: A shell command
+
+		return: The key as a string, None if the command's results can not be cached
+		"""
+
+		parsed = rfsizing.parse_cmsearch_command(cmd)
+
+		if parsed is None or parse_output_paths(cmd) is None:
+			return None
+
+		cm_path, seqfile, options = parsed
+		cmsearch_path = shlex.split(cmd)[0]
+
+		match = rfshard.UNIT_RE.match(seqfile)
+		if match is not None:
+			seqfile, seq_range = match.group(1), "%s-%s" % (match.group(2), match.group(3))
+		else:
+			seq_range = "all"
+
+		if not os.path.isfile(cm_path) or not os.path.isfile(seqfile):
+			return None
+
+		if cmsearch_path not in self.versions:
+			self.versions[cmsearch_path] = get_infernal_version(cmsearch_path)
+
+		if self.versions[cmsearch_path] is None:
+			return None
+
+		description = {"cm": sha256sum(cm_path),
+			"seqfile": os.path.abspath(seqfile),
+			"size": os.path.getsize(seqfile),
+			"sha256": self.get_checksum(seqfile),
+			"range": seq_range,
+			"options": options,
+			"infernal": self.versions[cmsearch_path]}
+
+		return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+	def materialize(self, key, tblout, searchout):
+		"""
+		Copies the outputs of a cache entry to the paths a search would have
+		written them to, and marks the entry as recently used
+
+		key: The cache key
+		tblout: Path of the tblout file to write
+		searchout: Path of the cmsearch output file to write
+
+		return: True on a hit, False if there is no complete entry for key
+		"""
+
+		entry_path = self.get_entry_path(key)
+
+		if not os.path.exists(os.path.join(entry_path, META_FILE)):
+			return False
+
+		try:
+			shutil.copyfile(os.path.join(entry_path, TBLOUT_FILE), tblout)
+			shutil.copyfile(os.path.join(entry_path, SEARCHOUT_FILE), searchout)
+			os.utime(entry_path, None)
+		except (IOError, OSError):
+			# evicted while copying
+			return False
+
+		return rfmerge.tail_contains(tblout, rfmerge.SUCCESS_STRING)
+
+	def store(self, key, tblout, searchout):
+		"""
+		Adds the outputs of a successful search to the cache. Entries are
+		written to a temporary directory first, so they are never seen
+		partially written.
+
+		key: The cache key
+		tblout: Path of the search's tblout file
+		searchout: Path of the search's cmsearch output file
+
+		return: True if an entry was added, False if one already existed
+		"""
+
+		entry_path = self.get_entry_path(key)
+
+		if os.path.exists(entry_path):
+			os.utime(entry_path, None)
+			return False
+
+		tmp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+		os.makedirs(tmp_path)
+
+		shutil.copyfile(tblout, os.path.join(tmp_path, TBLOUT_FILE))
+		shutil.copyfile(searchout, os.path.join(tmp_path, SEARCHOUT_FILE))
+
+		fp = open(os.path.join(tmp_path, META_FILE), 'w')
+		json.dump({"key": key, "stored": int(time.time())}, fp, sort_keys=True)
+		fp.close()
+
+		try:
+			os.rename(tmp_path, entry_path)
+		except OSError:
+			# stored concurrently by an identical search
+			shutil.rmtree(tmp_path, ignore_errors=True)
+			return False
+
+		return True
+
+	def list_entries(self):
+		"""
+		return: A list of (last used time, size in bytes, path) tuples, one per entry
+		"""
+
+		entries = []
+
+		for prefix in os.listdir(self.result_dir):
+			prefix_path = os.path.join(self.result_dir, prefix)
+			if len(prefix) != 2 or not os.path.isdir(prefix_path):
+				continue
+
+			for name in os.listdir(prefix_path):
+				entry_path = os.path.join(prefix_path, name)
+				try:
+					size = sum(os.path.getsize(os.path.join(entry_path, f)) for f in os.listdir(entry_path))
+					entries.append((os.path.getmtime(entry_path), size, entry_path))
+				except OSError:
+					continue
+
+		return entries
+
+	def evict(self):
+		"""
+		Removes the least recently used entries once the cache is larger than
+		max_bytes. Only one process evicts at a time, others return at once.
+
+		return: Number of entries removed
+		"""
+
+		lock = open(os.path.join(self.result_dir, ".lock"), 'w')
+
+		try:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except (IOError, OSError):
+			lock.close()
+			return 0
+
+		entries = sorted(self.list_entries())
+		total = sum(entry[1] for entry in entries)
+		nremoved = 0
+
+		if total > self.max_bytes:
+			for last_used, size, entry_path in entries:
+				if total <= self.max_bytes * EVICT_TARGET:
+					break
+				shutil.rmtree(entry_path, ignore_errors=True)
+				total -= size
+				nremoved += 1
+
+		fcntl.flock(lock, fcntl.LOCK_UN)
+		lock.close()
+
+		return nremoved
+
+# -----------------------------------------------------------------------------------
+
+def store_command(cmd, key):
+	"""
+	Appends the storing of a command's outputs in the result cache to it,
+	run only if the command succeeds. The exit status of the command is
+	preserved.
+
+	cmd: A cmsearch shell command
+	key: The cache key of the command
+
+	return: The shell command to run
+	"""
+
+	tblout, searchout, stderr = parse_output_paths(cmd)
+
+	# job pods don't see the environment of the login pod
+	store = "%s --result-dir %s store %s %s %s" % (RFRESULT_CMD, shlex.quote(RESULT_DIR), key, shlex.quote(tblout),
+		shlex.quote(searchout))
+	if stderr is not None:
+		store += " --stderr %s" % shlex.quote(stderr)
+
+	# a failed store leaves a warning in the pod log, but not the search failed
+	warning = "echo %s >&2" % shlex.quote("WARNING: results of %s not stored in %s" % (tblout, RESULT_DIR))
+
+	return "%s && { %s > /dev/null || %s; }" % (cmd, store, warning)
+
+# -----------------------------------------------------------------------------------
+
+def reuse_results(commands):
+	"""
+	Looks up the result cache for each command. The outputs of commands
+	found in the cache are written out and the command is dropped, the
+	others are set to store their outputs once they succeed. Commands are
+	kept unchanged if the cache is not available.
+
+	commands: A list of shell commands
+
+	return: A tuple (commands, indexes) of the commands left to run and their
+	index in the original list
+	"""
+
+	if not os.path.isdir(RESULT_DIR):
+		return (commands, list(range(len(commands))))
+
+	cache = ResultCache()
+	remaining = []
+	indexes = []
+
+	try:
+		for index, cmd in enumerate(commands):
+			key = cache.get_key(cmd)
+
+			if key is None:
+				remaining.append(cmd)
+				indexes.append(index)
+				continue
+
+			tblout, searchout, stderr = parse_output_paths(cmd)
+
+			if cache.materialize(key, tblout, searchout):
+				continue
+
+			remaining.append(store_command(cmd, key))
+			indexes.append(index)
+
+		cache.save_checksums()
+		cache.evict()
+
+	except (IOError, OSError) as e:
+		sys.stderr.write("WARNING: Result cache unavailable: %s\n" % e)
+		return (commands, list(range(len(commands))))
+
+	return (remaining, indexes)
+
+# -----------------------------------------------------------------------------------
+
+def print_status(cache):
+	"""
+	Prints the number of entries and size of the result cache
+	"""
+
+	entries = cache.list_entries()
+	total = sum(entry[1] for entry in entries)
+
+	print ("%s: %d entries, %.1f of %.1f Gb" % (cache.result_dir, len(entries), total / 2.0 ** 30,
+		cache.max_bytes / 2.0 ** 30))
+
+	if len(entries) > 0:
+		print ("least recently used: %s" % time.ctime(min(entries)[0]))
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Shared cache of cmsearch results')
+	parser.add_argument('--result-dir', help='cache directory (default: %s)' % RESULT_DIR, action="store",
+		type=str, default=RESULT_DIR)
+	parser.add_argument('--max-gb', help='size of the cache in Gb (default: %d)' % DEFAULT_MAX_GB,
+		action="store", type=float, default=DEFAULT_MAX_GB)
+	subparsers = parser.add_subparsers(dest="command")
+
+	store = subparsers.add_parser("store", help='add the outputs of a successful search (run in job pods)')
+	store.add_argument('key', help='cache key of the search')
+	store.add_argument('tblout', help='tblout file of the search')
+	store.add_argument('searchout', help='cmsearch output file of the search')
+	store.add_argument('--stderr', help='stderr file of the search, nothing is stored if it has errors',
+		action="store", type=str, default=None)
+
+	checksum = subparsers.add_parser("checksum", help='checksum search files ahead of searches (run once per database)')
+	checksum.add_argument('seqfiles', help='search files', nargs='+', metavar="SEQFILE")
+
+	subparsers.add_parser("evict", help='evict least recently used entries over the size limit')
+	subparsers.add_parser("status", help='print the size of the cache')
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	cache = ResultCache(args.result_dir, max_bytes=args.max_gb * 2 ** 30)
+
+	if args.command == "store":
+		if not rfmerge.tail_contains(args.tblout, rfmerge.SUCCESS_STRING):
+			sys.exit("ERROR: %s is incomplete, not stored" % args.tblout)
+
+		if args.stderr is not None and rfmerge.check_stderr(args.stderr) is not None:
+			sys.exit("ERROR: %s has errors, not stored" % args.stderr)
+
+		cache.store(args.key, args.tblout, args.searchout)
+
+	elif args.command == "checksum":
+		for seqfile in args.seqfiles:
+			print ("%s\t%s" % (seqfile, cache.get_checksum(seqfile)))
+		cache.save_checksums()
+
+	elif args.command == "evict":
+		print ("%d entries evicted" % cache.evict())
+
+	elif args.command == "status":
+		print_status(cache)
+
+	else:
+		parser.print_help()
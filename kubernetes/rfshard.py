@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import gzip
+import math
+import shutil
+import argparse
+import subprocess
+
+import rfsizing
+
+# -----------------------------------------------------------------------------------
+
+RFSHARD_CMD = "/Rfam/software/bin/rfshard.py"
+
+# the search file volume is read-only, indexes are written to the shared
+# read-write volume of login and job pods (manifests/rfresult-pv.yaml), by
+# file name, so that the node-local copies of the search files (see
+# rfcache.py) find the index and blocks of their file
+INDEX_DIR = os.environ.get("RFSHARD_INDEX_DIR", "/Rfam/rfresults/rfshard")
+
+# suffix of the residue count index of each search file
+INDEX_SUFFIX = ".rsidx"
+
+# suffix of the directory holding the sequences of each index block of a
+# search file, <first sequence>.fa.gz, written along with the index so that
+# a unit reads only its own blocks instead of the file up to its last sequence
+BLOCKS_SUFFIX = ".rsblocks"
+
+# the blocks are written once per database and read by many pods
+BLOCK_COMPRESSLEVEL = 1
+
+# sequences are grouped in index blocks of about this many residues, which
+# is the smallest amount of work a unit can be made of
+BLOCK_RESIDUES = 10000000
+
+# default cmsearch wall time per residue and unit of CM width, used when
+# there is no sizing history for the CM width being searched
+DEFAULT_SECS_PER_RESIDUE_PER_W = 1e-8
+
+DEFAULT_TARGET_SECS = 1800
+DEFAULT_MAX_UNITS = 400
+
+# a work unit is a search file followed by an inclusive range of 0-based
+# sequence indexes, e.g. /Rfam/rfamseq/r100_rfamseq14_3.fa.gz:0-5123
+UNIT_RE = re.compile(r'^(\S+):(\d+)-(\d+)$')
+
+# -----------------------------------------------------------------------------------
+
+def open_seqfile(seqfile):
+	"""
+	Opens a, possibly gzipped, fasta file for reading
+
+	seqfile: Path to a fasta file
+
+	return: A file object
+	"""
+
+	if seqfile.endswith(".gz"):
+		return gzip.open(seqfile, 'rt')
+
+	return open(seqfile, 'r')
+
+# -----------------------------------------------------------------------------------
+
+def get_index_path(seqfile):
+	"""
+	return: The path of the residue count index of seqfile, the same for all copies of the file
+	"""
+
+	return os.path.join(INDEX_DIR, os.path.basename(seqfile) + INDEX_SUFFIX)
+
+def get_blocks_dir(seqfile):
+	"""
+	return: The directory holding the index blocks of seqfile, the same for all copies of the file
+	"""
+
+	return os.path.join(INDEX_DIR, os.path.basename(seqfile) + BLOCKS_SUFFIX)
+
+def get_block_path(blocks_dir, block_first):
+	"""
+	return: The path of the block of sequences starting at sequence block_first
+	"""
+
+	return os.path.join(blocks_dir, "%d.fa.gz" % block_first)
+
+# -----------------------------------------------------------------------------------
+
+def build_index(seqfile, block_residues=BLOCK_RESIDUES, write_blocks=True):
+	"""
+	Counts the residues of every sequence in seqfile and writes an index of
+	consecutive blocks of sequences to INDEX_DIR, one block per line:
+	<first sequence> <number of sequences> <number of residues>
+	The sequences of each block are written to their own file in the same
+	pass, unless write_blocks is False.
+
+	seqfile: Path to a fasta file
+	block_residues: Approximate number of residues per block
+	write_blocks: True to write the sequences of each block to the blocks directory
+
+	return: The total number of residues in seqfile
+	"""
+
+	blocks = []
+	nseqs = 0
+	residues = 0
+	block_first = 0
+	block_nseqs = 0
+	block_residues_count = 0
+
+	blocks_dir = get_blocks_dir(seqfile)
+	tmp_blocks_dir = blocks_dir + ".tmp"
+	out = None
+
+	if not os.path.isdir(INDEX_DIR):
+		os.makedirs(INDEX_DIR)
+
+	if write_blocks:
+		shutil.rmtree(tmp_blocks_dir, ignore_errors=True)
+		os.makedirs(tmp_blocks_dir)
+		out = gzip.open(get_block_path(tmp_blocks_dir, 0), 'wt', compresslevel=BLOCK_COMPRESSLEVEL)
+
+	fp = open_seqfile(seqfile)
+
+	for line in fp:
+		if line.startswith('>'):
+			if block_residues_count >= block_residues:
+				blocks.append((block_first, block_nseqs, block_residues_count))
+				block_first = nseqs
+				block_nseqs = 0
+				block_residues_count = 0
+
+				if out is not None:
+					out.close()
+					out = gzip.open(get_block_path(tmp_blocks_dir, block_first), 'wt', compresslevel=BLOCK_COMPRESSLEVEL)
+
+			nseqs += 1
+			block_nseqs += 1
+
+		else:
+			length = len(line.strip())
+			residues += length
+			block_residues_count += length
+
+		if out is not None:
+			out.write(line)
+
+	fp.close()
+
+	if block_nseqs > 0:
+		blocks.append((block_first, block_nseqs, block_residues_count))
+
+	# blocks of an earlier index must not be read with the new one
+	shutil.rmtree(blocks_dir, ignore_errors=True)
+
+	if out is not None:
+		out.close()
+		os.rename(tmp_blocks_dir, blocks_dir)
+
+	# write then rename so that a partial index is never used
+	index_path = get_index_path(seqfile)
+	fp = open(index_path + ".tmp", 'w')
+	fp.write("# %s %d %d %d\n" % (os.path.basename(seqfile), nseqs, residues, os.path.getsize(seqfile)))
+	for block in blocks:
+		fp.write("%d\t%d\t%d\n" % block)
+	fp.close()
+	os.rename(index_path + ".tmp", index_path)
+
+	return residues
+
+# -----------------------------------------------------------------------------------
+
+def read_index(seqfile):
+	"""
+	Reads the residue count index of seqfile
+
+	seqfile: Path to a fasta file
+
+	return: A list of (first sequence, number of sequences, number of residues) tuples,
+	None if seqfile was not indexed, or its index is of another file of the same name
+	"""
+
+	index_path = get_index_path(seqfile)
+
+	if not os.path.exists(index_path):
+		return None
+
+	blocks = []
+	fp = open(index_path, 'r')
+	for line in fp:
+		if line.startswith('#'):
+			header = line[1:].split()
+
+			# a search file of another release
+			if len(header) > 3 and os.path.exists(seqfile) and int(header[3]) != os.path.getsize(seqfile):
+				fp.close()
+				return None
+			continue
+		blocks.append(tuple(int(x) for x in line.split('\t')))
+	fp.close()
+
+	return blocks
+
+# -----------------------------------------------------------------------------------
+
+def get_secs_per_residue(width, seqfiles, indexes):
+	"""
+	Estimates the cmsearch wall time per residue for a CM of a given width,
+	from the sizing history of whole search files if available
+
+	width: The CM window length
+	seqfiles: A list of search files
+	indexes: A dictionary of search file indexes, as returned by read_index
+
+	return: Wall time in seconds per residue
+	"""
+
+	try:
+		history = rfsizing.SizingHistory()
+	except Exception:
+		return width * DEFAULT_SECS_PER_RESIDUE_PER_W
+
+	tolerance = max(1, int(width * rfsizing.WIDTH_TOLERANCE))
+	rates = []
+
+	for seqfile in seqfiles:
+		rows = history.db.execute("SELECT unit, wall_secs FROM observations WHERE shard = ? AND width BETWEEN ? AND ?",
+			(os.path.basename(seqfile), width - tolerance, width + tolerance)).fetchall()
+
+		for unit, wall_secs in rows:
+			residues = count_unit_residues(indexes[seqfile], unit)
+			if residues > 0:
+				rates.append(wall_secs / residues)
+
+	history.close()
+
+	if len(rates) == 0:
+		return width * DEFAULT_SECS_PER_RESIDUE_PER_W
+
+	return max(rates)
+
+# -----------------------------------------------------------------------------------
+
+def count_unit_residues(blocks, unit):
+	"""
+	Counts the residues of a unit of a search file from its index blocks
+
+	blocks: The index blocks of the search file, as returned by read_index
+	unit: The sequence range of the unit (FIRST-LAST), "" for the whole file
+
+	return: The number of residues of the blocks in the unit
+	"""
+
+	if unit == "":
+		return sum(block[2] for block in blocks)
+
+	first, last = [int(x) for x in unit.split('-')]
+
+	return sum(block[2] for block in blocks if block[0] >= first and block[0] + block[1] - 1 <= last)
+
+# -----------------------------------------------------------------------------------
+
+def split_blocks(blocks, nunits):
+	"""
+	Splits the index blocks of a search file into up to nunits contiguous
+	sequence ranges holding about the same number of residues
+
+	blocks: A list of index blocks, as returned by read_index
+	nunits: Number of ranges to split the blocks in
+
+	return: A list of (first sequence, last sequence) tuples
+	"""
+
+	total = sum(block[2] for block in blocks)
+	target = float(total) / nunits
+
+	ranges = []
+	first = blocks[0][0]
+	residues = 0
+
+	for block_first, block_nseqs, block_residues in blocks:
+		residues += block_residues
+
+		if residues >= target * (len(ranges) + 1) and len(ranges) < nunits - 1:
+			ranges.append((first, block_first + block_nseqs - 1))
+			first = block_first + block_nseqs
+
+	last = blocks[-1][0] + blocks[-1][1] - 1
+	if first <= last:
+		ranges.append((first, last))
+
+	return ranges
+
+# -----------------------------------------------------------------------------------
+
+def plan_units(seqfiles, width, target_secs=DEFAULT_TARGET_SECS, max_units=DEFAULT_MAX_UNITS):
+	"""
+	Splits search files into residue balanced work units, so that a cmsearch
+	of each unit with a CM of the given width takes about target_secs. Units
+	never span more than one file and every file is at least one unit. Files
+	without an index are kept whole.
+
+	seqfiles: A list of search files
+	width: The CM window length
+	target_secs: Target wall time per unit in seconds
+	max_units: Maximum number of units
+
+	return: A list of unit specifications (FILE:FIRST-LAST, or FILE for whole files)
+	"""
+
+	indexes = dict((seqfile, read_index(seqfile)) for seqfile in seqfiles)
+	indexed = [seqfile for seqfile in seqfiles if indexes[seqfile]]
+
+	if len(indexed) == 0:
+		return list(seqfiles)
+
+	total = sum(sum(block[2] for block in indexes[seqfile]) for seqfile in indexed)
+	secs = total * get_secs_per_residue(width, indexed, indexes)
+	nunits = min(max_units, max(len(seqfiles), int(math.ceil(secs / target_secs))))
+
+	units = []
+	for seqfile in seqfiles:
+		blocks = indexes[seqfile]
+
+		if not blocks:
+			units.append(seqfile)
+			continue
+
+		residues = sum(block[2] for block in blocks)
+		file_units = max(1, int(round(nunits * float(residues) / total)))
+
+		if file_units == 1:
+			units.append(seqfile)
+			continue
+
+		for first, last in split_blocks(blocks, file_units):
+			units.append("%s:%d-%d" % (seqfile, first, last))
+
+	return units
+
+# -----------------------------------------------------------------------------------
+
+def get_unit_blocks(seqfile, first, last):
+	"""
+	Finds the block files holding exactly the sequences first to last of a
+	fasta file, as planned by plan_units
+
+	seqfile: Path to a fasta file
+	first: Index of the first sequence
+	last: Index of the last sequence
+
+	return: A list of block file paths, None if the blocks were not written or
+	first and last are not block boundaries
+	"""
+
+	blocks_dir = get_blocks_dir(seqfile)
+
+	if not os.path.isdir(blocks_dir):
+		return None
+
+	blocks = read_index(seqfile)
+
+	if not blocks:
+		return None
+
+	paths = []
+	for block_first, block_nseqs, block_residues in blocks:
+		block_last = block_first + block_nseqs - 1
+
+		if block_last < first or block_first > last:
+			continue
+
+		if block_first < first or block_last > last:
+			return None
+
+		paths.append(get_block_path(blocks_dir, block_first))
+
+	if len(paths) == 0 or not all(os.path.exists(path) for path in paths):
+		return None
+
+	return paths
+
+# -----------------------------------------------------------------------------------
+
+def write_sequences(seqfile, first, last, out):
+	"""
+	Writes the sequences first to last (0-based, inclusive) of a fasta file.
+	Only the blocks of the unit are read if the file was indexed with its
+	blocks, otherwise the file is read up to the last sequence.
+
+	seqfile: Path to a fasta file
+	first: Index of the first sequence
+	last: Index of the last sequence
+	out: A file object to write to
+	"""
+
+	block_paths = get_unit_blocks(seqfile, first, last)
+
+	if block_paths is not None:
+		for block_path in block_paths:
+			fp = gzip.open(block_path, 'rt')
+			shutil.copyfileobj(fp, out)
+			fp.close()
+		return
+
+	index = -1
+	fp = open_seqfile(seqfile)
+
+	for line in fp:
+		if line.startswith('>'):
+			index += 1
+			if index > last:
+				break
+
+		if index >= first:
+			out.write(line)
+
+	fp.close()
+
+	if index < last:
+		raise ValueError("%s has fewer than %d sequences" % (seqfile, last + 1))
+
+# -----------------------------------------------------------------------------------
+
+def search_unit(seqfile, first, last, cmd):
+	"""
+	Runs a cmsearch command reading a unit of sequences from its stdin.
+	The command must use '-' as its sequence file.
+
+	seqfile: Path to a fasta file
+	first: Index of the first sequence of the unit
+	last: Index of the last sequence of the unit
+	cmd: The cmsearch command as a list of arguments
+
+	return: The cmsearch exit status, 1 if the sequences could not be read
+	"""
+
+	process = subprocess.Popen(cmd, stdin=subprocess.PIPE, universal_newlines=True)
+
+	try:
+		write_sequences(seqfile, first, last, process.stdin)
+		process.stdin.close()
+
+	except (IOError, ValueError) as e:
+		sys.stderr.write("ERROR: Unable to read unit %s:%d-%d: %s\n" % (seqfile, first, last, e))
+		process.kill()
+		process.wait()
+		return 1
+
+	return process.wait()
+
+# -----------------------------------------------------------------------------------
+
+def expand_unit_command(cmd):
+	"""
+	Rewrites a cmsearch command whose sequence file is a unit specification
+	(FILE:FIRST-LAST) so that the unit is streamed to cmsearch by
+	rfshard.py search. Other commands are returned unchanged.
+
+	cmd: A shell command
+
+	return: The shell command to run
+	"""
+
+	return re.sub(r'(\S*cmsearch) (.*?)(\S+):(\d+)-(\d+)(?=\s|$)',
+		r'%s search \3 \4 \5 \1 --tformat fasta \2-' % RFSHARD_CMD, cmd, count=1)
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Residue balanced work units for rfsearch')
+	subparsers = parser.add_subparsers(dest="command")
+
+	index = subparsers.add_parser("index", help='build the residue count index of search files in %s (run once per database)' % INDEX_DIR)
+	index.add_argument('seqfiles', help='fasta files to index', nargs='+', metavar="SEQFILE")
+	index.add_argument('--no-blocks', help='do not write the sequences of each block, units then read their file from the start',
+		action="store_true", default=False)
+
+	plan = subparsers.add_parser("plan", help='print the work units to search, one per line')
+	plan.add_argument('seqfiles', help='search files', nargs='+', metavar="SEQFILE")
+	plan.add_argument('--width', help='CM window length', action="store", type=int, required=True)
+	plan.add_argument('--target-secs', help='target wall time per unit (default: %d)' % DEFAULT_TARGET_SECS,
+		action="store", type=int, default=DEFAULT_TARGET_SECS)
+	plan.add_argument('--max-units', help='maximum number of units (default: %d)' % DEFAULT_MAX_UNITS,
+		action="store", type=int, default=DEFAULT_MAX_UNITS)
+
+	search = subparsers.add_parser("search", help='stream a unit of sequences to a cmsearch command (run in job pods)')
+	search.add_argument('seqfile', help='search file')
+	search.add_argument('first', help='index of the first sequence (0-based)', type=int)
+	search.add_argument('last', help='index of the last sequence (0-based, inclusive)', type=int)
+	search.add_argument('cmd', help="cmsearch command reading sequences from '-'", nargs=argparse.REMAINDER)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	if args.command == "index":
+		for seqfile in args.seqfiles:
+			print ("%s\t%d residues" % (seqfile, build_index(seqfile, write_blocks=not args.no_blocks)))
+
+	elif args.command == "plan":
+		for unit in plan_units(args.seqfiles, args.width, target_secs=args.target_secs, max_units=args.max_units):
+			print (unit)
+
+	elif args.command == "search":
+		sys.exit(search_unit(args.seqfile, args.first, args.last, args.cmd))
+
+	else:
+		parser.print_help()
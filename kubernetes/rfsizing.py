@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import shlex
+import sqlite3
+import argparse
+
+# -----------------------------------------------------------------------------------
+
+# observations recorded by the pods and the history database live on the
+# user's volume, which is mounted at /workdir both on the login pod and the
+# job pods
+SIZING_DIR = os.environ.get("RFAM_SIZING_DIR", os.path.join("/workdir", ".rfsizing"))
+
+RECORD_CMD = "/Rfam/software/bin/rfsizing.py record"
+
+# minimum number of observations needed before requests are predicted
+MIN_OBSERVATIONS = 3
+
+# observations of CMs whose width is within this fraction of the CM being
+# sized are considered similar
+WIDTH_TOLERANCE = 0.1
+
+# requests are the highest observed usage plus this margin
+REQUEST_MARGIN = 1.25
+
+# memory limits are this multiple of the observed peak memory
+LIMIT_MARGIN = 2.0
+
+# maximum resources that can be requested per container
+MAX_CPUS = 8
+MAX_MEMORY_MB = 24 * 1024
+
+# smallest memory request in Mb
+MIN_MEMORY_MB = 256
+
+# shards that are a unit of a search file (FILE:FIRST-LAST, see rfshard.py)
+# are recorded under the file name, with the sequence range in the unit column
+UNIT_RANGE_RE = re.compile(r'^(.*):(\d+-\d+)$')
+
+# -----------------------------------------------------------------------------------
+
+def split_shard(shard):
+	"""
+	Splits a shard name in the search file name and unit sequence range
+
+	shard: A search file name or unit specification (e.g. rfamseq14_3.fa.gz:0-5123)
+
+	return: A tuple (search file name, sequence range FIRST-LAST or "" for the whole file)
+	"""
+
+	match = UNIT_RANGE_RE.match(shard)
+
+	if match is None:
+		return (shard, "")
+
+	return (match.group(1), match.group(2))
+
+# -----------------------------------------------------------------------------------
+
+def read_cm_width(cm_path):
+	"""
+	Reads the window length (W) from the header of a CM file
+
+	cm_path: Path to a CM file
+
+	return: W as an integer, None if it could not be read
+	"""
+
+	try:
+		fp = open(cm_path, 'r')
+	except IOError:
+		return None
+
+	width = None
+	for line in fp:
+		fields = line.split()
+		if len(fields) == 2 and fields[0] == "W":
+			width = int(fields[1])
+			break
+		# end of the CM header
+		if line.startswith("CM"):
+			break
+
+	fp.close()
+
+	return width
+
+# -----------------------------------------------------------------------------------
+
+def parse_cmsearch_command(cmd):
+	"""
+	Splits a cmsearch command, as built by Bio::Rfam::Infernal, in its CM
+	path, sequence file and options. The --tblout path and output redirection
+	are not part of the options.
+
+	cmd: A shell command (e.g. /Rfam/software/bin/cmsearch --tblout s.tbl --cpu 4 CM db.fa > s.out)
+
+	return: A tuple (cm_path, seqfile, options), None if cmd is not a cmsearch command
+	"""
+
+	try:
+		tokens = shlex.split(cmd)
+	except ValueError:
+		return None
+
+	if len(tokens) == 0 or os.path.basename(tokens[0]) != "cmsearch":
+		return None
+
+	if ">" in tokens:
+		tokens = tokens[:tokens.index(">")]
+
+	if len(tokens) < 3:
+		return None
+
+	options = []
+	args = tokens[1:-2]
+	i = 0
+	while i < len(args):
+		if args[i] == "--tblout":
+			i += 2
+			continue
+		options.append(args[i])
+		i += 1
+
+	return (tokens[-2], tokens[-1], ' '.join(options))
+
+# -----------------------------------------------------------------------------------
+
+def read_cgroup_usage():
+	"""
+	Reads the peak memory and CPU time used by the current container from
+	its cgroup (v2 or v1)
+
+	return: A tuple (peak memory in Mb, cpu seconds), None for values that could not be read
+	"""
+
+	peak_mb = None
+	cpu_secs = None
+
+	# cgroup v2
+	if os.path.exists("/sys/fs/cgroup/cpu.stat"):
+		if os.path.exists("/sys/fs/cgroup/memory.peak"):
+			peak_mb = int(open("/sys/fs/cgroup/memory.peak").read()) / (1024.0 * 1024.0)
+
+		for line in open("/sys/fs/cgroup/cpu.stat"):
+			fields = line.split()
+			if fields[0] == "usage_usec":
+				cpu_secs = int(fields[1]) / 1e6
+
+	# cgroup v1
+	else:
+		memory_peak = "/sys/fs/cgroup/memory/memory.max_usage_in_bytes"
+		cpu_usage = "/sys/fs/cgroup/cpuacct/cpuacct.usage"
+
+		if os.path.exists(memory_peak):
+			peak_mb = int(open(memory_peak).read()) / (1024.0 * 1024.0)
+		if os.path.exists(cpu_usage):
+			cpu_secs = int(open(cpu_usage).read()) / 1e9
+
+	return (peak_mb, cpu_secs)
+
+# -----------------------------------------------------------------------------------
+
+def record_observation(width, shard, options, start_time, exit_status, sizing_dir=SIZING_DIR):
+	"""
+	Writes the resources used by the current container to a new observation
+	file in sizing_dir/observations. Called from the job pods once the
+	search finished.
+
+	width: The CM window length
+	shard: The sequence file searched
+	options: The cmsearch options
+	start_time: The time the search started (seconds since the epoch)
+	exit_status: The exit status of the search
+	sizing_dir: Directory holding the observations
+	"""
+
+	peak_mb, cpu_secs = read_cgroup_usage()
+
+	if peak_mb is None or cpu_secs is None:
+		return
+
+	observation = {"width": width,
+		"shard": shard,
+		"options": options,
+		"peak_mb": peak_mb,
+		"cpu_secs": cpu_secs,
+		"wall_secs": max(1, time.time() - start_time),
+		"exit_status": exit_status,
+		"recorded": time.time()}
+
+	observation_dir = os.path.join(sizing_dir, "observations")
+	if not os.path.exists(observation_dir):
+		os.makedirs(observation_dir)
+
+	# write then rename so that a partial file is never ingested
+	observation_path = os.path.join(observation_dir, "%s-%d.json" % (os.uname()[1], os.getpid()))
+	fp = open(observation_path + ".tmp", 'w')
+	json.dump(observation, fp)
+	fp.close()
+	os.rename(observation_path + ".tmp", observation_path)
+
+# -----------------------------------------------------------------------------------
+
+class SizingHistory(object):
+	"""
+	SQLite database of the resources used by past cmsearch jobs, keyed by
+	CM width, shard and search options. Only the login pod writes to it,
+	the job pods write observation files that are ingested on demand.
+	"""
+
+	def __init__(self, sizing_dir=SIZING_DIR):
+		if not os.path.exists(sizing_dir):
+			os.makedirs(sizing_dir)
+
+		self.sizing_dir = sizing_dir
+		self.db = sqlite3.connect(os.path.join(sizing_dir, "history.sqlite"))
+		self.db.execute("CREATE TABLE IF NOT EXISTS observations ("
+			"width INTEGER, shard TEXT, options TEXT, peak_mb REAL, cpu_secs REAL, "
+			"wall_secs REAL, recorded REAL, unit TEXT NOT NULL DEFAULT '')")
+		self.db.execute("CREATE INDEX IF NOT EXISTS observations_key ON observations (shard, options, width)")
+		self.upgrade()
+		self.db.commit()
+
+	def upgrade(self):
+		"""
+		Adds the unit column to databases created before it existed, moving
+		the sequence range of units out of their shard name
+		"""
+
+		columns = [row[1] for row in self.db.execute("PRAGMA table_info(observations)")]
+
+		if "unit" in columns:
+			return
+
+		self.db.execute("ALTER TABLE observations ADD COLUMN unit TEXT NOT NULL DEFAULT ''")
+
+		for rowid, shard in self.db.execute("SELECT rowid, shard FROM observations").fetchall():
+			file_name, unit = split_shard(shard)
+			if unit != "":
+				self.db.execute("UPDATE observations SET shard = ?, unit = ? WHERE rowid = ?", (file_name, unit, rowid))
+
+	def close(self):
+		self.db.close()
+
+	def ingest(self):
+		"""
+		Moves observation files written by the job pods to the database.
+		Failed jobs are skipped.
+
+		return: The number of observations ingested
+		"""
+
+		observation_dir = os.path.join(self.sizing_dir, "observations")
+
+		if not os.path.exists(observation_dir):
+			return 0
+
+		count = 0
+		for filename in os.listdir(observation_dir):
+			if not filename.endswith(".json"):
+				continue
+
+			observation_path = os.path.join(observation_dir, filename)
+
+			try:
+				observation = json.load(open(observation_path))
+			except ValueError:
+				os.remove(observation_path)
+				continue
+
+			if observation["exit_status"] == 0:
+				shard, unit = split_shard(observation["shard"])
+				self.db.execute("INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+					(observation["width"], shard, observation["options"], observation["peak_mb"],
+					observation["cpu_secs"], observation["wall_secs"], observation["recorded"], unit))
+				count += 1
+
+			os.remove(observation_path)
+
+		self.db.commit()
+
+		return count
+
+	def predict(self, width, shard, options):
+		"""
+		Predicts the resources a cmsearch job will use from past jobs that
+		searched the same shard with the same options, using a CM of similar
+		width. Memory is scaled up linearly for CMs wider than the observed ones.
+		Searches of any unit of a search file count as searches of the file.
+
+		width: The CM window length
+		shard: The sequence file searched, or unit of it
+		options: The cmsearch options
+
+		return: A tuple (cpus, peak memory in Mb), None if there is not enough history
+		"""
+
+		tolerance = max(1, int(width * WIDTH_TOLERANCE))
+		rows = self.db.execute("SELECT width, peak_mb, cpu_secs, wall_secs FROM observations "
+			"WHERE shard = ? AND options = ? AND width BETWEEN ? AND ?",
+			(split_shard(shard)[0], options, width - tolerance, width + tolerance)).fetchall()
+
+		if len(rows) < MIN_OBSERVATIONS:
+			return None
+
+		peak_mb = max(peak * max(1.0, float(width) / observed_width) for observed_width, peak, cpu, wall in rows)
+		cpus = max(cpu / wall for observed_width, peak, cpu, wall in rows)
+
+		return (cpus, peak_mb)
+
+# -----------------------------------------------------------------------------------
+
+def wrap_command(cmd, width, shard, options):
+	"""
+	Wraps a command so that the job pod records the resources it used once
+	it finishes. The exit status of the command is preserved.
+
+	cmd: A cmsearch shell command
+	width: The CM window length
+	shard: The sequence file searched
+	options: The cmsearch options
+
+	return: The wrapped shell command
+	"""
+
+	record = "%s --width %d --shard %s --options %s --start $RFSIZING_START --exit-status $rc" % (
+		RECORD_CMD, width, shlex.quote(shard), shlex.quote(options))
+
+	return "RFSIZING_START=$(date +%%s); %s; rc=$?; %s > /dev/null 2>&1; exit $rc" % (cmd, record)
+
+# -----------------------------------------------------------------------------------
+
+def right_size(commands, cpus, memory):
+	"""
+	Predicts the requests and limits of a job running one of commands per
+	pod from the history of similar cmsearch jobs. The caller's values are
+	kept when commands are not cmsearch commands or there is not enough
+	history for any of them. cmsearch commands are wrapped to record the
+	resources they use.
+
+	commands: A list of shell commands
+	cpus: Number of cpus requested by the caller
+	memory: Memory in Mb requested by the caller
+
+	return: A tuple (cpus, memory, limits, commands) where limits is a dictionary
+	of k8s container limits or None to keep the defaults
+	"""
+
+	parsed = [parse_cmsearch_command(cmd) for cmd in commands]
+
+	if any(x is None for x in parsed):
+		return (cpus, memory, None, commands)
+
+	widths = {}
+	for cm_path, seqfile, options in parsed:
+		if cm_path not in widths:
+			widths[cm_path] = read_cm_width(cm_path)
+
+	if any(width is None for width in widths.values()):
+		return (cpus, memory, None, commands)
+
+	keys = [(widths[cm_path], os.path.basename(seqfile), options) for cm_path, seqfile, options in parsed]
+	wrapped = [wrap_command(cmd, *key) for cmd, key in zip(commands, keys)]
+
+	try:
+		history = SizingHistory()
+		history.ingest()
+		predictions = [history.predict(*key) for key in keys]
+		history.close()
+	except (sqlite3.Error, OSError):
+		return (cpus, memory, None, wrapped)
+
+	if any(prediction is None for prediction in predictions):
+		return (cpus, memory, None, wrapped)
+
+	# all pods of a job share the same requests, so size for the most demanding shard
+	predicted_cpus = max(prediction[0] for prediction in predictions)
+	predicted_mb = max(prediction[1] for prediction in predictions)
+
+	new_cpus = min(int(cpus), max(1, int(math.ceil(predicted_cpus * REQUEST_MARGIN))))
+	new_memory = min(MAX_MEMORY_MB, max(MIN_MEMORY_MB, int(math.ceil(predicted_mb * REQUEST_MARGIN))))
+	memory_limit = min(MAX_MEMORY_MB, max(new_memory, int(math.ceil(predicted_mb * LIMIT_MARGIN))))
+
+	limits = {"cpu": "%dm" % (min(MAX_CPUS, int(cpus)) * 1000), "memory": "%dMi" % memory_limit}
+
+	return (new_cpus, new_memory, limits, wrapped)
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Resource sizing of rfsearch k8s jobs')
+	subparsers = parser.add_subparsers(dest="command")
+
+	record = subparsers.add_parser("record", help='record the resources used by this container (run in job pods)')
+	record.add_argument('--width', help='CM window length', action="store", type=int, required=True)
+	record.add_argument('--shard', help='sequence file searched', action="store", type=str, required=True)
+	record.add_argument('--options', help='cmsearch options', action="store", type=str, required=True)
+	record.add_argument('--start', help='search start time (seconds since the epoch)', action="store",
+		type=float, required=True)
+	record.add_argument('--exit-status', help='exit status of the search', action="store", type=int, required=True)
+
+	predict = subparsers.add_parser("predict", help='predict the resources of a cmsearch job')
+	predict.add_argument('--width', help='CM window length', action="store", type=int, required=True)
+	predict.add_argument('--shard', help='sequence file searched', action="store", type=str, required=True)
+	predict.add_argument('--options', help='cmsearch options', action="store", type=str, required=True)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	if args.command == "record":
+		record_observation(args.width, args.shard, args.options, args.start, args.exit_status)
+
+	elif args.command == "predict":
+		history = SizingHistory()
+		history.ingest()
+		prediction = history.predict(args.width, os.path.basename(args.shard), args.options)
+		history.close()
+
+		if prediction is None:
+			sys.exit("Not enough history to size this job")
+
+		print ("cpus: %.2f\tpeak memory: %.0fMb" % prediction)
+
+	else:
+		parser.print_help()
@@ -0,0 +1,886 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+import threading
+import queue
+import statistics
+import datetime
+
+import rfkubesub
+import rfwatch
+import rfmerge
+import rfpool
+import rfledger
+
+# -----------------------------------------------------------------------------------
+
+# job phases after which a job's state will not change any more
+TERMINAL_PHASES = ("Succeeded", "Failed")
+
+# container waiting reasons from which a pod will not recover on its own
+FATAL_WAITING_REASONS = ("CrashLoopBackOff", "ErrImagePull", "ImagePullBackOff",
+	"CreateContainerConfigError", "CreateContainerError", "InvalidImageName")
+
+COMPLETION_INDEX_ANNOTATION = "batch.kubernetes.io/job-completion-index"
+
+# set on the speculative copies of straggler shards (see Speculator), to the
+# node the copy avoids
+SPECULATIVE_ANNOTATION = "rfam.org/speculative-copy"
+
+# suffix of the k8s job name of speculative copies
+COPY_SUFFIX = "-copy"
+
+# a running shard is copied once it ran this many times the median runtime
+# of the completed shards of its job
+STRAGGLER_FACTOR = 3.0
+
+# completed shards needed in a job before its stragglers are looked for,
+# half of the job's shards if more
+MIN_RUNTIMES = 3
+
+# shards that ran for less than this many seconds are never copied
+MIN_STRAGGLER_SECS = 120
+
+# number of seconds between looks for stragglers
+SPECULATION_INTERVAL = 5
+
+# exit codes
+SUCCESS = 0
+JOB_FAILED = 1
+TIMEOUT = 2
+WATCH_FAILED = 3
+
+# -----------------------------------------------------------------------------------
+
+def parse_index_set(indexes):
+	"""
+	Parses the completedIndexes/failedIndexes status field of an Indexed job
+	(e.g. "0-3,5,7-9") into a set of integers
+
+	indexes: The index string, can be None or empty
+
+	return: A set of completion indexes
+	"""
+
+	index_set = set()
+
+	if not indexes:
+		return index_set
+
+	for index_range in indexes.split(','):
+		if '-' in index_range:
+			start, end = [int(x) for x in index_range.split('-')]
+			index_set.update(range(start, end + 1))
+		else:
+			index_set.add(int(index_range))
+
+	return index_set
+
+# -----------------------------------------------------------------------------------
+
+def get_shard_index(metadata, completion_index):
+	"""
+	Maps the completion index of an Indexed job to its rfsearch shard
+	index. They differ when rfkubesub.py left shards with cached results
+	out of the job, in which case the Job and its pods are annotated with
+	the shard index of each completion index.
+
+	metadata: The V1ObjectMeta of a Job or Pod
+	completion_index: The completion index as an integer
+
+	return: The shard index as an integer
+	"""
+
+	annotations = metadata.annotations or {}
+	shard_indexes = annotations.get(rfkubesub.SHARD_INDEXES_ANNOTATION)
+
+	if shard_indexes is None:
+		return completion_index
+
+	return int(shard_indexes.split(',')[completion_index])
+
+# -----------------------------------------------------------------------------------
+
+class JobTracker(object):
+	"""
+	Keeps the phase of each tracked rfsearch job, indexed by job name, and
+	updates it from k8s Job and Pod objects received from the watch API.
+	"""
+
+	def __init__(self, user, job_names):
+		self.user = user
+		self.phases = dict((job_name, "Unknown") for job_name in job_names)
+		self.reasons = {}
+		self.pods = {} # job name -> last seen pod of the job, speculative copies excluded
+		self.k8s_jobs = {} # k8s job name -> V1Job, speculative copies excluded
+		self.speculative_wins = set() # job names a speculative copy succeeded first
+		self.pooled = set() # job names found in the worker pool queue
+
+	def set_phase(self, job_name, phase, reason=None):
+		"""
+		Updates the phase of a tracked job. Terminal phases are never
+		overwritten.
+
+		job_name: The rfsearch job name
+		phase: One of Unknown, Pending, Running, Succeeded, Failed
+		reason: A message explaining a failure
+		"""
+
+		if job_name not in self.phases or self.phases[job_name] in TERMINAL_PHASES:
+			return
+
+		self.phases[job_name] = phase
+
+		if reason is not None:
+			self.reasons[job_name] = reason
+
+	def set_succeeded(self, job_name, speculative=False):
+		"""
+		Marks a tracked job as Succeeded, remembering if its speculative copy
+		got there first
+
+		job_name: The rfsearch job name
+		speculative: True if the job succeeded in its speculative copy
+		"""
+
+		if speculative and job_name in self.phases and self.phases[job_name] not in TERMINAL_PHASES:
+			self.speculative_wins.add(job_name)
+
+		self.set_phase(job_name, "Succeeded")
+
+	def get_job_names(self, job):
+		"""
+		Returns the rfsearch job names run by a k8s Job
+
+		job: A V1Job object
+
+		return: A list of rfsearch job names, in completion index order, empty if the job was not created by rfkubesub
+		"""
+
+		annotations = job.metadata.annotations or {}
+		job_index = rfkubesub.get_job_index(self.user, job.metadata.name, annotations)
+
+		if job_index is None:
+			return []
+
+		if rfkubesub.MPI_PODS_ANNOTATION not in annotations and job.spec.completion_mode == "Indexed":
+			return ["%s-%s" % (job_index, get_shard_index(job.metadata, i)) for i in range(job.spec.completions)]
+
+		return [job_index]
+
+	def get_listed(self, jobs):
+		"""
+		Returns the rfsearch job names run by a listing of k8s Jobs
+
+		jobs: A list of V1Job objects
+
+		return: A set of rfsearch job names
+		"""
+
+		listed = set()
+
+		for job in jobs:
+			listed.update(self.get_job_names(job))
+
+		return listed
+
+	def update_from_job(self, event_type, job):
+		"""
+		Updates job phases from a k8s Job. An Indexed job holds one rfsearch
+		job per completion index, named <job index>-<completion index>, or
+		<job index>-<shard index> if shards were left out of the job (see
+		get_shard_index). Speculative copies only count when they succeed.
+		The pods of an MPI job (see rfkubesub.submit_mpi_job) run a single
+		rfsearch job, which succeeds when its launcher (pod 0) does.
+
+		event_type: The watch event type (ADDED, MODIFIED, DELETED)
+		job: A V1Job object
+		"""
+
+		job_names = self.get_job_names(job)
+
+		if len(job_names) == 0:
+			return
+
+		speculative = SPECULATIVE_ANNOTATION in (job.metadata.annotations or {})
+
+		if not speculative and event_type == "DELETED":
+			self.k8s_jobs.pop(job.metadata.name, None)
+		elif not speculative:
+			self.k8s_jobs[job.metadata.name] = job
+
+		status = job.status
+		conditions = status.conditions or []
+		failed_conditions = [c for c in conditions if c.type == "Failed" and c.status == "True"]
+
+		if rfkubesub.MPI_PODS_ANNOTATION in (job.metadata.annotations or {}):
+			completed = set([0]) if 0 in parse_index_set(status.completed_indexes) else set()
+			failed = set()
+
+		elif job.spec.completion_mode == "Indexed":
+			completed = parse_index_set(status.completed_indexes)
+			failed = parse_index_set(getattr(status, "failed_indexes", None))
+
+		else:
+			completed = set([0]) if status.succeeded else set()
+			failed = set()
+
+		for i, job_name in enumerate(job_names):
+			if i in completed:
+				self.set_succeeded(job_name, speculative)
+
+			# the original shard is still running
+			elif speculative:
+				continue
+
+			elif i in failed or len(failed_conditions) > 0:
+				reason = failed_conditions[0].message if len(failed_conditions) > 0 else "index failed"
+				self.set_phase(job_name, "Failed", reason)
+
+			elif event_type == "DELETED":
+				self.set_phase(job_name, "Failed", "job deleted before completion")
+
+			elif self.phases.get(job_name) == "Unknown":
+				self.set_phase(job_name, "Pending")
+
+	def update_from_pod(self, event_type, pod):
+		"""
+		Updates job phases from a k8s Pod.
+
+		event_type: The watch event type (ADDED, MODIFIED, DELETED)
+		pod: A V1Pod object
+		"""
+
+		# the job status is authoritative once pods are gone
+		if event_type == "DELETED":
+			return
+
+		labels = pod.metadata.labels or {}
+		job_name = labels.get("jobname", labels.get("job-name"))
+
+		if job_name is None:
+			return
+
+		annotations = pod.metadata.annotations or {}
+		job_index = rfkubesub.get_job_index(self.user, job_name, annotations)
+
+		if job_index is None:
+			return
+
+		completion_index = annotations.get(COMPLETION_INDEX_ANNOTATION)
+		mpi = rfkubesub.MPI_PODS_ANNOTATION in annotations
+
+		if completion_index is not None and not mpi:
+			job_index = "%s-%s" % (job_index, get_shard_index(pod.metadata, int(completion_index)))
+
+		speculative = SPECULATIVE_ANNOTATION in annotations
+
+		if not speculative and not mpi:
+			self.pods[job_index] = pod
+
+		for container_status in pod.status.container_statuses or []:
+			waiting = container_status.state.waiting if container_status.state is not None else None
+
+			if waiting is not None and waiting.reason in FATAL_WAITING_REASONS and not speculative:
+				self.set_phase(job_index, "Failed", "%s: %s" % (waiting.reason, waiting.message))
+				return
+
+		# the other pods of an MPI job exit once its launcher finished, whether it succeeded or not
+		if pod.status.phase == "Succeeded" and (not mpi or completion_index == "0"):
+			self.set_succeeded(job_index, speculative)
+
+		elif pod.status.phase == "Running":
+			self.set_phase(job_index, "Running")
+
+		elif pod.status.phase == "Pending" and self.phases.get(job_index) == "Unknown":
+			self.set_phase(job_index, "Pending")
+
+	def update_from_tasks(self, states):
+		"""
+		Updates job phases from the state of tasks in the worker pool queue
+
+		states: A dictionary of job name -> (state, exit status), as returned by rfpool.TaskQueue.get_states
+		"""
+
+		for job_name, (state, exit_status) in states.items():
+			self.pooled.add(job_name)
+
+			if state == rfpool.PENDING and self.phases.get(job_name) == "Unknown":
+				self.set_phase(job_name, "Pending")
+
+			elif state == rfpool.RUNNING:
+				self.set_phase(job_name, "Running")
+
+			elif state == rfpool.DONE and exit_status == 0:
+				self.set_phase(job_name, "Succeeded")
+
+			elif state == rfpool.DONE:
+				self.set_phase(job_name, "Failed", "exit status %d in the worker pool" % exit_status)
+
+	def mark_failed(self, job_name, reason):
+		"""
+		Marks a job as Failed even if it succeeded, for jobs whose output
+		turned out to be invalid
+
+		job_name: The rfsearch job name
+		reason: A message explaining the failure
+		"""
+
+		self.phases[job_name] = "Failed"
+		self.reasons[job_name] = reason
+
+	def mark_gone(self, outputs=None, success_string=rfmerge.SUCCESS_STRING, listed=None):
+		"""
+		Settles the jobs that were not found in the cluster. They finished
+		before we started watching (or were never submitted, e.g. for reused
+		results), were deleted before they could run, or finished and were
+		deleted while the watch was re-listing, so they only count as
+		succeeded if their output is complete. Jobs queued for the worker
+		pool are followed through the queue instead.
+
+		outputs: A dictionary of job name -> output file, None if unknown
+		success_string: The string the output of a complete job ends with
+		listed: The rfsearch job names of the last listing of k8s Jobs (see get_listed), None to only settle jobs never seen
+		"""
+
+		for job_name in self.phases:
+			phase = self.phases[job_name]
+
+			if phase in TERMINAL_PHASES:
+				continue
+
+			if phase != "Unknown" and (listed is None or job_name in listed or job_name in self.pooled):
+				continue
+
+			if outputs is not None and job_name in outputs and rfmerge.output_complete(outputs[job_name], success_string):
+				self.set_phase(job_name, "Succeeded")
+				self.reasons[job_name] = "finished while it was not watched"
+
+			elif outputs is not None and job_name in outputs:
+				self.set_phase(job_name, "Failed", "not found in the cluster and %s is incomplete" % outputs[job_name])
+
+			else:
+				self.set_phase(job_name, "Failed", "not found in the cluster")
+
+	def counts(self):
+		"""
+		Returns the number of succeeded, running and waiting jobs
+
+		return: A tuple (nsucceeded, nrunning, nwaiting)
+		"""
+
+		phases = list(self.phases.values())
+
+		nsucceeded = phases.count("Succeeded")
+		nrunning = phases.count("Running")
+		nwaiting = phases.count("Pending") + phases.count("Unknown")
+
+		return (nsucceeded, nrunning, nwaiting)
+
+	def finished(self):
+		"""
+		return: A list of succeeded job names
+		"""
+
+		return [job_name for job_name in self.phases if self.phases[job_name] == "Succeeded"]
+
+	def failed(self):
+		"""
+		return: A list of failed job names
+		"""
+
+		return [job_name for job_name in self.phases if self.phases[job_name] == "Failed"]
+
+	def done(self):
+		"""
+		return: True if all jobs are in a terminal phase, False otherwise
+		"""
+
+		return all(phase in TERMINAL_PHASES for phase in self.phases.values())
+
+# -----------------------------------------------------------------------------------
+
+def get_container_state(pod):
+	"""
+	return: The V1ContainerState of the first container of a pod, None if it is not known yet
+	"""
+
+	container_statuses = pod.status.container_statuses or []
+
+	return container_statuses[0].state if len(container_statuses) > 0 else None
+
+# -----------------------------------------------------------------------------------
+
+def build_copy_manifest(user, job_name, k8s_job, completion_index, node_name):
+	"""
+	Builds the manifest of a k8s job running a copy of a shard, from the pod
+	template of the job running the original, that cannot be scheduled on
+	the node of the original
+
+	user: A valid Rfam cloud account username
+	job_name: The rfsearch job name of the shard
+	k8s_job: The V1Job running the original shard
+	completion_index: The completion index of the shard in k8s_job, None if it is not an Indexed job
+	node_name: The node the original shard runs on
+
+	return: A k8s job manifest as a dictionary
+	"""
+
+	from kubernetes import client
+
+	template = client.ApiClient().sanitize_for_serialization(k8s_job.spec.template)
+	copy_name = rfkubesub.get_job_name(user, job_name) + COPY_SUFFIX
+	annotations = {rfkubesub.JOB_INDEX_ANNOTATION: job_name, SPECULATIVE_ANNOTATION: node_name}
+
+	template["metadata"] = {"labels": {"app": "family-builder",
+			"user": user,
+			"tier": "backend",
+			"jobname": copy_name},
+		"annotations": annotations}
+
+	# the pod script selects the shard it runs from its completion index
+	if completion_index is not None:
+		container = template["spec"]["containers"][0]
+		container.setdefault("env", []).append({"name": "JOB_COMPLETION_INDEX", "value": str(completion_index)})
+
+	affinity = template["spec"].setdefault("affinity", {})
+	node_affinity = affinity.setdefault("nodeAffinity", {})
+	required = node_affinity.setdefault("requiredDuringSchedulingIgnoredDuringExecution", {"nodeSelectorTerms": [{}]})
+
+	for term in required["nodeSelectorTerms"]:
+		term.setdefault("matchExpressions", []).append({"key": "kubernetes.io/hostname",
+			"operator": "NotIn", "values": [node_name]})
+
+	job_spec = {"ttlSecondsAfterFinished": 10,
+		"backoffLimit": rfkubesub.BACKOFF_LIMIT_PER_INDEX,
+		"template": template}
+
+	if os.environ.get(rfkubesub.ADMISSION_QUEUE_VAR) == "1":
+		job_spec["suspend"] = True
+
+	return {"apiVersion": "batch/v1",
+		"kind": "Job",
+		"metadata": {"name": copy_name,
+			"namespace": rfkubesub.NAMESPACE,
+			"labels": {"user": user, "tier": "backend"},
+			"annotations": annotations},
+		"spec": job_spec}
+
+# -----------------------------------------------------------------------------------
+
+class Speculator(object):
+	"""
+	Runs a copy of straggler shards, running well past the median runtime of
+	the completed shards of their job, on another node. Both copies write
+	their output atomically (see rfkubesub.build_atomic_command), the first
+	one to complete wins and the other one is deleted.
+	"""
+
+	def __init__(self, user, factor=STRAGGLER_FACTOR, batch_api=None, core_api=None):
+		if batch_api is None or core_api is None:
+			from kubernetes import client
+
+			batch_api = client.BatchV1Api()
+			core_api = client.CoreV1Api()
+
+		self.user = user
+		self.factor = factor
+		self.batch_api = batch_api
+		self.core_api = core_api
+		self.copies = {} # job name -> k8s job name of its copy
+		self.resolved = set()
+
+	def get_runtimes(self, tracker):
+		"""
+		Returns the runtimes of the completed shards of each job, leaving out
+		the shards that were copied
+
+		tracker: A JobTracker object
+
+		return: A dictionary of rfsearch job index -> list of runtimes in seconds
+		"""
+
+		runtimes = {}
+
+		for job_name, pod in tracker.pods.items():
+			if tracker.phases.get(job_name) != "Succeeded" or job_name in self.copies:
+				continue
+
+			state = get_container_state(pod)
+
+			if state is None or state.terminated is None or state.terminated.started_at is None:
+				continue
+
+			runtime = (state.terminated.finished_at - state.terminated.started_at).total_seconds()
+			runtimes.setdefault(job_name.rsplit('-', 1)[0], []).append(runtime)
+
+		return runtimes
+
+	def find_stragglers(self, tracker):
+		"""
+		Finds the running shards that were not copied yet and ran for more
+		than factor times the median runtime of their job's completed shards
+
+		tracker: A JobTracker object
+
+		return: A list of rfsearch job names
+		"""
+
+		runtimes = self.get_runtimes(tracker)
+		job_sizes = {}
+		stragglers = []
+		now = datetime.datetime.now(datetime.timezone.utc)
+
+		for job_name in tracker.phases:
+			job_index = job_name.rsplit('-', 1)[0]
+			job_sizes[job_index] = job_sizes.get(job_index, 0) + 1
+
+		for job_name, pod in tracker.pods.items():
+			if tracker.phases.get(job_name) != "Running" or job_name in self.copies:
+				continue
+
+			job_index = job_name.rsplit('-', 1)[0]
+			job_runtimes = runtimes.get(job_index, [])
+
+			if len(job_runtimes) < max(MIN_RUNTIMES, job_sizes[job_index] // 2):
+				continue
+
+			state = get_container_state(pod)
+
+			if state is None or state.running is None or state.running.started_at is None:
+				continue
+
+			elapsed = (now - state.running.started_at).total_seconds()
+
+			if elapsed > max(MIN_STRAGGLER_SECS, self.factor * statistics.median(job_runtimes)):
+				stragglers.append(job_name)
+
+		return stragglers
+
+	def start_copy(self, tracker, job_name):
+		"""
+		Submits a copy of a shard, on another node than the original
+
+		tracker: A JobTracker object
+		job_name: The rfsearch job name of the shard
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		pod = tracker.pods[job_name]
+		k8s_job = tracker.k8s_jobs.get((pod.metadata.labels or {}).get("jobname"))
+
+		if k8s_job is None or pod.spec.node_name is None:
+			return
+
+		completion_index = (pod.metadata.annotations or {}).get(COMPLETION_INDEX_ANNOTATION)
+		manifest = build_copy_manifest(self.user, job_name, k8s_job, completion_index, pod.spec.node_name)
+
+		try:
+			rfkubesub.submit_job(manifest)
+		except ApiException as e:
+			# copied by an earlier rfwait.py
+			if e.status != 409:
+				sys.stderr.write("WARNING: Unable to copy straggler %s: %s\n" % (job_name, e.reason))
+				return
+
+		self.copies[job_name] = manifest["metadata"]["name"]
+		sys.stderr.write("Copied straggler %s away from node %s\n" % (job_name, pod.spec.node_name))
+
+	def delete_loser(self, tracker, job_name):
+		"""
+		Deletes the copy of a shard that did not complete first. Deleting the
+		pod of an original shard in an Indexed job makes k8s start it again,
+		which then exits as the shard's output is complete.
+
+		tracker: A JobTracker object
+		job_name: The rfsearch job name of the shard
+		"""
+
+		from kubernetes.client.rest import ApiException
+
+		try:
+			if job_name not in tracker.speculative_wins:
+				self.batch_api.delete_namespaced_job(self.copies[job_name], rfkubesub.NAMESPACE,
+					propagation_policy="Background")
+
+			elif COMPLETION_INDEX_ANNOTATION in (tracker.pods[job_name].metadata.annotations or {}):
+				self.core_api.delete_namespaced_pod(tracker.pods[job_name].metadata.name, rfkubesub.NAMESPACE)
+
+			else:
+				self.batch_api.delete_namespaced_job(tracker.pods[job_name].metadata.labels["jobname"],
+					rfkubesub.NAMESPACE, propagation_policy="Background")
+
+		except ApiException as e:
+			if e.status != 404:
+				sys.stderr.write("WARNING: Unable to delete the losing copy of %s: %s\n" % (job_name, e.reason))
+
+	def update(self, tracker):
+		"""
+		Deletes the losing copies of completed shards and copies new stragglers
+
+		tracker: A JobTracker object
+		"""
+
+		for job_name in self.copies:
+			if job_name not in self.resolved and tracker.phases[job_name] in TERMINAL_PHASES:
+				self.delete_loser(tracker, job_name)
+				self.resolved.add(job_name)
+
+		for job_name in self.find_stragglers(tracker):
+			self.start_copy(tracker, job_name)
+
+	def finish(self, tracker):
+		"""
+		Deletes the losing copies of completed shards and the copies of
+		shards that did not complete, once we stop waiting
+
+		tracker: A JobTracker object
+		"""
+
+		for job_name in self.copies:
+			if job_name not in self.resolved:
+				self.delete_loser(tracker, job_name)
+				self.resolved.add(job_name)
+
+# -----------------------------------------------------------------------------------
+
+def start_watches(user, events):
+	"""
+	Starts background threads watching the user's backend Jobs and Pods
+
+	user: A valid Rfam cloud account username
+	events: A queue to put watch events on
+	"""
+
+	from kubernetes import client, config
+
+	config.load_incluster_config()
+	batch_api = client.BatchV1Api()
+	core_api = client.CoreV1Api()
+
+	label_selector = "user=%s,tier=backend" % user
+
+	for kind, list_func in (("Job", batch_api.list_namespaced_job), ("Pod", core_api.list_namespaced_pod)):
+		thread = threading.Thread(target=rfwatch.watch_resource, args=(kind, list_func, label_selector, events,
+			rfkubesub.NAMESPACE))
+		thread.daemon = True
+		thread.start()
+
+# -----------------------------------------------------------------------------------
+
+def print_progress(tracker):
+	"""
+	Prints a progress line of the form: progress <nsucceeded> <nrunning> <nwaiting>
+
+	tracker: A JobTracker object
+	"""
+
+	print("progress %d %d %d" % tracker.counts())
+	sys.stdout.flush()
+
+# -----------------------------------------------------------------------------------
+
+def wait_for_jobs(tracker, events, timeout=None, progress_interval=30, merger=None, task_queue=None,
+	speculator=None, outputs=None, success_string=rfmerge.SUCCESS_STRING):
+	"""
+	Consumes watch events until all tracked jobs are in a terminal phase,
+	any job fails or the timeout is reached. Progress lines are printed
+	when the job counts change, at most once every progress_interval seconds.
+	If a merger is given, the output of each job is merged as soon as it
+	succeeds, and we only return once all of it has been merged. If a
+	speculator is given, straggler shards are copied to other nodes.
+
+	tracker: A JobTracker object
+	events: A queue of watch events
+	timeout: Maximum number of seconds to wait, None for no limit
+	progress_interval: Minimum number of seconds between progress lines
+	merger: A rfmerge.ShardMerger object, None to not merge outputs
+	task_queue: A rfpool.TaskQueue object to follow jobs queued for the worker pool, None if there is none
+	speculator: A Speculator object, None to not copy stragglers
+	outputs: A dictionary of job name -> output file, to check jobs not found in the cluster
+	success_string: The string the output of a complete job ends with
+
+	return: One of SUCCESS, JOB_FAILED, TIMEOUT or WATCH_FAILED
+	"""
+
+	start_time = time.time()
+	synced = set()
+	listed = None
+	last_counts = None
+	last_print = 0
+	last_queue_poll = 0
+	last_speculation = 0
+
+	while True:
+		if timeout is not None and time.time() - start_time > timeout:
+			return TIMEOUT
+
+		# before the initial listings are synced, so queued jobs are not taken for gone ones
+		if task_queue is not None and time.time() - last_queue_poll >= 1:
+			tracker.update_from_tasks(task_queue.get_states(tracker.phases.keys()))
+			last_queue_poll = time.time()
+
+		try:
+			kind, event_type, obj = events.get(timeout=1)
+
+			if event_type == "FAILED":
+				sys.stderr.write("ERROR: lost the %s watch of the cluster: %s\n" % (kind, obj))
+				return WATCH_FAILED
+
+			if event_type == "SYNCED":
+				synced.add(kind)
+
+				if kind == "Job":
+					listed = tracker.get_listed(obj)
+
+				# anything not listed by now finished before we started watching, never ran,
+				# or finished and was deleted while the watch was re-listing
+				if len(synced) == 2:
+					tracker.mark_gone(outputs, success_string, listed)
+
+			elif kind == "Job":
+				tracker.update_from_job(event_type, obj)
+
+			else:
+				tracker.update_from_pod(event_type, obj)
+
+		except queue.Empty:
+			pass
+
+		if len(synced) < 2:
+			continue
+
+		counts = tracker.counts()
+
+		if counts != last_counts and time.time() - last_print >= progress_interval:
+			print_progress(tracker)
+			last_counts = counts
+			last_print = time.time()
+
+		if merger is not None:
+			for job_name in tracker.finished():
+				merger.submit(job_name)
+
+			for job_name, reason in merger.failed().items():
+				tracker.mark_failed(job_name, reason)
+
+		if speculator is not None and time.time() - last_speculation >= SPECULATION_INTERVAL:
+			speculator.update(tracker)
+			last_speculation = time.time()
+
+		if len(tracker.failed()) > 0:
+			return JOB_FAILED
+
+		if tracker.done() and (merger is None or merger.done()):
+			return SUCCESS
+
+# -----------------------------------------------------------------------------------
+
+def read_outputs(outputs_file):
+	"""
+	Reads the expected output file of each job, one job per line:
+	<jobname> <output file>
+
+	outputs_file: Path to the file
+
+	return: A dictionary of job name -> output file
+	"""
+
+	outputs = {}
+
+	fp = open(outputs_file, 'r')
+	for line in fp:
+		fields = line.split()
+		if len(fields) == 2:
+			outputs[fields[0]] = fields[1]
+	fp.close()
+
+	return outputs
+
+# -----------------------------------------------------------------------------------
+
+def parse_arguments():
+	"""
+	Uses python's argparse to parse the command line arguments
+
+	return: Argparse parser object
+	"""
+
+	parser = argparse.ArgumentParser(description='Waits for rfsearch k8s jobs to finish')
+
+	parser.add_argument('job_names', help='rfsearch job names to wait for (e.g. s-1234-0)', nargs='+',
+		metavar="JOBNAME")
+	parser.add_argument('--user', help='owner of the jobs, detected from the pod hostname by default',
+		action="store", type=str, default=None)
+	parser.add_argument('--timeout', help='maximum number of seconds to wait',
+		action="store", type=int, default=None)
+	parser.add_argument('--progress-interval', help='minimum number of seconds between progress lines (default: 30)',
+		action="store", type=int, default=30)
+	parser.add_argument('--merge', help='merge the output of jobs as they succeed, following a merge plan (see rfmerge.py)',
+		action="store", type=str, default=None, metavar="PLAN")
+	parser.add_argument('--speculate', help='copy shards running longer than FACTOR times the median runtime of their job to another node, 0 not to (default: %s)' % STRAGGLER_FACTOR,
+		action="store", type=float, default=STRAGGLER_FACTOR, metavar="FACTOR")
+	parser.add_argument('--outputs', help='file of <jobname> <output file> lines, jobs not found in the cluster only succeed if their output is complete (default: the tblouts of the merge plan)',
+		action="store", type=str, default=None, metavar="FILE")
+	parser.add_argument('--success-string', help='string the output of a complete job ends with (default: %s)' % rfmerge.SUCCESS_STRING,
+		action="store", type=str, default=rfmerge.SUCCESS_STRING)
+
+	return parser
+
+# -----------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+	parser = parse_arguments()
+	args = parser.parse_args()
+
+	user = args.user if args.user is not None else rfkubesub.get_username()
+
+	tracker = JobTracker(user, args.job_names)
+	events = queue.Queue()
+	merger = None
+	task_queue = None
+
+	if os.path.isdir(rfpool.QUEUE_DIR):
+		task_queue = rfpool.TaskQueue()
+
+	outputs = None
+	if args.outputs is not None:
+		outputs = read_outputs(args.outputs)
+
+	if args.merge is not None:
+		plan = rfmerge.read_merge_plan(args.merge)
+		merger = rfmerge.ShardMerger(plan)
+
+		if outputs is None:
+			outputs = dict((job_name, paths[0]) for job_name, paths in plan.items())
+
+	start_watches(user, events)
+
+	speculator = None
+	if args.speculate > 0:
+		speculator = Speculator(user, args.speculate)
+
+	status = wait_for_jobs(tracker, events, timeout=args.timeout, progress_interval=args.progress_interval,
+		merger=merger, task_queue=task_queue, speculator=speculator, outputs=outputs,
+		success_string=args.success_string)
+
+	if speculator is not None:
+		speculator.finish(tracker)
+
+	print_progress(tracker)
+
+	# record the shards found complete, so that a resumed run does not submit them again
+	if os.environ.get(rfledger.RUN_ID_VAR) is not None and os.path.exists(rfledger.LEDGER_FILE):
+		ledger = rfledger.RunLedger()
+		ledger.verify(tracker.finished())
+		ledger.close()
+
+	for job_name in sorted(tracker.phases):
+		print("%s %s %s" % (job_name, tracker.phases[job_name], tracker.reasons.get(job_name, "")))
+
+	sys.exit(status)
@@ -0,0 +1,90 @@
+import sys
+import time
+
+# -----------------------------------------------------------------------------------
+
+NAMESPACE = "default"
+
+# number of seconds a watch stream is kept open before it is renewed
+WATCH_TIMEOUT = 300
+
+# consecutive failed lists or watches after which watch_resource gives up
+MAX_WATCH_FAILURES = 10
+
+# maximum number of seconds between retries of a failed list or watch
+MAX_WATCH_BACKOFF = 60
+
+# -----------------------------------------------------------------------------------
+
+def watch_resource(kind, list_func, label_selector, events, namespace=NAMESPACE, field_selector=None):
+	"""
+	Lists and then watches k8s objects matching label_selector, putting
+	(kind, event type, object) tuples on the events queue. After each list a
+	(kind, "SYNCED", list of listed objects) tuple is queued. The watch is
+	resumed from the last seen resourceVersion and the objects are re-listed
+	if that is too old (410 Gone). Any other failure is retried with an
+	increasing delay, and after MAX_WATCH_FAILURES failures in a row a
+	(kind, "FAILED", error message) tuple is queued and the watch stops.
+
+	kind: A name for the kind of object watched (e.g. Job)
+	list_func: The k8s API list function (e.g. BatchV1Api.list_namespaced_job)
+	label_selector: A k8s label selector string
+	events: A queue to put events on
+	namespace: The k8s namespace to watch
+	field_selector: A k8s field selector string, None for all objects
+	"""
+
+	from kubernetes import watch
+	from kubernetes.client.rest import ApiException
+
+	resource_version = None
+	selectors = {"label_selector": label_selector}
+	failures = 0
+
+	if field_selector is not None:
+		selectors["field_selector"] = field_selector
+
+	while True:
+		try:
+			if resource_version is None:
+				listing = list_func(namespace, **selectors)
+
+				for item in listing.items:
+					events.put((kind, "ADDED", item))
+
+				resource_version = listing.metadata.resource_version
+				events.put((kind, "SYNCED", listing.items))
+				failures = 0
+
+			stream = watch.Watch().stream(list_func, namespace, resource_version=resource_version,
+				timeout_seconds=WATCH_TIMEOUT, **selectors)
+
+			for event in stream:
+				if event["type"] in ("ADDED", "MODIFIED", "DELETED"):
+					events.put((kind, event["type"], event["object"]))
+
+				resource_version = event["object"].metadata.resource_version
+				failures = 0
+
+		except ApiException as e:
+			if e.status == 410:
+				# resourceVersion too old, list again
+				resource_version = None
+				continue
+
+			failures += 1
+			error = "%s %s" % (e.status, e.reason)
+
+		# connection errors and timeouts of the API server
+		except Exception as e:
+			failures += 1
+			error = "%s: %s" % (type(e).__name__, e)
+
+		sys.stderr.write("WARNING: %s watch failed (%d/%d): %s\n" % (kind, failures, MAX_WATCH_FAILURES, error))
+		sys.stderr.flush()
+
+		if failures >= MAX_WATCH_FAILURES:
+			events.put((kind, "FAILED", error))
+			return
+
+		time.sleep(min(5 * 2 ** (failures - 1), MAX_WATCH_BACKOFF))
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the kubernetes/*.py scripts import each other as top level modules, as
+# they do once installed in /Rfam/software/bin
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import k8s_job_sweeper
+
+# -----------------------------------------------------------------------------------
+
+NOW = datetime.datetime(2026, 10, 18, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+def finished_job(name, condition_type, secs_ago=0):
+	condition = SimpleNamespace(type=condition_type, status="True",
+		last_transition_time=NOW - datetime.timedelta(seconds=secs_ago))
+
+	return SimpleNamespace(metadata=SimpleNamespace(name=name, deletion_timestamp=None),
+		status=SimpleNamespace(conditions=[condition]))
+
+class FakeBatchApi(object):
+	def __init__(self, failing):
+		self.failing = failing # names of jobs whose deletion fails
+		self.deleted = []
+
+	def delete_namespaced_job(self, name, namespace, propagation_policy=None):
+		from kubernetes.client.rest import ApiException
+
+		if name in self.failing:
+			raise ApiException(status=500, reason="Internal Server Error")
+		self.deleted.append(name)
+
+# -----------------------------------------------------------------------------------
+
+def test_failed_deletes_are_retried():
+	pytest.importorskip("kubernetes.client")
+
+	batch_api = FakeBatchApi(set(["job-a"]))
+	sweeper = k8s_job_sweeper.JobSweeper(batch_api, None, "default", failed_grace=60)
+
+	sweeper.observe_job("ADDED", finished_job("job-a", "Complete"))
+	sweeper.observe_job("ADDED", finished_job("job-b", "Complete"))
+	sweeper.observe_job("ADDED", finished_job("job-c", "Failed", secs_ago=10))
+	sweeper.queue_expired(NOW)
+	sweeper.flush()
+
+	assert batch_api.deleted == ["job-b"]
+	assert sweeper.pending == {("Job", "job-a"): "succeeded_jobs"}
+
+	batch_api.failing = set()
+	sweeper.queue_expired(NOW + datetime.timedelta(seconds=60))
+	sweeper.flush()
+
+	assert sorted(batch_api.deleted) == ["job-a", "job-b", "job-c"]
+	assert sweeper.pending == {}
+	assert sweeper.removed == {"succeeded_jobs": 2, "failed_jobs": 1, "orphaned_pods": 0}
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+import python_code.lib.k8s_state as k8s_state
+
+# -----------------------------------------------------------------------------------
+
+def fake_pod(name, phase, user="alice"):
+	return SimpleNamespace(metadata=SimpleNamespace(name=name, labels={"user": user, "tier": "frontend"},
+		deletion_timestamp=None), status=SimpleNamespace(phase=phase))
+
+def fake_cache(monkeypatch, events):
+	"""
+	A state cache whose watches get the given events, keeping the label selector of each watch
+	"""
+
+	selectors = []
+
+	def watch_resource(kind, list_func, label_selector, queue, namespace):
+		selectors.append(label_selector)
+		for event in events:
+			queue.put((kind,) + event)
+
+	monkeypatch.setattr(k8s_state.rfwatch, "watch_resource", watch_resource)
+	api = SimpleNamespace(list_namespaced_pod=None, list_namespaced_job=None,
+		list_namespaced_persistent_volume_claim=None, list_namespaced_deployment=None)
+
+	return k8s_state.K8sStateCache(api, api, api), selectors
+
+# -----------------------------------------------------------------------------------
+
+def test_login_pods_are_watched_per_user(monkeypatch):
+	cache, selectors = fake_cache(monkeypatch, [("ADDED", fake_pod("login-a", "Pending")),
+		("SYNCED", [fake_pod("login-a", "Pending")]), ("MODIFIED", fake_pod("login-a", "Running"))])
+
+	pod = cache.wait_for_login_pod("alice", timeout=5)
+
+	assert pod.metadata.name == "login-a"
+	assert selectors == ["user=alice,tier=frontend"]
+
+	cache.get_user_jobs("alice")
+	assert selectors[-1] == "user=alice,tier=backend"
+
+def test_relisting_drops_deleted_objects(monkeypatch):
+	cache, selectors = fake_cache(monkeypatch, [("SYNCED", [fake_pod("login-a", "Running"), fake_pod("login-b", "Running")]),
+		("DELETED", fake_pod("login-a", "Running")), ("SYNCED", [fake_pod("login-c", "Running")])])
+
+	def relisted(pods):
+		return any(pod.metadata.name == "login-c" for pod in pods) and pods
+
+	assert [pod.metadata.name for pod in cache.wait_until("pods", relisted, "alice", timeout=5)] == ["login-c"]
+
+def test_waiters_hear_of_a_lost_watch(monkeypatch):
+	cache, selectors = fake_cache(monkeypatch, [("SYNCED", []), ("FAILED", "403 Forbidden")])
+
+	with pytest.raises(k8s_state.WatchError, match="403 Forbidden"):
+		cache.wait_for_login_pod("alice")
+
+	# the next query watches again
+	with pytest.raises(k8s_state.WatchError):
+		cache.wait_for_login_pod("alice")
+	assert len(selectors) == 2
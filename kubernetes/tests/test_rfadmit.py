@@ -0,0 +1,57 @@
+import datetime
+from types import SimpleNamespace
+
+import rfadmit
+import rfkubesub
+
+# -----------------------------------------------------------------------------------
+
+NOW = datetime.datetime(2026, 10, 18, tzinfo=datetime.timezone.utc)
+
+def queued_job(user, job_index, completions, cpu="1", age_secs=0, annotations=None):
+	container = SimpleNamespace(resources=SimpleNamespace(requests={"cpu": cpu, "memory": "1Gi"}))
+	job = SimpleNamespace(
+		metadata=SimpleNamespace(name=rfkubesub.get_job_name(user, job_index), labels={"user": user},
+			annotations=annotations, creation_timestamp=NOW - datetime.timedelta(seconds=age_secs)),
+		spec=SimpleNamespace(suspend=True, completions=completions, parallelism=completions,
+			template=SimpleNamespace(spec=SimpleNamespace(containers=[container]))),
+		status=SimpleNamespace(succeeded=0))
+
+	return rfadmit.QueuedJob(job, NOW)
+
+def admitted(jobs):
+	return dict(("%s-%s" % (job.user, rfkubesub.get_job_index(job.user, job.name)), job.admitted) for job in jobs)
+
+# -----------------------------------------------------------------------------------
+
+def test_parse_quantity():
+	assert rfadmit.parse_quantity("500m") == 0.5
+	assert rfadmit.parse_quantity("24Gi") == 24 * 2 ** 30
+	assert rfadmit.parse_quantity(4) == 4.0
+
+def test_users_share_the_cluster_equally():
+	jobs = [queued_job("alice", "s-1", 10, age_secs=100), queued_job("bob", "s-2", 10)]
+	controller = rfadmit.AdmissionController(None, None, "default")
+
+	controller.plan(jobs, 6, 100 * 2 ** 30, {}, {})
+
+	assert admitted(jobs) == {"alice-s-1": 3, "bob-s-2": 3}
+
+def test_weights_caps_and_interactive_jobs():
+	jobs = [queued_job("alice", "s-1", 10), queued_job("bob", "s-2", 10), queued_job("carol", "ss-3", 1)]
+	controller = rfadmit.AdmissionController(None, None, "default")
+
+	controller.plan(jobs, 7, 100 * 2 ** 30, {"alice": 2}, {"bob": 1})
+
+	assert admitted(jobs) == {"alice-s-1": 5, "bob-s-2": 1, "carol-ss-3": 1}
+
+def test_mpi_jobs_are_admitted_whole():
+	annotations = {rfkubesub.MPI_PODS_ANNOTATION: "3"}
+	jobs = [queued_job("alice", "c-1", 3, cpu="8", annotations=annotations)]
+	controller = rfadmit.AdmissionController(None, None, "default")
+
+	controller.plan(jobs, 16, 100 * 2 ** 30, {}, {})
+	assert admitted(jobs) == {"alice-c-1": 0}
+
+	controller.plan(jobs, 24, 100 * 2 ** 30, {}, {})
+	assert admitted(jobs) == {"alice-c-1": 3}
@@ -0,0 +1,199 @@
+import os
+import sys
+import gzip
+import stat
+
+import pytest
+
+import rfbatch
+import rfmerge
+import rfresult
+
+# -----------------------------------------------------------------------------------
+
+def write_family(tmp_path, acc, name, width, sm, calibrated=True):
+	family_dir = tmp_path / acc
+	family_dir.mkdir()
+	(family_dir / "SEED").write_text("# STOCKHOLM 1.0\n//\n")
+	(family_dir / "DESC").write_text("AC   %s\nSM   %s\n" % (acc, sm))
+	(family_dir / "CM").write_text("INFERNAL1/a [1.1.4 | Dec 2020]\nNAME     %s\nW        %d\n%sCM\n//\n" %
+		(name, width, "ECMLI    0.6 -9.4 0.1 1600000 200 0.002\n" if calibrated else ""))
+
+	return str(family_dir)
+
+def family(acc, name, width, threshold="30.00"):
+	return {"dir": "/workdir/" + acc, "cm": "/workdir/%s/CM" % acc, "name": name, "width": width, "threshold": threshold}
+
+# writes cmsearch like outputs: one hit per target sequence, named after the CM,
+# a tblout trailer naming the CM and target file, and the options it was run with
+FAKE_CMSEARCH = """#!%s
+import sys
+args = sys.argv[1:]
+tblout, cm, seqfile = args[1], args[-2], args[-1]
+names = [line[1:].split()[0] for line in open(seqfile) if line.startswith('>')]
+out = open(tblout, 'w')
+for name in names:
+	out.write("%%s - %%s - cm 1 10 1 10 + no 1 0.5 0.0 40.0 1e-9 ! -\\n" %% (name, open(cm).read().strip()))
+out.write("# Query file:      %%s\\n# Target file:     %%s\\n# Option settings: cmsearch %%s\\n# [ok]\\n" %% (cm, seqfile, " ".join(args)))
+out.close()
+sys.stdout.write("# query CM file:     %%s\\n# target sequence database:     %%s\\nQuery: %%s\\n//\\n[ok]\\n" %% (cm, seqfile, open(cm).read().strip()))
+"""
+
+def use_fake_cmsearch(tmp_path, monkeypatch):
+	path = tmp_path / "cmsearch"
+	path.write_text(FAKE_CMSEARCH % sys.executable)
+	path.chmod(path.stat().st_mode | stat.S_IEXEC)
+	monkeypatch.setattr(rfbatch, "CMSEARCH", str(path))
+
+# -----------------------------------------------------------------------------------
+
+def test_read_family(tmp_path):
+	family_dir = write_family(tmp_path, "RF00001", "5S_rRNA", 200, "cmsearch --cpu 4 --verbose --nohmmonly -T 38 -Z 742849.287494 CM SEQDB")
+
+	assert rfbatch.read_family(family_dir) == {"dir": family_dir, "cm": os.path.join(family_dir, "CM"),
+		"name": "5S_rRNA", "width": 200, "threshold": "38.00"}
+
+def test_families_rfsearch_must_search(tmp_path):
+	evalue = write_family(tmp_path, "RF00001", "a", 200, "cmsearch --cpu 4 --verbose --nohmmonly -E 1000 -Z 742849.287494 CM SEQDB")
+	uncalibrated = write_family(tmp_path, "RF00002", "b", 200, "cmsearch -T 30 CM SEQDB", calibrated=False)
+
+	with pytest.raises(ValueError, match="E-value"):
+		rfbatch.read_family(evalue)
+	with pytest.raises(ValueError, match="calibrated"):
+		rfbatch.read_family(uncalibrated)
+
+	assert rfbatch.read_families([evalue, uncalibrated]) == []
+
+def test_search_options_match_rfsearch():
+	assert rfbatch.build_search_options(4, "30.00", "742849.287494") == \
+		"--cpu 4 --verbose --nohmmonly -T 30.00 -Z 742849.287494"
+	assert rfbatch.build_search_options(4, "30.00", "74146.497958", "742849.287494") == \
+		"--cpu 4 --verbose --nohmmonly -T 30.00 -Z 74146.497958 --FZ 742849.287494"
+
+def test_search_db_is_read_from_the_config(tmp_path):
+	config = tmp_path / "rfam.conf"
+	config.write_text("""<seqdb>
+  <rfamseq>
+    # both strands, in Mb
+    dbSize           742849.287494
+    nSearchFiles     3
+    searchPathPrefix /Rfam/rfamseq/r100_rfamseq14_
+    searchPathSuffix .fa.gz
+    revMate          revrfamseq
+  </rfamseq>
+  <testrfamseq>
+    dbSize           100
+    nSearchFiles     1
+    searchPathPrefix /Rfam/test/test
+    searchPathSuffix .fa
+  </testrfamseq>
+</seqdb>
+<revseqdb>
+  <revrfamseq>
+    dbSize           74146.497958
+    nSearchFiles     2
+    searchPathPrefix /Rfam/rfamseq/rev-rfamseq14_
+    searchPathSuffix .fa.gz
+  </revrfamseq>
+</revseqdb>
+""")
+
+	search_db = rfbatch.read_search_db(str(config))
+
+	assert search_db["files"] == ["/Rfam/rfamseq/r100_rfamseq14_%d.fa.gz" % i for i in (1, 2, 3)]
+	assert (search_db["size"], search_db["nfiles"]) == ("742849.287494", 3)
+	assert search_db["rev_files"] == ["/Rfam/rfamseq/rev-rfamseq14_1.fa.gz", "/Rfam/rfamseq/rev-rfamseq14_2.fa.gz"]
+	assert search_db["rev_size"] == "74146.497958"
+	assert rfbatch.read_search_db(str(config), "testrfamseq")["rev_files"] == []
+
+	# one strand of a search file, with room for the outputs
+	assert rfbatch.get_scratch_mb(search_db["size"], 100) == 4643
+
+def test_batches_share_a_memory_class():
+	families = [family("RF1", "a", 100), family("RF2", "b", 1500), family("RF3", "c", 300), family("RF4", "d", 200)]
+
+	batches = rfbatch.plan_batches(families, max_models=2)
+
+	assert [[f["dir"] for f in batch] for batch in batches] == [["/workdir/RF2"], ["/workdir/RF3", "/workdir/RF4"], ["/workdir/RF1"]]
+
+def test_batches_never_hold_two_cms_of_the_same_name():
+	batches = rfbatch.plan_batches([family("RF1", "a", 100), family("RF2", "a", 100), family("RF3", "b", 100)])
+
+	assert [[f["dir"] for f in batch] for batch in batches] == [["/workdir/RF1", "/workdir/RF3"], ["/workdir/RF2"]]
+
+def test_shards_read_each_file_once_for_all_cms(tmp_path):
+	families = [family("RF1", "a", 100, "25.00"), family("RF2", "b", 100, "40.50")]
+	for f in families:
+		f["seed"] = f["dir"] + "/seed.fa"
+	batch = {"name": "b0-12", "families": families}
+
+	search_db = {"files": ["/Rfam/rfamseq/db1.fa.gz", "/Rfam/rfamseq/db2.fa.gz"], "size": "742849.287494",
+		"rev_files": ["/Rfam/rfamseq/rev1.fa.gz"], "rev_size": "74146.497958"}
+	shards = rfbatch.build_batch_shards(batch, str(tmp_path), search_db)
+
+	assert [(shard["job"], shard["kind"]) for shard in shards] == [("b0-12-0", "s"), ("b0-12-1", "s"), ("b0-12-2", "rs"), ("b0-12-3", "ss")]
+	assert shards[0]["cmd"] == "%s search --tblout %s %s /Rfam/rfamseq/db1.fa.gz > %s 2> %s" % (rfbatch.RFBATCH_CMD,
+		shards[0]["tblout"], tmp_path / "b0-12.s.models", shards[0]["searchout"], shards[0]["stderr"])
+	assert rfresult.parse_output_paths(shards[3]["cmd"]) == (shards[3]["tblout"], shards[3]["searchout"], shards[3]["stderr"])
+
+	assert rfbatch.read_models(str(tmp_path / "b0-12.rs.models"))[1] == \
+		("/workdir/RF2/CM", "--cpu 4 --verbose --nohmmonly -T 40.50 -Z 74146.497958 --FZ 742849.287494", None)
+	assert rfbatch.read_models(str(tmp_path / "b0-12.ss.models"))[0][2] == "/workdir/RF1/seed.fa"
+
+def test_search_decompresses_the_shard_once(tmp_path, monkeypatch):
+	use_fake_cmsearch(tmp_path, monkeypatch)
+	seqfile = str(tmp_path / "db.fa.gz")
+	fp = gzip.open(seqfile, 'wt')
+	fp.write(">seq1\nACGU\n>seq2\nGGCC\n")
+	fp.close()
+
+	for name in ("a", "b"):
+		(tmp_path / (name + ".cm")).write_text(name)
+	models = str(tmp_path / "models")
+	rfbatch.write_models(models, [(str(tmp_path / "a.cm"), "-T 25.00", None), (str(tmp_path / "b.cm"), "-T 40.50", None)])
+
+	tblout = str(tmp_path / "shard.tbl")
+	searchout = open(str(tmp_path / "shard.cmsearch"), 'w')
+	assert rfbatch.search_models(tblout, models, seqfile, out=searchout) == 0
+	searchout.close()
+
+	lines = open(tblout).read().splitlines()
+	assert [line.split()[:3] for line in lines if not line.startswith('#')] == \
+		[["seq1", "-", "a"], ["seq2", "-", "a"], ["seq1", "-", "b"], ["seq2", "-", "b"]]
+	# the local copy and per CM tblout files are not visible in the outputs
+	assert "# Target file:     %s" % seqfile in lines
+	assert "# Option settings: cmsearch --tblout %s -T 40.50 %s %s" % (tblout, tmp_path / "b.cm", seqfile) in lines
+	assert lines[-1] == rfmerge.SUCCESS_STRING
+	assert "# target sequence database:     %s" % seqfile in open(str(tmp_path / "shard.cmsearch")).read()
+	assert sorted(os.listdir(str(tmp_path))) == ["a.cm", "b.cm", "cmsearch", "db.fa.gz", "models", "shard.cmsearch", "shard.tbl"]
+
+def test_split_gives_each_family_its_runs(tmp_path):
+	families = []
+	for acc in ("RF1", "RF2"):
+		(tmp_path / acc).mkdir()
+		families.append({"dir": str(tmp_path / acc), "cm": str(tmp_path / acc / "CM")})
+
+	batch = {"name": "b0-12", "families": families, "shards": [{"kind": "s"}]}
+	plan = {"workdir": str(tmp_path), "batches": [batch]}
+	merged_tblout, merged_searchout = rfbatch.get_merged_paths(str(tmp_path), batch, "s")
+
+	def tblout_run(f, hit):
+		return "%s\n# Query file:      %s\n# [ok]\n" % (hit, f["cm"])
+
+	def searchout_run(f, hit):
+		return "# query CM file:     %s\n%s\n//\n[ok]\n" % (f["cm"], hit)
+
+	# two shards, each searched with both CMs
+	runs = [(families[0], "x1"), (families[1], "y1"), (families[0], "x2"), (families[1], "y2")]
+	open(merged_tblout, 'w').write("".join(tblout_run(f, hit) for f, hit in runs))
+	open(merged_searchout, 'w').write("".join(searchout_run(f, hit) for f, hit in runs))
+
+	rfbatch.split_batch(plan, batch)
+
+	assert open(os.path.join(families[1]["dir"], "TBLOUT")).read() == tblout_run(families[1], "y1") + tblout_run(families[1], "y2")
+	assert open(os.path.join(families[0]["dir"], "searchout")).read() == searchout_run(families[0], "x1") + searchout_run(families[0], "x2")
+	assert not os.path.exists(os.path.join(families[0]["dir"], "REVTBLOUT"))
+
+	open(merged_tblout, 'a').write("x3\n")
+	with pytest.raises(ValueError, match="incomplete"):
+		rfbatch.split_batch(plan, batch)
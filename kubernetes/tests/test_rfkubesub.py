@@ -0,0 +1,220 @@
+import time
+import argparse
+import subprocess
+
+import pytest
+
+import rfcache
+import rfkubesub
+import rfmerge
+
+# -----------------------------------------------------------------------------------
+
+def run_script(script, env):
+	return subprocess.run(["sh", "-c", script], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+		universal_newlines=True)
+
+# -----------------------------------------------------------------------------------
+
+def test_indexed_command_runs_the_command_of_its_completion_index():
+	script = rfkubesub.build_indexed_command(["echo zero", "echo one", "echo two"])
+
+	assert run_script(script, {"JOB_COMPLETION_INDEX": "1"}).stdout == "one\n"
+	assert run_script(script, {"JOB_COMPLETION_INDEX": "2"}).stdout == "two\n"
+
+	unknown = run_script(script, {"JOB_COMPLETION_INDEX": "3"})
+	assert unknown.returncode == 1
+	assert "Unknown completion index 3" in unknown.stderr
+
+def test_template_command_offsets_the_completion_index():
+	script = rfkubesub.build_template_command("echo s-{index}.out", 10)
+
+	assert run_script(script, {"JOB_COMPLETION_INDEX": "0"}).stdout == "s-10.out\n"
+	assert run_script(script, {"JOB_COMPLETION_INDEX": "5"}).stdout == "s-15.out\n"
+
+def test_parse_index_range():
+	assert rfkubesub.parse_index_range("1-100") == (1, 100)
+	assert rfkubesub.parse_index_range("7-7") == (7, 1)
+
+	for index_range in ("5-1", "1", "a-b"):
+		with pytest.raises(argparse.ArgumentTypeError):
+			rfkubesub.parse_index_range(index_range)
+
+def test_read_batch_commands_skips_empty_lines(tmp_path):
+	cmd_file = tmp_path / "s.cmds"
+	cmd_file.write_text("cmd one\n\n  cmd two  \n")
+
+	assert rfkubesub.read_batch_commands(str(cmd_file)) == ["cmd one", "cmd two"]
+
+def test_job_name_round_trip():
+	job_name = rfkubesub.get_job_name("alice", "s-1234-1")
+
+	assert rfkubesub.get_job_index("alice", job_name) == "s-1234-1"
+	assert rfkubesub.get_job_index("bob", job_name) is None
+
+# -----------------------------------------------------------------------------------
+
+def test_single_pod_job_manifest():
+	manifest = rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000)
+	spec = manifest["spec"]
+	container = spec["template"]["spec"]["containers"][0]
+
+	assert manifest["metadata"]["name"] == "rfsearch-job-alice-s-1234-1"
+	assert "completionMode" not in spec
+	assert container["command"] == ["sh", "-c", "cmsearch"]
+	assert container["resources"]["requests"] == {"cpu": "4000m", "memory": "8000Mi"}
+
+def test_indexed_job_manifest():
+	manifest = rfkubesub.build_job_manifest("alice", "s-1234", "script", 4, 8000, completions=110)
+	spec = manifest["spec"]
+
+	assert spec["completionMode"] == "Indexed"
+	assert spec["completions"] == 110
+	assert spec["parallelism"] == 110
+
+def test_each_shard_of_an_indexed_job_has_its_own_retries():
+	indexed = rfkubesub.build_job_manifest("alice", "s-1234", "script", 4, 8000, completions=110)["spec"]
+	single = rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000)["spec"]
+
+	# failed shards are replaced by new pods, counted against their own index
+	assert indexed["backoffLimitPerIndex"] == rfkubesub.BACKOFF_LIMIT_PER_INDEX
+	assert "backoffLimit" not in indexed
+	assert indexed["template"]["spec"]["restartPolicy"] == "Never"
+
+	# single pod jobs are restarted in place, up to the default backoffLimit of 6
+	assert "backoffLimitPerIndex" not in single
+	assert single["template"]["spec"]["restartPolicy"] == "OnFailure"
+
+def test_every_volume_mount_has_a_volume():
+	manifest = rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000)
+	pod_spec = manifest["spec"]["template"]["spec"]
+	volumes = set(volume["name"] for volume in pod_spec["volumes"])
+
+	for container in pod_spec["containers"]:
+		for mount in container["volumeMounts"]:
+			assert mount["name"] in volumes
+
+def test_affinity_is_set_on_the_pod_template():
+	affinity = rfcache.node_affinity(["cmsearch x.cm /Rfam/rfamseq/rfamseq_1.fa > s.out"])
+	manifest = rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000, affinity=affinity)
+
+	assert affinity is not None
+	assert manifest["spec"]["template"]["spec"]["affinity"] == affinity
+
+	manifest = rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000)
+	assert "affinity" not in manifest["spec"]["template"]["spec"]
+
+# -----------------------------------------------------------------------------------
+
+def test_admission_queue_is_opt_in(monkeypatch):
+	monkeypatch.delenv(rfkubesub.ADMISSION_QUEUE_VAR, raising=False)
+	monkeypatch.setattr(rfkubesub, "get_admitter_update_time", None)
+
+	assert not rfkubesub.use_admission_queue()
+
+def test_admission_queue_needs_a_running_admitter(monkeypatch):
+	monkeypatch.setenv(rfkubesub.ADMISSION_QUEUE_VAR, "1")
+
+	monkeypatch.setattr(rfkubesub, "get_admitter_update_time", lambda: time.time() - 5)
+	assert rfkubesub.use_admission_queue()
+
+	for updated in (None, time.time() - rfkubesub.ADMITTER_STALE_SECS - 60):
+		monkeypatch.setattr(rfkubesub, "get_admitter_update_time", lambda: updated)
+		with pytest.raises(SystemExit):
+			rfkubesub.use_admission_queue()
+
+# -----------------------------------------------------------------------------------
+
+def test_staged_outputs_are_published_in_one_bundle(tmp_path, monkeypatch):
+	scratch = tmp_path / "scratch"
+	scratch.mkdir()
+	monkeypatch.setattr(rfkubesub, "SCRATCH_DIR", str(scratch))
+
+	tblout, searchout, stderr = [str(tmp_path / name) for name in ("s-1.tbl", "s-1.out", "s-1.err")]
+	cmd = "echo '# hits' > %s; echo '# [ok]' >> %s; echo search > %s; echo Warning 2> %s >&2" % (tblout, tblout,
+		searchout, stderr)
+	script = rfkubesub.build_staged_command(cmd, (tblout, searchout, stderr))
+
+	assert run_script(script, {"HOSTNAME": "pod-a", "PATH": "/usr/bin:/bin"}).returncode == 0
+	assert sorted(p.name for p in tmp_path.iterdir()) == ["s-1.tbl.tgz", "scratch"]
+
+	merged = tmp_path / "all.tbl"
+	plan = {"s-1": (tblout, searchout, stderr, str(merged), str(tmp_path / "all.out"))}
+	merger = rfmerge.ShardMerger(plan, visibility_timeout=0)
+	assert merger.merge("s-1") is None
+	assert merged.read_text() == "# hits\n# [ok]\n"
+
+def test_failed_staged_command_keeps_its_stderr(tmp_path, monkeypatch):
+	scratch = tmp_path / "scratch"
+	scratch.mkdir()
+	monkeypatch.setattr(rfkubesub, "SCRATCH_DIR", str(scratch))
+
+	tblout, searchout, stderr = [str(tmp_path / name) for name in ("s-1.tbl", "s-1.out", "s-1.err")]
+	script = rfkubesub.build_staged_command("(echo failed >&2; exit 3) 2> %s" % stderr, (tblout, searchout, stderr))
+
+	assert run_script(script, {"HOSTNAME": "pod-a", "PATH": "/usr/bin:/bin"}).returncode == 3
+	assert open(stderr).read() == "failed\n"
+	assert not (tmp_path / "s-1.tbl.tgz").exists()
+
+def test_staged_job_manifest_mounts_scratch():
+	manifest = rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000, scratch=True)
+	pod_spec = manifest["spec"]["template"]["spec"]
+
+	assert {"name": "scratch", "emptyDir": {}} in pod_spec["volumes"]
+	assert {"name": "scratch", "mountPath": rfkubesub.SCRATCH_DIR} in pod_spec["containers"][0]["volumeMounts"]
+
+def test_scratch_space_is_requested_as_ephemeral_storage():
+	manifest = rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000, scratch_mb=4643)
+	pod_spec = manifest["spec"]["template"]["spec"]
+
+	assert pod_spec["containers"][0]["resources"]["requests"]["ephemeral-storage"] == "4643Mi"
+	assert {"name": "scratch", "emptyDir": {"sizeLimit": "4643Mi"}} in pod_spec["volumes"]
+	assert "ephemeral-storage" not in rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000,
+		scratch=True)["spec"]["template"]["spec"]["containers"][0]["resources"]["requests"]
+
+# -----------------------------------------------------------------------------------
+
+def test_username_of_pooled_login_pods_comes_from_the_environment(monkeypatch):
+	monkeypatch.setenv(rfkubesub.USER_VAR, "alice")
+
+	assert rfkubesub.get_username() == "alice"
+
+def test_pooled_sessions_mount_the_users_home_directory(monkeypatch):
+	monkeypatch.setenv(rfkubesub.USER_VAR, "alice")
+
+	assert rfkubesub.get_workdir_claim("alice") == (rfkubesub.HOME_VOLUME_CLAIM, "alice")
+	assert rfkubesub.get_workdir_claim("bob") == ("rfam-pvc-bob", None)
+
+	pod_spec = rfkubesub.build_job_manifest("alice", "s-1234-1", "cmsearch", 4, 8000)["spec"]["template"]["spec"]
+	mount = [m for m in pod_spec["containers"][0]["volumeMounts"] if m["mountPath"] == rfkubesub.WORKDIR][0]
+	volume = [v for v in pod_spec["volumes"] if v["name"] == mount["name"]][0]
+
+	assert mount["subPath"] == "alice"
+	assert volume["persistentVolumeClaim"]["claimName"] == rfkubesub.HOME_VOLUME_CLAIM
+
+def test_pooled_shards_get_the_output_handling_of_jobs(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.delenv(rfkubesub.STAGE_OUTPUTS_VAR, raising=False)
+	monkeypatch.setattr(rfkubesub.rfledger, "resume_shards", lambda user, job_index, commands, batch:
+		(commands, list(range(len(commands))), None))
+	monkeypatch.setattr(rfkubesub.rfledger, "record_shards", lambda *args: None)
+	queued = []
+	monkeypatch.setattr(rfkubesub.rfpool, "submit_tasks", lambda user, tasks, cpus, memory: queued.extend(tasks))
+
+	tblout = str(tmp_path / "s-1.tbl")
+	cmd = "cmsearch --tblout %s CM db.fa > %s 2> %s" % (tblout, tmp_path / "s-1.cmsearch", tmp_path / "s-1.err")
+	open(tblout, 'w').write("# complete\n" + rfmerge.SUCCESS_STRING + "\n")
+
+	args = rfkubesub.parse_arguments().parse_args([cmd, "2", "1000", "s-1", "--pool", "--no-result-cache"])
+	assert rfkubesub.prepare_job(args, "alice") is None
+
+	# the complete tblout of an earlier submission is not taken for this one's
+	assert not (tmp_path / "s-1.tbl").exists()
+	assert [name for name, task_cmd in queued] == ["s-1"]
+	assert queued[0][1] == rfkubesub.build_atomic_command(cmd, (tblout, str(tmp_path / "s-1.cmsearch"), str(tmp_path / "s-1.err")))
+
+	queued[:] = []
+	args = rfkubesub.parse_arguments().parse_args([cmd, "2", "1000", "s-1", "--pool", "--stage", "--no-result-cache"])
+	rfkubesub.prepare_job(args, "alice")
+
+	assert rfmerge.get_bundle_path(tblout) in queued[0][1] and rfkubesub.SCRATCH_DIR in queued[0][1]
@@ -0,0 +1,232 @@
+import os
+import socket
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import rfkubesub
+import rfkubesubd
+
+# -----------------------------------------------------------------------------------
+
+class FakeClock(object):
+	"""
+	Stands in for time.monotonic and time.sleep, sleeping advances the clock
+	"""
+
+	def __init__(self):
+		self.now = 100.0
+		self.sleeps = []
+
+	def monotonic(self):
+		return self.now
+
+	def sleep(self, secs):
+		self.sleeps.append(secs)
+		self.now += secs
+
+def use_fake_clock(monkeypatch):
+	clock = FakeClock()
+	monkeypatch.setattr(rfkubesubd.time, "monotonic", clock.monotonic)
+	monkeypatch.setattr(rfkubesubd.time, "sleep", clock.sleep)
+
+	return clock
+
+class FakeBatchApi(object):
+	"""
+	Answers job creations with the given API errors, then creates the job.
+	Existing jobs run the command of the first manifest.
+	"""
+
+	def __init__(self, errors):
+		self.errors = list(errors)
+		self.created = []
+		self.command = None
+
+	def create_namespaced_job(self, namespace, body):
+		if self.command is None:
+			self.command = body["spec"]["template"]["spec"]["containers"][0]["command"]
+
+		if len(self.errors) > 0:
+			raise self.errors.pop(0)
+
+		self.created.append(body["metadata"]["name"])
+
+		return SimpleNamespace(metadata=SimpleNamespace(name=body["metadata"]["name"]))
+
+	def read_namespaced_job(self, name, namespace):
+		container = SimpleNamespace(command=self.command)
+
+		return SimpleNamespace(spec=SimpleNamespace(template=SimpleNamespace(spec=SimpleNamespace(containers=[container]))))
+
+def api_error(status, retry_after=None):
+	rest = pytest.importorskip("kubernetes.client.rest")
+	error = rest.ApiException(status=status, reason="error %d" % status)
+
+	if retry_after is not None:
+		error.headers = {"Retry-After": retry_after}
+
+	return error
+
+class FakeSubmitter(object):
+
+	def __init__(self):
+		self.manifests = []
+
+	def submit(self, manifest):
+		self.manifests.append(manifest)
+		return manifest["metadata"]["name"]
+
+@pytest.fixture
+def daemon():
+	socket_dir = tempfile.mkdtemp()
+	socket_path = os.path.join(socket_dir, "rfkubesubd.sock")
+	server = rfkubesubd.SubmissionServer(socket_path, FakeSubmitter())
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	yield server, socket_path
+
+	server.shutdown()
+	server.server_close()
+	os.remove(socket_path)
+	os.rmdir(socket_dir)
+
+# -----------------------------------------------------------------------------------
+
+def test_token_bucket_allows_a_burst(monkeypatch):
+	clock = use_fake_clock(monkeypatch)
+	bucket = rfkubesubd.TokenBucket(qps=2, burst=5)
+
+	for i in range(5):
+		bucket.acquire()
+
+	assert clock.sleeps == []
+
+def test_token_bucket_limits_the_rate_after_a_burst(monkeypatch):
+	clock = use_fake_clock(monkeypatch)
+	bucket = rfkubesubd.TokenBucket(qps=2, burst=5)
+	start = clock.now
+
+	for i in range(15):
+		bucket.acquire()
+
+	# 5 at once, then 10 more at 2 per second
+	assert abs(clock.now - start - 5.0) < 1e-6
+
+def test_token_bucket_refills_up_to_its_burst(monkeypatch):
+	clock = use_fake_clock(monkeypatch)
+	bucket = rfkubesubd.TokenBucket(qps=2, burst=5)
+
+	for i in range(5):
+		bucket.acquire()
+
+	# idle long enough to refill many times over
+	clock.now += 60
+	start = clock.now
+
+	for i in range(6):
+		bucket.acquire()
+
+	assert abs(clock.now - start - 0.5) < 1e-6
+
+# -----------------------------------------------------------------------------------
+
+def test_throttled_submissions_back_off(monkeypatch):
+	clock = use_fake_clock(monkeypatch)
+	api = FakeBatchApi([api_error(429), api_error(503), api_error(500)])
+	submitter = rfkubesubd.JobSubmitter(qps=1000, burst=10, batch_api=api)
+
+	assert submitter.submit(rfkubesub.build_job_manifest("alice", "s-1-0", "true", 1, 100)) == "rfsearch-job-alice-s-1-0"
+	assert api.created == ["rfsearch-job-alice-s-1-0"]
+	assert clock.sleeps == [0.5, 1.0, 2.0]
+
+def test_retry_after_is_honoured(monkeypatch):
+	clock = use_fake_clock(monkeypatch)
+	api = FakeBatchApi([api_error(429, retry_after="7"), api_error(429, retry_after="soon")])
+	submitter = rfkubesubd.JobSubmitter(qps=1000, burst=10, batch_api=api)
+
+	submitter.submit(rfkubesub.build_job_manifest("alice", "s-1-0", "true", 1, 100))
+
+	# a Retry-After that is not a number of seconds falls back to the backoff
+	assert clock.sleeps == [7, 1.0]
+
+def test_submissions_give_up_after_max_retries(monkeypatch):
+	clock = use_fake_clock(monkeypatch)
+	api = FakeBatchApi([api_error(503) for i in range(4)])
+	submitter = rfkubesubd.JobSubmitter(qps=1000, burst=10, max_retries=2, batch_api=api)
+
+	with pytest.raises(Exception) as error:
+		submitter.submit(rfkubesub.build_job_manifest("alice", "s-1-0", "true", 1, 100))
+
+	assert error.value.status == 503
+	assert len(clock.sleeps) == 2
+	assert api.created == []
+
+def test_conflict_on_a_retry_is_the_job_of_an_earlier_attempt(monkeypatch):
+	use_fake_clock(monkeypatch)
+	manifest = rfkubesub.build_job_manifest("alice", "s-1-0", "true", 1, 100)
+
+	# the first attempt created the job, but timed out on its way back
+	api = FakeBatchApi([api_error(504), api_error(409)])
+	assert rfkubesubd.JobSubmitter(batch_api=api).submit(manifest) == "rfsearch-job-alice-s-1-0"
+
+	# a job of the same name running another command, or a conflict on the first attempt, is an error
+	api = FakeBatchApi([api_error(504), api_error(409)])
+	api.command = ["sh", "-c", "other"]
+	with pytest.raises(Exception, match="409"):
+		rfkubesubd.JobSubmitter(batch_api=api).submit(manifest)
+
+	with pytest.raises(Exception, match="409"):
+		rfkubesubd.JobSubmitter(batch_api=FakeBatchApi([api_error(409)])).submit(manifest)
+
+# -----------------------------------------------------------------------------------
+
+def test_daemon_runs_rfkubesub_in_the_clients_directory(daemon, tmp_path, monkeypatch):
+	server, socket_path = daemon
+	monkeypatch.delenv(rfkubesub.USER_VAR, raising=False)
+	(tmp_path / "s-1.cmds").write_text("echo one\necho two\n")
+	request = {"argv": ["s-1.cmds", "2", "1000", "s-1", "--batch", "--no-sizing", "--no-result-cache", "--no-profile"],
+		"cwd": str(tmp_path), "env": {rfkubesub.USER_VAR: "alice"}}
+
+	response = rfkubesubd.submit_to_daemon(request, socket_path)
+
+	assert response["status"] == "ok" and response["job"] == "rfsearch-job-alice-s-1"
+	manifest = server.submitter.manifests[0]
+	assert manifest["spec"]["completions"] == 2
+	assert manifest["spec"]["template"]["spec"]["containers"][0]["resources"]["requests"] == {"cpu": "2000m", "memory": "1000Mi"}
+	# the daemon's own directory and environment are left as they were
+	assert os.getcwd() != str(tmp_path)
+	assert rfkubesub.USER_VAR not in os.environ
+
+def test_daemon_reports_rfkubesub_errors(daemon, tmp_path):
+	server, socket_path = daemon
+	request = {"argv": ["missing.cmds", "2", "1000", "s-1", "--batch"], "cwd": str(tmp_path), "env": {rfkubesub.USER_VAR: "alice"}}
+
+	response = rfkubesubd.submit_to_daemon(request, socket_path)
+
+	assert response["status"] == "error"
+	assert server.submitter.manifests == []
+
+def test_client_without_daemon_or_reply(tmp_path):
+	socket_dir = tempfile.mkdtemp()
+	socket_path = os.path.join(socket_dir, "rfkubesubd.sock")
+
+	assert rfkubesubd.submit_to_daemon({}, socket_path) is None
+
+	# a daemon that accepts the request but never replies
+	listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	listener.bind(socket_path)
+	listener.listen(1)
+
+	try:
+		response = rfkubesubd.submit_to_daemon({}, socket_path, timeout=0.2)
+	finally:
+		listener.close()
+		os.remove(socket_path)
+		os.rmdir(socket_dir)
+
+	assert response["status"] == "error" and "No response" in response["message"]
@@ -0,0 +1,102 @@
+import os
+
+import rfmerge
+import rfledger
+
+# -----------------------------------------------------------------------------------
+
+def shard_command(tmp_path, name):
+	return "cmsearch --tblout {0}.tbl CM db.fa > {0}.cmsearch 2> {0}.err".format(tmp_path / name)
+
+def complete_shard(tmp_path, name):
+	(tmp_path / (name + ".tbl")).write_text("# header\n" + rfmerge.SUCCESS_STRING + "\n")
+	(tmp_path / (name + ".cmsearch")).write_text("[ok]\n")
+	(tmp_path / (name + ".err")).write_text("")
+
+def k8s_job_states(states):
+	return lambda k8s_jobs: dict((k8s_job, states.get(k8s_job)) for k8s_job in k8s_jobs)
+
+# -----------------------------------------------------------------------------------
+
+def test_resume_plan(tmp_path):
+	ledger = rfledger.RunLedger(str(tmp_path / "ledger"))
+	names = ["s-12-%d" % i for i in range(5)]
+	commands = [shard_command(tmp_path, name) for name in names]
+
+	ledger.record_submission("12", "job-a", [(names[0], 0, commands[0], None), (names[1], 1, commands[1], None)])
+	ledger.record_submission("12", "job-b", [(names[2], 0, commands[2], None), (names[3], 1, commands[3], None)])
+	complete_shard(tmp_path, names[0])
+
+	# job-a still runs, job-b finished without completing its shards, the
+	# command of shard 2 changed and shard 4 was never submitted
+	changed = list(commands)
+	changed[2] = changed[2].replace("db.fa", "other.fa")
+	states, stale_jobs = ledger.plan_resume(names, changed, [None] * 5, k8s_job_states({"job-a": "active", "job-b": "finished"}))
+
+	assert states == [rfledger.VERIFIED, rfledger.REATTACH, rfledger.SUBMIT, rfledger.SUBMIT, rfledger.SUBMIT]
+	assert stale_jobs == ["job-b"]
+
+	# an active job running a shard whose command changed is deleted, its other shards run again
+	states, stale_jobs = ledger.plan_resume(names[:2], [commands[0], changed[2]], [None] * 2,
+		k8s_job_states({"job-a": "active"}))
+
+	assert states == [rfledger.VERIFIED, rfledger.SUBMIT]
+	assert stale_jobs == ["job-a"]
+
+	# a job that vanished runs its unverified shards again
+	states, stale_jobs = ledger.plan_resume(names[:2], commands[:2], [None] * 2, k8s_job_states({}))
+
+	assert states == [rfledger.VERIFIED, rfledger.SUBMIT]
+	assert stale_jobs == []
+
+	ledger.close()
+
+def test_error_output_is_not_verified(tmp_path):
+	ledger = rfledger.RunLedger(str(tmp_path / "ledger"))
+	command = shard_command(tmp_path, "s-12-0")
+	ledger.record_submission("12", None, [("s-12-0", None, command, None)])
+
+	complete_shard(tmp_path, "s-12-0")
+	(tmp_path / "s-12-0.err").write_text("Error: out of memory\n")
+
+	assert ledger.verify(["s-12-0"]) == set()
+	assert ledger.get_shard("s-12-0")["verified_time"] is None
+
+	ledger.close()
+
+def test_resumable_run(tmp_path):
+	ledger = rfledger.RunLedger(str(tmp_path / "ledger"))
+
+	assert ledger.get_resumable_run() is None
+
+	ledger.record_submission("12", None, [("s-12-0", None, "true", None)])
+	assert ledger.get_resumable_run() == "12"
+
+	ledger.finish_run("12")
+	assert ledger.get_resumable_run() is None
+
+	ledger.close()
+
+def test_resumed_submission_skips_finished_shards(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr(rfledger, "get_k8s_job_states", k8s_job_states({}))
+	deleted = []
+	monkeypatch.setattr(rfledger, "delete_k8s_jobs", deleted.extend)
+	commands = [shard_command(tmp_path, "s-12-%d" % i) for i in range(3)]
+
+	# without a run id every shard is submitted, and nothing is recorded
+	monkeypatch.delenv(rfledger.RUN_ID_VAR, raising=False)
+	assert rfledger.resume_shards("user", "s-12", commands, True) == (commands, [0, 1, 2], None)
+	rfledger.record_shards("user", "job-a", "s-12", commands, [0, 1, 2], True)
+	assert not os.path.exists(rfledger.LEDGER_FILE)
+
+	monkeypatch.setenv(rfledger.RUN_ID_VAR, "12")
+	assert rfledger.resume_shards("user", "s-12", commands, True) == (commands, [0, 1, 2], None)
+	rfledger.record_shards("user", "job-a", "s-12", commands, [0, 1, 2], True)
+
+	complete_shard(tmp_path, "s-12-1")
+	remaining, indexes, suffix = rfledger.resume_shards("user", "s-12", commands, True)
+
+	assert (remaining, indexes) == ([commands[0], commands[2]], [0, 2])
+	assert suffix.startswith("-r")
+	assert deleted == []
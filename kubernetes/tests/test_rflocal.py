@@ -0,0 +1,110 @@
+import os
+import time
+
+import rflocal
+import rfpool
+
+# -----------------------------------------------------------------------------------
+
+def run_until_drained(executor, timeout=30):
+	"""
+	Runs an executor until its queue is drained
+
+	return: A list of the sets of task names seen running at the same time
+	"""
+
+	snapshots = []
+	deadline = time.time() + timeout
+
+	while time.time() < deadline:
+		executor.reap_tasks()
+		executor.start_tasks()
+
+		running = frozenset(task["name"] for task, process, cpu_ids, memory in executor.running.values())
+		if len(snapshots) == 0 or snapshots[-1] != running:
+			snapshots.append(running)
+
+		if len(executor.running) == 0 and executor.task_queue.depth() == (0, 0):
+			return snapshots
+
+		time.sleep(0.05)
+
+	raise AssertionError("queue not drained")
+
+# -----------------------------------------------------------------------------------
+
+def test_claim_skips_tasks_that_do_not_fit(tmp_path):
+	task_queue = rfpool.TaskQueue(str(tmp_path))
+	task_queue.put("big", "true", 8, 1000)
+	task_queue.put("small", "true", 1, 100)
+
+	file_name, task = task_queue.claim("w", fits=lambda task: task["cpus"] <= 2)
+	assert task["name"] == "small"
+	assert task_queue.claim("w", fits=lambda task: task["cpus"] <= 2) is None
+
+	file_name, task = task_queue.claim("w")
+	assert task["name"] == "big"
+
+def test_tasks_are_packed_into_cpus_and_memory(tmp_path, monkeypatch):
+	pinned = tmp_path / "pinned"
+	pinned.mkdir()
+	# record the pinning instead of doing it, the cpus may not exist here
+	monkeypatch.setattr(os, "sched_setaffinity",
+		lambda pid, cpu_ids: (pinned / str(os.getpid())).write_text(",".join(map(str, sorted(cpu_ids)))))
+
+	task_queue = rfpool.TaskQueue(str(tmp_path / "queue"))
+	for i in range(4):
+		task_queue.put("a%d" % i, "sleep 0.3", 2, 1000, cwd=str(tmp_path))
+	task_queue.put("wide", "sleep 0.3", 4, 1000, cwd=str(tmp_path))
+	task_queue.put("fat", "sleep 0.3", 1, 3500, cwd=str(tmp_path))
+	task_queue.put("huge", "sleep 0.3", 64, 100000, cwd=str(tmp_path))
+
+	executor = rflocal.LocalExecutor(task_queue, [0, 1, 2, 3], 4000)
+	snapshots = run_until_drained(executor)
+
+	assert snapshots[0] == frozenset(["a0", "a1"])
+	assert frozenset(["a2", "a3"]) in snapshots
+	for running in snapshots:
+		# at most 4 cpus and 4000 Mb in use at any time
+		assert len(running & frozenset(["wide", "huge"])) == 0 or len(running) == 1
+		assert "fat" not in running or len(running) == 1
+	assert sorted(p.read_text() for p in pinned.iterdir()).count("0,1") == 2
+
+	states = task_queue.get_states(["a0", "wide", "fat", "huge"])
+	assert all(state == (rfpool.DONE, 0) for state in states.values())
+
+def test_oldest_task_is_not_starved_by_backfill(tmp_path, monkeypatch):
+	task_queue = rfpool.TaskQueue(str(tmp_path))
+	task_queue.put("wide", "true", 4, 0)
+	task_queue.put("small", "true", 1, 0)
+
+	executor = rflocal.LocalExecutor(task_queue, [0, 1, 2, 3], 4000)
+	executor.free_cpus = set([0, 1])
+
+	monkeypatch.setattr(rflocal, "MAX_BACKFILL_SECS", 3600)
+	executor.start_tasks()
+	assert [task["name"] for task, process, cpu_ids, memory in executor.running.values()] == ["small"]
+
+	task_queue.put("small2", "true", 1, 0)
+	monkeypatch.setattr(rflocal, "MAX_BACKFILL_SECS", -1)
+	assert executor.start_tasks() == 0
+
+	executor.stop()
+
+def test_phases_and_wait(tmp_path):
+	task_queue = rfpool.TaskQueue(str(tmp_path / "queue"))
+	task_queue.put("ok", "true", 1, 0, cwd=str(tmp_path))
+	task_queue.put("bad", "exit 3", 1, 0, cwd=str(tmp_path))
+
+	phases = rflocal.get_phases(task_queue, ["ok", "bad", "missing"])
+	assert phases["ok"] == ("Pending", "")
+	assert phases["missing"] == ("Failed", "not queued")
+
+	run_until_drained(rflocal.LocalExecutor(task_queue, [0], 1000))
+
+	status, phases = rflocal.wait_for_tasks(task_queue, ["ok"], progress_interval=0)
+	assert status == rflocal.SUCCESS
+
+	status, phases = rflocal.wait_for_tasks(task_queue, ["ok", "bad"], progress_interval=0)
+	assert status == rflocal.JOB_FAILED
+	assert phases["bad"] == ("Failed", "exit status 3")
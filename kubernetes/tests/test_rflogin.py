@@ -0,0 +1,136 @@
+from types import SimpleNamespace
+
+import pytest
+
+import rflogin
+
+# -----------------------------------------------------------------------------------
+
+class FakeCoreApi(object):
+	def __init__(self, pods, settings):
+		self.pods = pods
+		self.settings = settings
+		self.deleted = []
+
+	def read_namespaced_config_map(self, name, namespace):
+		return SimpleNamespace(data=self.settings)
+
+	def list_namespaced_pod(self, namespace, label_selector=None):
+		return SimpleNamespace(items=[pod for pod in self.pods if pod.metadata.name not in self.deleted])
+
+	def delete_namespaced_pod(self, name, namespace):
+		self.deleted.append(name)
+
+class FakeAppsApi(object):
+	def __init__(self):
+		self.replicas = {}
+		self.pools = {} # pool user -> deployment manifest
+
+	def list_namespaced_deployment(self, namespace, label_selector=None):
+		return SimpleNamespace(items=[SimpleNamespace(metadata=SimpleNamespace(labels=manifest["metadata"]["labels"]),
+			spec=SimpleNamespace(replicas=self.replicas[manifest["metadata"]["name"]])) for manifest in self.pools.values()])
+
+	def create_namespaced_deployment(self, namespace, body):
+		self.pools[body["metadata"]["labels"]["user"]] = body
+		self.replicas[body["metadata"]["name"]] = body["spec"]["replicas"]
+
+	def delete_namespaced_deployment(self, name, namespace):
+		user = [user for user, manifest in self.pools.items() if manifest["metadata"]["name"] == name][0]
+		del self.pools[user]
+		del self.replicas[name]
+
+	def patch_namespaced_deployment_scale(self, name, namespace, body):
+		self.replicas[name] = body["spec"]["replicas"]
+
+def login_pod(name, user, pooled=False):
+	labels = {"user": user, "tier": "frontend"}
+	if pooled:
+		labels[rflogin.POOLED_LABEL] = "true"
+
+	return SimpleNamespace(metadata=SimpleNamespace(name=name, labels=labels, deletion_timestamp=None),
+		status=SimpleNamespace(phase="Running"))
+
+# -----------------------------------------------------------------------------------
+
+def test_count_user_processes_leaves_out_init_and_the_probe():
+	probe_output = "\n".join(["40",
+		"1 (bash) S 0 1 1 0 -1",
+		"12 (rfsearch.pl) S 1 12 1 0 -1",
+		"40 (sh) S 0 40 40 0 -1",
+		"41 (cat) R 40 40 40 0 -1"])
+
+	assert rflogin.count_user_processes(probe_output) == 1
+	assert rflogin.count_user_processes("40\n1 (bash) S 0 1 1 0 -1\n40 (sh) S 0 40 40 0 -1\n") == 0
+
+def test_count_user_processes_handles_spaces_in_command_names():
+	assert rflogin.count_user_processes("9\n1 (bash) S 0 1\n7 (my prog) S 1 7\n9 (sh) S 0 9\n") == 1
+
+def test_idle_login_pods_are_scaled_to_zero_after_the_timeout(monkeypatch):
+	pytest.importorskip("kubernetes.client")
+
+	pods = [login_pod("rfam-login-pod-alice-1", "alice"), login_pod("rfam-login-pool-2", "bob", pooled=True),
+		login_pod("rfam-login-pod-carol-3", "carol")]
+	core_api = FakeCoreApi(pods, {"size": "3", "idle_timeout": "100", "users": '["bob"]'})
+	apps_api = FakeAppsApi()
+	manager = rflogin.LoginPoolManager(core_api, apps_api, "default")
+
+	processes = {"rfam-login-pod-alice-1": 0, "rfam-login-pool-2": 0, "rfam-login-pod-carol-3": 2}
+	monkeypatch.setattr(manager, "count_processes", lambda pod: processes[pod.metadata.name])
+
+	clock = [1000.0]
+	monkeypatch.setattr(rflogin.time, "time", lambda: clock[0])
+
+	manager.cycle()
+	assert apps_api.replicas == {"rfam-login-pool-bob": 3}
+	assert core_api.deleted == []
+
+	clock[0] += 150
+	manager.cycle()
+	assert apps_api.replicas["rfam-login-pod-alice"] == 0
+	assert core_api.deleted == ["rfam-login-pool-2"]
+	assert "rfam-login-pod-carol" not in apps_api.replicas
+
+def test_activity_resets_the_idle_time(monkeypatch):
+	pytest.importorskip("kubernetes.client")
+
+	core_api = FakeCoreApi([login_pod("rfam-login-pod-alice-1", "alice")], {"idle_timeout": "100"})
+	apps_api = FakeAppsApi()
+	manager = rflogin.LoginPoolManager(core_api, apps_api, "default")
+
+	processes = [0, 1, 0, 0]
+	monkeypatch.setattr(manager, "count_processes", lambda pod: processes.pop(0))
+
+	clock = [1000.0]
+	monkeypatch.setattr(rflogin.time, "time", lambda: clock[0])
+
+	for i in range(4):
+		manager.cycle()
+		clock[0] += 60
+
+	assert "rfam-login-pod-alice" not in apps_api.replicas
+
+def test_pool_pods_mount_only_the_users_home_directory():
+	manifest = rflogin.build_pool_deployment("alice", 2)
+	pod_spec = manifest["spec"]["template"]["spec"]
+	container = pod_spec["containers"][0]
+	home_volume = [v["name"] for v in pod_spec["volumes"] if v["persistentVolumeClaim"]["claimName"] == "rfhome-pvc"][0]
+
+	assert [m for m in container["volumeMounts"] if m["name"] == home_volume] == [
+		{"name": home_volume, "mountPath": "/workdir", "subPath": "alice"}]
+	assert {"name": "RFAM_USER", "value": "alice"} in container["env"]
+	assert manifest["spec"]["selector"]["matchLabels"] == manifest["spec"]["template"]["metadata"]["labels"]
+	assert manifest["spec"]["selector"]["matchLabels"]["user"] == "alice"
+
+def test_pools_follow_the_pool_users(monkeypatch):
+	pytest.importorskip("kubernetes.client")
+
+	settings = {"size": "1", "users": '["alice", "bob"]'}
+	apps_api = FakeAppsApi()
+	manager = rflogin.LoginPoolManager(FakeCoreApi([], settings), apps_api, "default")
+
+	manager.cycle()
+	assert apps_api.replicas == {"rfam-login-pool-alice": 1, "rfam-login-pool-bob": 1}
+
+	settings.update(size="2", users='["bob"]')
+	manager.cycle()
+	assert apps_api.replicas == {"rfam-login-pool-bob": 2}
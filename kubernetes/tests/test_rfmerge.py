@@ -0,0 +1,83 @@
+import os
+import time
+import tarfile
+
+import rfmerge
+
+# -----------------------------------------------------------------------------------
+
+def hit(name, score, evalue):
+	fields = [name] + ["-"] * 13 + [str(score), str(evalue), "!", "-"]
+
+	return " ".join(fields) + "\n"
+
+def write_shard(tmp_path, job_name, hits):
+	tblout = tmp_path / (job_name + ".tbl")
+	tblout.write_text("# header\n" + "".join(hits) + rfmerge.SUCCESS_STRING + "\n")
+	(tmp_path / (job_name + ".out")).write_text("output of %s\n" % job_name)
+
+	return (str(tblout), str(tmp_path / (job_name + ".out")), str(tmp_path / (job_name + ".err")),
+		str(tmp_path / "all.tbl"), str(tmp_path / "all.out"))
+
+def merge(plan, job_names, truncate=True):
+	merger = rfmerge.ShardMerger(plan, visibility_timeout=0, truncate=truncate)
+
+	for job_name in job_names:
+		merger.submit(job_name)
+
+	while len(merger.merged) + len(merger.failures) < len(merger.submitted):
+		time.sleep(0.01)
+
+	return merger
+
+def read_hits(path):
+	return [line.split()[0] for line in open(path) if not line.startswith('#')]
+
+# -----------------------------------------------------------------------------------
+
+def test_hits_are_sorted_by_score_then_evalue():
+	lines = [hit("low", 10, 1e-2), hit("high", 50, 1e-9), hit("tie", 50, 1e-5)]
+
+	assert [line.split()[0] for line in sorted(lines, key=rfmerge.hit_sort_key)] == ["high", "tie", "low"]
+
+def test_merged_index_is_score_sorted(tmp_path):
+	plan = {"s-1": write_shard(tmp_path, "s-1", [hit("a", 20, 1e-3), hit("b", 5, 1)]),
+		"s-2": write_shard(tmp_path, "s-2", [hit("c", 30, 1e-6)])}
+
+	merger = merge(plan, ["s-1", "s-2"])
+
+	assert merger.done() and merger.failed() == {}
+	assert read_hits(str(tmp_path / "all.tbl")) == ["a", "b", "c"]
+	assert read_hits(str(tmp_path / "all.tbl.sorted")) == ["c", "a", "b"]
+
+def test_incomplete_shard_fails(tmp_path):
+	plan = {"s-1": write_shard(tmp_path, "s-1", [hit("a", 20, 1e-3)])}
+	(tmp_path / "s-1.tbl").write_text("# header\n")
+
+	assert "does not end with" in merge(plan, ["s-1"]).failed()["s-1"]
+
+def test_merging_some_shards_keeps_the_others(tmp_path):
+	plan = {"s-1": write_shard(tmp_path, "s-1", [hit("a", 20, 1e-3)]),
+		"s-2": write_shard(tmp_path, "s-2", [hit("c", 30, 1e-6)])}
+
+	merge(plan, ["s-1"])
+	merge(plan, ["s-1", "s-2"], truncate=False)
+
+	assert read_hits(str(tmp_path / "all.tbl")) == ["a", "c"]
+	assert read_hits(str(tmp_path / "all.tbl.sorted")) == ["c", "a"]
+	assert open(str(tmp_path / "all.out")).read() == "output of s-1\noutput of s-2\n"
+
+def test_bundle_with_errors_fails(tmp_path):
+	plan = {"s-1": write_shard(tmp_path, "s-1", [hit("a", 20, 1e-3)])}
+	tblout, searchout = plan["s-1"][:2]
+	(tmp_path / "stderr").write_text("Error: out of memory\n")
+
+	bundle = tarfile.open(rfmerge.get_bundle_path(tblout), 'w:gz')
+	for path, name in ((tblout, rfmerge.BUNDLE_TBLOUT), (searchout, rfmerge.BUNDLE_SEARCHOUT),
+		(str(tmp_path / "stderr"), rfmerge.BUNDLE_STDERR)):
+		bundle.add(path, arcname=name)
+	bundle.close()
+	os.remove(tblout)
+
+	assert rfmerge.output_complete(tblout)
+	assert "Error: out of memory" in merge(plan, ["s-1"]).failed()["s-1"]
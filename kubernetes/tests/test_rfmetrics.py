@@ -0,0 +1,133 @@
+import queue
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import rfadmit
+import rfmetrics
+
+# -----------------------------------------------------------------------------------
+
+T0 = datetime.datetime(2026, 10, 18, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+def at(secs):
+	return T0 + datetime.timedelta(seconds=secs)
+
+def condition(condition_type, secs):
+	return SimpleNamespace(type=condition_type, status="True", last_transition_time=at(secs))
+
+def backend_pod(name, phase, conditions, started=None, finished=None, restarts=0):
+	if finished is not None:
+		state = SimpleNamespace(running=None, terminated=SimpleNamespace(started_at=at(started), finished_at=at(finished)))
+	elif started is not None:
+		state = SimpleNamespace(running=SimpleNamespace(started_at=at(started)), terminated=None)
+	else:
+		state = None
+
+	return SimpleNamespace(
+		metadata=SimpleNamespace(name=name, creation_timestamp=at(0),
+			labels={"user": "alice", "jobname": "rfsearch-job-alice-s-12-0", "tier": "backend"}),
+		spec=SimpleNamespace(node_name="node-1"),
+		status=SimpleNamespace(phase=phase, conditions=conditions,
+			container_statuses=[SimpleNamespace(restart_count=restarts, state=state)]))
+
+def backend_job(name, conditions, annotations=None):
+	return SimpleNamespace(
+		metadata=SimpleNamespace(name=name, uid="uid-" + name, creation_timestamp=at(0), labels={"user": "alice"},
+			annotations=annotations),
+		status=SimpleNamespace(conditions=conditions))
+
+def pulled_event(pod_name, message):
+	return SimpleNamespace(involved_object=SimpleNamespace(kind="Pod", name=pod_name), message=message)
+
+def observed(collector, phase):
+	"""
+	return: The (sum, count) of the phase durations of alice's s- pods on node-1
+	"""
+
+	node = "" if phase in ("admission", "completion_lag") else "node-1"
+	series = collector.phase_seconds.series.get((phase, "alice", "s-", node))
+
+	return None if series is None else (series[1], series[2])
+
+# -----------------------------------------------------------------------------------
+
+def test_go_durations_and_job_prefixes():
+	assert rfmetrics.parse_go_duration("1m2.5s") == 62.5
+	assert rfmetrics.parse_go_duration("350ms") == pytest.approx(0.35)
+	assert rfmetrics.get_job_prefix("s-12-0") == "s-"
+	assert rfmetrics.get_job_prefix("c-77") == "calibrate"
+	assert rfmetrics.get_job_prefix("x-1") == "other"
+
+def test_pod_phase_durations():
+	collector = rfmetrics.MetricsCollector()
+	name = "rfsearch-job-alice-s-12-0-abcde"
+
+	# the Pulled event may come before the pod is known
+	collector.observe_event("ADDED", pulled_event(name, 'Successfully pulled image "rfam/cloud:kubes" in 2.5s (2.5s including waiting)'))
+
+	scheduled = [condition("PodScheduled", 3)]
+	collector.observe_pod("ADDED", backend_pod(name, "Pending", scheduled))
+	initialized = scheduled + [condition("Initialized", 5)]
+	collector.observe_pod("MODIFIED", backend_pod(name, "Running", initialized, started=10))
+	collector.observe_pod("MODIFIED", backend_pod(name, "Succeeded", initialized, started=10, finished=70, restarts=1))
+	# repeated events are not observed twice
+	collector.observe_pod("MODIFIED", backend_pod(name, "Succeeded", initialized, started=10, finished=70, restarts=1))
+
+	assert observed(collector, "queued") == (3.0, 1)
+	assert observed(collector, "sandbox") == (2.0, 1)
+	assert observed(collector, "image_pull") == (2.5, 1)
+	assert observed(collector, "container_start") == (2.5, 1)
+	assert observed(collector, "run") == (60.0, 1)
+	assert collector.pods_total.series == {("alice", "s-", "node-1", "succeeded"): 1}
+	assert collector.restarts_total.series == {("alice", "s-", "node-1"): 1}
+
+	collector.observe_pod("DELETED", backend_pod(name, "Succeeded", initialized, started=10, finished=70))
+	assert collector.pods == {}
+
+def test_pods_not_created_by_rfkubesub_are_ignored():
+	collector = rfmetrics.MetricsCollector()
+	pod = backend_pod("other-pod", "Running", [condition("PodScheduled", 3)])
+	pod.metadata.labels = {"user": "alice", "jobname": "some-other-job"}
+
+	collector.observe_pod("ADDED", pod)
+
+	assert collector.pods == {}
+	assert collector.phase_seconds.series == {}
+
+def test_job_results_admission_and_completion_lag():
+	collector = rfmetrics.MetricsCollector()
+	name = "rfsearch-job-alice-s-12-0"
+	pod = backend_pod(name + "-abcde", "Succeeded", [condition("PodScheduled", 1), condition("Initialized", 2)],
+		started=2, finished=40)
+	annotations = {rfadmit.ADMITTED_ANNOTATION: at(20).isoformat()}
+
+	collector.observe_pod("MODIFIED", pod)
+	collector.observe_job("MODIFIED", backend_job(name, [condition("Complete", 45)], annotations))
+	collector.observe_job("MODIFIED", backend_job(name, [condition("Complete", 45)], annotations))
+	collector.observe_job("MODIFIED", backend_job("rfsearch-job-alice-s-12-1", [condition("Failed", 30)]))
+
+	assert observed(collector, "admission") == (20.0, 1)
+	assert observed(collector, "completion_lag") == (5.0, 1)
+	assert collector.jobs_total.series == {("alice", "s-", "succeeded"): 1, ("alice", "s-", "failed"): 1}
+
+def test_rendered_metrics():
+	collector = rfmetrics.MetricsCollector()
+	collector.observe_pod("ADDED", backend_pod("rfsearch-job-alice-s-12-0-abcde", "Pending", [condition("PodScheduled", 3)]))
+
+	lines = collector.render().split("\n")
+
+	assert 'rfam_job_phase_seconds_bucket{phase="queued",user="alice",prefix="s-",node="node-1",le="5"} 1' in lines
+	assert 'rfam_job_phase_seconds_bucket{phase="queued",user="alice",prefix="s-",node="node-1",le="2"} 0' in lines
+	assert 'rfam_pods{user="alice",prefix="s-",phase="Pending"} 1' in lines
+
+def test_collector_exits_on_a_lost_watch():
+	events = queue.Queue()
+	events.put(("Pod", "SYNCED", []))
+	events.put(("Pod", "FAILED", "ConnectionError: connection refused"))
+
+	with pytest.raises(SystemExit) as exit_info:
+		rfmetrics.collect_forever(rfmetrics.MetricsCollector(), events)
+
+	assert "lost the Pod watch" in str(exit_info.value)
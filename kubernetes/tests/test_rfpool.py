@@ -0,0 +1,69 @@
+import os
+import time
+
+import rfpool
+
+# -----------------------------------------------------------------------------------
+
+def age_task(task_queue, state, file_name, secs):
+	path = task_queue.get_path(state, file_name)
+	os.utime(path, (time.time() - secs, time.time() - secs))
+
+# -----------------------------------------------------------------------------------
+
+def test_claim_takes_the_oldest_task_that_fits(tmp_path):
+	task_queue = rfpool.TaskQueue(str(tmp_path))
+	task_queue.put("s-12-0", "true", cpus=8, memory=1000)
+	task_queue.put("s-12-1", "true", cpus=2, memory=1000)
+	task_queue.put("s-12-2", "true", cpus=2, memory=1000)
+
+	file_name, task = task_queue.claim("worker-a", fits=lambda task: task["cpus"] <= 4)
+
+	assert task["name"] == "s-12-1"
+	assert (task["worker"], task["attempts"]) == ("worker-a", 1)
+	assert os.path.exists(task_queue.get_path(rfpool.RUNNING, file_name))
+	assert task_queue.depth() == (2, 1)
+
+	assert task_queue.claim("worker-b")[1]["name"] == "s-12-0"
+	assert task_queue.claim("worker-b")[1]["name"] == "s-12-2"
+	assert task_queue.claim("worker-b") is None
+
+def test_stale_tasks_are_requeued_then_failed(tmp_path):
+	task_queue = rfpool.TaskQueue(str(tmp_path))
+	task_queue.put("s-12-0", "true")
+	task_queue.put("s-12-1", "true")
+	fresh_file, fresh = task_queue.claim("worker-a")
+	stale_file, stale = task_queue.claim("worker-b")
+
+	# worker-b stopped refreshing its claim, worker-a is alive
+	age_task(task_queue, rfpool.RUNNING, stale_file, rfpool.STALE_SECS + 1)
+	task_queue.heartbeat(fresh_file)
+
+	assert task_queue.requeue_stale() == 1
+	assert task_queue.list_tasks(rfpool.PENDING) == [stale_file]
+	assert task_queue.list_tasks(rfpool.RUNNING) == [fresh_file]
+
+	# a task whose workers keep dying fails after MAX_ATTEMPTS
+	for attempt in range(rfpool.MAX_ATTEMPTS - 1):
+		file_name, task = task_queue.claim("worker-b")
+		age_task(task_queue, rfpool.RUNNING, file_name, rfpool.STALE_SECS + 1)
+		assert task_queue.requeue_stale() == 1
+
+	assert task_queue.list_tasks(rfpool.PENDING) == []
+	assert task_queue.get_states(["s-12-1"]) == {"s-12-1": (rfpool.DONE, -1)}
+
+def test_task_states(tmp_path):
+	task_queue = rfpool.TaskQueue(str(tmp_path))
+	for name in ("s-12-0", "s-12-1", "s-12-2"):
+		task_queue.put(name, "true")
+
+	file_name, task = task_queue.claim("worker-a")
+	task_queue.complete(file_name, task, 3)
+	task_queue.claim("worker-a")
+
+	assert task_queue.get_states(["s-12-0", "s-12-1", "s-12-2", "s-99-0"]) == {
+		"s-12-0": (rfpool.DONE, 3), "s-12-1": (rfpool.RUNNING, None), "s-12-2": (rfpool.PENDING, None)}
+
+	# queueing a task again replaces the record of its last run
+	task_queue.put("s-12-0", "true")
+	assert task_queue.get_states(["s-12-0"]) == {"s-12-0": (rfpool.PENDING, None)}
@@ -0,0 +1,119 @@
+import os
+import json
+import stat
+import shlex
+import subprocess
+
+import rfprofile
+
+# -----------------------------------------------------------------------------------
+
+class FakeCgroup(object):
+	"""
+	A cgroup whose CPU usage grows by one second per read, with 100Mb more
+	memory in use at each read
+	"""
+
+	def __init__(self):
+		self.reads = 0
+
+	def read(self):
+		self.reads += 1
+		return {"cpu_usec": self.reads * 1000000, "throttled_usec": 0, "nr_throttled": 0,
+			"memory_bytes": self.reads * 100 * 1024 * 1024, "memory_peak_bytes": None,
+			"io_read_bytes": self.reads * 1024 * 1024, "io_write_bytes": 0}
+
+def profile(tblout, wall, cpu_secs, peak_mb, search_secs, cpus=4, memory=16000):
+	return {"tblout": tblout, "start": 0, "exit_status": 0, "wall_secs": wall, "input_secs": wall - search_secs,
+		"search_secs": search_secs, "output_secs": 0.0, "cpu_secs": cpu_secs, "throttled_secs": 0.0, "peak_mb": peak_mb,
+		"read_mb": 10.0, "cpus_requested": cpus, "memory_requested_mb": memory}
+
+# -----------------------------------------------------------------------------------
+
+def test_cgroup_v2_counters(tmp_path):
+	(tmp_path / "cgroup.controllers").write_text("cpu io memory\n")
+	(tmp_path / "cpu.stat").write_text("usage_usec 5000000\nuser_usec 4000000\nnr_throttled 3\nthrottled_usec 250000\n")
+	(tmp_path / "memory.current").write_text("1048576\n")
+	(tmp_path / "memory.peak").write_text("2097152\n")
+	(tmp_path / "io.stat").write_text("8:0 rbytes=100 wbytes=10 rios=1 wios=1\n8:16 rbytes=50 wbytes=5 rios=1 wios=1\n")
+
+	assert rfprofile.CgroupReader(str(tmp_path)).read() == {"cpu_usec": 5000000, "throttled_usec": 250000, "nr_throttled": 3,
+		"memory_bytes": 1048576, "memory_peak_bytes": 2097152, "io_read_bytes": 150, "io_write_bytes": 15}
+
+def test_cgroup_v1_counters(tmp_path):
+	for controller in ("cpuacct", "cpu", "memory", "blkio"):
+		(tmp_path / controller).mkdir()
+	(tmp_path / "cpuacct" / "cpuacct.usage").write_text("5000000000\n")
+	(tmp_path / "cpu" / "cpu.stat").write_text("nr_periods 10\nnr_throttled 3\nthrottled_time 250000000\n")
+	(tmp_path / "memory" / "memory.usage_in_bytes").write_text("1048576\n")
+	(tmp_path / "memory" / "memory.max_usage_in_bytes").write_text("2097152\n")
+	(tmp_path / "blkio" / "blkio.throttle.io_service_bytes").write_text("8:0 Read 100\n8:0 Write 10\n8:0 Total 110\nTotal 110\n")
+
+	assert rfprofile.CgroupReader(str(tmp_path)).read() == {"cpu_usec": 5000000, "throttled_usec": 250000, "nr_throttled": 3,
+		"memory_bytes": 1048576, "memory_peak_bytes": 2097152, "io_read_bytes": 100, "io_write_bytes": 10}
+
+def test_descendants_and_their_io():
+	process = subprocess.Popen(["sh", "-c", "sleep 5; true"])
+
+	try:
+		for i in range(50):
+			descendants = rfprofile.list_descendants(process.pid)
+			if "sleep" in descendants.values():
+				break
+			subprocess.call(["sleep", "0.1"])
+		assert "sleep" in descendants.values()
+	finally:
+		process.kill()
+		process.wait()
+
+	assert rfprofile.read_process_io(os.getpid())[0] > 0
+	assert rfprofile.read_process_io(process.pid) is None
+
+def test_profile_phases_and_exit_status(tmp_path, monkeypatch):
+	cmsearch = tmp_path / "cmsearch"
+	cmsearch.write_text("#!/bin/sh\nsleep 1\n")
+	cmsearch.chmod(cmsearch.stat().st_mode | stat.S_IEXEC)
+	tblout = str(tmp_path / "s-12-0.tbl")
+
+	profiler = rfprofile.ShardProfiler(cgroup=FakeCgroup(), interval=0.05)
+	status = rfprofile.profile_command("sleep 0.5; %s; sleep 0.5; exit 3" % cmsearch, tblout, 4, 16000, profiler=profiler)
+
+	assert status == 3
+	result = json.load(open(rfprofile.get_profile_path(tblout)))
+	assert result["exit_status"] == 3
+	assert result["cpus_requested"] == 4 and result["memory_requested_mb"] == 16000
+	assert 0.3 < result["input_secs"] < 0.9
+	assert 0.7 < result["search_secs"] < 1.3
+	assert 0.3 < result["output_secs"] < 0.9
+	assert result["cpu_secs"] > 0
+	# memory.peak missing, the highest sampled usage is used
+	assert result["peak_mb"] >= 100
+	assert not os.path.exists(rfprofile.get_profile_path(tblout) + ".tmp")
+
+def test_profiled_command_keeps_the_shard_command(tmp_path, monkeypatch):
+	cmd = "[ -f s.tbl.tgz ] && exit 0; (cmsearch --tblout /scratch/tblout CM db > /scratch/searchout); rc=$?"
+	wrapped = rfprofile.build_profiled_command(cmd, "/workdir/RF1/s-12-0.tbl", 4, "16000")
+
+	assert shlex.split(wrapped) == [rfprofile.RFPROFILE_CMD, "run", "--tblout", "/workdir/RF1/s-12-0.tbl",
+		"--cpus", "4", "--memory", "16000", cmd]
+
+	# a failed profile never fails the shard
+	monkeypatch.setattr(rfprofile, "write_profile", lambda path, profile: open(str(tmp_path / "missing" / "x"), 'w'))
+	assert rfprofile.profile_command("exit 0", str(tmp_path / "s.tbl"), 1, 100,
+		profiler=rfprofile.ShardProfiler(cgroup=FakeCgroup(), interval=0.05)) == 0
+
+def test_report_of_a_run(tmp_path):
+	for name, wall, cpu_secs in (("s-12-0.tbl", 100.0, 300.0), ("s-12-1.tbl", 100.0, 100.0), ("s-99-0.tbl", 10.0, 1.0)):
+		rfprofile.write_profile(rfprofile.get_profile_path(str(tmp_path / name), "pod"),
+			profile(str(tmp_path / name), wall, cpu_secs, 4000.0, wall / 2))
+
+	paths = rfprofile.find_profiles([str(tmp_path)], run_id="12")
+	assert [os.path.basename(path) for path in paths] == ["s-12-0.tbl.pod.profile.json", "s-12-1.tbl.pod.profile.json"]
+
+	lines = rfprofile.build_report([json.load(open(path)) for path in paths])
+
+	assert lines[1].split()[:8] == ["s-12-0.tbl", "0", "100", "50", "50", "0", "3.00", "75"]
+	assert lines[2].split()[9:11] == ["4000", "25"]
+	assert "2 profiles, 0.2 cpu hours requested, 0.1 used (50%)" in lines
+	assert "wall time: 50% input, 50% search, 0% output" in lines
+	assert "peak memory: 4000Mb max, 16000Mb requested" in lines
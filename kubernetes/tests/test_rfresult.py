@@ -0,0 +1,32 @@
+import subprocess
+
+import rfresult
+
+# -----------------------------------------------------------------------------------
+
+def test_parse_output_paths():
+	cmd = "cmsearch --tblout s.tbl --cpu 4 CM db.fa > s.out 2> s.err"
+
+	assert rfresult.parse_output_paths(cmd) == ("s.tbl", "s.out", "s.err")
+	assert rfresult.parse_output_paths("cmsearch --tblout s.tbl CM db.fa > /dev/null") is None
+
+def test_store_and_materialize(tmp_path):
+	cache = rfresult.ResultCache(str(tmp_path / "cache"))
+	(tmp_path / "s.tbl").write_text("hit\n# [ok]\n")
+	(tmp_path / "s.out").write_text("alignments\n")
+
+	assert cache.store("key1", str(tmp_path / "s.tbl"), str(tmp_path / "s.out"))
+	assert cache.materialize("key1", str(tmp_path / "r.tbl"), str(tmp_path / "r.out"))
+	assert (tmp_path / "r.tbl").read_text() == "hit\n# [ok]\n"
+	assert not cache.materialize("key2", str(tmp_path / "x.tbl"), str(tmp_path / "x.out"))
+
+def test_failed_store_is_reported_and_keeps_the_search_status(tmp_path, monkeypatch):
+	monkeypatch.setattr(rfresult, "RFRESULT_CMD", "false")
+	monkeypatch.setattr(rfresult, "RESULT_DIR", "/readonly/rfresults")
+
+	cmd = rfresult.store_command("cmsearch --tblout s.tbl CM db.fa > s.out", "key1").replace("cmsearch", "true", 1)
+	assert "--result-dir /readonly/rfresults store key1" in cmd
+
+	result = subprocess.run(["sh", "-c", cmd], cwd=str(tmp_path), stderr=subprocess.PIPE, universal_newlines=True)
+	assert result.returncode == 0
+	assert "WARNING: results of s.tbl not stored in /readonly/rfresults" in result.stderr
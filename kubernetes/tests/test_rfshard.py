@@ -0,0 +1,134 @@
+import io
+import os
+import gzip
+import shutil
+
+import pytest
+
+import rfshard
+import rfsizing
+
+# -----------------------------------------------------------------------------------
+
+def write_fasta(path, lengths):
+	fp = gzip.open(str(path), 'wt')
+	for i, length in enumerate(lengths):
+		fp.write(">seq%d\n%s\n" % (i, "A" * length))
+	fp.close()
+
+	return str(path)
+
+def use_sizing_dir(monkeypatch, tmp_path):
+	sizing_history = rfsizing.SizingHistory
+	monkeypatch.setattr(rfsizing, "SizingHistory", lambda: sizing_history(str(tmp_path / "sizing")))
+
+@pytest.fixture(autouse=True)
+def index_dir(tmp_path, monkeypatch):
+	monkeypatch.setattr(rfshard, "INDEX_DIR", str(tmp_path / "index"))
+
+	return tmp_path / "index"
+
+# -----------------------------------------------------------------------------------
+
+def test_index_blocks(tmp_path):
+	seqfile = write_fasta(tmp_path / "db.fa.gz", [40, 60, 50, 50, 10, 90])
+
+	assert rfshard.build_index(seqfile, block_residues=100) == 300
+	assert rfshard.read_index(seqfile) == [(0, 2, 100), (2, 2, 100), (4, 2, 100)]
+
+def test_units_are_residue_balanced(tmp_path, monkeypatch):
+	seqfile = write_fasta(tmp_path / "db.fa.gz", [100] * 40)
+	rfshard.build_index(seqfile, block_residues=100)
+	use_sizing_dir(monkeypatch, tmp_path)
+
+	# 4000 residues at the default rate, about 0.001 seconds per unit
+	units = rfshard.plan_units([seqfile], 100, target_secs=0.001, max_units=4)
+
+	assert units == ["%s:%d-%d" % (seqfile, first, first + 9) for first in (0, 10, 20, 30)]
+
+def test_unindexed_files_are_kept_whole(tmp_path):
+	seqfile = write_fasta(tmp_path / "db.fa.gz", [100] * 4)
+
+	assert rfshard.plan_units([seqfile], 100) == [seqfile]
+
+def test_units_read_their_blocks_only(tmp_path, monkeypatch):
+	seqfile = write_fasta(tmp_path / "db.fa.gz", [100] * 6)
+	rfshard.build_index(seqfile, block_residues=200)
+
+	# the search file itself is not read for block aligned units
+	monkeypatch.setattr(rfshard, "open_seqfile", None)
+
+	out = io.StringIO()
+	rfshard.write_sequences(seqfile, 2, 5, out)
+
+	assert [line for line in out.getvalue().split("\n") if line.startswith(">")] == [">seq2", ">seq3", ">seq4", ">seq5"]
+
+def test_node_cached_copies_use_the_index_of_their_file(tmp_path, monkeypatch, index_dir):
+	(tmp_path / "nfs").mkdir()
+	(tmp_path / "cache").mkdir()
+	seqfile = write_fasta(tmp_path / "nfs" / "db.fa.gz", [100] * 6)
+	rfshard.build_index(seqfile, block_residues=200)
+	cached_seqfile = str(tmp_path / "cache" / "db.fa.gz")
+	shutil.copy(seqfile, cached_seqfile)
+
+	# nothing is written next to the search file
+	assert sorted(os.listdir(str(tmp_path / "nfs"))) == ["db.fa.gz"]
+	assert rfshard.read_index(cached_seqfile) == rfshard.read_index(seqfile)
+
+	monkeypatch.setattr(rfshard, "open_seqfile", None)
+	out = io.StringIO()
+	rfshard.write_sequences(cached_seqfile, 2, 3, out)
+
+	assert [line for line in out.getvalue().split("\n") if line.startswith(">")] == [">seq2", ">seq3"]
+
+def test_index_of_another_release_is_not_used(tmp_path):
+	seqfile = write_fasta(tmp_path / "db.fa.gz", [100] * 6)
+	rfshard.build_index(seqfile, block_residues=200)
+	write_fasta(tmp_path / "db.fa.gz", [100] * 8)
+
+	assert rfshard.read_index(seqfile) is None
+	assert rfshard.plan_units([seqfile], 100) == [seqfile]
+
+def test_unaligned_units_are_read_from_the_file(tmp_path):
+	seqfile = write_fasta(tmp_path / "db.fa.gz", [100] * 6)
+	rfshard.build_index(seqfile, block_residues=200)
+
+	out = io.StringIO()
+	rfshard.write_sequences(seqfile, 1, 2, out)
+
+	assert out.getvalue() == ">seq1\n%s\n>seq2\n%s\n" % ("A" * 100, "A" * 100)
+
+def test_unit_command_expansion():
+	cmd = rfshard.expand_unit_command("cmsearch --cpu 4 CM /Rfam/rfamseq/db.fa.gz:10-19 > s.out")
+
+	assert cmd == "%s search /Rfam/rfamseq/db.fa.gz 10 19 cmsearch --tformat fasta --cpu 4 CM - > s.out" % rfshard.RFSHARD_CMD
+
+# -----------------------------------------------------------------------------------
+
+def test_unit_history_is_used_for_the_file_rate(tmp_path, monkeypatch):
+	seqfile = write_fasta(tmp_path / "db.fa.gz", [100] * 40)
+	rfshard.build_index(seqfile, block_residues=100)
+	use_sizing_dir(monkeypatch, tmp_path)
+
+	history = rfsizing.SizingHistory()
+	history.db.execute("INSERT INTO observations VALUES (100, ?, '', 100, 10, 50, 0, '0-9')", ("db.fa.gz",))
+	history.db.commit()
+	history.close()
+
+	indexes = {seqfile: rfshard.read_index(seqfile)}
+
+	# 50 seconds for the 1000 residues of sequences 0-9
+	assert rfshard.get_secs_per_residue(100, [seqfile], indexes) == 0.05
+
+def test_units_are_recorded_under_their_file(tmp_path, monkeypatch):
+	history = rfsizing.SizingHistory(str(tmp_path))
+	monkeypatch.setattr(rfsizing, "read_cgroup_usage", lambda: (1000.0, 100.0))
+
+	for i in range(rfsizing.MIN_OBSERVATIONS):
+		rfsizing.record_observation(100, "db.fa.gz:%d-%d" % (i * 10, i * 10 + 9), "-E 1", 0, 0, sizing_dir=str(tmp_path))
+		history.ingest()
+
+	rows = history.db.execute("SELECT shard, unit FROM observations").fetchall()
+	assert sorted(rows) == [("db.fa.gz", "0-9"), ("db.fa.gz", "10-19"), ("db.fa.gz", "20-29")]
+	assert history.predict(100, "db.fa.gz", "-E 1") is not None
+	assert history.predict(100, "db.fa.gz:30-39", "-E 1") is not None
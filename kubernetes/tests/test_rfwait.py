@@ -0,0 +1,313 @@
+import queue
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import rfcache
+import rfkubesub
+import rfpool
+import rfwait
+
+# -----------------------------------------------------------------------------------
+
+def build_k8s_job(manifest):
+	client = pytest.importorskip("kubernetes.client")
+
+	return client.ApiClient()._ApiClient__deserialize(manifest, "V1Job")
+
+def fake_job(job_index, completions=None, completed=None, failed=None, succeeded=None, conditions=None, annotations=None):
+	"""
+	A V1Job like object of an rfsearch job, Indexed if completions is set
+	"""
+
+	metadata = SimpleNamespace(name=rfkubesub.get_job_name("alice", job_index), annotations=annotations)
+	spec = SimpleNamespace(completion_mode="Indexed" if completions is not None else "NonIndexed", completions=completions)
+	status = SimpleNamespace(completed_indexes=completed, failed_indexes=failed, succeeded=succeeded,
+		conditions=[SimpleNamespace(type=c, status="True", message=c.lower()) for c in conditions or []])
+
+	return SimpleNamespace(metadata=metadata, spec=spec, status=status)
+
+def fake_pod(job_index, phase, completion_index=None, waiting=None, annotations=None, started_at=None,
+	finished_at=None, node_name="node-a"):
+	"""
+	A V1Pod like object of an rfsearch job
+	"""
+
+	annotations = dict(annotations or {})
+	if completion_index is not None:
+		annotations[rfwait.COMPLETION_INDEX_ANNOTATION] = str(completion_index)
+
+	running = SimpleNamespace(started_at=started_at) if phase == "Running" else None
+	terminated = SimpleNamespace(started_at=started_at, finished_at=finished_at) if finished_at is not None else None
+	waiting = SimpleNamespace(reason=waiting, message="failed") if waiting is not None else None
+	state = SimpleNamespace(running=running, terminated=terminated, waiting=waiting)
+	job_name = rfkubesub.get_job_name("alice", job_index)
+
+	return SimpleNamespace(metadata=SimpleNamespace(name="%s-%s" % (job_name, completion_index),
+			labels={"jobname": job_name}, annotations=annotations),
+		spec=SimpleNamespace(node_name=node_name),
+		status=SimpleNamespace(phase=phase, container_statuses=[SimpleNamespace(state=state)]))
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+def minutes_ago(minutes):
+	return NOW - datetime.timedelta(minutes=minutes)
+
+MPI = {rfkubesub.MPI_PODS_ANNOTATION: "4"}
+SPECULATIVE = {rfwait.SPECULATIVE_ANNOTATION: "node-a"}
+
+# -----------------------------------------------------------------------------------
+
+def test_copy_keeps_the_preferred_affinity_and_avoids_the_node():
+	affinity = rfcache.node_affinity(["cmsearch x.cm /Rfam/rfamseq/rfamseq_1.fa > s.out"])
+	manifest = rfkubesub.build_job_manifest("alice", "s-1234", "script", 4, 8000, completions=10, affinity=affinity)
+
+	copy = rfwait.build_copy_manifest("alice", "s-1234-3", build_k8s_job(manifest), 3, "node-a")
+	node_affinity = copy["spec"]["template"]["spec"]["affinity"]["nodeAffinity"]
+
+	assert node_affinity["preferredDuringSchedulingIgnoredDuringExecution"] == \
+		affinity["nodeAffinity"]["preferredDuringSchedulingIgnoredDuringExecution"]
+	terms = node_affinity["requiredDuringSchedulingIgnoredDuringExecution"]["nodeSelectorTerms"]
+	assert terms[0]["matchExpressions"] == [{"key": "kubernetes.io/hostname", "operator": "NotIn", "values": ["node-a"]}]
+	assert {"name": "JOB_COMPLETION_INDEX", "value": "3"} in copy["spec"]["template"]["spec"]["containers"][0]["env"]
+
+# -----------------------------------------------------------------------------------
+
+def test_jobs_not_found_in_the_cluster_only_succeed_with_complete_output(tmp_path):
+	complete = tmp_path / "complete.tblout"
+	complete.write_text("hit\n# [ok]\n")
+	partial = tmp_path / "partial.tblout"
+	partial.write_text("hit\n")
+
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1", "s-1-2"])
+	tracker.mark_gone({"s-1-0": str(complete), "s-1-1": str(partial)})
+
+	assert tracker.phases == {"s-1-0": "Succeeded", "s-1-1": "Failed", "s-1-2": "Failed"}
+	assert tracker.finished() == ["s-1-0"]
+	assert sorted(tracker.failed()) == ["s-1-1", "s-1-2"]
+	assert tracker.counts() == (1, 0, 0)
+
+def test_jobs_not_found_in_the_cluster_fail_without_outputs():
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1"])
+	tracker.set_phase("s-1-0", "Running")
+	tracker.mark_gone()
+
+	assert tracker.phases == {"s-1-0": "Running", "s-1-1": "Failed"}
+	assert tracker.reasons["s-1-1"] == "not found in the cluster"
+
+def test_read_outputs(tmp_path):
+	outputs_file = tmp_path / "rfwait.outputs"
+	outputs_file.write_text("s-1-0 /a/0.tblout\ns-1-1 /a/1.tblout\n\n")
+
+	assert rfwait.read_outputs(str(outputs_file)) == {"s-1-0": "/a/0.tblout", "s-1-1": "/a/1.tblout"}
+
+# -----------------------------------------------------------------------------------
+
+def test_indexed_job_completed_and_failed_indexes():
+	tracker = rfwait.JobTracker("alice", ["s-1-%d" % i for i in range(6)] + ["s-2"])
+
+	tracker.update_from_job("MODIFIED", fake_job("s-1", completions=6, completed="0-2,4", failed="5"))
+	tracker.update_from_job("ADDED", fake_job("s-2"))
+
+	assert tracker.phases == {"s-1-0": "Succeeded", "s-1-1": "Succeeded", "s-1-2": "Succeeded",
+		"s-1-3": "Pending", "s-1-4": "Succeeded", "s-1-5": "Failed", "s-2": "Pending"}
+	assert tracker.reasons["s-1-5"] == "index failed"
+
+	tracker.update_from_job("MODIFIED", fake_job("s-2", succeeded=1))
+	assert tracker.phases["s-2"] == "Succeeded"
+
+def test_indexed_job_with_shards_left_out():
+	tracker = rfwait.JobTracker("alice", ["s-1-1", "s-1-3"])
+	job = fake_job("s-1", completions=2, completed="1", annotations={rfkubesub.SHARD_INDEXES_ANNOTATION: "1,3"})
+
+	tracker.update_from_job("MODIFIED", job)
+
+	assert tracker.phases == {"s-1-1": "Pending", "s-1-3": "Succeeded"}
+
+def test_failed_condition_fails_unfinished_shards():
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1"])
+
+	tracker.update_from_job("MODIFIED", fake_job("s-1", completions=2, completed="0", conditions=["Failed"]))
+
+	assert tracker.phases == {"s-1-0": "Succeeded", "s-1-1": "Failed"}
+	assert tracker.reasons["s-1-1"] == "failed"
+
+def test_job_deleted_before_completion():
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1"])
+	job = fake_job("s-1", completions=2, completed="0")
+
+	tracker.update_from_job("ADDED", job)
+	assert rfkubesub.get_job_name("alice", "s-1") in tracker.k8s_jobs
+
+	tracker.update_from_job("DELETED", job)
+
+	assert tracker.phases == {"s-1-0": "Succeeded", "s-1-1": "Failed"}
+	assert tracker.reasons["s-1-1"] == "job deleted before completion"
+	assert tracker.k8s_jobs == {}
+
+def test_mpi_job_succeeds_with_its_launcher():
+	tracker = rfwait.JobTracker("alice", ["s-1"])
+
+	# the other pods exit once the launcher did, whether it succeeded or not
+	tracker.update_from_pod("MODIFIED", fake_pod("s-1", "Succeeded", completion_index=2, annotations=MPI))
+	tracker.update_from_job("MODIFIED", fake_job("s-1", completions=4, completed="1-3", annotations=MPI))
+	assert tracker.phases["s-1"] == "Pending"
+	assert tracker.pods == {}
+
+	tracker.update_from_pod("MODIFIED", fake_pod("s-1", "Succeeded", completion_index=0, annotations=MPI))
+	assert tracker.phases["s-1"] == "Succeeded"
+
+	tracker = rfwait.JobTracker("alice", ["s-1"])
+	tracker.update_from_job("MODIFIED", fake_job("s-1", completions=4, completed="0", annotations=MPI))
+	assert tracker.phases["s-1"] == "Succeeded"
+
+def test_pod_phases():
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1", "s-1-2"])
+
+	tracker.update_from_pod("ADDED", fake_pod("s-1", "Pending", completion_index=0))
+	tracker.update_from_pod("ADDED", fake_pod("s-1", "Running", completion_index=1))
+	tracker.update_from_pod("MODIFIED", fake_pod("s-1", "Succeeded", completion_index=2))
+	# a deleted pod says nothing about its job
+	tracker.update_from_pod("DELETED", fake_pod("s-1", "Failed", completion_index=1))
+
+	assert tracker.phases == {"s-1-0": "Pending", "s-1-1": "Running", "s-1-2": "Succeeded"}
+	assert set(tracker.pods) == set(["s-1-0", "s-1-1", "s-1-2"])
+
+	# a pod going back to Pending (e.g. restarted) stays Running
+	tracker.update_from_pod("MODIFIED", fake_pod("s-1", "Pending", completion_index=1))
+	assert tracker.phases["s-1-1"] == "Running"
+
+@pytest.mark.parametrize("reason", rfwait.FATAL_WAITING_REASONS)
+def test_fatal_waiting_reasons_fail_the_shard(reason):
+	tracker = rfwait.JobTracker("alice", ["s-1-0"])
+
+	tracker.update_from_pod("MODIFIED", fake_pod("s-1", "Pending", completion_index=0, waiting="ContainerCreating"))
+	assert tracker.phases["s-1-0"] == "Pending"
+
+	tracker.update_from_pod("MODIFIED", fake_pod("s-1", "Pending", completion_index=0, waiting=reason))
+	assert tracker.phases["s-1-0"] == "Failed"
+	assert tracker.reasons["s-1-0"] == "%s: failed" % reason
+
+def test_speculative_copies_only_count_when_they_succeed():
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1"])
+	tracker.set_phase("s-1-0", "Running")
+	tracker.set_phase("s-1-1", "Running")
+	copy_annotations = dict(SPECULATIVE, **{rfkubesub.JOB_INDEX_ANNOTATION: "s-1-0"})
+
+	# failing, deleted or crashing copies leave the original running
+	tracker.update_from_job("MODIFIED", fake_job("s-1-0-copy", conditions=["Failed"], annotations=copy_annotations))
+	tracker.update_from_job("DELETED", fake_job("s-1-0-copy", annotations=copy_annotations))
+	tracker.update_from_pod("MODIFIED", fake_pod("s-1-0-copy", "Pending", waiting="CrashLoopBackOff", annotations=copy_annotations))
+	assert tracker.phases["s-1-0"] == "Running"
+	assert tracker.k8s_jobs == {}
+	assert tracker.pods == {}
+
+	tracker.update_from_job("MODIFIED", fake_job("s-1-0-copy", succeeded=1, annotations=copy_annotations))
+	tracker.update_from_job("MODIFIED", fake_job("s-1", completions=2, completed="0,1"))
+
+	assert tracker.phases == {"s-1-0": "Succeeded", "s-1-1": "Succeeded"}
+	assert tracker.speculative_wins == set(["s-1-0"])
+
+def test_jobs_gone_while_watching_are_settled_from_their_output(tmp_path):
+	complete = tmp_path / "complete.tblout"
+	complete.write_text("hit\n# [ok]\n")
+	outputs = dict(("s-1-%d" % i, str(complete if i == 0 else tmp_path / "missing")) for i in range(4))
+
+	tracker = rfwait.JobTracker("alice", sorted(outputs))
+	for job_name in outputs:
+		tracker.set_phase(job_name, "Running")
+	tracker.update_from_tasks({"s-1-3": (rfpool.RUNNING, None)})
+
+	# s-1-0 and s-1-1 completed and were deleted while the watch was re-listing,
+	# s-1-2 is still listed, s-1-3 runs in the worker pool
+	listed = tracker.get_listed([fake_job("s-1", completions=4, annotations={rfkubesub.SHARD_INDEXES_ANNOTATION: "2,2,2,2"})])
+	assert listed == set(["s-1-2"])
+
+	tracker.mark_gone(outputs, listed=listed)
+
+	assert tracker.phases == {"s-1-0": "Succeeded", "s-1-1": "Failed", "s-1-2": "Running", "s-1-3": "Running"}
+	assert tracker.reasons["s-1-1"].startswith("not found in the cluster")
+
+def test_wait_settles_jobs_missing_from_each_listing(tmp_path):
+	complete = tmp_path / "complete.tblout"
+	complete.write_text("hit\n# [ok]\n")
+
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1"])
+	job = fake_job("s-1", completions=2)
+	events = queue.Queue()
+	for event in (("Job", "ADDED", job), ("Job", "SYNCED", [job]), ("Pod", "SYNCED", []),
+			("Pod", "MODIFIED", fake_pod("s-1", "Running", completion_index=0)),
+			("Pod", "MODIFIED", fake_pod("s-1", "Running", completion_index=1)),
+			("Job", "SYNCED", [])):
+		events.put(event)
+
+	status = rfwait.wait_for_jobs(tracker, events, timeout=10, outputs={"s-1-0": str(complete), "s-1-1": str(complete)})
+
+	assert status == rfwait.SUCCESS
+	assert tracker.reasons["s-1-0"] == "finished while it was not watched"
+
+def test_wait_fails_when_the_watch_is_lost():
+	events = queue.Queue()
+	events.put(("Job", "SYNCED", []))
+	events.put(("Pod", "FAILED", "ProtocolError: connection reset"))
+
+	assert rfwait.wait_for_jobs(rfwait.JobTracker("alice", ["s-1"]), events, timeout=10) == rfwait.WATCH_FAILED
+
+# -----------------------------------------------------------------------------------
+
+def test_stragglers_are_shards_running_past_the_median():
+	speculator = rfwait.Speculator("alice", factor=3.0, batch_api=object(), core_api=object())
+	tracker = rfwait.JobTracker("alice", ["s-1-%d" % i for i in range(6)])
+
+	# three shards completed in 10 minutes
+	for i in range(3):
+		tracker.set_phase("s-1-%d" % i, "Succeeded")
+		tracker.pods["s-1-%d" % i] = fake_pod("s-1", "Succeeded", completion_index=i, started_at=minutes_ago(60),
+			finished_at=minutes_ago(50))
+
+	for i, minutes in ((3, 20), (4, 40), (5, 100)):
+		tracker.set_phase("s-1-%d" % i, "Running")
+		tracker.pods["s-1-%d" % i] = fake_pod("s-1", "Running", completion_index=i, started_at=minutes_ago(minutes))
+
+	assert speculator.get_runtimes(tracker) == {"s-1": [600.0, 600.0, 600.0]}
+	assert speculator.find_stragglers(tracker) == ["s-1-4", "s-1-5"]
+
+	# copied shards are not copied again
+	speculator.copies["s-1-4"] = "copy"
+	assert speculator.find_stragglers(tracker) == ["s-1-5"]
+
+	# and the runtime of a copied shard is left out, leaving too few to compare with
+	speculator.copies["s-1-0"] = "copy"
+	assert speculator.get_runtimes(tracker) == {"s-1": [600.0, 600.0]}
+	assert speculator.find_stragglers(tracker) == []
+
+def test_no_stragglers_before_enough_shards_completed():
+	speculator = rfwait.Speculator("alice", batch_api=object(), core_api=object())
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1"])
+	tracker.set_phase("s-1-0", "Succeeded")
+	tracker.pods["s-1-0"] = fake_pod("s-1", "Succeeded", completion_index=0, started_at=minutes_ago(2), finished_at=minutes_ago(1))
+	tracker.set_phase("s-1-1", "Running")
+	tracker.pods["s-1-1"] = fake_pod("s-1", "Running", completion_index=1, started_at=minutes_ago(100))
+
+	assert speculator.find_stragglers(tracker) == []
+
+def test_losing_copies_are_deleted():
+	deleted = []
+	api = SimpleNamespace(delete_namespaced_job=lambda name, namespace, **kwargs: deleted.append(("job", name)),
+		delete_namespaced_pod=lambda name, namespace, **kwargs: deleted.append(("pod", name)))
+	speculator = rfwait.Speculator("alice", batch_api=api, core_api=api)
+	tracker = rfwait.JobTracker("alice", ["s-1-0", "s-1-1"])
+
+	for i in range(2):
+		tracker.pods["s-1-%d" % i] = fake_pod("s-1", "Running", completion_index=i)
+		speculator.copies["s-1-%d" % i] = "copy-%d" % i
+
+	# s-1-0 finished first in its copy, s-1-1 in the original
+	tracker.set_succeeded("s-1-0", speculative=True)
+	tracker.set_succeeded("s-1-1")
+	pytest.importorskip("kubernetes.client")
+	speculator.update(tracker)
+
+	assert deleted == [("pod", tracker.pods["s-1-0"].metadata.name), ("job", "copy-1")]
+	assert speculator.resolved == set(["s-1-0", "s-1-1"])
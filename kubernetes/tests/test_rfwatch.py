@@ -0,0 +1,41 @@
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+import rfwatch
+
+# -----------------------------------------------------------------------------------
+
+def test_watch_retries_and_gives_up(monkeypatch):
+	pytest.importorskip("kubernetes.watch")
+	sleeps = []
+	monkeypatch.setattr(rfwatch.time, "sleep", sleeps.append)
+	calls = []
+
+	def list_func(namespace, **kwargs):
+		calls.append(kwargs)
+		raise ConnectionError("connection refused")
+
+	events = queue.Queue()
+	rfwatch.watch_resource("Job", list_func, "user=alice", events)
+
+	assert len(calls) == rfwatch.MAX_WATCH_FAILURES
+	assert sleeps[:3] == [5, 10, 20] and max(sleeps) == rfwatch.MAX_WATCH_BACKOFF
+	assert events.get_nowait() == ("Job", "FAILED", "ConnectionError: connection refused")
+
+def test_listing_is_queued_before_the_watch(monkeypatch):
+	pytest.importorskip("kubernetes.watch")
+	monkeypatch.setattr(rfwatch.time, "sleep", lambda secs: None)
+	item = SimpleNamespace(metadata=SimpleNamespace(name="job-a", resource_version="7"))
+
+	def list_func(namespace, **kwargs):
+		if kwargs.get("watch"):
+			raise ConnectionError("connection reset")
+		return SimpleNamespace(items=[item], metadata=SimpleNamespace(resource_version="7"))
+
+	events = queue.Queue()
+	rfwatch.watch_resource("Job", list_func, "user=alice", events)
+
+	assert [events.get_nowait() for i in range(3)] == [("Job", "ADDED", item), ("Job", "SYNCED", [item]),
+		("Job", "FAILED", "ConnectionError: connection reset")]